@@ -11,7 +11,7 @@ import numpy as np
 import os, pickle
 # from atmdyn.properties import variablePlotatts
 from geodata.base import Variable, Axis, concatDatasets, monthlyUnitsList
-from geodata.netcdf import DatasetNetCDF, VarNC
+from geodata.netcdf import DatasetNetCDF, VarNC, LonShift, registerTransform
 from geodata.gdal import addGDALtoDataset, GDALError
 from geodata.misc import DatasetError, AxisError, DateError, ArgumentError, isNumber, isInt
 from datasets.common import ( translateVarNames, data_root, grid_folder, default_varatts, 
@@ -83,24 +83,10 @@ def getFolderName(name=None, experiment=None, folder=None, mode='avg', cvdp_mode
   return folder, experiment, name
 
 
-# function to undo NCL's lonFlip
-def flipLon(data, flip=144, lrev=False, var=None, slc=None):
-  ''' shift longitude on the fly, so as to undo NCL's lonFlip; only works on entire array '''
-  if var is not None: # ignore parameters
-    if not isinstance(var,VarNC): raise TypeError
-    ax = var.axisIndex('lon')
-    flip = len(var.lon)/2
-  if data.ndim < var.ndim: # some dimensions have been squeezed
-    sd = 0 # squeezed dimensions before ax
-    for sl in slc:
-      if isinstance(sl,(int,np.integer)): sd += 1
-    ax -= sd # remove squeezed dimensions
-  if not ( data.ndim > ax and data.shape[ax] == flip*2 ): 
-    raise NotImplementedError, "Can only shift longitudes of the entire array!"
-  # N.B.: this operation only makes sense with a full array!
-  if lrev: flip *= -1 # reverse flip  
-  data = np.roll(data, shift=flip, axis=ax) # shift values half way along longitude
-  return data
+# read-time transform to undo NCL's lonFlip
+# N.B.: the shift is translated into an index remapping before the read, so that partial slices of 
+#       longitude can be loaded directly (the longitude axis is not shifted)
+flipLon = registerTransform(LonShift(name='flipLon'))
 
 
 ## variable attributes and name
@@ -18,7 +18,7 @@ from operator import isCallable
 from utils.misc import expandArgumentList
 from geodata.misc import AxisError, DatasetError, DateError, ArgumentError, EmptyDatasetError, DataError
 from geodata.base import Dataset, Variable, Axis, Ensemble
-from geodata.netcdf import DatasetNetCDF, VarNC
+from geodata.netcdf import DatasetNetCDF, VarNC, MonthlyFactor, registerTransform
 from geodata.gdal import GDALError, addGDALtoDataset, loadPickledGridDef, griddef_pickle
 # import some calendar definitions
 from geodata.misc import name_of_month, days_per_month, days_per_month_365, seconds_per_month, seconds_per_month_365
@@ -168,65 +168,14 @@ def addLengthAndNamesOfMonth(dataset, noleap=False, length=None, names=None):
 #   return precip
 
 
-# transform function to convert monthly precip amount into precip rate on-the-fly
-def transformPrecip(data, l365=False, var=None, slc=None):
-  ''' convert monthly precip amount to SI units (mm/s) '''
-  if not isinstance(var,VarNC): raise TypeError
-  if var.units == 'kg/m^2/month' or var.units == 'mm/month':
-    assert data.ndim == var.ndim
-    tax = var.axisIndex('time')
-    # expand slices
-    if slc is None or isinstance(slc,slice): tslc = slc
-    elif isinstance(slc,(list,tuple)): tslc = slc[tax]
-    # handle sliced or non-sliced axis
-    if tslc is None or tslc == slice(None):
-      # trivial case
-      te = len(var.time)
-      if not ( data.shape[tax] == te and te%12 == 0 ): raise NotImplementedError, "The record has to start and end at a full year!"
-    else:  
-      # special treatment if time axis was sliced
-      tlc = slc[tax]
-      ts = tlc.start or 0 
-      te = ( tlc.stop or len(var.time) ) - ts
-      if not ( ts%12 == 0 and te%12 == 0 ): raise NotImplementedError, "The record has to start and end at a full year!"
-      assert data.shape[tax] == te
-      # assuming the record starts some year in January, and we always need to load full years
-    shape = [1,]*data.ndim; shape[tax] = te # dimensions of length 1 will be expanded as needed
-    spm = seconds_per_month_365 if l365 else seconds_per_month
-    data /= np.tile(spm, te/12).reshape(shape) # convert in-place
-    var.units = 'kg/m^2/s'
-  return data      
+# read-time transform to convert monthly precip amount into precip rate on-the-fly
+# N.B.: transforms are applied to arbitrary slices, but assume that the record starts in January
+transformPrecip = registerTransform(MonthlyFactor(name='transformPrecip', values=seconds_per_month, 
+                                                  units=('kg/m^2/month','mm/month'), newunits='kg/m^2/s'))
       
-# transform function to convert days per month into a ratio
-def transformDays(data, l365=False, var=None, slc=None):
-  ''' convert days per month to fraction '''
-  if not isinstance(var,VarNC): raise TypeError
-  if var.units == 'days':
-    assert data.ndim == var.ndim
-    tax = var.axisIndex('time')
-    # expand slices
-    if slc is None or isinstance(slc,slice): tslc = slc
-    elif isinstance(slc,(list,tuple)): tslc = slc[tax]
-    # handle sliced or non-sliced axis
-    if tslc is None or tslc == slice(None):
-      # trivial case
-      te = len(var.time)
-      if not ( data.shape[tax] == te and te%12 == 0 ): 
-        raise NotImplementedError, "The record has to start and end at a full year!"
-    else:  
-      # special treatment if time axis was sliced
-      tlc = slc[tax]
-      ts = tlc.start or 0 
-      te = ( tlc.stop or len(var.time) ) - ts
-      if not ( ts%12 == 0 and te%12 == 0 ): 
-        raise NotImplementedError, "The record has to start and end at a full year!"
-      assert data.shape[tax] == te
-      # assuming the record starts some year in January, and we always need to load full years
-    shape = [1,]*data.ndim; shape[tax] = te # dimensions of length 1 will be expanded as needed
-    spm = days_per_month_365 if l365 else days_per_month
-    data /= np.tile(spm, te/12).reshape(shape) # convert in-place
-    var.units = '' # fraction
-  return data      
+# read-time transform to convert days per month into a ratio
+transformDays = registerTransform(MonthlyFactor(name='transformDays', values=days_per_month, 
+                                                units=('days',), newunits='')) # fraction
       
       
 ## functions to load a dataset
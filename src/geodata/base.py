@@ -19,7 +19,7 @@ from warnings import warn
 import utils.nanfunctions as nf
 from plotting.properties import getPlotAtts, variablePlotatts # import plot properties from different file
 from geodata.misc import checkIndex, isEqual, isInt, isNumber, AttrDict, joinDicts, floateps
-from geodata.misc import genStrArray, translateSeasons
+from geodata.misc import genStrArray, translateSeasons, broadcastView, BroadcastMaskedArray
 from geodata.misc import VariableError, AxisError, DataError, DatasetError, ArgumentError
 from processing.multiprocess import apply_along_axis
 from utils.misc import histogram, binedges, detrend, percentile, tabulate
@@ -796,7 +796,11 @@ class Variable(object):
           # values and ranges are in coordinate values
           # translate coordinate values into indices
           if isinstance(axval,(tuple,list,np.ndarray)): 
-            idxslc = [ax.getIndex(idx, outOfBounds=True) for idx in axval]
+            if rngmod: idxslc = [ax.getIndex(idx, outOfBounds=True) for idx in axval]
+            else:
+              # look up all coordinates at once; out-of-bounds values are marked with None
+              idxarr, oob = ax.getIndexArray(axval, mode='closest', lmask=True)
+              idxslc = [None if lo else int(idx) for idx,lo in zip(idxarr,oob)]
             # expand ranges
             if rngmod:
               # coordinate values are inclusive, unlike indices
@@ -927,7 +931,9 @@ class Variable(object):
         if lrecast: data = data.astype(self.dtype)
         else: raise DataError, "Dtypes of Variable and array are inconsistent."
       if np.issubdtype(data.dtype, np.inexact) and not isinstance(data, ma.masked_array):
-        data = ma.masked_invalid(data, copy=False)     
+        # N.B.: memory maps are not scanned for invalid values, since that would page in the whole array
+        if isinstance(data, np.memmap): data = ma.MaskedArray(data, copy=False)
+        else: data = ma.masked_invalid(data, copy=False)     
         data._fill_value = fillValue if fillValue is not None else self.fillValue
 #         ma.set_fill_value(data, fillValue if fillValue is not None else self.fillValue) # this seems to work more reliably!
       # handle/apply mask
@@ -979,7 +985,8 @@ class Variable(object):
     ''' Copy the entire data array or a slice; option to unmask and to reorder/reshape to specified axes. '''
     # without data, this will fail
     if self.data:
-      if copy: datacopy = self.data_array.copy() # copy, if desired
+      # N.B.: broadcast arrays are copied at the end (if at all), so that only one copy is made
+      if copy and not broadcast: datacopy = self.data_array.copy() # copy, if desired
       else: datacopy = self.data_array 
       # unmask    
       if unmask and self.masked: 
@@ -1006,9 +1013,9 @@ class Variable(object):
       if broadcast:
         assert all([isinstance(ax,Axis) and len(ax)>0 for ax in axes]),\
            'All axes need to have a defined length in order broadcast the array.'
-        # get tiling list
-        tiling = [len(ax) if l == 1 else 1 for ax,l in zip(axes,datacopy.shape)]
-        datacopy = np.tile(datacopy, reps=tiling)
+        # broadcast using zero strides (read-only view); only make a copy if requested
+        datacopy = broadcastView(datacopy, shape=[len(ax) for ax in axes])
+        if copy: datacopy = datacopy.copy()
     else:
       raise DataError, "No data loaded (Variable '{:s}')".format(self.name)
     # return array
@@ -1018,25 +1025,28 @@ class Variable(object):
     ''' A method to add a mask to an unmasked array, or extend or replace an existing mask. '''
     if mask is not None:
       assert isinstance(mask,np.ndarray) or isinstance(mask,Variable), 'Mask has to be a numpy array or a Variable instance!'
-      # 'mask' can be a variable
-      if isinstance(mask,Variable): mask = mask.getArray(unmask=True,axes=self.axes,broadcast=True)
+      # 'mask' can be a variable (reordered, with singleton dimensions, but not broadcast)
+      if isinstance(mask,Variable): mask = mask.getArray(unmask=True,axes=self.axes,broadcast=False,copy=False)
       assert isinstance(mask,np.ndarray), 'Mask has to be convertible to a numpy array!'      
       # if 'mask' has less dimensions than the variable, it can be extended      
       if len(self.shape) < len(mask.shape): raise AxisError, 'Data array needs to have the same number of dimensions or more than the mask!'
-      if self.shape[self.ndim-mask.ndim:] != mask.shape: raise AxisError, 'Data array and mask have to be of the same shape!'
+      if not all([ml == 1 or ml == dl for ml,dl in zip(mask.shape[::-1],self.shape[::-1])]): 
+        raise AxisError, 'Data array and mask have to be of the same shape!'
       # convert to a boolean numpy array
       if invert: mask = ( mask == 0 ) # mask where zero or False 
       else: mask = ( mask != 0 ) # mask where non-zero or True
-      # broadcast mask to data array
-      mask = np.broadcast_arrays(mask,self.data_array)[0] # only need first element (the broadcasted mask)
-      # create new data array
-      if merge and self.masked: # the first mask is usually the land-sea mask, which we want to keep
-        data = self.getArray(unmask=False) # get data with mask
-        mask = ma.mask_or(data.mask, mask, copy=True, shrink=False) # merge masks
-      else:         
-        data = self.getArray(unmask=False) # don't fill missing values!
-        if self.masked: data.mask = ma.nomask # unmask, sort of...
-      self.__dict__['data_array'] = ma.array(data, mask=mask)
+      # merge low-dimensional mask on the fly, or attach it as a broadcast view (without allocating a
+      # full-size mask; the mask is only expanded, if it is modified later)
+      data = self.data_array
+      fill_value = data._fill_value if isinstance(data,ma.MaskedArray) else None
+      if merge and self.masked and ma.getmask(data) is not ma.nomask: # the first mask is usually the land-sea mask, which we want to keep
+        mask = np.logical_or(ma.getmask(data), mask) # merge masks (the old mask may be shared)
+        self.__dict__['data_array'] = ma.array(ma.getdata(data), mask=mask, fill_value=fill_value, 
+                                               copy=False, keep_mask=False)
+      else: 
+        mask = broadcastView(mask, self.shape)
+        self.__dict__['data_array'] = BroadcastMaskedArray(ma.getdata(data), mask=mask, fill_value=fill_value, 
+                                                           copy=False, keep_mask=False)
     elif maskValue is not None:
       if isinstance(self.dtype,(int,bool,np.integer,np.bool)): 
         self.__dict__['data_array'] = ma.masked_equal(self.data_array, maskValue, copy=False)
@@ -2145,16 +2155,14 @@ class Variable(object):
     else:
       iaxis = self.axisIndex(axis, lcheck=lcheckAxis)
       # get axis coordinates
-      ax = self.axes[iaxis].coord if ldetrend else None
-      if ldetrend or lsmooth:
-        if lsmooth and ax.size <= window_len: window_len = ax.size-1 # shrink window, if data too short
-        # prepare parallel function call
-        aaa_fct = functools.partial(detrend, ax=ax, lcopy=False, 
-                                    ldetrend=ldetrend, ltrend=ltrend, degree=degree, rcond=rcond, w=w, 
-                                    lsmooth=lsmooth, lresidual=lresidual, window_len=window_len, window=window)
-        # apply along selected axis
-        data = apply_along_axis(aaa_fct, iaxis, data, laax=True)
-        # reassigning array (apply_along_axis creates a new results array)
+      ax = self.axes[iaxis].coord
+      if ldetrend or ltrend or lsmooth or lresidual:
+        if (lsmooth or lresidual) and ax.size <= window_len: window_len = ax.size-1 # shrink window, if data too short
+        # detrend/smooth all series along the selected axis at once
+        data = detrend(data, ax=ax, axis=iaxis, lcopy=False, 
+                       ldetrend=ldetrend, ltrend=ltrend, degree=degree, rcond=rcond, w=w, 
+                       lsmooth=lsmooth, lresidual=lresidual, window_len=window_len, window=window)
+        # N.B.: trends and smoothed series are new arrays, residuals are computed in-place
     # standardize (subtract mean and divide by standard deviation)
     if lstandardize:
       # in-place with unsafe casting
@@ -2467,6 +2475,9 @@ class Axis(Variable):
   def getIndex(self, value, mode='closest', outOfBounds=None):
     ''' Return the coordinate index that is closest to the value or suitable for index ranges (left/right). '''
     if not self.data: raise DataError
+    # arrays of values are handled by the vectorized version
+    if isinstance(value,(list,tuple,np.ndarray)): 
+      return self.getIndexArray(value, mode=mode, outOfBounds=outOfBounds)
     if outOfBounds is None:
       if mode.lower() == 'closest': outOfBounds = False
 #       elif mode.lower() in ('left','right'): outOfBounds = False # return lowest/highest index if out of bounds
@@ -2512,6 +2523,77 @@ class Axis(Variable):
     if not self.ascending: idx = self.len - idx -1 # flip again
     return idx 
 
+  def _getSortedCoord(self):
+    ''' Return an ascending view of the coordinate vector and the origin and spacing, if the 
+        coordinates are regularly spaced (otherwise None); the results are cached. '''
+    coord = self.coord
+    coord = coord.data if isinstance(coord,ma.MaskedArray) else coord # masks do not matter here
+    key = (coord.size, coord[0], coord[-1]) # in-place changes usually affect the bounds
+    cache = self.__dict__.get('_sorted_coord', None)
+    if cache is not None and cache[0] is self.coord and cache[1] == key: 
+      return cache[2], cache[3]
+    # N.B.: the reversed array is only a view, not a copy
+    srtcrd = coord if self.ascending else coord[::-1]
+    # check if spacing is regular (within a small tolerance, so that floats can qualify)
+    regular = None
+    if srtcrd.size > 1 and np.issubdtype(srtcrd.dtype, np.number):
+      delta = float(srtcrd[-1] - srtcrd[0]) / ( srtcrd.size - 1 )
+      # N.B.: constant coordinates (zero spacing) can not be indexed arithmetically; use binary search
+      if delta > 0 and np.all( np.abs( np.diff(srtcrd) - delta ) <= 1.e-4*delta ): 
+        regular = (float(srtcrd[0]), delta)
+    self.__dict__['_sorted_coord'] = (self.coord, key, srtcrd, regular)
+    return srtcrd, regular
+
+  def getIndexArray(self, values, mode='closest', outOfBounds=None, lmask=False):
+    ''' Return the coordinate indices for an array of values; the modes are the same as for getIndex, 
+        but indices for out-of-bounds values are clipped to the valid range. If outOfBounds is True, a 
+        masked array is returned, where out-of-bounds values are masked; if lmask is True, the (unmasked)
+        index array and a boolean array indicating out-of-bounds values are returned instead. 
+        Regularly spaced coordinates are indexed directly, otherwise a binary search is used. '''
+    if not self.data: raise DataError
+    mode = mode.lower()
+    if mode not in ('left','right','closest'): raise ValueError, "Mode '{:s}' unknown.".format(mode)
+    if outOfBounds is None: outOfBounds = mode != 'closest' # same default as getIndex
+    values = np.asarray(values)
+    coord, regular = self._getSortedCoord()
+    n = coord.size
+    # out-of-bounds values (NaN values are also considered out-of-bounds)
+    oob = np.logical_or(values < coord[0], values > coord[-1])
+    if np.issubdtype(values.dtype, np.inexact): oob = np.logical_or(oob, np.isnan(values))
+    # in descending order, swap left and right 
+    if not self.ascending:
+      if mode == 'left': mode = 'right'
+      elif mode == 'right': mode = 'left'
+    # number of coordinates less than or equal to value (same as searchsorted with side='right')
+    if regular is None:
+      nle = coord.searchsorted(values, side='right')
+    else:
+      origin, delta = regular
+      with np.errstate(invalid='ignore'): # NaN's are handled by the mask
+        nle = np.floor( (values - origin) / delta ) + 1
+      nle = np.clip(np.nan_to_num(nle), 0, n).astype(np.int)
+      # correct for roundoff errors and irregularities within tolerance
+      nle += np.logical_and(nle < n, coord[np.minimum(nle,n-1)] <= values)
+      nle -= np.logical_and(nle > 0, coord[np.maximum(nle-1,0)] > values)
+    # behavior depends on mode
+    if mode == 'left':
+      # index suitable for beginning of range (inclusive)
+      idx = nle - 1
+    elif mode == 'right':
+      # index suitable for end of range (inclusive)
+      lexact = np.logical_and(nle > 0, coord[np.maximum(nle-1,0)] == values)
+      idx = nle - lexact
+    elif mode == 'closest':
+      # choose the closer neighbor (the lower one in case of a tie)
+      lo = np.clip(nle-1, 0, n-1); hi = np.clip(nle, 0, n-1)
+      idx = np.where( coord[hi] - values < values - coord[lo], hi, lo )
+    idx = np.clip(idx, 0, n-1)
+    if not self.ascending: idx = n - idx - 1 # flip again
+    # return
+    if lmask: return idx, oob
+    elif outOfBounds: return ma.masked_array(idx, mask=oob)
+    else: return idx
+
   def getIndices(self, coords):
     ''' Method to find occurences of coords and return their index values. '''
     if not self.data: self.load()
@@ -3079,10 +3161,18 @@ class Dataset(object):
     else: raise AttributeError, attr # raise previous exception
       
 
-def concatVars(variables, axis=None, coordlim=None, idxlim=None, asVar=True, offset=None, 
+def concatVars(variables, axis=None, coordlim=None, idxlim=None, asVar=True, offset=None, target=None,
                name=None, units=None, axatts=None, varatts=None, lcheckAxis=True, lensembleAxis=None):
   ''' A function to concatenate Variables from different sources along a given axis;
-      this is useful to generate a continuous time series from an ensemble. '''
+      this is useful to generate a continuous time series from an ensemble. 
+      If a writable DatasetNetCDF is passed as target, the concatenated Variable is created in the 
+      target file and the data are copied member by member (streaming), so that only one member 
+      slab has to be held in memory at a time; the new VarNC is returned (not loaded). '''
+  if target is not None:
+    from geodata.netcdf import DatasetNetCDF # avoid circular import
+    if not isinstance(target,DatasetNetCDF) or 'w' not in target.mode: 
+      raise ArgumentError, "Streaming concatenation requires a DatasetNetCDF target with write access."
+    if not asVar: raise ArgumentError, "Streaming concatenation always returns a Variable."
   if lensembleAxis and axis is None: axis = 'ensemble'
   elif isinstance(axis,(Axis,basestring)) and not any([var.hasAxis(axis) for var in variables]):
     if lensembleAxis is None: lensembleAxis = True
@@ -3099,7 +3189,6 @@ def concatVars(variables, axis=None, coordlim=None, idxlim=None, asVar=True, off
   var0 = variables[0] # shortcut
   if not all([var.shape == var0.shape  for var in variables]): 
     raise AxisError, "All Variables need to have the same shape for concatenation!"
-  if not var0.data: var.load()
   # get some axis info
   if lnew:
     tax = 0 # add ensemble axis as first axis (assuming C order)
@@ -3151,22 +3240,19 @@ def concatVars(variables, axis=None, coordlim=None, idxlim=None, asVar=True, off
     newshape = list(var0.shape)
     newshape[tax] = tlen
     newshape = tuple(newshape)
-  # load data
-  data = []
-  for var in variables:
-    if not var.data: var.load()
+  # helper function to extract the (sliced) data array of a member
+  def getSlab(var):
     if lcoordlim: 
-      array = var(**coordlim)     
-    elif lidxlim:
-      array = var.getArray().take(xrange(*idxslc.indices(len(axt))), axis=tax)
-    else: 
-      array = var.getArray()
+      array = var(**coordlim).getArray(unmask=False, copy=False)
+    else:
+      slcs = [slice(None)]*var.ndim
+      if lidxlim: slcs[tax] = idxslc
+      if var.data: array = var.data_array.__getitem__(tuple(slcs))
+      elif getattr(var,'ncvar',None) is not None and getattr(var,'slices',None) is None: 
+        array = var.__getitem__(slcs) # read directly from NetCDF file without loading the Variable
+      else: array = var.getArray(unmask=False, copy=False).__getitem__(tuple(slcs))
     if lnew: array = array.reshape((1,)+array.shape) # add singleton dimension to concatenate over
-    data.append(array)
-  # concatenate
-  data = np.concatenate(data, axis=tax)
-  assert data.shape[tax] == tlen
-  assert data.shape == newshape
+    return array
   # cast as variable
   if asVar:      
     # create new concatenation axis
@@ -3187,23 +3273,50 @@ def concatVars(variables, axis=None, coordlim=None, idxlim=None, asVar=True, off
       coord = np.arange(offset,tlen*delta+offset,delta) 
       if axatts is not None: tmpatts.update(axatts)      
       axes = list(var0.axes); axes[tax] = Axis(coord=coord, atts=tmpatts)
-    # create new variable
+    # new variable attributes
     vatts = var0.atts.copy()
     vatts['name'] = name or var0.name; vatts['units'] = units or var0.units
     if varatts is not None: vatts.update(varatts)
-    return Variable(data=data, axes=axes, atts=vatts)
-    # or return data
+  # streaming: create empty variable in target file and write member slabs directly
+  if target is not None:
+    newvar = Variable(axes=axes, atts=vatts, dtype=var0.dtype) # no data
+    target.addVariable(newvar, asNC=True, copy=True)
+    newvar = target.variables[newvar.name]
+    assert newvar.shape == newshape and not newvar.data 
+    i = 0; slcs = [slice(None)]*len(newshape)
+    for var in variables:
+      array = getSlab(var)
+      te = array.shape[tax]
+      slcs[tax] = slice(i,i+te); i += te
+      newvar[slcs] = array # written directly to NetCDF file
+      del array # free memory before the next member is read
+    assert i == tlen
+    newvar.sync() # update attributes and flush to disk
+    return newvar
+  # load data
+  data = []
+  for var in variables:
+    if not var.data: var.load()
+    data.append(getSlab(var))
+  # concatenate
+  data = np.concatenate(data, axis=tax)
+  assert data.shape[tax] == tlen
+  assert data.shape == newshape
+  # create new variable or return data
+  if asVar: return Variable(data=data, axes=axes, atts=vatts)
   else: return data
   
   
 def concatDatasets(datasets, name=None, axis=None, coordlim=None, idxlim=None, offset=None, axatts=None,
                    title=None, lensembleAxis=None, lignoreConst=True, time_axes=None, check_vars=None,
-                   lcpOther=True, lcpAny=False, ldeepcopy=True, lcheckVars=True, lcheckAxis=True):
+                   lcpOther=True, lcpAny=False, ldeepcopy=True, lcheckVars=True, lcheckAxis=True, target=None):
   ''' A function to concatenate Datasets from different sources along a given axis; this
       function essentially applies concatVars to every Variable and creates a new dataset. 
       When concatenating station or shape arrays, use check_vars with an array of unique ID's
       to make sure they are all in the same order (since only the first axis and ID variable
-      (pseudo-axis) will be retained. '''
+      (pseudo-axis) will be retained. 
+      If a writable DatasetNetCDF is passed as target, Variables are concatenated directly into 
+      the target file (see concatVars) and the target Dataset is returned. '''
   if lensembleAxis and axis is None: axis = 'ensemble'
   if lignoreConst and time_axes is None: time_axes = ('time','year')
   elif isinstance(axis,(Axis,basestring)) and not any([ds.hasAxis(axis) for ds in datasets]):
@@ -3212,6 +3325,8 @@ def concatDatasets(datasets, name=None, axis=None, coordlim=None, idxlim=None, o
   if isinstance(axis,(Axis,basestring)): axislist = (axis,)
   else: axislist = axis
   nax = len(axislist)
+  if target is not None and nax > 1: 
+    raise NotImplementedError, "Streaming concatenation is only supported along a single axis."
   if isinstance(coordlim,(tuple,list)):
     if isinstance(coordlim[0],(tuple,list)): climlist = coordlim
     elif len(coordlim) == 2: climlist = (coordlim,)*nax
@@ -3273,7 +3388,7 @@ def concatDatasets(datasets, name=None, axis=None, coordlim=None, idxlim=None, o
           if lall: 
             variables[varname] = concatVars([ds.variables[varname] for ds in datasets], axis=axis, asVar=True,
                                             coordlim=coordlim, idxlim=idxlim, offset=offset, axatts=axatts,
-                                            lcheckAxis=lcheckAxis, lensembleAxis=lensembleAxis)
+                                            lcheckAxis=lcheckAxis, lensembleAxis=lensembleAxis, target=target)
           else:
             if lcheckVars:       
               raise DatasetError, "Variable '{:s}' is not present in all Datasets!".format(varname)
@@ -3289,6 +3404,14 @@ def concatDatasets(datasets, name=None, axis=None, coordlim=None, idxlim=None, o
         catax = variables.values()[c].getAxis(axis, lcheck=False); c += 1 # return None if not present
       axes[axis] = catax # add new concatenation axis
     # copy first dataset and replace concatenation axis and variables
+  if target is not None:
+    # concatenated variables are already in the target, so just add the remaining variables
+    for varname,var in variables.iteritems():
+      if var is not None and not target.hasVariable(varname): 
+        target.addVariable(var, asNC=True, copy=True, deepcopy=ldeepcopy)
+    if title is not None: target.title = title
+    target.sync()
+    return target
   return datasets[0].copy(axes=axes, name=name, title=title, variables=variables, varlist=None, 
                           varargs=None, axesdeep=True, varsdeep=False)
 
@@ -0,0 +1,154 @@
+'''
+Created on 2016-04-04
+
+A persistent catalog of NetCDF files: for every file in a folder we record the variables with their
+dimensions, shapes, dtypes and units, the dimensions, some global attributes (e.g. period and grid)
+and the size and modification time of the file. The catalog is a JSON file in the data folder, which
+is built (or updated) by the scan command:
+
+  python geodata/catalog.py scan <folder> [<folder> ...]
+  python geodata/catalog.py show <folder>
+
+When a catalog is present, DatasetNetCDF uses it to discard files that do not contain any of the
+requested variables, without opening them; this avoids opening irrelevant files when many datasets
+(e.g. ensemble members) are loaded with a short varlist. Records of files that were modified after
+the scan are ignored (i.e. such files are always opened).
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import os, sys, json
+import netCDF4 as nc
+from glob import glob
+
+## module settings
+catalog_file = '.dataset_catalog.json' # name of the catalog file in the data folder
+catalog_atts = ('name', 'title', 'period', 'grid', 'begin_date', 'end_date') # global attributes to record
+_catalogs = dict() # catalogs that have already been loaded: folder -> (catalog file ID, catalog)
+
+
+## helper functions
+
+def getFileID(filepath):
+  ''' return size and modification time of a file (None, if the file does not exist) '''
+  if not os.path.exists(filepath): return None
+  stat = os.stat(filepath)
+  return [stat.st_size, stat.st_mtime]
+
+def _coerceAtt(value):
+  ''' convert NetCDF attributes into a JSON-compatible form '''
+  if hasattr(value,'tolist'): return value.tolist() # numpy arrays and scalars
+  elif isinstance(value,(basestring,int,long,float)): return value
+  else: return str(value)
+
+def scanFile(filepath):
+  ''' open a NetCDF file and return its catalog record '''
+  ds = nc.Dataset(filepath, mode='r')
+  try:
+    record = dict(file_id=getFileID(filepath))
+    record['dimensions'] = {dim:len(ds.dimensions[dim]) for dim in ds.dimensions.keys()}
+    record['variables'] = {varname:dict(dims=list(ncvar.dimensions), shape=list(ncvar.shape), dtype=str(ncvar.dtype),
+                                        units=_coerceAtt(ncvar.units) if 'units' in ncvar.ncattrs() else '')
+                           for varname,ncvar in ds.variables.iteritems()}
+    record['atts'] = {att:_coerceAtt(ds.getncattr(att)) for att in catalog_atts if att in ds.ncattrs()}
+  finally: ds.close()
+  return record
+
+
+## catalog files
+
+def loadCatalog(folder):
+  ''' load the catalog of a data folder; returns an empty catalog, if there is none (catalogs are kept
+      in memory, until the catalog file changes) '''
+  folder = os.path.abspath(folder)
+  filepath = os.path.join(folder,catalog_file)
+  fileid = getFileID(filepath)
+  if fileid is None: return dict(files=dict())
+  if folder in _catalogs and _catalogs[folder][0] == fileid: return _catalogs[folder][1]
+  with open(filepath, 'r') as f: catalog = json.load(f)
+  catalog.setdefault('files',dict()) # file records, indexed by filename
+  _catalogs[folder] = (fileid, catalog)
+  return catalog
+
+def writeCatalog(folder, catalog):
+  ''' write the catalog of a data folder (atomically, through a temporary file) '''
+  filepath = os.path.join(folder,catalog_file)
+  tmpfilepath = filepath + '.tmp'
+  with open(tmpfilepath, 'w') as f: json.dump(catalog, f, indent=1, sort_keys=True)
+  os.rename(tmpfilepath, filepath) # replaces old catalog
+
+def scanFolder(folder, pattern='*.nc', lforce=False, lfeedback=False):
+  ''' build or update the catalog of a data folder; only new or modified files are opened, unless
+      lforce is True, and records of removed files are discarded; returns the catalog '''
+  folder = os.path.abspath(folder)
+  catalog = dict(files=dict()) if lforce else loadCatalog(folder)
+  files = dict(); nscan = 0
+  for filepath in sorted(glob(os.path.join(folder,pattern))):
+    filename = os.path.basename(filepath)
+    record = catalog['files'].get(filename,None)
+    if record is None or record['file_id'] != getFileID(filepath):
+      try: record = scanFile(filepath); nscan += 1
+      except (RuntimeError,IOError):
+        if lfeedback: print("Error reading file '{:s}' - skipping".format(filename))
+        continue
+    files[filename] = record
+  catalog = dict(files=files)
+  writeCatalog(folder, catalog)
+  if lfeedback:
+    print("Catalog of folder '{:s}': {:d} files ({:d} scanned)".format(folder,len(files),nscan))
+  return catalog
+
+def lookupFile(filepath):
+  ''' return the catalog record of a file, or None, if the file is not in the catalog, or the
+      record is out of date '''
+  filepath = os.path.abspath(filepath)
+  catalog = loadCatalog(os.path.dirname(filepath))
+  record = catalog['files'].get(os.path.basename(filepath),None)
+  if record is None or record['file_id'] != getFileID(filepath): return None
+  return record
+
+
+## functions for loaders
+
+def getVariables(filelist, folder=''):
+  ''' return a dict of variables in the catalog and the files that contain them (files without a
+      valid record are not included) '''
+  variables = dict()
+  for filename in filelist:
+    record = lookupFile(folder+filename)
+    if record is not None:
+      for varname in record['variables']: variables.setdefault(varname,[]).append(filename)
+  return variables
+
+def selectFiles(filelist, varlist, folder=''):
+  ''' discard files that do not contain any of the variables in varlist (coordinate variables do not
+      count, since they are present in most files); files without a valid record are always retained,
+      and if no file contains any of the variables, the filelist is returned as is '''
+  if varlist is None: return filelist
+  varlist = set([varlist] if isinstance(varlist,basestring) else varlist)
+  selected = []
+  for filename in filelist:
+    record = lookupFile(folder+filename)
+    if record is None: selected.append(filename)
+    elif any(varname in varlist for varname in record['variables'] if varname not in record['dimensions']):
+      selected.append(filename)
+  return selected if selected else filelist
+  # N.B.: global attributes of discarded files are not added to the dataset
+
+
+if __name__ == '__main__':
+
+  # simple command line interface: scan folders or show catalog
+  if len(sys.argv) < 3 or sys.argv[1] not in ('scan','show'):
+    print('Usage: {:s} scan|show <folder> [<folder> ...]'.format(sys.argv[0])); sys.exit(2)
+  for folder in sys.argv[2:]:
+    if not os.path.isdir(folder):
+      print("\n   ***   Folder '{:s}' not found   ***   ".format(folder)); continue
+    if sys.argv[1] == 'scan':
+      scanFolder(folder, lfeedback=True)
+    else:
+      print("\n   ***   Catalog of folder '{:s}'   ***   ".format(folder))
+      for filename,record in sorted(loadCatalog(folder)['files'].iteritems()):
+        lvalid = record['file_id'] == getFileID(os.path.join(folder,filename))
+        print('{:s} {:s}: {:s}'.format('OK   ' if lvalid else 'STALE',filename,', '.join(sorted(record['variables']))))
@@ -0,0 +1,156 @@
+'''
+Created on 2016-04-25
+
+An EOF/PCA engine for large gridded fields: instead of the feature covariance matrix (see PCA in
+utils.misc), which is impossible to handle for a full grid, the leading modes are computed with a
+randomized SVD of the (area-weighted) anomalies, or with an incremental SVD, which processes the
+sample axis in chunks; VarNC instances are read chunk by chunk, so that the full data array never has
+to be in memory. EOF maps, PC time-series and explained variance fractions are returned as Variables:
+
+  eofs, pcs, evf = computeEOFs(var, nmodes=5, method='incremental', chunksize=120)
+  # anomalies (in the units of var) ~ sum over modes of pcs(time,mode) * eofs(mode,y,x)
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import numpy as np
+import numpy.ma as ma
+# internal imports
+from geodata.base import Variable, Axis
+from geodata.misc import ArgumentError, AxisError, DataError
+from utils.misc import randomizedSVD, incrementalSVD
+
+
+## helper functions
+
+def getFeatureWeights(var, iaxis, lweight=True):
+  ''' return the square root of the normalized cell area of every feature (grid point) of a GDAL-enabled
+      variable, or None, if no weighting is applied; the horizontal axes have to be the last axes '''
+  if not lweight or not getattr(var,'gdal',False): return None
+  if var.axisIndex(var.xlon) != var.ndim-1 or var.axisIndex(var.ylat) != var.ndim-2:
+    raise NotImplementedError, "Horizontal axes have to be the last indices."
+  area = var.griddef.getAreaWeights()
+  shape = var.shape[:iaxis] + var.shape[iaxis+1:]
+  weights = np.broadcast_to(np.sqrt(area/area.mean()), shape) # read-only view
+  return weights.reshape((-1,))
+
+def iterChunks(var, iaxis, chunksize):
+  ''' iterate over chunks of a variable along the sample axis; yields the index range and the chunk as a
+      2D array (samples, features) with NaN's for missing values; VarNC instances are read chunk by chunk '''
+  n = var.shape[iaxis]; axname = var.axes[iaxis].name
+  for i0 in xrange(0, n, chunksize):
+    i1 = min(i0+chunksize, n)
+    if var.data: data = var.data_array[(slice(None),)*iaxis + (slice(i0,i1),)]
+    else: data = var.slicing(lidx=True, lsqueeze=False, **{axname:slice(i0,i1)}).getArray(copy=False)
+    data = ma.filled(ma.asarray(data, dtype=np.float64), np.NaN)
+    yield i0, i1, np.moveaxis(data, iaxis, 0).reshape((i1-i0,-1))
+
+def _fillMissing(chunk, running):
+  ''' replace (sporadic) missing values with the mean of the chunk, i.e. with zero anomalies (in-place); 
+      features that are missing in the entire chunk are filled with the running mean of earlier chunks, 
+      which is accumulated in 'running' (sums and counts of valid values, updated in-place) '''
+  nans = np.isnan(chunk); nvalid = chunk.shape[0] - nans.sum(axis=0)
+  if nans.any():
+    with np.errstate(invalid='ignore', divide='ignore'):
+      means = np.where(nvalid > 0, np.nansum(chunk, axis=0)/nvalid, running[0]/running[1])
+    means[np.isnan(means)] = 0. # no valid values so far (not possible for features of the first chunk)
+    running[0] += np.nansum(chunk, axis=0); running[1] += nvalid
+    chunk[nans] = means[np.nonzero(nans)[1]]
+  else:
+    running[0] += chunk.sum(axis=0); running[1] += nvalid
+  return chunk
+
+def _orientModes(Vt, U=None):
+  ''' fix the sign of each mode, so that the largest loading of every EOF is positive (in-place) '''
+  signs = np.sign(Vt[np.arange(Vt.shape[0]),np.abs(Vt).argmax(axis=1)])
+  signs[signs == 0] = 1
+  Vt *= signs.reshape((-1,1))
+  if U is not None: U *= signs.reshape((1,-1))
+  return Vt, U
+
+
+## EOF engine
+
+def computeEOFs(var, nmodes=10, axis='time', method='incremental', chunksize=None, lweight=True,
+                noversample=10, niter=4, seed=None, name=None, lfeedback=False):
+  ''' Compute the leading EOFs of a Variable (or VarNC) along a sample axis; all other axes are features
+      (grid points). If the Variable is GDAL-enabled and lweight is True, features are weighted by the
+      square root of the cell area. With method='incremental', the sample axis is processed in chunks
+      of size chunksize (two passes, the second for the PC's; noversample additional modes are retained
+      during the first pass), and with method='randomized', the weighted anomalies are decomposed with
+      a randomized SVD in memory. Features that are missing in the first chunk are excluded (NaN in the
+      EOF maps); other missing values are treated as zero anomalies (relative to the chunk, or to the 
+      running mean of earlier chunks, if a feature is missing in an entire chunk).
+      Returns EOF maps (mode, features...), PC series (sample, mode) and explained variance fractions
+      (mode) as Variables; anomalies can be reconstructed as the sum over modes of PC's times EOF's. '''
+  if not isinstance(var,Variable): raise TypeError, var
+  if method not in ('incremental','randomized'): raise ArgumentError, "Unknown method '{:s}'.".format(method)
+  if not var.hasAxis(axis): raise AxisError, "Variable '{:s}' has no axis '{:s}'.".format(var.name,axis)
+  iaxis = var.axisIndex(axis); nsamples = var.shape[iaxis]
+  if nmodes > nsamples: raise ArgumentError, "Number of modes exceeds number of samples."
+  if chunksize is None: chunksize = max(2*nmodes,120)
+  if method == 'incremental' and chunksize < nmodes: raise ArgumentError, "Chunks have to be larger than the number of modes."
+  name = name or var.name
+  weights = getFeatureWeights(var, iaxis, lweight=lweight)
+  valid = None; total = 0. # sum of squared (weighted) anomalies
+  if method == 'incremental':
+    # first pass: incremental SVD over chunks
+    S = Vt = mean = sumsq = None; n = 0
+    for i0,i1,chunk in iterChunks(var, iaxis, chunksize):
+      if valid is None:
+        valid = np.isfinite(chunk).all(axis=0) # features that are valid in the first chunk
+        if weights is not None: weights = weights[valid]
+        running = np.zeros((2,valid.sum())) # running sums and counts for missing values
+      chunk = _fillMissing(chunk[:,valid], running)
+      if weights is not None: chunk *= weights
+      S, Vt, mean, n = incrementalSVD(chunk, nmodes+noversample, S=S, Vt=Vt, mean=mean, n=n)
+      sumsq = (chunk**2).sum(axis=0) if sumsq is None else sumsq + (chunk**2).sum(axis=0)
+    total = ( sumsq - n*mean**2 ).sum()
+    S = S[:nmodes]; Vt,U = _orientModes(Vt[:nmodes,:]) # additional modes improve accuracy of leading modes
+    # second pass: project anomalies onto EOF's
+    pcs = np.zeros((nsamples,nmodes)); running[:] = 0 # same missing values as in first pass
+    for i0,i1,chunk in iterChunks(var, iaxis, chunksize):
+      chunk = _fillMissing(chunk[:,valid], running)
+      if weights is not None: chunk *= weights
+      pcs[i0:i1,:] = np.dot(chunk - mean, Vt.T)
+  else:
+    # assemble weighted anomalies in memory (chunk by chunk)
+    data = None
+    for i0,i1,chunk in iterChunks(var, iaxis, chunksize):
+      if valid is None:
+        valid = np.isfinite(chunk).all(axis=0)
+        if weights is not None: weights = weights[valid]
+        data = np.zeros((nsamples,valid.sum()))
+        running = np.zeros((2,valid.sum())) # running sums and counts for missing values
+      data[i0:i1,:] = _fillMissing(chunk[:,valid], running)
+    data -= data.mean(axis=0) # anomalies
+    if weights is not None: data *= weights
+    total = (data**2).sum()
+    U, S, Vt = randomizedSVD(data, nmodes, noversample=noversample, niter=niter, seed=seed)
+    del data
+    Vt,U = _orientModes(Vt, U)
+    pcs = U * S
+  if not valid.any(): raise DataError, "Variable '{:s}' has no valid features.".format(var.name)
+  evf = S**2 / total # explained variance fraction
+  # EOF maps in original units (remove weights) with missing features
+  if weights is not None: Vt /= weights
+  eofs = np.empty((nmodes,valid.size)); eofs.fill(np.NaN)
+  eofs[:,valid] = Vt
+  eofs = ma.masked_invalid(eofs.reshape((nmodes,)+var.shape[:iaxis]+var.shape[iaxis+1:]))
+  if lfeedback:
+    string = "Variance explained by {:d} leading EOF's of '{:s}': {:s}; total variance explained: {:2.0f}%"
+    print(string.format(nmodes, var.name, ', '.join('{:.0f}%'.format(e*100.) for e in evf), evf.sum()*100.))
+  # create Variables
+  modeax = Axis(name='mode', units='#', coord=np.arange(1,nmodes+1), atts=dict(long_name='EOF Mode'))
+  features = [ax.copy() for i,ax in enumerate(var.axes) if i != iaxis]
+  eofvar = Variable(name='{:s}_eof'.format(name), units='', axes=[modeax]+features, data=eofs,
+                    atts=dict(long_name='EOF Maps of {:s}'.format(var.atts.get('long_name',var.name))))
+  if getattr(var,'gdal',False):
+    from geodata.gdal import addGDALtoVar
+    eofvar = addGDALtoVar(eofvar, griddef=var.griddef)
+  pcvar = Variable(name='{:s}_pc'.format(name), units=var.units, axes=(var.axes[iaxis].copy(),modeax), data=pcs,
+                   atts=dict(long_name='PC Series of {:s}'.format(var.atts.get('long_name',var.name))))
+  evfvar = Variable(name='{:s}_evf'.format(name), units='', axes=(modeax,), data=evf,
+                    atts=dict(long_name='Explained Variance Fraction'))
+  return eofvar, pcvar, evfvar
@@ -18,6 +18,8 @@ import pickle
 # gdal imports
 from osgeo import gdal, osr, ogr
 from utils.misc import flip
+from utils.constants import Re # radius of the earth, for cell areas
+import utils.cache as cache
 # register RAM driver
 ramdrv = gdal.GetDriverByName('MEM')
 # use exceptions (off by default)
@@ -172,6 +174,16 @@ class GridDefinition(object):
   def getProjection(self):
     ''' Convenience method that emulates behavior of the function of the same name '''
     return self.projection, self.isProjected, self.xlon, self.ylat
+  
+  def getAreaWeights(self):
+    ''' Return the area of each grid cell as a (y/lat,x/lon) array; the array is computed only once and 
+        cached, i.e. it is shared between all variables on this grid and must not be modified. '''
+    area = self.__dict__.get('_area_weights', None)
+    if area is None:
+      area = getCellArea(self.geotransform, self.size, isProjected=self.isProjected)
+      area.flags.writeable = False # shared, read-only
+      self.__dict__['_area_weights'] = area
+    return area
     
   def __str__(self):
     ''' A string representation of the grid definition '''
@@ -197,6 +209,7 @@ class GridDefinition(object):
     pickle['_xlon'] = len(self.xlon) 
     pickle['_ylat'] = len(self.ylat)
     del pickle['geotransform'], pickle['isProjected'], pickle['xlon'], pickle['ylat']
+    pickle.pop('_area_weights', None) # cell areas are cheap to recompute
     # return instance dict to pickle
     return pickle
   
@@ -242,9 +255,9 @@ def loadPickledGridDef(grid=None, res=None, filename=None, folder=None, check=Tr
     filepath = '{0:s}/{1:s}'.format(folder,filename)
   # load pickle
   if os.path.exists(filepath):
-    filehandle = open(filepath, 'r')
-    griddef = pickle.load(filehandle)
-    filehandle.close()
+    def loadPickle():
+      with open(filepath, 'r') as filehandle: return pickle.load(filehandle)
+    griddef = cache.cachedLoad('griddefs', filepath, [filepath], loadPickle) # only in persistent workers
   elif check: 
     raise IOError, "GridDefinition pickle file '{0:s}' not found!".format(filepath) 
   else:
@@ -403,6 +416,59 @@ def getAxes(geotransform, xlen=0, ylen=0, projected=False):
   return xlon, ylat
 
 
+def getCellArea(geotransform, size, isProjected=True):
+  ''' Compute the area of each grid cell from the geotransform and the size (x/lon,y/lat) of a grid; 
+      for projected grids the cell area is simply dx*dy (in projected units), for geographic grids 
+      the exact area on a sphere is computed (in m^2). Returns a (y/lat,x/lon) array. '''
+  (x0, dx, s, y0, t, dy) = geotransform; del x0,s,t
+  nx, ny = size
+  if isProjected:
+    band = np.empty((ny,), dtype=np.float64); band.fill(abs(dx*dy)) # all cells have the same area
+  else:
+    # N.B.: the area of a spherical cell is Re^2 * dlon * ( sin(lat_north) - sin(lat_south) )
+    ylat = np.clip(y0 + dy*np.arange(ny+1, dtype=np.float64), -90., 90.) # cell boundaries
+    band = np.abs(np.diff(np.sin(np.radians(ylat)))) * np.radians(abs(dx)) * Re**2 
+  # all cells in a latitude band have the same area
+  return np.repeat(band.reshape((ny,1)), nx, axis=1)
+
+
+def weightedMean(data, weights, mask=None, blocksize=2**22):
+  ''' Compute weighted averages over the last axis of 'data' for one (1D 'weights') or several (2D 
+      'weights') sets of weights at once, using one matrix product per block of leading axes; masked and 
+      NaN values are excluded by re-normalizing the weights, but the data is never copied into a masked 
+      array. A separate (boolean) 'mask' can be passed for plain arrays. Sums are accumulated in double 
+      precision, but only blocks of about 'blocksize' values are up-cast at a time. Returns a masked array 
+      (with the dtype of floating point data). '''
+  values = ma.getdata(data) # plain ndarray (view) 
+  if mask is None: mask = ma.getmask(data) # can be nomask
+  if np.issubdtype(values.dtype,np.inexact):
+    nans = np.isnan(values)
+    if nans.any(): mask = np.logical_or(mask, nans) 
+    dtype = values.dtype # cast the mean back to the data type
+  else: dtype = np.float64
+  weights = np.asarray(weights, dtype=np.float64)
+  lead = values.shape[:-1]; npts = values.shape[-1]
+  values = values.reshape((-1,npts)) # flatten leading axes (view, if possible)
+  if np.any(mask): mask = np.broadcast_to(mask, lead+(npts,)).reshape((-1,npts))
+  else: mask = None
+  nrows = values.shape[0]
+  total = np.empty((nrows,)+weights.shape[:-1], dtype=np.float64)
+  if mask is not None: norm = np.empty_like(total)
+  else: norm = weights.sum(axis=-1) # same normalization for all leading axes
+  step = max(1, blocksize//max(1,npts))
+  for i in xrange(0, nrows, step):
+    block = values[i:i+step].astype(np.float64) # up-cast one block at a time
+    if mask is not None:
+      invalid = mask[i:i+step]
+      block[invalid] = 0 # zero out invalid points (not a masked array)
+      norm[i:i+step] = np.dot(np.logical_not(invalid).astype(np.float64), weights.T)
+    total[i:i+step] = np.dot(block, weights.T)
+  # N.B.: if there are no valid points, the norm is zero and the mean is NaN
+  with np.errstate(invalid='ignore', divide='ignore'): mean = total / norm
+  mean = mean.reshape(lead+weights.shape[:-1]).astype(dtype, copy=False)
+  return ma.masked_invalid(mean, copy=False)
+
+
 def getGeotransform(xlon=None, ylat=None, geotransform=None):
   ''' Function to check or infer GDAL geotransform from coordinate axes. '''
   if geotransform is None:  # infer geotransform from axes
@@ -733,38 +799,80 @@ def addGDALtoVar(var, griddef=None, projection=None, geotransform=None, gridfold
     var.getMapMask = types.MethodType(getMapMask, var)   
     
     # extension to mean
-    def mapMean(self, mask=None, integral=False, invert=False, squeeze=True, **kwargs):
-      ''' Compute mean over the horizontal axes, optionally applying a 2D shape or mask. '''
+    def mapMean(self, mask=None, integral=False, invert=False, squeeze=True, asVar=True, lweight=True, **kwargs):
+      ''' Compute mean over the horizontal axes, optionally applying a 2D shape or mask; the 2D mask 
+          is applied directly to the map dimensions, without broadcasting it to the full array. 
+          By default the mean is weighted by the (cached) cell areas of the grid; several masks can be 
+          averaged at once by passing a stack of 2D masks (only with asVar=False; the mask axis is last). '''
       if not self.data: raise DataError
       # if mask is a shape object, create the mask
       if isinstance(mask,Shape):
         shape = mask 
         mask = shape.rasterize(griddef=self.griddef, invert=invert, asVar=False)
       else: shape = None      
-      # determine relevant axes
-      axes = {self.xlon.name:None, self.ylat.name:None} # the relevant map axes; entire coordinate
-      # temporarily mask 
-      if self.masked: oldmask = ma.getmask(self.data_array) # save old mask
-      else: oldmask = None
-      self.mask(mask=mask, invert=invert, merge=True) # new mask on top of old mask
-      # compute average
-      kwargs.update(axes)# update dictionary
-      newvar = self.mean(**kwargs)
-      if squeeze: newvar.squeeze()
+      if isinstance(mask,Variable): mask = mask.getArray(unmask=True, axes=(self.ylat.name,self.xlon.name))
+      # only keyword arguments that do not slice map axes are compatible with the fast path
+      if any(key not in ('coordIndex','checkAxis') for key in kwargs):
+        if mask is not None and mask.ndim != 2: raise NotImplementedError, "Multiple masks are only supported without slicing."
+        # determine relevant axes
+        axes = {self.xlon.name:None, self.ylat.name:None} # the relevant map axes; entire coordinate
+        kwargs.update(axes)# update dictionary
+        if mask is None: newvar = self.mean(asVar=asVar, **kwargs) # no masking necessary
+        else:
+          # temporarily mask (the mask is attached to a new array object, which shares the data)
+          olddata = self.data_array # save old array with old mask
+          self.mask(mask=mask, invert=invert, merge=True) # new mask on top of old mask
+          # compute average
+          try: newvar = self.mean(asVar=asVar, **kwargs)
+          finally: self.__dict__['data_array'] = olddata # lift mask
+        if integral and not self.isProjected: raise NotImplementedError
+        # N.B.: areas are always positive, independent of the orientation of the grid (sign of dy)
+        if mask is None: area = None
+        else: area = ( (mask != 0) if invert else (mask == 0) ).sum()*abs(self.geotransform[1]*self.geotransform[5])
+      else:
+        # N.B.: the data is never copied into a masked array and the map mask is never expanded; instead 
+        #       the weights of masked points are set to zero and all means are computed at once 
+        npts = self.mapSize[0]*self.mapSize[1]
+        if lweight: weights = self.griddef.getAreaWeights().reshape((npts,))
+        else: weights = np.ones((npts,), dtype=np.float64)
+        if mask is not None:
+          if mask.shape[-2:] != self.mapSize: raise AxisError, "Mask has to have the same shape as the map."
+          if mask.ndim == 3 and asVar: raise NotImplementedError, "Multiple masks are only supported with asVar=False."
+          elif mask.ndim not in (2,3): raise AxisError, mask.shape
+          valid = ( mask == 0 ) if not invert else ( mask != 0 ) # i.e. not masked
+          valid = valid.reshape(mask.shape[:-2]+(npts,))
+          weights = weights * valid # zero weight outside of mask (new array)
+          idx = np.flatnonzero(valid.any(axis=0) if valid.ndim == 2 else valid) # only valid points
+          weights = weights[...,idx]
+        else: idx = None
+        # move map axes to the end (view) and flatten (copy, only if map axes are not innermost) 
+        iy = self.axisIndex(self.ylat.name); ix = self.axisIndex(self.xlon.name)
+        order = [i for i in xrange(self.ndim) if i not in (iy,ix)]
+        newaxes = tuple(self.axes[i] for i in order)
+        order += [iy,ix]; lead = tuple(self.shape[i] for i in order[:-2])
+        values = ma.getdata(self.data_array).transpose(order).reshape(lead+(npts,))
+        datamask = ma.getmask(self.data_array)
+        if datamask is not ma.nomask: datamask = datamask.transpose(order).reshape(lead+(npts,))
+        else: datamask = None
+        if idx is not None: 
+          values = values[...,idx] # only copies the selected points
+          if datamask is not None: datamask = datamask[...,idx]
+        data = weightedMean(values, weights, mask=datamask) # mask axis is last
+        area = weights.sum(axis=-1) # in map units (m^2 for geographic grids)
+        if not lweight: area *= abs(self.geotransform[1]*self.geotransform[5]) # number of points to area (positive)
+        if asVar:
+          newvar = self.copy(name='{:s}_mean'.format(self.name), units=self.units, axes=newaxes, data=data)
+        else: newvar = data
+      if squeeze and isinstance(newvar,Variable): newvar.squeeze()
       # if integrating
       if integral:
-        if not self.isProjected: raise NotImplementedError
-        dx = self.geotransform[1]; dy = self.geotransform[5] 
-        area = (1-mask).sum()*dx*dy
+        if area is None: raise ArgumentError, "Integration requires a mask."
+        if not self.isProjected and not lweight: raise NotImplementedError, "Integration on geographic grids requires weights."
         newvar *= area # in-place scaling
-        if self.xlon.units == self.ylat.units: newvar.units = '{} {}^2'.format(newvar.units,self.ylat.units) 
-        else: newvar.units ='{} {} {}'.format(newvar.units,self.xlon.units,self.ylat.units)
-      # lift mask
-      if oldmask is not None: 
-        self.data_array.mask = oldmask # change back to old mask
-      else: 
-        self.data_array.mask = ma.nomask # remove mask
-        if not self.masked: self.data_array = np.asarray(self.data_array) # and change class to ndarray
+        if isinstance(newvar,Variable):
+          if not self.isProjected: newvar.units = '{} m^2'.format(newvar.units)
+          elif self.xlon.units == self.ylat.units: newvar.units = '{} {}^2'.format(newvar.units,self.ylat.units) 
+          else: newvar.units ='{} {} {}'.format(newvar.units,self.xlon.units,self.ylat.units)
       # return new variable
       return newvar
     # add new method to object
@@ -859,6 +967,11 @@ def addGDALtoVar(var, griddef=None, projection=None, geotransform=None, gridfold
   # # the return value is actually not necessary, since the object is modified immediately
   return var
 
+def _getConstructed(dataset):
+  ''' return the Variables of a Dataset, without constructing lazy Variables (see geodata.netcdf) '''
+  if hasattr(dataset.variables,'getConstructed'): return dataset.variables.getConstructed()
+  else: return dataset.variables.values()
+
 def addGDALtoDataset(dataset, griddef=None, projection=None, geotransform=None, gridfolder=None, lwrap360=None, geolocator=False):
   ''' 
     A function that adds GDAL-based geographic projection features to an existing Dataset instance
@@ -894,8 +1007,10 @@ def addGDALtoDataset(dataset, griddef=None, projection=None, geotransform=None,
       xlon_name,ylat_name = ('x','y') if isProjected else ('lon','lat')
       assert dataset.axes[xlon_name].units == griddef.xlon.units and np.all(dataset.axes[xlon_name][:] == griddef.xlon[:])
       assert dataset.axes[ylat_name].units == griddef.ylat.units and np.all(dataset.axes[ylat_name][:] == griddef.ylat[:])
-      assert all([dataset.axes[xlon_name] == var.getAxis(xlon_name) for var in dataset.variables.values() if var.hasAxis(xlon_name)])
-      assert all([dataset.axes[ylat_name] == var.getAxis(ylat_name) for var in dataset.variables.values() if var.hasAxis(ylat_name)])
+      # N.B.: Variables that are constructed lazily (see geodata.netcdf.LazyVariables) use the Dataset axes
+      variables = _getConstructed(dataset)
+      assert all([dataset.axes[xlon_name] == var.getAxis(xlon_name) for var in variables if var.hasAxis(xlon_name)])
+      assert all([dataset.axes[ylat_name] == var.getAxis(ylat_name) for var in variables if var.hasAxis(ylat_name)])
 #       projection, isProjected, xlon, ylat = griddef.getProjection()
 #       lgdal = xlon is not None and ylat is not None # need non-None xlon & ylat        
   else: lgdal = False
@@ -924,13 +1039,17 @@ def addGDALtoDataset(dataset, griddef=None, projection=None, geotransform=None,
     dataset.__dict__['gridfolder'] = gridfolder
     
     # add GDAL functionality to all variables!
-    for var in dataset.variables.values():
+    def addGDAL(var):
       # call variable 'constructor' for all variables
       var = addGDALtoVar(var, griddef=griddef)
       # check result
       if var.ndim >= 2 and var.hasAxis(dataset.xlon) and var.hasAxis(dataset.ylat):
         if not var.gdal:  
           raise GDALError, "Variable '{:s}' violates GDAL status (gdal={:s})".format(var.name, str(var.gdal))    
+      return var
+    for var in _getConstructed(dataset): addGDAL(var)
+    # Variables that are constructed lazily get GDAL functionality when they are constructed
+    if hasattr(dataset.variables,'addHook'): dataset.variables.addHook(addGDAL)
     # get grid definition object
     dataset.getGridDef = types.MethodType(getGridDef, dataset)
         
@@ -9,6 +9,7 @@ Miscellaneous decorators, methods. and classes, as well as exception classes.
 # numpy imports
 import numpy as np
 import numpy.ma as ma
+from numpy.lib.stride_tricks import as_strided
 import collections as col
 import inspect
 
@@ -193,6 +194,149 @@ def genStrArray(string_list):
   assert strarray.shape == (len(string_list),)
   return strarray
     
+# broadcast an array without duplicating memory
+def broadcastView(array, shape):
+  ''' Return a read-only view of an array, broadcast to a new shape using zero strides (i.e. without 
+      duplicating memory); masks of masked arrays are broadcast the same way. '''
+  shape = tuple(shape)
+  if array.ndim > len(shape): raise ValueError, "Cannot broadcast array to fewer dimensions."
+  if array.ndim < len(shape): array = array.reshape((1,)*(len(shape)-array.ndim)+array.shape)
+  strides = []
+  for n,l,st in zip(shape,array.shape,array.strides):
+    if n == l: strides.append(st)
+    elif l == 1: strides.append(0) # repeat the same section in memory
+    else: raise ValueError, "Array of shape {:s} cannot be broadcast to shape {:s}.".format(str(array.shape),str(shape))
+  def view(arr):
+    arr = as_strided(arr, shape=shape, strides=strides)
+    arr.flags.writeable = False # writing to a broadcast view is not safe
+    return arr
+  # handle masked arrays
+  if isinstance(array,ma.MaskedArray):
+    mask = ma.getmask(array)
+    if mask is not ma.nomask: mask = view(mask)
+    array = ma.MaskedArray(view(array.data), mask=mask, fill_value=array._fill_value, copy=False)
+  else: array = view(array)
+  return array
+
+class _MaskFamily(object):
+  ''' The mask state that is shared by a BroadcastMaskedArray and all its views: the read-only broadcast 
+      mask is expanded into one full (writable) mask, when any member is modified, and all members map 
+      their masks onto this one array, so that modifications are visible through all views. '''
+
+  def __init__(self, data, mask):
+    self.data = data.view(np.ndarray) # the (C-contiguous) data array the family is based on
+    self.bounds = np.byte_bounds(self.data)
+    self.mask = mask # the read-only broadcast mask of the base array
+    self.full = None # the expanded mask, once it has been allocated
+
+  def expand(self):
+    ''' allocate the full mask (only once) '''
+    if self.full is None: self.full = np.array(self.mask, order='C')
+
+  def isMember(self, array):
+    ''' check if an array is a view of the family's data array '''
+    if array.itemsize != self.data.itemsize: return False
+    lo,hi = np.byte_bounds(array)
+    return self.bounds[0] <= lo and hi <= self.bounds[1]
+
+  def getMask(self, array):
+    ''' expand the mask (if necessary) and return a view of the full mask that matches the array '''
+    self.expand()
+    itemsize = self.data.itemsize
+    offset = np.byte_bounds(array)[0] - self.bounds[0]
+    offset -= sum(st*(n-1) for n,st in zip(array.shape,array.strides) if st < 0) # first element
+    if offset % itemsize or any(st % itemsize for st in array.strides): return None
+    mask = self.full.reshape(-1)[offset//itemsize:]
+    return as_strided(mask, shape=array.shape, strides=[st//itemsize for st in array.strides])
+
+
+class BroadcastMaskedArray(ma.MaskedArray):
+  ''' A masked array with a read-only (e.g. zero-stride, broadcast) mask, so that a low-dimensional mask
+      can be applied without allocating a full-size mask; the mask is expanded into a full (writable) array
+      only when it is modified (copy-on-write). The expanded mask is shared by the array and all its views 
+      (slices, reshapes etc.), just like the mask of a regular masked array. '''
+
+  def __new__(cls, data=None, mask=ma.nomask, **kwargs):
+    self = super(BroadcastMaskedArray,cls).__new__(cls, data, mask=mask, **kwargs)
+    mask = self.__dict__.get('_bmask',ma.nomask)
+    if mask is not ma.nomask and not mask.flags.writeable and self.__dict__.get('_family') is None:
+      # N.B.: the mapping between data and mask views only works, if the data array is contiguous
+      if self.flags.c_contiguous: 
+        self.__dict__['_family'] = _MaskFamily(self, mask); self.__dict__['_bstale'] = True
+      else: self.__dict__['_bmask'] = mask.copy()
+    return self
+
+  def _update_from(self, obj):
+    # N.B.: this is called for all new views and copies; views of the data inherit the mask family
+    super(BroadcastMaskedArray,self)._update_from(obj)
+    family = getattr(obj, '_family', None)
+    if family is not None and not family.isMember(self): family = None
+    self.__dict__['_family'] = family
+    self.__dict__['_bstale'] = family is not None and family.full is None
+
+  # N.B.: masks that were derived from the broadcast mask (before it was expanded) are 'stale', once the
+  #       mask was expanded through any member of the family, and are replaced by views of the full mask
+  def _getBroadcastMask(self):
+    mask = self.__dict__.get('_bmask',ma.nomask)
+    family = self.__dict__.get('_family')
+    if family is not None and family.full is not None and self.__dict__.get('_bstale',False):
+      full = family.getMask(self)
+      if full is not None: self._mask = mask = full
+    return mask
+  def _setBroadcastMask(self, mask):
+    family = self.__dict__.get('_family')
+    self.__dict__['_bmask'] = mask
+    self.__dict__['_bstale'] = family is not None and family.full is None
+  _mask = property(fget=_getBroadcastMask, fset=_setBroadcastMask)
+
+  def _expandMask(self):
+    ''' replace a broadcast mask by a writable mask that is shared with all views '''
+    mask = self._mask
+    if mask is ma.nomask: return
+    family = self.__dict__.get('_family')
+    if family is not None and self.__dict__.get('_bstale',False): 
+      full = family.getMask(self) # expand once and map all views onto it
+      if full is not None: self._mask = full; return
+    if not mask.flags.writeable: self._mask = mask.copy() # not a view of the base array
+
+  def __setitem__(self, indx, value):
+    self._expandMask()
+    super(BroadcastMaskedArray,self).__setitem__(indx, value)
+
+  def __setmask__(self, mask, copy=False):
+    self._expandMask()
+    super(BroadcastMaskedArray,self).__setmask__(mask, copy=copy)
+
+  def _get_mask(self):
+    # N.B.: the public mask can be modified in-place, hence it has to be expanded first
+    self._expandMask()
+    return super(BroadcastMaskedArray,self)._get_mask()
+  mask = property(fget=_get_mask, fset=__setmask__, doc="Mask")
+
+  def put(self, indices, values, mode='raise'):
+    self._expandMask()
+    super(BroadcastMaskedArray,self).put(indices, values, mode=mode)
+
+  def view(self, dtype=None, type=None, fill_value=None):
+    # N.B.: other masked array classes would write to the read-only mask, so it has to be expanded
+    cls = type if type is not None else dtype if inspect.isclass(dtype) else None
+    if cls is not None and issubclass(cls,ma.MaskedArray) and not issubclass(cls,BroadcastMaskedArray):
+      self._expandMask()
+    return super(BroadcastMaskedArray,self).view(dtype=dtype, type=type, fill_value=fill_value)
+
+  def _inplace(opname):
+    ''' wrap in-place operators, which update the mask in-place '''
+    op = getattr(ma.MaskedArray, opname)
+    def iop(self, other):
+      self._expandMask()
+      return op(self, other)
+    iop.__name__ = opname
+    return iop
+  __iadd__ = _inplace('__iadd__'); __isub__ = _inplace('__isub__'); __imul__ = _inplace('__imul__')
+  __idiv__ = _inplace('__idiv__'); __itruediv__ = _inplace('__itruediv__')
+  __ifloordiv__ = _inplace('__ifloordiv__'); __ipow__ = _inplace('__ipow__')
+  del _inplace
+    
 # utility function to separate a run-together camel-casestring
 def separateCamelCase(string, **kwargs):
   ''' Utility function to separate a run-together camel-casestring and replace string sequences. '''
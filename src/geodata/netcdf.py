@@ -10,7 +10,8 @@ A module that provides access to NetCDF datasets for GeoData datasets and variab
 import numpy as np
 import collections as col
 import netCDF4 as nc # netcdf python module
-import os, functools
+import os, glob, functools
+from multiprocessing.pool import ThreadPool
 
 # import all base functionality from PyGeoDat
 # from nctools import * # my own netcdf toolkit
@@ -19,6 +20,8 @@ from geodata.misc import checkIndex, isEqual, joinDicts
 from geodata.misc import ( DatasetError, DataError, AxisError, NetCDFError, PermissionError, 
                            FileError, VariableError, ArgumentError, EmptyDatasetError )
 from utils.nctools import coerceAtts, writeNetCDF, add_var, add_coord, checkFillValue
+import utils.profiling as prof
+from geodata.catalog import selectFiles
 
 
 def asVarNC(var=None, ncvar=None, mode='rw', axes=None, deepcopy=False, **kwargs):
@@ -104,6 +107,177 @@ class NoNetCDF(object):
     # N.B.: similar implementation to 'partial': need to return a callable that behaves like the instance method
     return functools.partial(self.__call__, instance) # but using 'partial' is simpler
 
+## read-time transforms for VarNC
+
+# helper functions to translate slicing directives to absolute indices and back
+def expandIndex(slc, n):
+  ''' Convert a slicing directive for a dimension of length 'n' into absolute indices (scalar or array). '''
+  if slc is None: slc = slice(None)
+  if isinstance(slc,slice): return np.arange(*slc.indices(n))
+  elif isinstance(slc,(int,np.integer)): return slc+n if slc < 0 else slc
+  else: 
+    idx = np.asarray(slc)
+    return np.where(idx < 0, idx+n, idx)
+
+def compressIndex(idx):
+  ''' Convert absolute indices back into a slice, if they are regularly spaced, or a list. '''
+  if np.ndim(idx) == 0: return int(idx)
+  elif len(idx) == 1: return slice(int(idx[0]),int(idx[0])+1)
+  step = idx[1] - idx[0]
+  if step > 0 and np.all(np.diff(idx) == step): 
+    return slice(int(idx[0]), int(idx[-1]+step), int(step)) # regular: read a slab
+  else: return [int(i) for i in idx] # N.B.: netCDF4 reads index lists orthogonally
+
+
+class ReadTransform(object):
+  ''' 
+    A transform that is applied when VarNC data are read from file; transforms operate along a single
+    axis and can remap indices before the read (e.g. to shift longitudes), or provide a factor for each 
+    coordinate value (e.g. to convert units), which is cached and fused with the scalefactor and offset. 
+    Since the transform is expressed in terms of indices, it works with arbitrary slices.
+  '''
+  name = '' # name of the transform in the registry
+  axis = None # name of the axis that the transform operates on
+  units = None # list of units that the transform applies to (None: all)
+  newunits = None # units after transform (None: unchanged)
+  
+  def __init__(self, name=None, axis=None, units=None, newunits=None):
+    ''' Set parameters; all parameters also have class defaults. '''
+    if name is not None: self.name = name
+    if axis is not None: self.axis = axis
+    if units is not None: self.units = units
+    if newunits is not None: self.newunits = newunits
+    self._factors = dict() # cache for factors
+  
+  def applies(self, var):
+    ''' Check if the transform applies to a variable (only based on meta data). '''
+    if self.units is not None and var.units not in self.units: return False
+    return var.hasAxis(self.axis) or self.axis in var.ncvar.dimensions
+  
+  def remap(self, idx, n):
+    ''' Translate absolute indices (scalar or array) along the axis to indices in the file. '''
+    return None # default: no remapping
+  
+  def factors(self, idx, n):
+    ''' Return factors for absolute indices (scalar or array) along the axis, or None. '''
+    return None # default: no scaling
+  
+  def getFactor(self, slc, n):
+    ''' Return (cached) factors for a slicing directive along the axis. '''
+    if slc is None: slc = slice(None)
+    if isinstance(slc,slice): key = slc.indices(n)
+    elif isinstance(slc,(int,np.integer)): key = int(slc)
+    else: return self.factors(expandIndex(slc, n), n) # index lists are not cached
+    if key not in self._factors: self._factors[key] = self.factors(expandIndex(slc, n), n)
+    return self._factors[key]
+
+# registry of named read-time transforms
+read_transforms = dict()
+
+def registerTransform(transform):
+  ''' Add a ReadTransform instance to the registry, so that it can be referenced by name. '''
+  if not isinstance(transform,ReadTransform): raise TypeError, transform
+  read_transforms[transform.name] = transform
+  return transform
+
+def getTransform(transform):
+  ''' Look up a transform in the registry, if it is referenced by name. '''
+  if isinstance(transform,basestring): 
+    if transform not in read_transforms: raise ArgumentError, "Unknown transform: '{:s}'".format(transform)
+    transform = read_transforms[transform]
+  return transform
+
+
+class FusedTransform(object):
+  ''' 
+    A sequence of read-time transforms, bound to a VarNC instance: index remapping is performed on the 
+    slicing directive before the read and all factors are combined with the scalefactor and offset of the 
+    variable, so that the loaded slab is only scaled once; regular functions are applied afterwards.
+  '''
+  
+  def __init__(self, transforms, var=None):
+    ''' Select transforms that apply to the variable and determine the new units. '''
+    if not isinstance(transforms,(list,tuple)): transforms = (transforms,)
+    self.transforms = []; self.functions = [] 
+    self.units = var.units
+    for transform in transforms:
+      transform = getTransform(transform)
+      if isinstance(transform,ReadTransform):
+        if transform.applies(var): 
+          self.transforms.append(transform)
+          if transform.newunits is not None: self.units = transform.newunits
+      elif callable(transform): self.functions.append(transform)
+      else: raise TypeError, transform
+  
+  def __nonzero__(self):
+    return len(self.transforms) > 0 or len(self.functions) > 0
+
+  def dimIndex(self, transform, var):
+    ''' Find the dimension in the NetCDF variable that a transform operates on. '''
+    if var.hasAxis(transform.axis):
+      ax = var.getAxis(transform.axis)
+      dim = ax.ncvar._name if isinstance(ax,AxisNC) else ax.name
+      if dim in var.ncvar.dimensions: return var.ncvar.dimensions.index(dim)
+    if transform.axis in var.ncvar.dimensions: return var.ncvar.dimensions.index(transform.axis)
+    raise AxisError, "Axis '{:s}' not found in NetCDF variable '{:s}'.".format(transform.axis,var.ncvar._name)
+  
+  def remap(self, slcs, var):
+    ''' Translate a slicing directive (one element per NetCDF dimension) into indices in the file. '''
+    slcs = list(slcs)
+    for transform in self.transforms:
+      i = self.dimIndex(transform, var); n = var.ncvar.shape[i]
+      idx = transform.remap(expandIndex(slcs[i], n), n)
+      if idx is not None: slcs[i] = compressIndex(idx)
+    return slcs
+  
+  def factor(self, slcs, var):
+    ''' Combine factors of all transforms into one array that can be broadcast with the data. '''
+    factor = None
+    for transform in self.transforms:
+      i = self.dimIndex(transform, var); n = var.ncvar.shape[i]
+      f = transform.getFactor(slcs[i], n)
+      if f is None: continue
+      if np.ndim(f) > 0:
+        # N.B.: integer indices remove a dimension on retrieval 
+        iax = len([slc for slc in slcs[:i] if not isinstance(slc,(int,np.integer))])
+        shape = [1,]*len([slc for slc in slcs if not isinstance(slc,(int,np.integer))])
+        shape[iax] = len(f); f = f.reshape(shape)
+      factor = f if factor is None else factor * f
+    return factor
+  
+  def __call__(self, data, var=None, slc=None):
+    ''' Apply regular transform functions to the data. '''
+    for function in self.functions: data = function(data, var=var, slc=slc)
+    return data
+
+
+class LonShift(ReadTransform):
+  ''' Shift longitudes by half the axis length (e.g. to undo NCL's lonFlip) by remapping indices. '''
+  axis = 'lon'
+  
+  def __init__(self, lrev=False, **kwargs):
+    super(LonShift,self).__init__(**kwargs)
+    self.lrev = lrev
+  
+  def remap(self, idx, n):
+    flip = n/2 if self.lrev else -(n/2)
+    return ( idx + flip ) % n # N.B.: equivalent to np.roll(data, shift=n/2) after the read
+
+
+class MonthlyFactor(ReadTransform):
+  ''' Divide monthly data by a value for each month of the year (e.g. to convert monthly totals into 
+      rates); the record is assumed to start in January. '''
+  axis = 'time'
+  
+  def __init__(self, values=None, **kwargs):
+    super(MonthlyFactor,self).__init__(**kwargs)
+    if len(values) != 12: raise ArgumentError, values
+    self.values = 1./np.asarray(values, dtype=np.float64) # inverse, to multiply
+  
+  def factors(self, idx, n):
+    return self.values[np.asarray(idx)%12]
+
+
 class VarNC(Variable):
   '''
     A variable class that implements access to data from a NetCDF variable object.
@@ -120,7 +294,7 @@ class VarNC(Variable):
         ncvar = None # the associated netcdf variable
         scalefactor = 1 # linear scale factor w.r.t. values in netcdf file
         offset = 0 # constant offset w.r.t. values in netcdf file
-        transform = None # function that can perform non-trivial transforms upon load
+        transform = None # read-time transforms (FusedTransform), e.g. unit conversions or shifts
         squeezed = False # if True, all singleton dimensions in NetCDF Variable are silently ignored
         slices = None # slice with respect to NetCDF Variable
     '''
@@ -191,8 +365,6 @@ class VarNC(Variable):
             raise AxisError, ncvar          
       # N.B.: slicing with index lists can change the shape
     else: ncatts = atts
-    # check transform
-    if transform is not None and not callable(transform): raise TypeError
     # call parent constructor
     super(VarNC,self).__init__(name=name, units=units, axes=axes, data=None, dtype=dtype, 
                                mask=None, fillValue=fillValue, atts=ncatts, plot=plot)
@@ -201,11 +373,17 @@ class VarNC(Variable):
     self.__dict__['mode'] = mode
     self.__dict__['offset'] = offset
     self.__dict__['scalefactor'] = scalefactor
-    self.__dict__['transform'] = transform
+    self.__dict__['transform'] = None
     self.__dict__['squeezed'] = False
     self.__dict__['slices'] = slices # initial default (i.e. everything)
     assert self.strvar == lstrvar
     assert self.strlen == strlen
+    # bind read-time transforms to this variable (transforms can change units)
+    if transform is not None:
+      if not isinstance(transform,FusedTransform): transform = FusedTransform(transform, var=self)
+      if transform: 
+        self.__dict__['transform'] = transform
+        self.units = transform.units
     if squeeze: self.squeeze() # may set 'squeezed' to True
     # handle data
     if load and data is not None: raise DataError, "Arguments 'load' and 'data' are mutually exclusive, i.e. only one can be used!"
@@ -246,8 +424,11 @@ class VarNC(Variable):
         assert isinstance(self.slices,(list,tuple)) and isinstance(slcs,list)
         # substitute None-slices with the preset slicing directive
         slcs = [sslc if oslc == slice(None) else oslc for oslc,sslc in zip(slcs,self.slices)]
-      # finally, get data!
-      data = self.ncvar.__getitem__(slcs) # exceptions handled by netcdf module
+      # finally, get data! (transforms can remap indices before the read)
+      with prof.timer('load', self.name):
+        if self.transform is not None: data = self.ncvar.__getitem__(self.transform.remap(slcs, self))
+        else: data = self.ncvar.__getitem__(slcs) # exceptions handled by netcdf module
+      prof.addBytes('read', data.nbytes, self.name); prof.count('netcdf_read')
       if self.dtype is not None and not np.issubdtype(data.dtype,self.dtype):
         if 'scale_factor' in self.ncvar.ncattrs():
           self.dtype = data.dtype # data was scaled automatically in NetCDF module
@@ -257,13 +438,39 @@ class VarNC(Variable):
       if self.strvar: data = nc.chartostring(data)
       #assert self.ndim == data.ndim # make sure that squeezing works!
       # N.B.: the shape and even dimension number can change dynamically when a slice is loaded, so don't check for that, or it will fail!
-      # apply scalefactor and offset
-      if self.scalefactor != 1: data *= self.scalefactor
-      if self.offset != 0: data += self.offset
-      if self.transform is not None: data = self.transform(data, var=self, slc=slc)
+      # apply scalefactor and offset, fused with factors from read-time transforms
+      scalefactor = self.scalefactor; offset = self.offset
+      if self.transform is not None and not self.strvar:
+        factor = self.transform.factor(slcs, self) # cached, broadcastable factors
+        if factor is not None:
+          scalefactor = factor * scalefactor 
+          if offset != 0: offset = factor * offset
+      if np.any(scalefactor != 1): data *= scalefactor
+      if np.any(offset != 0): data += offset
+      if self.transform is not None: data = self.transform(data, var=self, slc=slc) # regular functions
     # return data
     return data
   
+  def __setitem__(self, slc, data):
+    ''' Method implementing write access to the data; if data is not loaded, write directly to the 
+        NetCDF file (e.g. to fill a large variable slab by slab, without holding it in memory). '''
+    if self.data or 'w' not in self.mode:
+      super(VarNC,self).__setitem__(slc, data) # call parent method
+    else:
+      if self.squeezed or self.slices or self.strvar:
+        raise NotImplementedError, "Direct write access is only supported for unsliced numerical variables."
+      if self.scalefactor != 1 or self.offset != 0 or self.transform is not None: 
+        raise NotImplementedError, "Direct write access does not support scale factors, offsets or transforms."
+      if self.dtype is not None and not np.issubdtype(data.dtype, self.dtype):
+        raise DataError, "Dtypes of Variable and array are inconsistent."
+      # masked values are filled with the missing value (same as in sync)
+      fillValue = checkFillValue(self.fillValue, self.dtype)
+      if fillValue is not None and 'missing_value' not in self.ncvar.ncattrs(): 
+        self.ncvar.setncattr('missing_value',fillValue)
+      with prof.timer('write', self.name):
+        self.ncvar.__setitem__(slc, data) # exceptions handled by netcdf module
+      prof.addBytes('write', np.asarray(data).nbytes, self.name); prof.count('netcdf_write')
+  
   def slicing(self, lidx=None, lrng=None, years=None, listAxis=None, asVar=None, lsqueeze=True, 
               lcheck=False, lcopy=False, lslices=False, linplace=False, asNC=None, **axes):
     ''' This method implements access to slices via coordinate values and returns Variable objects. 
@@ -415,15 +622,17 @@ class VarNC(Variable):
       if self.data:
         fillValue = self.fillValue
         # special handling of some data types
-        if isinstance(self.data_array,np.bool_): 
-          ncvar[:] = self.data_array.astype('i1') # cast boolean as 8-bit integers
-          if fillValue is not None: fillValue = 1 if fillValue else 0
-        elif self.strvar:
-          ncvar[:] = nc.stringtochar(self.data_array) # transform string array to char array with one more dimension
-          if fillValue is not None: raise NotImplementedError
-        else: ncvar[:] = self.data_array # masking should be handled by the NetCDF module
+        with prof.timer('write', self.name):
+          if isinstance(self.data_array,np.bool_): 
+            ncvar[:] = self.data_array.astype('i1') # cast boolean as 8-bit integers
+            if fillValue is not None: fillValue = 1 if fillValue else 0
+          elif self.strvar:
+            ncvar[:] = nc.stringtochar(self.data_array) # transform string array to char array with one more dimension
+            if fillValue is not None: raise NotImplementedError
+          else: ncvar[:] = self.data_array # masking should be handled by the NetCDF module
+        prof.addBytes('write', self.data_array.nbytes, self.name); prof.count('netcdf_write')
         # reset scale factors etc.
-        self.scalefactor = 1; self.offset = 0
+        self.scalefactor = 1; self.offset = 0; self.transform = None
         fillValue = checkFillValue(fillValue, self.dtype)
         if fillValue is not None:
           ncvar.setncattr('missing_value',fillValue) 
@@ -477,6 +686,102 @@ class AxisNC(Axis,VarNC):
     if 'w' in mode: self.sync()    
       
 
+## helpers for opening NetCDF datasets
+
+prefetch_size = 2**20 # number of bytes read from the beginning of each file, before it is opened
+prefetch_threads = 8 # number of threads used for prefetching
+
+def _prefetchFile(filepath):
+  ''' read the beginning of a file (where most NetCDF/HDF5 metadata is located), so that the file 
+      system caches it; returns False, if the file does not exist '''
+  if not os.path.exists(filepath): return False
+  with open(filepath, 'rb') as f: f.read(prefetch_size)
+  return True
+
+def prefetchFiles(filelist):
+  ''' check and prefetch headers of several files concurrently (file I/O releases the GIL); the NetCDF 
+      files themselves are opened sequentially, because the HDF5 library is not generally thread-safe '''
+  if len(filelist) < 2 or prefetch_size <= 0: return [os.path.exists(filepath) for filepath in filelist]
+  pool = ThreadPool(processes=min(len(filelist),prefetch_threads))
+  try: return pool.map(_prefetchFile, filelist)
+  finally: pool.close()
+
+
+class LazyVariables(dict):
+  ''' 
+    A dictionary of Variables that constructs VarNC instances on first access; all keys are known from 
+    the start, so that membership tests and listing variables do not construct any Variables. Accessing 
+    values (e.g. values() or iteritems()) constructs all remaining Variables. Functions that modify 
+    Variables (e.g. addGDALtoVar) can be registered as hooks, which are applied on construction. 
+  '''
+  
+  def __init__(self, variables, factories, dataset):
+    ''' Initialize with constructed variables and factory functions for the remaining variables. '''
+    super(LazyVariables,self).__init__(variables)
+    self.factories = factories # name -> function that returns a VarNC
+    self.dataset = dataset
+    self.hooks = [] # functions that are applied to Variables, when they are constructed
+    
+  def _construct(self, key):
+    ''' Construct a Variable and add it to the dataset (this also adds the shortcut attribute). '''
+    var = self.factories.pop(key)()
+    for hook in self.hooks: var = hook(var)
+    super(DatasetNetCDF,self.dataset).addVariable(var, copy=False) # N.B.: calls __setitem__
+    return var
+  
+  def addHook(self, hook):
+    ''' Register a function that takes and returns a Variable and is applied to all Variables that are 
+        constructed from now on (Variables that were already constructed have to be modified directly). '''
+    self.hooks.append(hook)
+    
+  def replaceAxis(self, oldname, newaxis):
+    ''' Replace an axis in all Variables that have not been constructed yet. '''
+    for factory in self.factories.itervalues():
+      axes = factory.keywords['axes']
+      for i,ax in enumerate(axes):
+        if ax.name == oldname: axes[i] = newaxis
+  
+  def constructAll(self):
+    ''' Construct all remaining Variables. '''
+    for key in self.factories.keys(): self._construct(key)
+    
+  def getConstructed(self):
+    ''' Return a list of Variables that have already been constructed. '''
+    return super(LazyVariables,self).values()
+  
+  def __getitem__(self, key):
+    if key in self.factories: return self._construct(key)
+    return super(LazyVariables,self).__getitem__(key)
+  
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+  
+  def __setitem__(self, key, value):
+    self.factories.pop(key,None)
+    super(LazyVariables,self).__setitem__(key, value)
+    
+  def __delitem__(self, key):
+    if key in self.factories: self._construct(key) # removeVariable also removes the shortcut
+    super(LazyVariables,self).__delitem__(key)
+    
+  def pop(self, key, *default):
+    if key in self.factories: self._construct(key)
+    return super(LazyVariables,self).pop(key, *default)
+    
+  def __contains__(self, key): return key in self.factories or super(LazyVariables,self).__contains__(key)
+  def has_key(self, key): return key in self
+  def __len__(self): return len(self.factories) + super(LazyVariables,self).__len__()
+  def __iter__(self): return iter(self.keys())
+  def iterkeys(self): return iter(self.keys())
+  def keys(self): return super(LazyVariables,self).keys() + self.factories.keys()
+  # N.B.: methods that return Variables need to construct all of them first
+  def values(self): self.constructAll(); return super(LazyVariables,self).values()
+  def itervalues(self): self.constructAll(); return super(LazyVariables,self).itervalues()
+  def items(self): self.constructAll(); return super(LazyVariables,self).items()
+  def iteritems(self): self.constructAll(); return super(LazyVariables,self).iteritems()
+  def copy(self): self.constructAll(); return dict(super(LazyVariables,self).items())
+  
+
 class DatasetNetCDF(Dataset):
   '''
     A Dataset Class that provides access to variables in one or more NetCDF files. The class supports reading
@@ -485,7 +790,8 @@ class DatasetNetCDF(Dataset):
   
   def __init__(self, name=None, title=None, dataset=None, filelist=None, varlist=None, variables=None,
       	       varatts=None, atts=None, axes=None, multifile=False, check_override=None, ignore_list=None, 
-               folder='', mode='r', ncformat='NETCDF4', squeeze=True, load=False, check_vars=None):
+               folder='', mode='r', ncformat='NETCDF4', squeeze=True, load=False, check_vars=None, lazy=None,
+               lcatalog=True):
     ''' 
       Create a Dataset from one or more NetCDF files; Variables are created from NetCDF variables. 
       Alternatively, create a netcdf file from an existing Dataset (Variables can be added as well).  
@@ -506,6 +812,10 @@ class DatasetNetCDF(Dataset):
         ncformat       : format of NetCDF file, i.e. NETCDF3 NETCDF4 or NETCDF_CLASSIC (string; passed to netCDF4.Dataset)
         squeeze        : squeeze singleton dimensions from all variables
         load           : load data from disk immediately (passed on to VarNC)
+        lazy           : construct Variables on first access (default: if mode = 'r' and data is not 
+                         loaded immediately)
+        lcatalog       : if mode = 'r' and a varlist is given, use the catalog of the data folder to 
+                         discard files that do not contain any of the variables (see geodata.catalog)
                        
       NetCDF Attributes:
         mode           = 'r' # a string indicating whether read ('r') or write ('w') actions are intended/permitted
@@ -556,17 +866,25 @@ class DatasetNetCDF(Dataset):
         ncmode = 'a' if 'r' in mode and 'w' in mode else mode # 'rw' -> 'a' for "append"     
         # open netcdf datasets from netcdf files
         if not isinstance(filelist,col.Iterable): raise TypeError
-        # check if file exists
-        for filename in filelist:
-          if not os.path.exists(folder+filename): 
-            raise FileError, "File {0:s} not found in folder {1:s}".format(filename,folder)     
+        # discard irrelevant files using the catalog (without opening them)
+        if lcatalog and mode == 'r' and varlist is not None and not multifile:
+          filelist = selectFiles(filelist, varlist, folder=folder)
+        # check if files exist (and prefetch file headers concurrently)
+        if multifile: # lists of files or regular expressions
+          for ncfile in filelist:
+            if isinstance(ncfile,(list,tuple)): lexists = all(prefetchFiles([folder+ncf for ncf in ncfile]))
+            else: lexists = len(glob.glob(folder+ncfile)) > 0
+            if not lexists: raise FileError, "Files {0:s} not found in folder {1:s}".format(str(ncfile),folder)     
+        else:
+          for filename,lexists in zip(filelist,prefetchFiles([folder+filename for filename in filelist])):
+            if not lexists: raise FileError, "File {0:s} not found in folder {1:s}".format(filename,folder)     
         datasets = []; filenames = []
         for ncfile in filelist:        
           try: # NetCDF4 error messages are not very helpful...
             if multifile: # open a netCDF4 multi-file dataset 
               if isinstance(ncfile,(list,tuple)): tmpfile = [folder+ncf for ncf in ncfile]
               else: tmpfile = folder+ncfile # multifile via regular expressions
-              datasets.append(nc.MFDataset(tmpfile), mode=ncmode, format=ncformat, clobber=False)
+              datasets.append(nc.MFDataset(tmpfile)) # read-only
             else: # open a simple single-file dataset
               tmpfile = folder+ncfile
               datasets.append(nc.Dataset(tmpfile, mode=ncmode, format=ncformat, clobber=False))
@@ -591,9 +909,12 @@ class DatasetNetCDF(Dataset):
       if axes is None: axes = dict()
       else: check_override += axes.keys() # don't check externally provided axes   
       if not isinstance(axes,dict): raise TypeError
+      # if a varlist is given, only dimensions of the selected variables need axes (other coordinates are not read)
+      if varlist is None: dimlist = None
+      else: dimlist = set(dim for ds in datasets for var in varlist if var in ds.variables for dim in ds.variables[var].dimensions)
       for ds in datasets:
         for dim in ds.dimensions.keys():
-          if dim not in ignore_list:
+          if dim not in ignore_list and ( dimlist is None or dim in dimlist ):
             if dim[:8] == 'str_dim_': pass # dimensions added to store strings as charater arrays        
             elif dim in ds.variables: # dimensions with an associated coordinate variable           
               if dim in axes: # if already present, make sure axes are essentially the same
@@ -610,7 +931,8 @@ class DatasetNetCDF(Dataset):
               else: # if this is a new axis, add it to the list
                 params = dict(name=dim,coord=np.arange(len(ds.dimensions[dim]))); params.update(varatts.get(dim,{}))
                 axes[dim] = Axis(**params) # also use overrride parameters          
-      # create variables from netcdf variables    
+      # create variables from netcdf variables (or factories for lazy construction)    
+      if lazy is None: lazy = mode == 'r' and not load
       variables = dict()
       if not isinstance(check_vars, (list,tuple)): check_vars = (check_vars,)
       for ds in datasets:
@@ -623,7 +945,16 @@ class DatasetNetCDF(Dataset):
           elif ncvar.ndim == 0: pass # also ignore scalars for now...
           elif var in variables: # if already present, make sure variables are essentially the same
             varobj = variables[var] 
-            if var not in check_override:
+            if isinstance(varobj,functools.partial): # not constructed yet: compare NetCDF variables
+              varobj = varobj.keywords['ncvar']
+              if var not in check_override:
+                if varobj.shape != ncvar.shape or varobj.dimensions != ncvar.dimensions:
+                  raise DatasetError, "Error constructing Dataset: Variables '{:s}' from different files have incompatible dimensions.".format(var)
+                if 'units' in ncvar.ncattrs() and getattr(varobj,'units',None) != ncvar.units:
+                  raise DatasetError, "Error constructing Dataset: Variables '{:s}' from different files have incompatible units.".format(var)
+                if var in check_vars and np.any(varobj[:] != ncvar[:]):
+                  raise DatasetError, "Error constructing Dataset: Variables '{:s}' from different files have incompatible values.".format(var)                
+            elif var not in check_override:
               # check shape (don't load)
               if varobj.strvar and varobj.ndim == ncvar.ndim-1:
                 if varobj.shape != ncvar.shape[:-1] or varobj.ncvar.dimensions != ncvar.dimensions:
@@ -657,19 +988,23 @@ class DatasetNetCDF(Dataset):
               strtype = np.dtype('|S{:d}'.format(ncvar.shape[-1])) # string with length of string dimension
               # N.B.: apparently len(dim) does not work properly - ncvar.shape is more reliable
               # create new variable using the override parameters in varatts
-              variables[tmpatts['name']] = VarNC(ncvar=ncvar, axes=varaxes, dtype=strtype, 
-                                                 mode=mode, squeeze=squeeze, load=load, **tmpatts)
+              factory = functools.partial(VarNC, ncvar=ncvar, axes=varaxes, dtype=strtype, 
+                                          mode=mode, squeeze=squeeze, load=load, **tmpatts)
+              variables[tmpatts['name']] = factory if lazy else factory()
             elif all([dim in axes for dim in ncvar.dimensions]):
               varaxes = [axes[dim] for dim in ncvar.dimensions] # collect axes
               # create new variable using the override parameters in varatts
-              variables[tmpatts['name']] = VarNC(ncvar=ncvar, axes=varaxes, 
-                                                 mode=mode, squeeze=squeeze, load=load, **tmpatts)
+              factory = functools.partial(VarNC, ncvar=ncvar, axes=varaxes, 
+                                          mode=mode, squeeze=squeeze, load=load, **tmpatts)
+              variables[tmpatts['name']] = factory if lazy else factory()
               # N.B.: using tmpatts['name'] as key is more reliable in preventing duplicate variables,
               #       because it also works when NetCDF names are different across files
             elif not any([dim in ignore_list for dim in ncvar.dimensions]): # legitimate omission
               raise DatasetError, 'Error constructing Variable: Axes/coordinates not found:\n {:s}, {:s}'.format(str(var), str(ncvar.dimensions))
-      variables = variables.values()
+      factories = {name:var for name,var in variables.iteritems() if isinstance(var,functools.partial)}
+      variables = [var for var in variables.itervalues() if not isinstance(var,functools.partial)]
     else:
+      factories = None
       if isinstance(variables,dict): variables = variables.values()
       if isinstance(dataset,nc.Dataset):
         datasets = [dataset]  # datasets is used later
@@ -696,6 +1031,13 @@ class DatasetNetCDF(Dataset):
     super(DatasetNetCDF,self).__init__(name=name, title=title, varlist=variables, axes=None, atts=ncattrs)
     # N.B.: don't pass axes explicitly, otherwise we are adding a lot of unneccessary axes, which causes confusion
     #       (in particular, the singular Time axis from constant files will be loaded, which causes problems)
+    if factories:
+      # add axes of variables that are constructed lazily (singleton axes are squeezed)
+      for factory in factories.itervalues():
+        for ax in factory.keywords['axes']:
+          if not ( squeeze and len(ax) == 1 ) and not self.hasAxis(ax.name): 
+            super(DatasetNetCDF,self).addAxis(ax, copy=False)
+      self.__dict__['variables'] = LazyVariables(self.variables, factories, self)
     # check that stuff was loaded
     if len(self.variables) == 0 and mode != 'w': raise EmptyDatasetError
     # catch exception if an empty dataset is OK
@@ -705,6 +1047,22 @@ class DatasetNetCDF(Dataset):
     ''' The first element of the datasets list. '''
     return self.datasets[0] 
   
+  def __getattr__(self, attr):
+    ''' Construct lazy Variables, when they are accessed as attributes (shortcuts are only created, 
+        when a Variable is constructed); otherwise fall back to the Dataset method, which applies the 
+        attribute to all Variables, unless it is clear that no Variable has it. '''
+    variables = self.__dict__.get('variables',None)
+    if isinstance(variables,LazyVariables) and variables.factories:
+      if attr in variables.factories: return variables[attr]
+      # N.B.: without hooks, all lazy Variables have the same attributes as the first one, so that e.g. 
+      #       hasattr(dataset,'gdal') does not need to construct all Variables
+      if not variables.hooks:
+        constructed = variables.getConstructed()
+        if not any(isinstance(var,VarNC) for var in constructed): 
+          constructed.append(variables[variables.factories.keys()[0]])
+        if not any(hasattr(var,attr) for var in constructed): raise AttributeError, attr
+    return super(DatasetNetCDF,self).__getattr__(attr)
+  
   @ApplyTestOverList
   def addAxis(self, ax, asNC=None, copy=True, loverwrite=False, deepcopy=False):
     ''' Method to add an Axis to the Dataset. (If the Axis is already present, check that it is the same.) '''   
@@ -734,10 +1092,10 @@ class DatasetNetCDF(Dataset):
       newaxis = oldaxis; oldaxis = newaxis.name # i.e. replace old axis with the same name
     # check axis
     if not self.hasAxis(oldaxis): raise AxisError
+    if isinstance(oldaxis,Axis): oldname = oldaxis.name # just go by name
+    else: oldname = oldaxis
     # special treatment for VarNC: transfer of ownership of NetCDF variable
     if asNC or isinstance(newaxis,AxisNC):
-      if isinstance(oldaxis,Axis): oldname = oldaxis.name # just go by name
-      else: oldname = oldaxis
       oldaxis = self.axes[oldname]
       if len(oldaxis) != len(newaxis): raise AxisError # length has to be the same!
       # N.B.: the length of a dimension in a NetCDF file can't change!
@@ -748,12 +1106,19 @@ class DatasetNetCDF(Dataset):
       newaxis = asAxisNC(ax=newaxis, ncvar=oldaxis.ncvar, mode=oldaxis.mode, deepcopy=deepcopy)
       # ... and add new axis to dataset
       self.addAxis(newaxis, copy=False)
-      # loop over variables with this axis    
-      newaxis = self.axes[newaxis.name] # update reference
-      for var in self.variables.values():
-        if var.hasAxis(oldname): var.replaceAxis(oldname,newaxis)    
     else: # no need for special treatment...
-      super(DatasetNetCDF,self).replaceAxis(oldaxis, newaxis)
+      oldaxis = self.axes[oldname]
+      if len(oldaxis) != len(newaxis): raise AxisError # length has to be the same!    
+      self.removeAxis(oldaxis, force=True)
+      self.addAxis(newaxis, copy=False)
+    # loop over variables with this axis (lazy Variables are constructed with the new axis)
+    newaxis = self.axes[newaxis.name] # update reference
+    if isinstance(self.variables,LazyVariables):
+      self.variables.replaceAxis(oldname, newaxis)
+      variables = self.variables.getConstructed()
+    else: variables = self.variables.values()
+    for var in variables:
+      if var.hasAxis(oldname): var.replaceAxis(oldname,newaxis)    
     # return verification
     return self.hasAxis(newaxis)        
   
@@ -761,6 +1126,8 @@ class DatasetNetCDF(Dataset):
   def addVariable(self, var, asNC=None, copy=True, loverwrite=False, lautoTrim=False, deepcopy=False):
     ''' Method to add a new Variable to the Dataset. '''
     if asNC is None: asNC = copy
+    if isinstance(self.variables,LazyVariables) and var.name in self.variables.factories: 
+      self.variables[var.name] # construct existing variable first, so that conflicts are detected
     if var.name in self.__dict__: 
       # replace axes, if permitted; need to use NetCDF method immediately, though
       if loverwrite and self.hasVariable(var.name): 
@@ -860,8 +1227,10 @@ class DatasetNetCDF(Dataset):
     ''' Method to sync the currently loaded dataset to file and free up memory (discard data in memory) '''
     # synchronize data with NetCDF file
     if 'w' in self.mode: self.sync() # only if we have write permission, of course
-    # unload all variables
-    super(DatasetNetCDF,self).unload()  
+    # unload all variables (that have been constructed)
+    if isinstance(self.variables,LazyVariables):
+      for var in self.variables.getConstructed(): var.unload()
+    else: super(DatasetNetCDF,self).unload()  
     # return itself- this allows for some convenient syntax
     return self
     
@@ -0,0 +1,175 @@
+'''
+Created on 2016-04-27
+
+A skill-score matrix for model-observation comparisons: all members of an Ensemble are compared to a
+reference Dataset (e.g. CRU or PRISM), for a list of variables and seasons. For each variable, the
+member fields are stacked and standard deviations, correlations, centred RMS errors and biases of all
+members and seasons are computed in one vectorized pass, using (area-)weighted sums over space and
+season weights over time; results are cached per variable. The statistics are the quantities shown in
+Taylor diagrams (see TaylorDiagram.plot_skill in plotting.taylor):
+
+  skill = SkillMatrix(wrfens, cru, varlist=['T2','precip'], seasons=['annual','djf','jja'])
+  corr = skill.getStat('corr', 'T2', season='jja') # one value per member
+  dia = TaylorDiagram(); dia.setup_axes(fig); dia.plot_skill(skill, 'T2', season='jja')
+
+Regions can be selected by slicing (or masking) the member and reference datasets beforehand.
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import numpy as np
+import numpy.ma as ma
+# internal imports
+from geodata.base import Variable, Dataset, Ensemble, monthlyUnitsList
+from geodata.misc import ArgumentError, AxisError, DatasetError, translateSeasons
+
+
+## helper functions
+
+def getSeasonWeights(var, seasons, taxis='time'):
+  ''' return an array (season, time) of season weights (1 for months in the season, 0 otherwise); the
+      time axis has to be monthly (a climatology or a time-series starting in January); a season of
+      None means all time steps (also without time axis) '''
+  if not var.hasAxis(taxis):
+    if any(season is not None for season in seasons):
+      raise AxisError, "Variable '{:s}' has no axis '{:s}' to extract seasons.".format(var.name,taxis)
+    return np.ones((len(seasons),1))
+  time = var.getAxis(taxis); tcoord = np.asarray(time.coord)
+  weights = np.zeros((len(seasons),len(tcoord)))
+  if any(season is not None for season in seasons):
+    if not time.units.lower() in monthlyUnitsList:
+      raise NotImplementedError, "Time units='month' required to extract seasons! (got '{:s}')".format(time.units)
+    lclim = len(tcoord) == 12 and tcoord[0] == 1 # climatologies are enumerated from 1 to 12
+    months = np.asarray(tcoord - 1 if lclim else tcoord, dtype=np.int) % 12
+  for i,season in enumerate(seasons):
+    if season is None: weights[i,:] = 1.
+    else: weights[i,:] = np.in1d(months, translateSeasons(season))
+  return weights
+
+def getAreaWeights(var, taxis='time', lweight=True):
+  ''' return the normalized cell area of every feature (grid point) of a GDAL-enabled variable, with
+      the time axis removed, or None, if no weighting is applied '''
+  if not lweight or not getattr(var,'gdal',False): return None
+  if var.axisIndex(var.xlon) != var.ndim-1 or var.axisIndex(var.ylat) != var.ndim-2:
+    raise NotImplementedError, "Horizontal axes have to be the last indices."
+  area = var.griddef.getAreaWeights()
+  shape = tuple(len(ax) for ax in var.axes if ax.name != taxis)
+  return np.broadcast_to(area/area.mean(), shape).reshape((-1,))
+
+def getSamples(var, taxis='time'):
+  ''' return a copy of the data of a variable as a 2D array (time, features) in double precision,
+      with NaN's for missing values; variables are loaded temporarily, if necessary '''
+  lload = not var.data
+  if lload: var.load()
+  data = np.array(ma.filled(ma.asarray(var.data_array, dtype=np.float64), np.NaN)) # always a copy
+  if lload: var.unload()
+  if var.hasAxis(taxis): data = np.moveaxis(data, var.axisIndex(taxis), 0)
+  else: data = data.reshape((1,)+data.shape)
+  return data.reshape((data.shape[0],-1))
+
+def _getVariable(member, varname):
+  ''' return a Variable from a Dataset member, or the member itself, if it is a Variable; None if the
+      member does not have the variable '''
+  if isinstance(member,Variable): return member if member.name == varname else None
+  elif isinstance(member,Dataset): return member.variables.get(varname,None)
+  else: raise TypeError, member
+
+
+## skill scores
+
+def computeSkill(members, reference, varname, seasons=(None,), taxis='time', lweight=True):
+  ''' Compute skill statistics of a list of members (Datasets or Variables) with respect to a reference
+      for one variable and a list of seasons in one vectorized pass; members have to be on the same grid
+      as the reference. Returns a dictionary of arrays (member, season) with the number of valid samples
+      ('n'), the (weighted) mean bias ('bias'), the standard deviations of the members ('std') and the
+      reference ('ref_std'), their ratio ('std_ratio'), the correlation ('corr') and the centred RMS
+      error ('crmse'); statistics are computed over all valid (common) points in space and time.
+      Members without the variable have NaN statistics. '''
+  refvar = _getVariable(reference, varname)
+  if refvar is None: raise DatasetError, "Reference '{:s}' has no Variable '{:s}'.".format(reference.name,varname)
+  seasonw = getSeasonWeights(refvar, seasons, taxis=taxis) # (season, time)
+  ref = getSamples(refvar, taxis=taxis)
+  areaw = getAreaWeights(refvar, taxis=taxis, lweight=lweight)
+  if areaw is None: areaw = np.ones(ref.shape[1])
+  # stack members; all data are shifted by the reference mean to improve accuracy of single-pass sums
+  offset = np.nanmean(ref) if np.isfinite(ref).any() else 0.
+  ref -= offset
+  data = np.empty((len(members),)+ref.shape); data.fill(np.NaN)
+  for i,member in enumerate(members):
+    var = _getVariable(member, varname)
+    if var is None: continue
+    if var.shape != refvar.shape or [ax.name for ax in var.axes] != [ax.name for ax in refvar.axes]:
+      raise AxisError, "Variable '{:s}' of member '{:s}' is not on the same grid as the reference.".format(varname,member.name)
+    data[i,:] = getSamples(var, taxis=taxis); data[i,:] -= offset
+  # common valid points of members and reference
+  valid = np.isfinite(data); valid &= np.isfinite(ref)
+  data[~valid] = 0.; ref = np.where(valid, ref, 0.) # (member, time, features)
+  wsum = lambda a: np.dot(np.dot(a, areaw), seasonw.T) # (member, season)
+  n = np.dot(valid.sum(axis=2), seasonw.T)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    nw = wsum(valid)
+    mean = wsum(data) / nw; refmean = wsum(ref) / nw
+    variance = np.maximum(wsum(data*data) / nw - mean**2, 0)
+    refvariance = np.maximum(wsum(ref*ref) / nw - refmean**2, 0)
+    cov = wsum(data*ref) / nw - mean*refmean
+    std = np.sqrt(variance); refstd = np.sqrt(refvariance)
+    stats = dict(n=n, bias=mean-refmean, std=std, ref_std=refstd, std_ratio=std/refstd,
+                 corr=np.clip(cov/(std*refstd), -1, 1), crmse=np.sqrt(np.maximum(variance+refvariance-2*cov, 0)))
+  return stats
+
+
+class SkillMatrix(object):
+  ''' A matrix of skill statistics of ensemble members with respect to a reference Dataset for several
+      variables and seasons; statistics are computed (see computeSkill) and cached per variable, when
+      they are first accessed. '''
+  stats = ('n', 'bias', 'std', 'ref_std', 'std_ratio', 'corr', 'crmse') # available statistics
+
+  def __init__(self, ensemble, reference, varlist=None, seasons=None, taxis='time', lweight=True):
+    ''' Save members and reference; seasons can be a season or a list of seasons (None means all time
+        steps); the default varlist are all numeric variables of the reference. '''
+    if isinstance(ensemble,Ensemble): self.members = list(ensemble.members); self.names = list(ensemble.idkeys)
+    elif isinstance(ensemble,(list,tuple)): self.members = list(ensemble); self.names = [member.name for member in ensemble]
+    else: raise TypeError, ensemble
+    if not isinstance(reference,(Dataset,Variable)): raise TypeError, reference
+    self.reference = reference
+    if varlist is None:
+      if isinstance(reference,Variable): varlist = [reference.name]
+      else: varlist = [varname for varname,var in reference.variables.iteritems() if np.issubdtype(var.dtype, np.number)]
+    elif isinstance(varlist,basestring): varlist = [varlist]
+    self.varlist = list(varlist)
+    self.seasons = tuple(seasons) if isinstance(seasons,(list,tuple)) else (seasons,)
+    self.taxis = taxis; self.lweight = lweight
+    self._cache = dict() # statistics by variable
+
+  def compute(self, varname, lrecompute=False):
+    ''' Return the statistics of a variable (a dictionary of arrays (member, season)); statistics are
+        only computed once, unless lrecompute is True. '''
+    if varname not in self.varlist: raise ArgumentError, "Variable '{:s}' is not in the varlist.".format(varname)
+    if lrecompute or varname not in self._cache:
+      self._cache[varname] = computeSkill(self.members, self.reference, varname, seasons=self.seasons,
+                                          taxis=self.taxis, lweight=self.lweight)
+    return self._cache[varname]
+
+  def __getitem__(self, varname): return self.compute(varname)
+
+  def clearCache(self):
+    ''' Discard all computed statistics. '''
+    self._cache.clear()
+
+  def getStat(self, stat, varname, season=None):
+    ''' Return a statistic of a variable for a season (one value per member), or for all seasons (member,
+        season), if season is None (and None is not one of the seasons). '''
+    if stat not in self.stats: raise ArgumentError, "Unknown statistic '{:s}'.".format(stat)
+    values = self.compute(varname)[stat]
+    if season is None and None not in self.seasons: return values
+    if season not in self.seasons: raise ArgumentError, "Season '{:s}' is not in the list of seasons.".format(str(season))
+    return values[:,self.seasons.index(season)]
+
+  def getTaylorCoords(self, varname, season=None, lnormalize=True):
+    ''' Return the polar coordinates of the members in a Taylor diagram: theta=arccos(correlation) and
+        radius=standard deviation (normalized by the standard deviation of the reference) '''
+    if season is None and None not in self.seasons: season = self.seasons[0]
+    theta = np.arccos(self.getStat('corr', varname, season=season))
+    radius = self.getStat('std_ratio' if lnormalize else 'std', varname, season=season)
+    return theta, radius
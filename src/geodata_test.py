@@ -128,8 +128,20 @@ class BaseVarTest(unittest.TestCase):
       assert ax.getIndex(val, 'closest') == len(ax)-1
       # test batch value retrieval (exact match only)
       vals = coord[[0,1,2]]
-      assert np.all(ax.getIndices(vals) == np.asarray([0,1,2])) 
-    
+      assert np.all(ax.getIndices(vals) == np.asarray([0,1,2]))
+      # test vectorized index lookup (approximate match and out-of-bounds values)
+      vals = [( coord[1] + coord[2] + coord[2] ) / 3., coord[1], coord[0] - ( coord[1] - coord[0] )]
+      for mode in ('left','right','closest'):
+        idx = ax.getIndexArray(vals, mode=mode, outOfBounds=True)
+        assert isinstance(idx,np.ma.MaskedArray) and np.all(idx.mask == [False,False,True])
+        assert all([ax.getIndex(val, mode) == i for val,i in zip(vals[:2],idx[:2])])
+      idx, oob = ax.getIndexArray(vals, mode='closest', lmask=True)
+      assert np.all(idx == [2,1,0]) and np.all(oob == [False,False,True])
+      # single-point coordinates have no spacing
+      cax = Axis(name='point', units='none', coord=np.asarray([5.]))
+      idx, oob = cax.getIndexArray([4.,5.,6.], mode='closest', lmask=True)
+      assert np.all(oob == [True,False,True]) and np.all(idx == 0)
+
   def testBinaryArithmetic(self):
     ''' test binary arithmetic functions '''
     # get test objects
@@ -181,6 +193,10 @@ class BaseVarTest(unittest.TestCase):
     #print data.shape # this is what it is
     #print new_shape # this is what it should be
     assert data.shape == new_shape 
+    # broadcasting without copy returns a read-only view with zero strides
+    view = var.getArray(axes=new_axes, broadcast=True, copy=False)
+    assert view.shape == new_shape and view.strides[1] == 0 and not view.flags.writeable
+    assert isEqual(view, data)
     
   def testConcatVars(self):
     ''' test concatenation of variables '''
@@ -399,6 +415,41 @@ class BaseVarTest(unittest.TestCase):
     tes = ens(time=slice(0,3,2))
     assert all(len(tax)==2 for tax in tes.time)
       
+  def testEOF(self):
+    ''' test EOF analysis with incremental and randomized SVD '''
+    from geodata.eof import computeEOFs
+    np.random.seed(42) # reproducible noise
+    # synthetic field with two modes
+    te,ye,xe = 120,6,8; tc = np.arange(te)
+    m1 = np.outer(np.sin(np.linspace(0,np.pi,ye)), np.cos(np.linspace(0,np.pi,xe)))
+    m2 = np.outer(np.cos(np.linspace(0,2*np.pi,ye)), np.ones(xe))
+    data = 5*np.sin(tc/12.).reshape((te,1,1))*m1 + 2*np.cos(tc/7.).reshape((te,1,1))*m2 + 0.1*np.random.randn(te,ye,xe)
+    axes = (Axis(name='time', units='month', coord=tc), Axis(name='y', units='m', coord=np.arange(ye)), 
+            Axis(name='x', units='m', coord=np.arange(xe)))
+    var = Variable(name='test', units='K', axes=axes, data=data)
+    # exact solution
+    anom = data.reshape((te,-1)) - data.reshape((te,-1)).mean(axis=0)
+    sv = np.linalg.svd(anom, compute_uv=False); evf = sv[:2]**2/(sv**2).sum()
+    for method in ('incremental','randomized'):
+      eofvar, pcvar, evfvar = computeEOFs(var, nmodes=2, method=method, chunksize=25, seed=1)
+      assert eofvar.shape == (2,ye,xe) and pcvar.shape == (te,2) and evfvar.shape == (2,)
+      assert pcvar.units == var.units and eofvar.axes[0].name == 'mode'
+      assert np.allclose(evfvar[:], evf, rtol=1e-4)
+      # reconstruction from PC's and EOF's
+      rec = np.dot(pcvar[:], eofvar[:].reshape((2,-1)))
+      assert np.mean((anom-rec)**2) < 0.01*np.mean(anom**2)
+    # a feature that is missing in an entire chunk is filled with the running mean, not zero
+    data = data + 280.; data[50:75,2,3] = np.NaN # same anomalies, but a large mean
+    var = Variable(name='test', units='K', axes=axes, data=data)
+    for method in ('incremental','randomized'):
+      eofvar, pcvar, evfvar = computeEOFs(var, nmodes=2, method=method, chunksize=25, seed=1)
+      assert np.allclose(evfvar[:], evf, rtol=0.05) and np.all(np.isfinite(eofvar[:]))
+    # test variable (chunked reading of NetCDF variables)
+    var = self.var
+    if var.hasAxis('time') and var.ndim > 1:
+      eofvar, pcvar, evfvar = computeEOFs(var, nmodes=1, method='incremental', chunksize=12)
+      assert pcvar.shape == (len(var.time),1) and 0 <= evfvar[0] <= 1.0001
+      
   def testIndexing(self):
     ''' test indexing and slicing '''
     # get test objects
@@ -522,6 +573,33 @@ class BaseVarTest(unittest.TestCase):
     var.mask(mask=rav.data_array> 6)
     #print ma.array(self.data,mask=(rav.data_array>0)), var.getArray(unmask=False)
     assert isEqual(ma.array(self.data,mask=(rav.data_array>6)), var.getArray(unmask=False)) 
+    # test masking with a lower-dimensional mask (broadcast on the fly)
+    var.unmask(fillValue=-9999)
+    mask2d = rav.data_array[0,:] > 6; ref2d = mask2d.copy()
+    var.mask(mask=mask2d, merge=False)
+    assert var.getMask().shape == var.shape
+    assert np.all(var.getMask() == np.broadcast_arrays(mask2d,self.data)[0])
+    if var.ndim > mask2d.ndim: assert var.getMask().strides[0] == 0 # no full-size mask allocated
+    # the mask is only expanded, when it is modified (copy-on-write)
+    var.data_array[(0,)*var.ndim] = ma.masked
+    assert var.getMask()[(0,)*var.ndim] and var.getMask().flags.writeable
+    assert np.all(var.getMask()[1:] == np.broadcast_arrays(mask2d,self.data)[0][1:])
+    assert np.all(mask2d == ref2d) # the original mask is not modified
+    # the expanded mask is shared with views, so masking through a slice also masks the parent
+    if var.ndim > 1:
+      var.mask(mask=mask2d, merge=False)
+      data = var.data_array; view = data[1] # a view of the data
+      view[(0,)*view.ndim] = ma.masked
+      assert ma.getmask(data)[(1,)+(0,)*view.ndim] and np.all(ma.getmask(data)[1] == ma.getmask(view))
+      assert ma.getmask(data)[0].sum() == mask2d.sum() # only one element was added
+      data.mask[(0,)*var.ndim] = True # in-place modification of the public mask
+      assert ma.getmask(view)[(0,)*view.ndim] and ma.getmask(data)[(0,)*var.ndim]
+    # writing with 'put' also expands the mask
+    var.mask(mask=mask2d, merge=False)
+    data = var.data_array; idx = data.size-1
+    data.put([idx], ma.array([0], mask=[True]))
+    assert ma.getmask(data).flat[idx] and ma.getmask(data).flags.writeable
+    assert ma.getmask(data).sum() == np.broadcast_arrays(mask2d,self.data)[0].sum() + (not mask2d.flat[-1])
     
   def testPrint(self):
     ''' just print the string representation '''
@@ -603,6 +681,20 @@ class BaseVarTest(unittest.TestCase):
     varvar = var.var(ddof=3, **{t.name:None})
     assert varvar.units == '({:s})^2'.format(var.units) # check units!
     assert isEqual(nf.nanvar(data, axis=var.axisIndex(t.name),ddof=3), varvar.getArray())
+    if lsimple:
+      # NaN-aware kernels accumulate single precision in double precision and process data in slabs
+      slab_size = nf.slab_size; nf.slab_size = 10 # force many slabs
+      ref = np.asarray(data, dtype=np.float64) + np.random.randn(*data.shape); ref[0,0,:] = np.NaN
+      tdata = ref.astype(np.float32); iax = var.axisIndex(t.name)
+      try:
+        assert nf.nanmean(tdata, axis=iax).dtype == np.float32
+        assert isEqual(nf.nanmean(tdata, axis=iax), np.nanmean(ref, axis=iax).astype(np.float32))
+        assert isEqual(nf.nanstd(tdata, axis=iax, ddof=1), np.nanstd(ref, axis=iax, ddof=1).astype(np.float32))
+        assert isEqual(nf.nancount(tdata, axis=iax), np.isfinite(ref).sum(axis=iax))
+        out = np.empty(var.shape[1:]); assert nf.nanvar(tdata, axis=iax, out=out) is out
+        assert isEqual(out, np.nanvar(ref, axis=iax), eps=1e-5)
+        assert isEqual(nf.nansem(ma.masked_invalid(tdata)), np.nanstd(ref)/np.sqrt(np.isfinite(ref).sum()), eps=1e-6)
+      finally: nf.slab_size = slab_size
 #     assert isEqual(np.nanmax(self.data,axis=var.axisIndex(x.name)), var.max(**{x.name:None}).getArray())
 #     assert isEqual(np.nanmin(self.data, axis=var.axisIndex(y.name)), var.min(**{y.name:None}).getArray())
     # test percentiles
@@ -755,6 +847,12 @@ class BaseVarTest(unittest.TestCase):
     assert stdvar.name == var.name+'_test'
     assert stdvar.mean() < trendvar.mean()
     assert stdvar.std() < trendvar.std()
+    # vectorized detrending should be the same as fitting every series separately
+    detvar = trendvar.standardize(linplace=False, axis='time', lstandardize=False, ldetrend=True, lsmooth=False)
+    data = trendvar.getArray(unmask=True, fillValue=np.NaN); tc = trendvar.axes[0].coord
+    if np.all(np.isfinite(data[:,0,0])): 
+      fit = np.polyval(np.polyfit(tc, data[:,0,0], 1), tc)
+      assert np.allclose(detvar.getArray(unmask=True, fillValue=np.NaN)[:,0,0], data[:,0,0]-fit)
     # now standardize in-place
     name = var.name
     var.standardize(linplace=True, axis=None, lstandardize=True, ldetrend=False, lsmooth=False) # make variables more likely to test positive
@@ -1162,6 +1260,33 @@ class BaseDatasetTest(unittest.TestCase):
     sne = ens[range(len(ens)-1,-1,-1)]
     assert sne[-1] == ens[0] and sne[0] == ens[-1]
 
+  def testSkillMatrix(self):
+    ''' test skill statistics of ensemble members with respect to a reference '''
+    from geodata.skill import SkillMatrix
+    lsimple = self.__class__ is BaseDatasetTest
+    dataset = self.dataset.load()
+    var = dataset[self.var.name]
+    # a perfect member and a scaled member (the reference is the dataset itself)
+    scaled = Dataset(name='scaled', varlist=[var.copy(data=var.getArray()*2.+1.)])
+    ens = Ensemble(dataset, scaled, name='ensemble', basetype='Dataset')
+    seasons = ['annual','jja'] if lsimple else None
+    skill = SkillMatrix(ens, dataset, varlist=[var.name], seasons=seasons)
+    stats = skill[var.name]
+    assert skill[var.name] is stats # cached
+    nseason = len(seasons) if seasons else 1
+    assert all(stats[stat].shape == (2,nseason) for stat in skill.stats)
+    assert np.allclose(stats['corr'], 1.) and np.allclose(stats['crmse'][0,:], 0.)
+    assert np.allclose(stats['std_ratio'], [[1.],[2.]]) and np.allclose(stats['bias'][0,:], 0.)
+    assert np.allclose(stats['crmse'][1,:], stats['ref_std'][1,:])
+    theta, radius = skill.getTaylorCoords(var.name, season=seasons[-1] if seasons else None)
+    assert np.allclose(theta, 0., atol=1e-6) and np.allclose(radius, [1.,2.])
+    if lsimple:
+      # compare to simple statistics for summer
+      jja = var.getArray()[5:8,:]
+      assert isEqual(skill.getStat('ref_std', var.name, season='jja')[0], jja.std())
+      assert isEqual(skill.getStat('bias', var.name, season='jja')[1], jja.mean()+1.)
+      assert skill.getStat('n', var.name, season='annual')[0] == var.getArray().size
+
   def testIndexing(self):
     ''' test collective slicing and coordinate/point extraction  '''
     lsimple = self.__class__ is BaseDatasetTest
@@ -1310,7 +1435,7 @@ class BaseDatasetTest(unittest.TestCase):
   
 
 # import modules to be tested
-from geodata.netcdf import VarNC, AxisNC, DatasetNetCDF
+from geodata.netcdf import VarNC, AxisNC, DatasetNetCDF, MonthlyFactor, LonShift
 
 class NetCDFVarTest(BaseVarTest):  
   
@@ -1420,6 +1545,23 @@ class NetCDFVarTest(BaseVarTest):
     assert self.size == var.shape
     assert isEqual(self.data*2+100., var.data_array)
   
+  def testReadTransform(self):
+    ''' test read-time transforms with slices (fused factors and index remapping) '''
+    # get test objects
+    var = self.var; tax = var.axes[0]; xax = var.axes[-1]
+    nt = len(tax); nx = len(xax)
+    values = np.arange(1,13, dtype=np.float64)
+    factor = MonthlyFactor(name='test_factor', axis=tax.name, values=values, newunits='test')
+    shift = LonShift(name='test_shift', axis=xax.name)
+    tvar = VarNC(self.ncvar, axes=self.axes, scalefactor=2., transform=[factor,shift])
+    assert tvar.units == 'test'
+    # expected result: shifted and scaled 
+    data = np.roll(self.data, nx/2, axis=-1)*2.
+    data /= np.tile(values, nt/12+1)[:nt].reshape((nt,)+(1,)*(var.ndim-1))
+    # partial slices (the longitude slice wraps around in the file)
+    for sl in [(slice(None),)*3, (slice(1,10,2),slice(None),slice(0,nx-1)), (3,slice(2,5),slice(nx/2-2,nx/2+2))]:
+      assert isEqual(data.__getitem__(sl), tvar[sl], masked_equal=True)
+  
 
 class DatasetNetCDFTest(BaseDatasetTest):  
   
@@ -1523,6 +1665,30 @@ class DatasetNetCDFTest(BaseDatasetTest):
     print(dataset)
     dataset.close()
 
+  def testConcatStream(self):
+    ''' test streaming concatenation of datasets into a NetCDF file '''
+    filename = self.folder + 'test.nc'
+    if os.path.exists(filename): os.remove(filename)
+    ds = self.dataset; cp = self.dataset.copy()
+    varname = self.var.name; axname = self.axes[0].name
+    lckax = self.dataset_name not in ('GPCC','NARR') # will fail with GPCC and NARR, due to sub-monthly time units
+    # reference data (in memory)
+    concat_data = concatVars([ds[varname],cp[varname]], axis=axname, asVar=False, lcheckAxis=lckax)
+    ds.unload(); cp.unload()
+    # concatenate directly into new NetCDF file
+    target = DatasetNetCDF(filelist=[filename],mode='w')
+    ccds = concatDatasets([ds, cp], axis=axname, offset=0, lcheckAxis=lckax, target=target)
+    assert ccds is target
+    ccvar = ccds[varname]
+    assert isinstance(ccvar,VarNC) and not ccvar.data
+    assert ccvar.shape == concat_data.shape
+    assert not ds[varname].data and not cp[varname].data # members were not loaded
+    ccds.close()
+    # check that it is OK
+    ccds = DatasetNetCDF(filelist=[filename],mode='r',load=True)
+    assert isEqual(ccds[varname].data_array, concat_data) # masked_equal = True
+    ccds.close()
+
   def testStringVar(self):
     ''' test behavior of string variables in a netcdf dataset '''
     filename = self.folder + 'test.nc'
@@ -1565,6 +1731,55 @@ class DatasetNetCDFTest(BaseDatasetTest):
     dataset.unload()
     assert all([not var.data for var in dataset])
 
+  def testLazy(self):
+    ''' test lazy construction of Variables '''
+    # open the same files with and without lazy construction
+    kwargs = dict(filelist=self.dataset.filelist, ignore_list=('nbnds',))
+    lazy = DatasetNetCDF(lazy=True, **kwargs); eager = DatasetNetCDF(lazy=False, **kwargs)
+    assert len(lazy.variables.getConstructed()) == 0
+    assert sorted(lazy.variables.keys()) == sorted(eager.variables.keys())
+    assert sorted(lazy.axes.keys()) == sorted(eager.axes.keys())
+    # Variables are constructed on first access
+    varname = lazy.variables.keys()[0]
+    var = getattr(lazy, varname)
+    assert isinstance(var,VarNC) and lazy[varname] is var and var.dataset is lazy
+    assert len(lazy.variables.getConstructed()) == 1
+    assert var.shape == eager.variables[varname].shape
+    assert all(ax is lazy.axes[ax.name] for ax in var.axes)
+    # attributes that Variables don't have are looked up without constructing all Variables
+    assert not hasattr(lazy, 'gdal') and len(lazy.variables.getConstructed()) == 1
+    # values() constructs all remaining Variables
+    assert len(lazy.variables.values()) == len(eager.variables)
+    lazy.close(); eager.close()
+    # open through a loader, which replaces the time axis and adds GDAL functionality
+    if self.dataset_name == 'GPCC':
+      from datasets.GPCC import loadGPCC_TS
+      dataset = loadGPCC_TS(folder='', filelist=self.dataset.filelist)
+      assert dataset.gdal and len(dataset.variables.getConstructed()) == 0
+      var = dataset.precip # constructed with the new time axis and GDAL functionality
+      assert var.gdal and var.hasAxis(dataset.xlon) and var.time is dataset.time
+      assert dataset.time.units == 'month' and len(dataset.variables.getConstructed()) == 1
+      dataset.close()
+
+  def testCatalog(self):
+    ''' test selection of files using the dataset catalog '''
+    from geodata.catalog import scanFolder, selectFiles, getVariables, catalog_file
+    filelist = [os.path.basename(filepath) for filepath in self.dataset.filelist]
+    folder = os.path.dirname(self.dataset.filelist[0])+'/'
+    catalog = scanFolder(folder)
+    try:
+      assert all(filename in catalog['files'] for filename in filelist)
+      ncvar = self.ncvarname
+      assert catalog['files'][filelist[0]]['variables'][ncvar]['shape'] == list(self.ncvar.shape)
+      assert getVariables(filelist, folder=folder)[ncvar][0] == filelist[0]
+      # only files that contain the variable are selected (coordinates don't count)
+      assert selectFiles(filelist, [ncvar,'time'], folder=folder) == filelist[:1]
+      assert selectFiles(filelist, ['time'], folder=folder) == filelist # nothing to select
+      dataset = DatasetNetCDF(folder=folder, filelist=filelist, varlist=[ncvar], ignore_list=('nbnds',))
+      assert len(dataset.filelist) == 1 and ncvar in dataset
+      dataset.close()
+    finally: os.remove(folder+catalog_file)
+
 
 # import modules to be tested
 from geodata.gdal import addGDALtoVar, addGDALtoDataset
@@ -1627,7 +1842,32 @@ class GDALVarTest(NetCDFVarTest):
       assert not slcvar.gdal 
     # do standard tests
     super(GDALVarTest,self).testIndexing()
-    
+
+  def testMapMean(self):
+    ''' test area-weighted map averages with one or several masks '''
+    var = self.var.copy(); var.load()
+    area = var.griddef.getAreaWeights()
+    assert area.shape == var.mapSize and np.all(area > 0)
+    assert area is var.griddef.getAreaWeights() # cached
+    # one mask, compared to masked average
+    mask = np.zeros(var.mapSize, dtype=np.bool); mask[:var.mapSize[0]/2,:] = True
+    mean = var.mapMean(mask=mask, asVar=False)
+    data = ma.masked_invalid(var.getArray(axes=var.axes[:-2]+(var.ylat.name,var.xlon.name)))
+    data = data.reshape(data.shape[:-2]+(area.size,))
+    weights = np.where(mask.ravel(), 0, area.ravel())
+    assert np.allclose(mean, ma.average(data, axis=-1, weights=weights))
+    # several masks at once (mask axis is last)
+    masks = np.concatenate([mask.reshape((1,)+mask.shape), ~mask.reshape((1,)+mask.shape)], axis=0)
+    means = var.mapMean(mask=masks, asVar=False)
+    assert means.shape == var.shape[:-2]+(2,)
+    assert np.allclose(means[...,0], mean)
+    # integrals have the same sign as the mean, with and without weights
+    if var.isProjected:
+      total = var.mapMean(mask=mask, asVar=False, integral=True)
+      assert np.allclose(total, mean*area.ravel()[~mask.ravel()].sum())
+      total = var.mapMean(mask=mask, asVar=False, integral=True, lweight=False)
+      assert np.allclose(total, mean*area.ravel()[~mask.ravel()].sum())
+
   def testWriteASCII(self):
     ''' test function to write Arc/Info ASCII Grid / ASCII raster files '''
     # get test objects
@@ -1739,6 +1979,70 @@ class DatasetGDALTest(DatasetNetCDFTest):
       # this filename should exist
       filepath = '{:s}/TEST_{:s}_Time_{:04.0f}'.format(folder,self.var.name,dataset.axes['time'][0])
       assert os.path.exists(filepath), filepath
+      # bulk export should produce the same files and values
+      from processing.export import exportRasterBulk
+      bulkfolder = '{:s}/ASCII_bulk/'.format(workdir)
+      if os.path.exists(bulkfolder): shutil.rmtree(bulkfolder)
+      refdict = dataset.ASCII_raster(varlist=varlist, folder=folder)
+      filedict = exportRasterBulk(dataset, varlist=varlist, folder=bulkfolder, NT=2)
+      readGrid = lambda fp: np.array([l.split() for l in open(fp) if not l[0].isalpha()], dtype=np.float) # skip header
+      for var,filelist in filedict.iteritems():
+        assert len(filelist) == len(refdict[var])
+        for filepath,refpath in zip(filelist,refdict[var]):
+          assert os.path.basename(filepath) == os.path.basename(refpath)
+          assert np.allclose(readGrid(filepath), readGrid(refpath))
+      # file names also have to match for variables with two extra axes (ASCII_raster only applies the
+      # formatter and coordinate tags to the outermost axis)
+      from geodata.gdal import addGDALtoDataset
+      var = dataset.variables[self.var.name]
+      member = Axis(name='member', units='#', coord=np.arange(1,3))
+      var4d = Variable(name='var4d', units=var.units, axes=(member,)+var.axes, 
+                       data=ma.concatenate([var.data_array[np.newaxis,:]]*2, axis=0))
+      ds4d = Dataset(name='test', varlist=[var4d]); addGDALtoDataset(ds4d, griddef=dataset.griddef)
+      formatter = dict(member=('Member','{:02d}'))
+      refdict = ds4d.ASCII_raster(folder=folder, lcoord=True, formatter=formatter, prefix='TEST4D')
+      filedict = exportRasterBulk(ds4d, folder=bulkfolder, lcoord=True, formatter=formatter, prefix='TEST4D')
+      assert len(filedict['var4d']) == 2*len(var.axes[0])
+      assert [os.path.basename(fp) for fp in filedict['var4d']] == [os.path.basename(fp) for fp in refdict['var4d']]
+        
+  def testWriteColumnar(self):
+    ''' test round trip of station time series through columnar (Arrow) files in long and wide layout '''
+    from processing.export import writeColumnar, pa
+    if pa is None: return # pyarrow is optional
+    # a small station time-series dataset with metadata and a missing value
+    station = Axis(name='station', units='#', coord=np.arange(1,4))
+    time = Axis(name='time', units='month', coord=np.arange(6))
+    data = np.arange(18, dtype=np.float32).reshape((3,6)); data[1,2] = np.NaN
+    precip = Variable(name='precip', units='mm/day', axes=(station,time), data=data)
+    stn_name = Variable(name='stn_name', units='', axes=(station,), data=np.array(['A','B','C']))
+    zs = Variable(name='zs', units='m', axes=(station,), data=np.array([10.,20.,30.]))
+    dataset = Dataset(name='test', varlist=[precip,stn_name,zs], atts=dict(period='1979-1985'))
+    folder = '{:s}/columnar/'.format(workdir)
+    if not os.path.exists(folder): os.mkdir(folder)
+    getValues = lambda column: np.array(column.to_pylist(), dtype=np.float) # nulls become NaN
+    # long layout: one row per station and time step
+    filepath = writeColumnar(dataset, folder+'test_long.arrow', layout='long')
+    table = pa.ipc.open_file(pa.memory_map(filepath)).read_all()
+    assert table.schema.metadata['layout'] == 'long' and table.num_rows == 18
+    assert table.column('station').to_pylist() == list(np.repeat(station.coord, 6))
+    assert table.column('time').to_pylist() == list(np.tile(time.coord, 3))
+    assert table.column('stn_name').to_pylist() == list(np.repeat(['A','B','C'], 6))
+    assert np.all(getValues(table.column('zs')) == np.repeat(zs.data_array, 6))
+    values = getValues(table.column('precip'))
+    assert np.isnan(values[8]) and np.sum(np.isnan(values)) == 1
+    assert np.allclose(values[~np.isnan(values)], data.ravel()[~np.isnan(data.ravel())])
+    # wide layout: one row per time step and one column per station, with metadata in the fields
+    filepath = writeColumnar(dataset, folder+'test_wide.arrow', layout='wide')
+    table = pa.ipc.open_file(pa.memory_map(filepath)).read_all()
+    assert table.schema.metadata['layout'] == 'wide' and table.num_rows == 6
+    assert table.schema.names == ['time','precip_1','precip_2','precip_3']
+    for i,name in enumerate(table.schema.names[1:]):
+      values = getValues(table.column(name))
+      assert np.array_equal(np.isnan(values), np.isnan(data[i,:]))
+      assert np.allclose(values[~np.isnan(values)], data[i,~np.isnan(data[i,:])])
+      meta = table.schema.field(name).metadata
+      assert meta['stn_name'] == stn_name.data_array[i] and meta['units'] == 'mm/day'
+    shutil.rmtree(folder)
         
     
 if __name__ == "__main__":
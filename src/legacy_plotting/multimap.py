@@ -24,7 +24,6 @@ plt.ioff()
 mpl.rc('lines', linewidth=1.)
 mpl.rc('font', size=10)
 # PyGeoDat stuff
-from mpl_toolkits.basemap import maskoceans # used for masking data
   
 from geodata.base import DatasetError
 from datasets.WSC import basins_info
@@ -777,7 +776,7 @@ if __name__ == '__main__':
               vardata[mask==16] = -2. # use land use index (ocean)  
               vardata[mask==24] = -2. # use land use index (lake)
             else :
-              vardata = maskoceans(lon,lat,vardata,resolution=res,grid=grid)
+              vardata = mapSetup.maskOceans(lon,lat,vardata) # cached ocean mask
           # figure out land mask
           if lmsklnd: 
             if exp.variables.has_key('landfrac'): # CESM and CFSR 
@@ -825,7 +824,7 @@ if __name__ == '__main__':
         for n in xrange(nax):
           xtpl = []; ytpl = []
           for m in xrange(nexps[n]):
-            xx, yy = maps[n](lons[n][m],lats[n][m]) # convert to map-native coordinates
+            xx, yy = mapSetup.projectGrid(lons[n][m],lats[n][m]) # convert to map-native coordinates (cached)
             xtpl.append(xx); ytpl.append(yy)
           x.append(xtpl); y.append(ytpl) 
         
@@ -79,6 +79,252 @@ class MultiProcessTest(unittest.TestCase):
     ec = asyncPoolEC(test_func_ec, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=False)
     assert ec == 0
     
+  def testAsyncPoolDAG(self):
+    ''' test task graph scheduler '''    
+    from processing.multiprocess import asyncPoolDAG, Job, test_func_dag
+    import tempfile, shutil
+    folder = tempfile.mkdtemp()
+    a, b, c, d = [os.path.join(folder,name) for name in 'abcd']
+    # N.B.: jobs are listed in reverse order and 'd' depends on a missing file (i.e. fails)
+    jobs = [Job(test_func_dag, args=([b,c],d), inputs=[b,c], outputs=[d]),
+            Job(test_func_dag, args=([a],c), inputs=[a], outputs=[c], size=10),
+            Job(test_func_dag, args=([a],b), inputs=[a], outputs=[b], size=20),
+            Job(test_func_dag, args=([],a), outputs=[a]),]
+    ec = asyncPoolDAG(jobs, NP=NP, memory=1, ldebug=ldebug)
+    assert ec == 0 and os.path.exists(d)
+    # a missing input fails a job and its dependents are skipped
+    jobs = [Job(test_func_dag, args=([a+'x'],b+'x'), inputs=[a+'x'], outputs=[b+'x']),
+            Job(test_func_dag, args=([b+'x'],c+'x'), inputs=[b+'x'], outputs=[c+'x']),]
+    ec = asyncPoolDAG(jobs, NP=NP, ldebug=ldebug)
+    assert ec == 2 and not os.path.exists(c+'x')
+    shutil.rmtree(folder)
+    
+  def testProfiling(self):
+    ''' test aggregation of job profiles in pool functions '''    
+    from processing.multiprocess import asyncPoolEC, test_func_dag
+    import utils.profiling as prof
+    import tempfile, shutil, json
+    folder = tempfile.mkdtemp()
+    profile = os.path.join(folder,'profile.json')
+    args = [([],os.path.join(folder,str(n))) for n in xrange(3)]
+    ec = asyncPoolEC(test_func_dag, args, dict(wait=0.1), NP=NP, ldebug=ldebug, ltrialnerror=True, profile=profile)
+    assert ec == 0 and not prof.isEnabled()
+    report = json.load(open(profile))
+    assert report['summary']['njobs'] == 3 and report['summary']['wall'] >= 0.3
+    # exclusive timers and byte counts
+    prof.startProfiling(folder); prof.startJob(name='test')
+    with prof.timer('compute', 'T2'):
+      with prof.timer('load'): prof.addBytes('read', 100)
+    prof.saveJob(); report = prof.collectReports(folder); prof.stopProfiling()
+    assert report['summary']['bytes']['read'] == 100
+    job = report['jobs'][0]; assert 0 <= job['peak_rss_increase'] <= job['worker_peak_rss']
+    assert set(report['summary']['phases'].keys()) == set(['compute','load'])
+    assert all(record['variable'] == 'T2' for record in report['jobs'][0]['records'])
+    prof.writeReport(report, os.path.join(folder,'profile.csv'))
+    shutil.rmtree(folder)
+    
+  def testAffinityPool(self):
+    ''' test LRU caches and persistent workers with affinity scheduling '''    
+    from processing.multiprocess import AffinityPool, asyncPoolDAG, Job, test_func_dag, test_func_crash, WorkerLostError
+    from utils.cache import LRUCache
+    import tempfile, shutil
+    # bounded cache with release of discarded entries
+    closed = []
+    lru = LRUCache('test', maxsize=2, close=closed.append)
+    for key in 'abc': lru.load(key, lambda: key.upper())
+    assert len(lru) == 2 and closed == ['A'] and lru.misses == 3
+    assert lru.load('b', None) == 'B' and lru.hits == 1
+    lru.resize(0); assert len(lru) == 0 and closed == ['A','C','B']
+    # tasks with the same key are executed by the same worker
+    pool = AffinityPool(processes=max(NP,2))
+    names = [pool.apply_async(os.getpid, affinity=key).get() for key in 'aabba'] # one at a time
+    pool.close(); pool.join()
+    assert names[0] == names[1] == names[4] and names[2] == names[3]
+    # a worker that dies fails its task (and is replaced), instead of blocking the pool
+    pool = AffinityPool(processes=2)
+    result = pool.apply_async(test_func_crash, (1,))
+    try: result.get(); lerror = False
+    except WorkerLostError: lerror = True
+    assert lerror and pool.apply_async(os.getpid).get() > 0
+    pool.close(); pool.join()
+    # dead workers are also detected, while other workers keep returning results
+    pool = AffinityPool(processes=2, interval=0.1)
+    result = pool.apply_async(test_func_crash, (1,))
+    for _ in xrange(100):
+      pool.apply_async(sleep, (0.02,)).get()
+      if result.ready(): break
+    assert result.ready() and not result.successful()
+    pool.close(); pool.join()
+    # task graph scheduler with caching
+    folder = tempfile.mkdtemp()
+    filepath = lambda name: os.path.join(folder,name)
+    jobs = [Job(test_func_dag, args=([],filepath('a')), outputs=[filepath('a')])]
+    jobs += [Job(test_func_dag, args=([filepath('a')],filepath(str(n))), inputs=[filepath('a')], 
+                 outputs=[filepath(str(n))]) for n in xrange(3)]
+    assert jobs[1].affinity == jobs[2].affinity == (filepath('a'),)
+    ec = asyncPoolDAG(jobs, NP=NP, ldebug=ldebug, ltrialnerror=True, lcache=True)
+    assert ec == 0 and all(os.path.exists(filepath(str(n))) for n in xrange(3))
+    shutil.rmtree(folder)
+    
+  def testJobQueue(self):
+    ''' test file-based job queue with dependencies and retries '''    
+    from processing.multiprocess import Job, test_func_dag
+    from processing.jobqueue import runQueue, getStatus, submitJobs, connectQueue, claimJob
+    import tempfile, shutil
+    folder = tempfile.mkdtemp()
+    filepath = lambda name: os.path.join(folder,name)
+    queuefile = filepath('queue.db')
+    jobs = [Job(test_func_dag, args=([filepath('a')],filepath('b')), inputs=[filepath('a')], outputs=[filepath('b')]),
+            Job(test_func_dag, args=([],filepath('a')), outputs=[filepath('a')]),
+            Job(test_func_dag, args=([filepath('x')],filepath('y')), inputs=[filepath('x')], outputs=[filepath('y')]),
+            Job(test_func_dag, args=([filepath('y')],filepath('z')), inputs=[filepath('y')], outputs=[filepath('z')])]
+    # the third job fails (twice) and the fourth depends on it
+    ec = runQueue(jobs, queuefile, NP=NP, retries=1, poll=0.1, ldebug=ldebug)
+    assert ec == 2 and os.path.exists(filepath('b'))
+    status = getStatus(queuefile)
+    assert status['done'] == 2 and status['failed'] == 2
+    # expired leases are returned to the queue
+    submitJobs(queuefile, jobs[1:2], retries=1)
+    conn = connectQueue(queuefile)
+    assert claimJob(conn, 'worker1', lease=-1) is not None # expires immediately
+    assert claimJob(conn, 'worker2', lease=600) is not None # claimed again
+    assert claimJob(conn, 'worker3', lease=600) is None # nothing ready
+    conn.close()
+    # queues with unfinished jobs are not replaced, unless requested explicitly
+    try: submitJobs(queuefile, jobs[1:2]); lerror = False
+    except IOError: lerror = True
+    assert lerror
+    submitJobs(queuefile, jobs[1:2], loverwrite=True)
+    # expired leases of workers that are still running on this node are renewed
+    import subprocess, socket
+    live = subprocess.Popen(['sleep','60'])
+    conn = connectQueue(queuefile)
+    assert claimJob(conn, '{:s}:{:d}'.format(socket.gethostname(),live.pid), lease=-1) is not None
+    assert claimJob(conn, 'worker2', lease=600) is None # still running
+    live.kill(); live.wait()
+    conn.execute('UPDATE jobs SET lease=-1') # expire again
+    assert claimJob(conn, 'worker2', lease=600) is not None # worker is gone
+    conn.close()
+    shutil.rmtree(folder)
+    
+  def testBuildManifest(self):
+    ''' test build manifest for exact skips '''    
+    from processing.manifest import checkBuild, recordBuild, getStaleOutputs
+    import tempfile, shutil, json
+    folder = tempfile.mkdtemp()
+    src, out = os.path.join(folder,'source.txt'), os.path.join(folder,'output.txt')
+    with open(src,'w') as f: f.write('source')
+    params = dict(varlist=['T2','precip'], period='1979-1994')
+    # no record: compute and record output
+    lskip, reason, build = checkBuild(out, inputs=[src], params=params, code=('processing.manifest',))
+    assert not lskip and reason == 'no build record'
+    with open(out,'w') as f: f.write('output')
+    recordBuild(out, build)
+    lskip, reason, build = checkBuild(out, inputs=[src], params=params, code=('processing.manifest',))
+    assert lskip and reason == '' and getStaleOutputs(folder) == {'output.txt':[]}
+    # a touched (but otherwise identical) input does not trigger recomputation
+    os.utime(src, (0,0))
+    lskip, reason, build = checkBuild(out, inputs=[src], params=params, code=('processing.manifest',))
+    assert lskip
+    # changes of parameters and inputs
+    lskip, reason, build = checkBuild(out, inputs=[src], params=dict(params, period='1979-2009'))
+    assert not lskip and 'parameters changed: period' in reason and 'code changed' in reason
+    with open(src,'w') as f: f.write('new source')
+    assert 'input changed' in getStaleOutputs(folder)['output.txt'][0]
+    os.remove(out)
+    assert getStaleOutputs(folder) == {'output.txt':['output missing']}
+    # outputs without a build record are adopted, if they are newer than their inputs
+    old = os.path.join(folder,'old.txt')
+    with open(old,'w') as f: f.write('old output')
+    os.utime(src, (0,0))
+    lskip, reason, build = checkBuild(old, inputs=[src], params=params)
+    assert lskip and getStaleOutputs(folder)['old.txt'] == []
+    os.utime(src, None)
+    lskip, reason, build = checkBuild(os.path.join(folder,'older.txt'), inputs=[src], params=params)
+    assert not lskip and reason == 'no build record'
+    with open(os.path.join(folder,'older.txt'),'w') as f: f.write('older output')
+    os.utime(os.path.join(folder,'older.txt'), (0,0))
+    lskip, reason, build = checkBuild(os.path.join(folder,'older.txt'), inputs=[src], params=params)
+    assert not lskip and 'older than inputs' in reason
+    # changes in the middle of large files (same size, header and trailing block) are detected
+    from processing.manifest import block_size, hashFileLegacy, manifest_file
+    big = os.path.join(folder,'big.nc')
+    with open(big,'wb') as f: f.write('header' + 'a'*3*block_size + 'trailer')
+    lskip, reason, build = checkBuild(out, inputs=[big], params=params)
+    with open(out,'w') as f: f.write('output')
+    recordBuild(out, build)
+    with open(big,'r+b') as f: f.seek(2*block_size); f.write('b')
+    lskip, reason, build = checkBuild(out, inputs=[big], params=params)
+    assert not lskip and 'input changed' in reason
+    # legacy fingerprints are accepted, unless the input was modified after the output was written
+    recordBuild(out, build)
+    with open(os.path.join(folder,manifest_file),'r') as f: manifest = json.load(f)
+    manifest['outputs']['output.txt']['inputs'][os.path.abspath(big)] = hashFileLegacy(big)
+    with open(os.path.join(folder,manifest_file),'w') as f: json.dump(manifest, f)
+    os.utime(big, (0,0))
+    assert getStaleOutputs(folder)['output.txt'] == []
+    os.utime(big, None)
+    assert 'input changed' in getStaleOutputs(folder)['output.txt'][0]
+    shutil.rmtree(folder)
+    
+  def testCheckpointFile(self):
+    ''' test recovery of temporary files from crashed runs '''    
+    from processing.misc import getCheckpointFile, checkpoint_att, owner_att, target_att, heartbeat_att
+    import tempfile, shutil, subprocess, socket, time
+    import netCDF4 as nc
+    folder = tempfile.mkdtemp() + '/'
+    def makeTmpFile(filename, key, pid, target='out.nc', host=socket.gethostname(), heartbeat=None):
+      ncfile = nc.Dataset(folder+filename, 'w')
+      ncfile.setncattr(checkpoint_att, key)
+      ncfile.setncattr(owner_att, '{:s}:{:d}'.format(host,pid))
+      ncfile.setncattr(target_att, target)
+      if heartbeat is not None: ncfile.setncattr(heartbeat_att, heartbeat)
+      ncfile.close()
+      if heartbeat is not None: os.utime(folder+filename, (heartbeat,heartbeat))
+    dead = subprocess.Popen(['true']); dead.wait() # a process that is no longer running
+    live = subprocess.Popen(['sleep','60']) # a process that is still writing its file
+    makeTmpFile('tmp_test_proc01_out.nc', 'key', dead.pid, heartbeat=time.time()-20) # recovered
+    makeTmpFile('tmp_test_proc02_out.nc', 'key', live.pid) # left alone
+    makeTmpFile('tmp_test_proc03_out.nc', 'other', dead.pid) # a different job: removed
+    makeTmpFile('tmp_test_proc04_my_out.nc', 'key', dead.pid, target='my_out.nc') # another target: left alone
+    makeTmpFile('tmp_test_proc05_out.nc', 'key', dead.pid, target='other.nc') # not the same target: left alone
+    # owners on other hosts are assumed to be dead, once their lease has expired
+    makeTmpFile('tmp_test_proc06_out.nc', 'key', 1, host='remote', heartbeat=time.time()-10) # left alone
+    makeTmpFile('tmp_test_proc07_out.nc', 'key', 1, host='remote', heartbeat=time.time()-3600) # removed
+    ckptfile = getCheckpointFile(folder, 'out.nc', tmppfx='tmp_test_', key='key', lease=600)
+    live.kill()
+    assert ckptfile == folder+'ckpt_out.nc'
+    assert sorted(os.listdir(folder)) == ['ckpt_out.nc','tmp_test_proc02_out.nc','tmp_test_proc04_my_out.nc',
+                                          'tmp_test_proc05_out.nc','tmp_test_proc06_out.nc']
+    with nc.Dataset(ckptfile, 'r') as ncfile: assert ncfile.getncattr(owner_att).endswith(':{:d}'.format(dead.pid))
+    shutil.rmtree(folder)
+    
+  def testScratchStore(self):
+    ''' test memory-mapping of intermediate results and removal of scratch folders in worker processes '''    
+    from processing.process import getScratchStore, closeScratchStore
+    import numpy.ma as ma
+    import tempfile, shutil
+    folder = tempfile.mkdtemp()
+    store = getScratchStore(folder)
+    assert getScratchStore(folder) is store # one store per process
+    data = np.arange(10.); data[3] = np.NaN
+    var = Variable(name='test', units='n/a', axes=(Axis(name='x', units='n/a', coord=np.arange(10)),), data=data)
+    store.spill(var)
+    assert isinstance(ma.getdata(var.data_array), np.memmap)
+    assert var.data_array.mask[3] and var.data_array[4] == 4.
+    assert len(os.listdir(folder)) == 1 and os.listdir(store.folder) == []
+    # worker processes exit without atexit handlers, hence the folder has to be removed explicitly
+    def spillVar():
+      assert getScratchStore(folder) is not store # a new store after fork
+      getScratchStore(folder).spill(Variable(name='test', units='n/a', axes=var.axes, data=np.ones(10)))
+      closeScratchStore()
+    worker = multiprocessing.Process(target=spillVar); worker.start(); worker.join()
+    assert worker.exitcode == 0
+    assert os.listdir(folder) == [os.path.basename(store.folder)]
+    closeScratchStore()
+    assert os.listdir(folder) == [] and var.data_array[4] == 4. # maps remain valid
+    shutil.rmtree(folder)
+    
 
   
 ## tests related to loading datasets
@@ -313,6 +559,28 @@ class DatasetsTest(unittest.TestCase):
     # But diff first, to check for actual updates!
     # P/S at the moment I'm importing the custom nanfunctions directly
     
+  def testExportColumnar(self):
+    ''' test export of station time-series to a columnar (Arrow) file through the export driver '''
+    from processing.export import performExport, pa
+    from processing.misc import getExperimentList
+    from datasets.WRF import loadWRF_StnTS
+    import tempfile, shutil, glob
+    if pa is None: return # pyarrow is optional
+    folder = tempfile.mkdtemp()
+    exp = getExperimentList(['ctrl-1'], None, 'WRF')[0]
+    dataargs = dict(experiment=exp, filetypes=['hydro'], domain=2, station='ecprecip', varlist=None)
+    expargs = dict(format='Arrow', lm3=False, varlist=['MaxPrecip_1d'], project='test', layout='long', 
+                   folder=folder+'/{0:s}/{1:s}/{2:s}/', prefix='{0:s}_{1:s}_{2:s}_{3:s}')
+    assert performExport('WRF', 'time-series', dataargs, expargs, loverwrite=True) == 0
+    filelist = glob.glob(folder+'/test/ecprecip/*/test_ecprecip_*_timeseries.arrow')
+    assert len(filelist) == 1
+    table = pa.ipc.open_file(pa.memory_map(filelist[0])).read_all()
+    assert table.schema.metadata['sample_axis'] == 'station'
+    assert 'MaxPrecip_1d' in table.schema.names and 'time' in table.schema.names
+    ds = loadWRF_StnTS(experiment=exp, domains=2, station='ecprecip', filetypes=['hydro'], varlist=['MaxPrecip_1d'])
+    assert table.num_rows == ds.MaxPrecip_1d.data_array.size 
+    shutil.rmtree(folder)
+    
     
 if __name__ == "__main__":
 
@@ -325,6 +593,7 @@ if __name__ == "__main__":
 #     specific_tests += ['BasicLoadEnsembleTS']
 #     specific_tests += ['AdvancedLoadEnsembleTS']
 #     specific_tests += ['LoadStandardDeviation']
+#     specific_tests += ['ExportColumnar']
 
 
     # list of tests to be performed
@@ -15,7 +15,8 @@ from types import NoneType
 # internal imports
 from geodata.base import Variable
 from geodata.misc import ListError, ArgumentError, isEqual, AxisError
-from plotting.misc import smooth, checkVarlist, getPlotValues, errorPercentile, checkSample
+from plotting.misc import smooth, checkVarlist, getPlotValues, errorPercentile, checkSample, decimateIndex
+from plotting.misc import sampleStatistics
 from collections import OrderedDict
 from utils.misc import binedges, expandArgumentList
 
@@ -64,11 +65,12 @@ class MyAxes(Axes):
                flipxy=None, xlabel=True, ylabel=True, xticks=True, yticks=True, reset_color=None, 
                lparasiteMeans=False, lparasiteErrors=False, parasite_axes=None, lrescale=False, 
                scalefactor=1., offset=0., bootstrap_axis='bootstrap', lprint=False, lfracdiff=False,
-               xlog=False, ylog=False, xlim=None, ylim=None, lsmooth=False, lperi=False,
+               xlog=False, ylog=False, xlim=None, ylim=None, lsmooth=False, lperi=False, decimate=None,
                expand_list=None, lproduct='inner', method='pdf', plotatts=None, **plotargs):
     ''' A function to draw a list of 1D variables into an axes, and annotate the plot based on 
         variable properties; extra keyword arguments (plotargs) are passed through expandArgumentList,
-        before being passed to Axes.plot(). '''
+        before being passed to Axes.plot(). Long lines can be decimated before plotting (see 
+        _decimatePlotValues; decimate can be True, 'minmax', 'lttb' or a number of points). '''
     ## figure out variables
     varlist = checkVarlist(varlist, varname=varname, ndim=1, bins=bins, support=support, 
                            method=method, lignore=lignore, bootstrap_axis=bootstrap_axis)
@@ -123,6 +125,11 @@ class MyAxes(Axes):
           bnd, varunits, bndname = self._getPlotValues(bndvar, lrescale=lrescale, scalefactor=scalefactor, offset=offset,
                                                        checkunits=varunits, lsmooth=lsmooth, lperi=lperi, lshift=False); del bndname
         else: bnd = None
+        # reduce number of points (retaining extrema and error bands)
+        if decimate:
+          bndlines = [] if bnd is None else [val+bnd, val-bnd]
+          errlines = [] if err is None else [val+err, val-err]
+          axe, val, err, bnd = self._decimatePlotValues(axe, [val]+bndlines+errlines, decimate, val, err, bnd)
         # variable and axis scaling is not always independent...
         if var.plot is not None and varax.plot is not None: 
           if varax.units != axunits and var.plot.preserve == 'area':
@@ -192,10 +199,11 @@ class MyAxes(Axes):
                lrescale=False, scalefactor=1., offset=0., bootstrap_axis='bootstrap', band_vars=None,  
                flipxy=None, xlabel=True, ylabel=True, xticks=True, yticks=True, reset_color=None, 
                xlog=None, ylog=None, xlim=None, ylim=None, lsmooth=False, lperi=False, lprint=False, 
-               expand_list=None, lproduct='inner', method='pdf', plotatts=None, **plotargs):
+               decimate=None, expand_list=None, lproduct='inner', method='pdf', plotatts=None, **plotargs):
     ''' A function to draw a colored bands between two lists of 1D variables representing the upper
         and lower limits of the bands; extra keyword arguments (plotargs) are passed through 
-        expandArgumentList, before being passed on to Axes.fill_between() (used to draw bands). '''
+        expandArgumentList, before being passed on to Axes.fill_between() (used to draw bands). 
+        Long bands can be decimated before plotting (see linePlot). '''
     ## figure out variables
     upper = checkVarlist(upper, varname=varname, ndim=1, bins=bins, bootstrap_axis=bootstrap_axis, 
                                support=support, method=method, lignore=lignore)
@@ -249,6 +257,7 @@ class MyAxes(Axes):
         # N.B.: other scaling behavior could be added here
         if lprint: print varname, varunits, np.nanmean(up), np.nanmean(low)           
         if lsmooth: up = smooth(up); low = smooth(low)
+        if decimate: axe, up, low = self._decimatePlotValues(axe, [up, low], decimate, up, low)
         # update plotargs from defaults
         plotarg = self._getPlotArgs(label=label, var=upvar, llabel=llabel, plotatts=plotatts, plotarg=plotarg)
         ## draw actual bands 
@@ -299,10 +308,24 @@ class MyAxes(Axes):
                  xlog=False, ylog=False, xlim=None, ylim=None, lsmooth=False, lprint=False,
                  lignore=False, expand_list=None, lproduct='inner', plotatts=None, method='pdf',
                  where=None, bandalpha=None, edgecolor=None, facecolor=None, bandarg=None, **plotargs):
-    ''' A function to draw moments of a distribution/sample using line-styles and bands '''
+    ''' A function to draw moments of a distribution/sample using line-styles and bands; the mean and 
+        percentiles are computed together, in one pass over the sample (see sampleStatistics) '''
     plts = None # avoid error if no plot
     if color and not colors: colors = color
     elif color and colors: raise ArgumentError
+    # figure out percentiles
+    if percentiles is not None or lmedian:
+      lmedian = lmedian is None or lmedian # default is to plot the median if percentiles are calculated
+      if lmedian:
+        if percentiles is None: percentiles = (0.5,)
+#           raise ArgumentError, "Median only works with percentiles."
+        elif len(percentiles) == 2: 
+          percentiles = (percentiles[0], 0.5, percentiles[1]) # add median to percentiles
+      assert 1 <= len(percentiles) <= 3
+      lpercentiles = True
+    else: lpercentiles = False
+    # without a bootstrap axis, mean and percentiles are computed from the same sample
+    lsame = bootstrap_axis is None and lpercentiles
     # plot mean
     if lmean: 
       # don't overwrite varlist and sample_axis (yet)
@@ -310,10 +333,12 @@ class MyAxes(Axes):
                                         method=method, lignore=lignore, sample_axis=sample_axis, 
                                         temporary_sample_axis='temporary_sample_axis',
                                         bootstrap_axis=bootstrap_axis, lmergeBootstrap=False)
-      means = [] # compute the means over the sample_axis; variables without sample_axis are used as is (and removed later)
-      for var in meanlist:
+      stats = [None if var is None or not var.hasAxis(mean_axis) else 
+               sampleStatistics(var, mean_axis, percentiles=percentiles if lsame else None) for var in meanlist]
+      means = [] # means over the sample_axis; variables without sample_axis are used as is (and removed later)
+      for var,stat in zip(meanlist,stats):
         if var is None: means.append(None)
-        elif var.hasAxis(mean_axis): means.append(var.mean(axis=mean_axis)) 
+        elif stat is not None: means.append(stat[0]) 
         else: 
           var.name += '_mean'; means.append(var) # don't confuse the naming scheme...
       plts = self.linePlot(varlist=means, llabel=llabel, labels=labels, lineformat=mean_fmt, colors=colors,
@@ -328,28 +353,24 @@ class MyAxes(Axes):
       # get line colors to use in all subsequent plots 
       if colors is None:
         colors = ['' if plt is None else plt.get_color() for plt in plts] # color argument has to be string
-    # check and preprocess again, this time merge sample_axis with bootstrap_axis 
-    varlist, sample_axis = checkSample(varlist, varname=varname, bins=bins, support=support, 
-                                       method=method, lignore=lignore, sample_axis=sample_axis, 
-                                       temporary_sample_axis='temporary_sample_axis',
-                                       bootstrap_axis=bootstrap_axis, lmergeBootstrap=True)
-    # remove variables that don't have the sample axis (replace with None)
-    varlist = [None if var is None or not var.hasAxis(sample_axis) else var for var in varlist]
-    # determine percentiles along bootstrap axis
-    if percentiles is not None or lmedian:
-      lmedian = lmedian is None or lmedian # default is to plot the median if percentiles are calculated
-      if lmedian:
-        if percentiles is None: percentiles = (0.5,)
-#           raise ArgumentError, "Median only works with percentiles."
-        elif len(percentiles) == 2: 
-          percentiles = (percentiles[0], 0.5, percentiles[1]) # add median to percentiles
-      # compute percentiles
-      assert 1 <= len(percentiles) <= 3
-      qvars = [None if var is None else var.percentile(q=percentiles, axis=sample_axis) for var in varlist]
+    # determine percentiles along sample (and bootstrap) axis
+    if lpercentiles:
+      if lmean and lsame: # already computed with the means
+        qvars = [None if stat is None else stat[1] for stat in stats]
+      else:
+        # check and preprocess again, this time merge sample_axis with bootstrap_axis 
+        varlist, sample_axis = checkSample(varlist, varname=varname, bins=bins, support=support, 
+                                           method=method, lignore=lignore, sample_axis=sample_axis, 
+                                           temporary_sample_axis='temporary_sample_axis',
+                                           bootstrap_axis=bootstrap_axis, lmergeBootstrap=True)
+        # compute percentiles (skip variables that don't have the sample axis)
+        qvars = [None if var is None or not var.hasAxis(sample_axis) else 
+                 sampleStatistics(var, sample_axis, percentiles=percentiles, lmean=False)[1] for var in varlist]
+      # N.B.: qvars are lists of percentile Variables (slices of the same array)
       # add median plot
       if lmedian:
-        mdslc = dict(percentile=1 if len(percentiles) == 3 else 0, lidx=True)  
-        meadians = [None if var is None else var(**mdslc) for var in qvars]
+        imd = 1 if len(percentiles) == 3 else 0 
+        meadians = [None if qvar is None else qvar[imd] for qvar in qvars]
         if median_fmt == '' and lmean: median_fmt = '--'
         tmpplts = self.linePlot(varlist=meadians, lineformat=median_fmt, llabel=llabel, labels=labels, 
                                 legend=legend, xlabel=xlabel, ylabel=ylabel, xticks=xticks, yticks=yticks,
@@ -363,10 +384,9 @@ class MyAxes(Axes):
             colors = ['' if plt is None else plt.get_color() for plt in plts] # color argument has to be string
       # percentile band
       if len(percentiles) > 1:
-        upslc = dict(percentile=2 if lmedian else 1, lidx=True)
-        uppers = [None if var is None else var(**upslc) for var in qvars]
-        loslc = dict(percentile=0, lidx=True) 
-        lowers = [None if var is None else var(**loslc) for var in qvars]
+        iup = 2 if lmedian else 1
+        uppers = [None if qvar is None else qvar[iup] for qvar in qvars]
+        lowers = [None if qvar is None else qvar[0] for qvar in qvars]
         # plot percentiles as error bands
         facecolor = facecolor or colors
         lsmoothBand = True if lsmooth or lsmooth is None else False
@@ -714,6 +734,22 @@ class MyAxes(Axes):
       if lshift: val += vlim[0]  
     return val, varunits, varname
   
+  def _decimatePlotValues(self, axe, lines, decimate, *values):
+    ''' reduce the number of points of long lines to about two per pixel of the axes (at the print 
+        resolution of the figure), retaining the extrema of all lines; returns the decimated axis and 
+        values (None values are passed through) '''
+    if decimate is True: decimate = 'minmax'
+    if isinstance(decimate,basestring):
+      bbox = self.get_window_extent() # in pixels at screen resolution
+      dpi = max(self.figure.dpi, (getattr(self.figure,'print_setings',None) or dict()).get('dpi',0))
+      npts = 2*int( ( bbox.height if self.flipxy else bbox.width ) * dpi / self.figure.dpi )
+      method = decimate
+    elif isinstance(decimate,(int,np.integer)): npts = decimate; method = 'minmax'
+    else: raise TypeError, decimate
+    if len(axe) <= npts: return (axe,)+values # nothing to do
+    idx = decimateIndex(axe, lines, npts, method=method)
+    return (axe[idx],)+tuple(None if val is None else val[idx] for val in values)
+  
   def _getPlotLabels(self, varlist):
     ''' figure out reasonable plot labels based variable and dataset names '''
     # make list without None's for checking uniqueness
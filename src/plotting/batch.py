@@ -0,0 +1,119 @@
+'''
+Created on 2016-04-11
+
+A batch rendering mode for figures: figures are described by FigureSpec instances (arguments for
+getFigAx, a plot function that draws into the axes, and arguments for MyFigure.save), which are
+rendered in parallel by a pool of persistent workers with a non-interactive (Agg) backend. Workers
+keep datasets (see loadCached) and MapSetup instances (see plotting.mapsetup.getMapSetup) in their
+caches across figures, and figures with the same affinity key (e.g. the same dataset or map) are
+routed to the same worker (see AffinityPool in processing.multiprocess).
+
+Plot functions are called as plotfct(fig, axes, **plotargs) and have to be defined at module level,
+so that they can be passed to the worker processes, e.g.:
+
+  def plotMap(fig, ax, varname=None, exp=None):
+    dataset = loadCached(exp, lambda: loadWRF(experiment=exp, ...))
+    ...
+  specs = [FigureSpec(plotMap, filename=(exp,'T2'), varname='T2', exp=exp, affinity=exp) for exp in exps]
+  ec = renderFigures(specs, NP=4, folder=figure_folder)
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import traceback
+from time import time
+# internal imports
+from plotting.figure import getFigAx
+from processing.multiprocess import AffinityPool
+import utils.cache as cache
+
+
+class FigureSpec(object):
+  ''' The specification of a figure that can be rendered by a batch worker. '''
+
+  def __init__(self, plotfct, filename=None, subplot=1, folder=None, affinity=None, figargs=None,
+               saveargs=None, **plotargs):
+    ''' Save plot function and arguments; filename can be a string or a list of name components (see
+        MyFigure.save); figargs are passed to getFigAx and saveargs to MyFigure.save '''
+    if not callable(plotfct): raise TypeError
+    if filename is None: raise ValueError, 'A filename is required for batch rendering.'
+    self.plotfct = plotfct
+    self.filename = tuple(filename) if isinstance(filename,(list,tuple)) else (filename,)
+    self.subplot = subplot
+    self.folder = folder
+    self.affinity = affinity # e.g. dataset or map name
+    self.figargs = figargs or dict()
+    self.saveargs = saveargs or dict()
+    self.plotargs = plotargs
+
+  @property
+  def name(self): return '_'.join(str(name) for name in self.filename if name is not None)
+
+
+## functions that run in the worker processes
+
+def loadCached(key, loadfct, filelist=None):
+  ''' Load a dataset through the dataset cache of the worker (datasets are reused across figures;
+      if a filelist is given, the dataset is reloaded, when one of the files changes). '''
+  return cache.cachedLoad('datasets', key, filelist or [], loadfct)
+
+def initRenderWorker(backend='Agg'):
+  ''' Initialize a render worker: switch to a non-interactive backend and enable caching. '''
+  import matplotlib.pyplot as plt
+  plt.switch_backend(backend)
+  cache.enableCaching()
+
+def renderFigure(spec, folder=None):
+  ''' Create a figure, draw it using the plot function of the spec, and save it; returns the name of
+      the figure, the file path (None, if an error occurred), the render time and the traceback. '''
+  import matplotlib.pyplot as plt
+  t0 = time(); fig = None
+  try:
+    fig,axes = getFigAx(spec.subplot, name=spec.name, **spec.figargs)
+    spec.plotfct(fig, axes, **spec.plotargs)
+    folder = spec.folder or folder
+    saveargs = spec.saveargs.copy(); saveargs.setdefault('filetype','png')
+    filepath = fig.save(*spec.filename, folder=folder, **saveargs)
+    err = None
+  except Exception:
+    filepath = None; err = traceback.format_exc() # traceback objects can't be pickled
+  finally:
+    if fig is not None: plt.close(fig) # free memory
+  return spec.name, filepath, time()-t0, err
+
+
+## batch rendering
+
+def renderFigures(specs, NP=None, folder=None, lfeedback=True, ldebug=False):
+  ''' Render a list of FigureSpec instances on NP worker processes (NP=1 renders serially in the
+      current process); folder is the default figure folder. If ldebug is True, the first error is
+      raised, otherwise errors are reported and rendering continues. Returns the number of failures
+      as the exit code. '''
+  if not isinstance(specs,(list,tuple)) or not all(isinstance(spec,FigureSpec) for spec in specs): raise TypeError
+  if NP is not None and not isinstance(NP,int): raise TypeError
+  t0 = time()
+  if NP == 1:
+    cache.enableCaching() # in this process (the backend is not changed)
+    try: results = [renderFigure(spec, folder=folder) for spec in specs]
+    finally: cache.disableCaching() # close cached files and release map setups
+  else:
+    pool = AffinityPool(processes=NP, initializer=initRenderWorker)
+    try:
+      asyncs = [pool.apply_async(renderFigure, (spec,), dict(folder=folder), affinity=spec.affinity) for spec in specs]
+      results = [result.get() for result in asyncs]
+    except:
+      pool.terminate(); raise
+    pool.close(); pool.join()
+  # report results
+  ec = 0
+  for name,filepath,rtime,err in results:
+    if err is None:
+      if lfeedback: print("Saved figure '{:s}' ({:.1f} s)".format(filepath,rtime))
+    else:
+      ec += 1
+      if ldebug: raise RuntimeError, "Error rendering figure '{:s}':\n{:s}".format(name,err)
+      print("\n   ###   Error rendering figure '{:s}'   ###   \n{:s}".format(name,err))
+  if lfeedback:
+    print('\n   ===   Rendered {:d} of {:d} figures in {:.1f} s   ===   \n'.format(len(specs)-ec,len(specs),time()-t0))
+  return ec
@@ -234,7 +234,7 @@ class MyFigure(Figure):
   
   # save figure
   def save(self, *args, **kwargs):
-    ''' save figure with some sensible default settings '''
+    ''' save figure with some sensible default settings; returns the file path '''
     if len(args) == 0: raise ArgumentError
     # get option
     folder = kwargs.pop('folder', None)
@@ -260,6 +260,7 @@ class MyFigure(Figure):
       filename = '{:s}/{:s}'.format(folder,filename)
       if lfeedback: print("('{:s}')".format(folder))
     self.savefig(filename, **sf) # save figure to pdf
+    return filename
 
 
 ## convenience function to return a figure and an array of ImageGrid axes
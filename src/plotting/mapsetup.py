@@ -4,14 +4,30 @@ Created on 2013-11-08
 This module defines a MapSetup Class that carries parameters concerning map setup and annotation.
 The class is intended for use the with plotting functions in this package.      
 
+Projected grid coordinates and ocean masks are cached by MapSetup instances, keyed by a fingerprint of
+the map projection and a fingerprint of the lon/lat grid; if the MapSetup has a cache folder (e.g. 
+the pickle folder of getMapSetup), they are also saved to disk, so that repeated map plots of the same 
+domain skip all projection work (the Basemap with its coastlines is saved with the pickled MapSetup).
+
 @author: Andre R. Erler, GPL v3
 '''
 
-import pickle, os
-from mpl_toolkits.basemap import Basemap
+import pickle, os, json, hashlib
+import numpy as np
+import numpy.ma as ma
+from mpl_toolkits.basemap import Basemap, maskoceans
+import utils.cache as cache
 
 rsphere = (6378137.00, 6356752.3142)
 
+def getGridKey(lon, lat):
+  ''' return a fingerprint of a grid, based on the 2D lon/lat coordinate fields '''
+  sha = hashlib.sha1()
+  for coord in (lon,lat):
+    coord = np.ascontiguousarray(coord, dtype=np.float64)
+    sha.update(str(coord.shape)); sha.update(coord.tostring())
+  return sha.hexdigest()
+
 class MapSetup(object):
   ''' The MapSetup class that carries parameters concerning map setup and annotation and contains methods 
       to annotate map or axes objects with these data. '''
@@ -39,7 +55,62 @@ class MapSetup(object):
     self.scale = scale
     # more annotation
     self.point_markers = point_markers
+    # cache for projected geometry
+    self.cache_folder = None # folder to save projected geometry (set by getMapSetup)
+    self._geometry = dict()
      
+  def __getstate__(self):
+    ''' don't pickle cached geometry (it is saved separately) '''
+    state = self.__dict__.copy()
+    state.pop('_geometry', None)
+    return state
+  
+  def __setstate__(self, state):
+    ''' initialize geometry cache (also for old pickles) '''
+    self.__dict__.update(state)
+    self.__dict__.setdefault('cache_folder', None)
+    self._geometry = dict()
+    
+  def getMapKey(self):
+    ''' return a fingerprint of the map projection '''
+    mapid = dict(name=self.name, projection=self.projection, resolution=self.resolution, grid=self.grid)
+    return hashlib.sha1(json.dumps(mapid, sort_keys=True, default=str)).hexdigest()
+  
+  def _loadGeometry(self, kind, lon, lat, computefct):
+    ''' load cached geometry from memory or disk, or compute it and save it to the cache '''
+    key = (kind, getGridKey(lon, lat))
+    if key in self._geometry: return self._geometry[key]
+    filename = None
+    if self.cache_folder is not None:
+      filename = '{:s}/{:s}_{:s}_{:s}.npz'.format(self.cache_folder, kind, self.getMapKey()[:16], key[1][:16])
+    if filename is not None and os.path.exists(filename):
+      npz = np.load(filename)
+      geometry = tuple(npz['arr_{:d}'.format(i)] for i in xrange(len(npz.files)))
+      npz.close()
+    else:
+      geometry = computefct()
+      if filename is not None:
+        tmpfile = filename[:-4] + '.{:d}.tmp.npz'.format(os.getpid()) # np.savez appends .npz
+        np.savez(tmpfile, *geometry); os.rename(tmpfile, filename) # atomic, for parallel workers
+    self._geometry[key] = geometry
+    return geometry
+  
+  # project grid
+  def projectGrid(self, lon, lat):
+    ''' convert 2D lon/lat fields to map-native coordinates (cached) '''
+    return self._loadGeometry('xy', lon, lat, lambda: tuple(self.basemap(lon,lat)))
+  
+  # ocean mask
+  def getOceanMask(self, lon, lat):
+    ''' return a boolean mask that is True over oceans and inland water bodies (cached) '''
+    computefct = lambda: (ma.getmaskarray(maskoceans(lon, lat, np.zeros(np.shape(lon)), 
+                                                     resolution=self.resolution, grid=self.grid)),)
+    return self._loadGeometry('ocean', lon, lat, computefct)[0]
+  
+  def maskOceans(self, lon, lat, data):
+    ''' mask data over oceans and inland water bodies (like Basemap's maskoceans, but cached) '''
+    return ma.array(data, mask=ma.getmaskarray(data) | self.getOceanMask(lon, lat))
+  
   # get projection
   def getProjectionSettings(self):
     ''' return elements of the projection dict and a bit more; mostly legacy '''
@@ -95,7 +166,16 @@ class MapSetup(object):
 
 ## function that serves a MapSetup instance with complementary pickles
 def getMapSetup(lpickle=False, folder=None, name=None, lrm=False, **kwargs):
-  ''' function that serves a MapSetup instance with complementary pickles '''
+  ''' function that serves a MapSetup instance with complementary pickles; if caching is enabled (e.g. in 
+      batch rendering workers), instances are reused '''
+  if not lrm and cache.isEnabled('mapsetups'):
+    key = json.dumps(dict(kwargs, lpickle=lpickle, folder=folder, name=name), sort_keys=True, default=str)
+    return cache.cachedLoad('mapsetups', key, [], 
+                            lambda: _loadMapSetup(lpickle=lpickle, folder=folder, name=name, lrm=lrm, **kwargs))
+  return _loadMapSetup(lpickle=lpickle, folder=folder, name=name, lrm=lrm, **kwargs)
+
+def _loadMapSetup(lpickle=False, folder=None, name=None, lrm=False, **kwargs):
+  ''' load a MapSetup instance from a pickle or create a new one (see getMapSetup) '''
   # handle pickling
   if lpickle:
     if not isinstance(folder,basestring): raise TypeError 
@@ -116,5 +196,7 @@ def getMapSetup(lpickle=False, folder=None, name=None, lrm=False, **kwargs):
   else:
     # instantiate object
     mapSetup = MapSetup(name=name, **kwargs)
+  # save projected geometry with the pickles
+  if folder is not None: mapSetup.cache_folder = folder
   # return MapSetup instance
   return mapSetup
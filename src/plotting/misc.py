@@ -15,6 +15,7 @@ from types import NoneType
 from geodata.base import Variable, Dataset, Ensemble
 from geodata.misc import VariableError, AxisError
 from utils.misc import evalDistVars
+import utils.nanfunctions as nf
 from utils.signalsmooth import smooth # commonly used in conjunction with plotting...
 
 # import matplotlib as mpl
@@ -166,6 +167,77 @@ def getPlotValues(var, checkunits=None, checkname=None, lsmooth=False, lperi=Fal
   # return values, units, name
   return val, varunits, varname     
 
+# summary statistics of a sample
+def sampleStatistics(var, sample_axis, percentiles=None, lmean=True):
+  ''' Compute the mean and several percentiles of a Variable along a sample axis in one pass over the
+      data (the percentiles are computed together, so that the sample is only partitioned once);
+      returns the mean (None, if lmean is False) and a list of percentile Variables, which are created
+      from slices of the same result array (the other axes are preserved). '''
+  axidx = var.axisIndex(sample_axis)
+  data = var.getArray(unmask=True, fillValue=np.NaN, copy=False)
+  data = np.rollaxis(data, axidx) # sample axis first
+  axes = var.axes[:axidx] + var.axes[axidx+1:]
+  mean = None; qvars = []
+  if lmean:
+    mean = var.copy(axes=axes, data=nf.nanmean(data, axis=0), atts=dict(var.atts, name='{:s}_mean'.format(var.name)))
+  if percentiles:
+    qdata = np.percentile(data, [100.*q for q in percentiles], axis=0) # same as Variable.percentile
+    qatts = dict(var.atts, name='{:s}_q'.format(var.name))
+    qvars = [var.copy(axes=axes, data=qdata[i], atts=qatts.copy()) for i in xrange(len(percentiles))]
+  return mean, qvars
+
+# data reduction for long lines
+def _minmaxIndex(y, nbins):
+  ''' indices of the minimum and maximum in each of nbins (equal-count) bins; NaNs are ignored '''
+  n = len(y); bins = np.repeat(np.arange(nbins), np.diff(np.linspace(0, n, nbins+1).astype(np.int)))
+  nan = np.isnan(y)
+  first = np.searchsorted(bins, np.arange(nbins)) # first position of each bin in sorted order
+  imin = np.lexsort((np.where(nan, np.inf, y), bins))[first] # sort by bin, then value
+  imax = np.lexsort((np.where(nan, -np.inf, -y), bins))[first]
+  return np.concatenate((imin,imax))
+
+def _lttbIndex(x, y, npts):
+  ''' indices selected by the Largest-Triangle-Three-Buckets algorithm (Steinarsson, 2013); the first
+      and last points are always selected, and one point from each bucket in between '''
+  n = len(y)
+  if npts >= n or npts < 3: return np.arange(n)
+  edges = np.linspace(1, n-1, npts-1).astype(np.int) # buckets between first and last point
+  index = np.zeros(npts, dtype=np.int); index[-1] = n-1
+  for i in xrange(npts-2):
+    lo,hi = edges[i],max(edges[i+1],edges[i]+1)
+    # average of the next bucket (or the last point)
+    nlo,nhi = hi,(edges[i+2] if i+2 < len(edges) else n)
+    xavg = x[nlo:max(nhi,nlo+1)].mean(); yavg = y[nlo:max(nhi,nlo+1)].mean()
+    # choose point that forms the largest triangle with the previous selection and the average
+    xa = x[index[i]]; ya = y[index[i]]
+    area = np.abs( (xa - xavg)*(y[lo:hi] - ya) - (xa - x[lo:hi])*(yavg - ya) )
+    index[i+1] = lo + np.argmax(area)
+  return index
+
+def decimateIndex(x, ylist, npts, method='minmax'):
+  ''' Return a sorted index array that reduces a line (or several lines with the same support) to 
+      about npts points; the first and last point and the extrema of every line are always retained, 
+      as well as the beginning of gaps (NaN), so that lines are not connected across gaps. 
+      Methods are 'minmax' (minimum and maximum in npts/2 bins, i.e. one bin per pixel) and 'lttb'
+      (Largest-Triangle-Three-Buckets, which preserves the visual shape). '''
+  if isinstance(ylist,np.ndarray): ylist = [ylist]
+  n = len(x)
+  if n <= npts: return np.arange(n)
+  x = np.asarray(x, dtype=np.float64)
+  index = [np.array([0,n-1])]
+  for y in ylist:
+    y = np.asarray(y, dtype=np.float64)
+    if y.shape != x.shape: raise AxisError, "Line and axis values have incompatible shapes."
+    nan = np.isnan(y)
+    if method.lower() == 'minmax': index.append(_minmaxIndex(y, max(npts//2,1)))
+    elif method.lower() == 'lttb': 
+      valid = np.flatnonzero(~nan)
+      if len(valid): index.append(valid[_lttbIndex(x[valid], y[valid], npts)])
+    else: raise ValueError, "Unknown decimation method '{:s}'.".format(method)
+    if not nan.all(): index.append(np.array([np.nanargmin(y),np.nanargmax(y)])) # global extrema
+    index.append(np.flatnonzero(nan & ~np.concatenate(([False],nan[:-1])))) # beginning of gaps
+  return np.unique(np.concatenate(index))
+
   
 # Log-axis ticks
 def logTicks(ticks, base=None, power=0):
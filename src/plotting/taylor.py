@@ -17,10 +17,14 @@ class TaylorDiagram(object):
     r=stddev and theta=arccos(correlation).
     """
 
-    def __init__(self, refsample):
-        """refsample is the reference (data) sample to be compared to."""
+    def __init__(self, refsample=None, refstd=None):
+        """refsample is the reference (data) sample to be compared to;
+        alternatively, only the standard deviation of the reference can
+        be given. Without either, the diagram is normalized (refstd=1)."""
 
-        self.ref = NP.asarray(refsample)
+        if refsample is None and refstd is None: refstd = 1.
+        self.ref = None if refsample is None else NP.asarray(refsample)
+        self.refstd = self.ref.std() if refstd is None else refstd
 
     def setup_axes(self, fig, rect=111):
         """Set up Taylor diagram axes, i.e. single quadrant polar
@@ -45,7 +49,7 @@ class TaylorDiagram(object):
 
         ghelper = FA.GridHelperCurveLinear(tr,
                                            extremes=(0,NP.pi/2, # 1st quadrant
-                                                     0,1.5*self.ref.std()),
+                                                     0,1.5*self.refstd),
                                            grid_locator1=gl1,
                                            tick_formatter1=tf1,
                                            )
@@ -76,10 +80,10 @@ class TaylorDiagram(object):
         self.ax = ax.get_aux_axes(tr)   # Polar coordinates
 
         # Add reference point and stddev contour
-        print "Reference std:", self.ref.std()
-        self.ax.plot([0],self.ref.std(),'ko', label='_')
+        print "Reference std:", self.refstd
+        self.ax.plot([0],self.refstd,'ko', label='_')
         t = NP.linspace(0,NP.pi/2)
-        r = NP.zeros_like(t) + self.ref.std()
+        r = NP.zeros_like(t) + self.refstd
         self.ax.plot(t,r,'k--', label='_')
 
         return self.ax
@@ -88,6 +92,10 @@ class TaylorDiagram(object):
         """Computes theta=arccos(correlation),rad=stddev of sample
         wrt. reference sample."""
 
+        if self.ref is None:
+            raise ValueError("Samples can only be compared to a reference "
+                             "sample (only refstd was given); use "
+                             "plot_skill for precomputed statistics.")
         std = NP.std(sample)
         corr = NP.corrcoef(self.ref, sample) # [[1,rho],[rho,1]]
         theta = NP.arccos(corr[0,1])
@@ -105,6 +113,30 @@ class TaylorDiagram(object):
 
         return l
 
+    def plot_skill(self, skill, varname, season=None, lnormalize=True,
+                   lannotate=True, *args, **kwargs):
+        """Add all members of a SkillMatrix (see geodata.skill) for one
+        variable and season to the Taylor diagram, without recomputing
+        any statistics; if lnormalize is True, standard deviations are
+        normalized by the reference and scaled to refstd, so that the
+        reference point corresponds to a ratio of 1. Members are labeled
+        with their names. args and kwargs are directly propagated to
+        the plot command."""
+
+        theta,radius = skill.getTaylorCoords(varname, season=season,
+                                             lnormalize=lnormalize)
+        if lnormalize: radius = radius * self.refstd # ratio 1 is the reference
+        lines = []
+        for t,r,name in zip(theta,radius,skill.names):
+            if not (NP.isfinite(t) and NP.isfinite(r)): continue
+            l, = self.ax.plot(t,r, *args, label=name, **kwargs)
+            if lannotate:
+                self.ax.annotate(name, xy=(t,r), xytext=(3,3),
+                                 textcoords='offset points', size='small')
+            lines.append(l)
+
+        return lines
+
 
 if __name__=='__main__':
 
@@ -38,6 +38,13 @@ if not os.path.isdir(workdir): raise IOError, workdir
 # stylesheet = None
 figargs = dict(stylesheet='myggplot', lpresentation=True, lpublication=False)
 
+# plot function for batch rendering test (has to be defined at module level)
+def batchLinePlot(fig, ax, slope=1., ylim=None):
+  ''' draw a simple line plot (fails, if ylim is not a tuple) '''
+  x = np.linspace(0,10,11)
+  ax.plot(x, slope*x)
+  ax.set_ylim(*ylim)
+
 
 class LinePlotTest(unittest.TestCase):  
    
@@ -209,6 +216,35 @@ class LinePlotTest(unittest.TestCase):
     # add a line
     ax.addHline(3)
     
+  def testDecimatedLinePlot(self):
+    ''' test decimation of a long line plot '''
+    from plotting.misc import decimateIndex
+    fig,ax = getFigAx(1, name=sys._getframe().f_code.co_name[4:], **figargs) # use test method name as title
+    x = np.linspace(0,100,100000); xax = Axis(name='X-Axis', units='X Units', coord=x)
+    data = np.sin(x) + np.random.randn(len(x))/10.; data[500:510] = np.NaN
+    var = Variable(axes=(xax,), data=data, atts=dict(name='blue', units='units'))
+    for method in ('minmax','lttb'):
+      idx = decimateIndex(x, data, 1000, method=method)
+      assert len(idx) <= 1010 and idx[0] == 0 and idx[-1] == len(x)-1
+      assert np.nanmax(data[idx]) == np.nanmax(data) and np.nanmin(data[idx]) == np.nanmin(data)
+      assert np.isnan(data[idx]).sum() == 1 # line is broken at the gap
+    plts = ax.linePlot([var], decimate=True)
+    assert len(plts) == 1 and len(plts[0].get_xdata()) < len(x)/10
+    
+  def testBatchRendering(self):
+    ''' test parallel rendering of figure specs '''
+    from plotting.batch import FigureSpec, renderFigures
+    import tempfile, shutil
+    folder = tempfile.mkdtemp()
+    try:
+      specs = [FigureSpec(batchLinePlot, filename=('batch',i), slope=i, ylim=(0,100), affinity=i%2) for i in xrange(4)]
+      specs.append(FigureSpec(batchLinePlot, filename='error', ylim=None)) # fails
+      ec = renderFigures(specs, NP=2, folder=folder, lfeedback=False)
+      assert ec == 1
+      assert sorted(os.listdir(folder)) == ['batch_{:d}.png'.format(i) for i in xrange(4)]
+      assert renderFigures(specs[:1], NP=1, folder=folder, lfeedback=False) == 0
+    finally: shutil.rmtree(folder)
+    
     
 class DistPlotTest(unittest.TestCase):  
    
@@ -302,6 +338,19 @@ class DistPlotTest(unittest.TestCase):
     ax.addLabel(label=pstr, loc=1, lstroke=False, lalphabet=True, size=None, prop=None)
 
 
+  def testSampleStatistics(self):
+    ''' test combined computation of mean and percentiles '''
+    from plotting.misc import sampleStatistics
+    var = self.var1.insertAxis(axis='sample', iaxis=0, length=20)
+    var.data_array += np.random.randn(*var.shape)
+    percentiles = (0.25,0.5,0.75)
+    mean, qvars = sampleStatistics(var, 'sample', percentiles=percentiles)
+    assert mean.name == var.name+'_mean' and len(qvars) == len(percentiles)
+    assert isEqual(mean[:], var.mean(axis='sample')[:])
+    ref = var.percentile(q=percentiles, axis='sample')
+    for i,qvar in enumerate(qvars):
+      assert qvar.shape == mean.shape and isEqual(qvar[:], np.take(ref[:], i, axis=ref.axisIndex('percentile')))
+    
   def testSamplePlot(self):
     ''' test a line and band plot showing the mean/median and given percentiles '''    
     fig,ax = getFigAx(1, name=sys._getframe().f_code.co_name[4:], **figargs) # use test method name as title
@@ -354,10 +403,13 @@ if __name__ == "__main__":
 #     specific_tests += ['CombinedLinePlot']
 #     specific_tests += ['AxesGridLinePlot']    
 #     specific_tests += ['MeanAxisPlot']
+#     specific_tests += ['DecimatedLinePlot']
+#     specific_tests += ['BatchRendering']
     # DistPlot
 #     specific_tests += ['BasicHistogram']
 #     specific_tests += ['BootstrapCI']
 #     specific_tests += ['SamplePlot']
+#     specific_tests += ['SampleStatistics']
     
     # list of tests to be performed
     tests = [] 
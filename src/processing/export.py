@@ -7,18 +7,25 @@ A script to convert datasets to raster format using GDAL.
 '''
 
 # external imports
-import os, shutil # check if files are present etc.
+import os, shutil, json # check if files are present etc.
 import numpy as np
+import numpy.ma as ma
 from importlib import import_module
 from datetime import datetime
+from itertools import product
+from multiprocessing.pool import ThreadPool
 import logging     
+from osgeo import gdal
+try: import pyarrow as pa # only for columnar export (optional)
+except ImportError: pa = None
 # internal imports
 from geodata.base import Dataset
 from geodata.gdal import addGDALtoDataset, addGDALtoVar
 from geodata.misc import DateError, printList, ArgumentError, VariableError,\
-  GDALError
+  GDALError, DatasetError
 from datasets import gridded_datasets
-from processing.multiprocess import asyncPoolEC
+from processing.multiprocess import asyncPoolEC, Job
+from processing.jobqueue import runQueue
 from processing.misc import getMetaData,  getExperimentList, loadYAML, getTargetFile
 # new variable functions
 import processing.newvars as newvars
@@ -159,6 +166,305 @@ class ASCII_raster(FileFormat):
     if not os.path.exists(filedict.values()[0][0]): raise IOError, filedict.values()[0][0] # random check
     if not os.path.exists(filedict.values()[-1][-1]): raise IOError, filedict.values()[-1][-1] # random check
 
+class RasterBulk(ASCII_raster):
+  ''' A class to handle bulk exports to raster formats: either ASCII raster files (one per band, with the 
+      same names as ASCII_raster), which are written directly, or one multi-band GeoTIFF file per variable; 
+      files are written by a pool of threads (see exportRasterBulk). '''
+  
+  def __init__(self, project=None, folder=None, prefix=None, driver='AAIGrid', NT=None, **expargs):
+    ''' take arguments that have been passed from caller and initialize parameters '''
+    super(RasterBulk,self).__init__(project=project, folder=folder, prefix=prefix, **expargs)
+    self.driver = driver; self.NT = NT
+    
+  def exportDataset(self, dataset):
+    ''' method to write all GDAL-enabled variables of a Dataset instance to raster files '''
+    filedict = exportRasterBulk(dataset, folder=self.folder, prefix=self.prefix, driver=self.driver, 
+                                NT=self.NT, **self.export_arguments)
+    # check first and last
+    if not os.path.exists(filedict.values()[0][0]): raise IOError, filedict.values()[0][0] # random check
+    if not os.path.exists(filedict.values()[-1][-1]): raise IOError, filedict.values()[-1][-1] # random check
+
+class Columnar(FileFormat):
+  ''' A class to handle exports of station and shape time series (e.g. '_stnts' and '_shpts' datasets) to 
+      a columnar format (Arrow IPC files, which can be read as Feather V2 files); station and shape 
+      metadata become columns, and the time series are stored in 'long' or 'wide' layout (see writeColumnar); 
+      the station or shape name takes the place of the grid in the folder and prefix patterns. '''
+  
+  def __init__(self, project=None, folder=None, prefix=None, layout='long', ext='.arrow', **expargs):
+    ''' take arguments that have been passed from caller and initialize parameters '''
+    if pa is None: raise ImportError, "The columnar export format requires the 'pyarrow' module."
+    self.project = project; self.folder_pattern = folder; self.prefix_pattern = prefix
+    self.layout = layout; self.ext = ext
+    self.export_arguments = expargs
+      
+  def defineDataset(self, name=None, dataset=None, mode=None, dataargs=None, lwrite=True, ldebug=False):
+    ''' a method to set exteral parameters about the Dataset, so that the export destination
+        can be determined (and returned) '''
+    # extract variables
+    dataset_name = dataargs.dataset_name; periodstr = dataargs.periodstr
+    grid = dataargs.station or dataargs.shape; domain = dataargs.domain
+    if not grid: raise DatasetError, "The columnar format requires a station or shape dataset."
+    # assemble specific names
+    expname = '{:s}_d{:02d}'.format(dataset_name,domain) if domain else dataset_name
+    expprd = 'clim_{:s}'.format(periodstr) if periodstr else 'timeseries'
+    # insert into patterns 
+    folder = self.folder_pattern.format(self.project, grid, expname, expprd)
+    filename = self.prefix_pattern.format(self.project, grid, expname, expprd) + self.ext
+    if ldebug: filename = 'test_{:s}'.format(filename)
+    self.filepath = '{:s}/{:s}'.format(folder,filename)
+    return self.filepath
+
+  def prepareDestination(self, srcage=None, loverwrite=False):
+    ''' create the destination folder, as necessary, and check if source is newer (for skipping) '''
+    folder = os.path.dirname(self.filepath)
+    if not os.path.exists(folder): os.makedirs(folder)
+    if os.path.exists(self.filepath):
+      if loverwrite:
+        os.remove(self.filepath); lskip = False
+      else:
+        age = datetime.fromtimestamp(os.path.getmtime(self.filepath))
+        lskip = ( age > srcage ) # skip if newer than source
+    else: lskip = False    
+    # return with a decision on skipping
+    return lskip 
+    
+  def exportDataset(self, dataset):
+    ''' method to write the time series of a station or shape Dataset to a columnar file '''
+    writeColumnar(dataset, self.filepath, layout=self.layout, **self.export_arguments)
+    if not os.path.exists(self.filepath): raise IOError, self.filepath
+
+  
+## bulk raster export (one array operation per variable, instead of one GDAL dataset per slice)
+
+def getRasterBands(var, wrap360=False, fillValue=None):
+  ''' return the data of a GDAL-enabled variable as a contiguous array of bands (bands, ny, nx), which is 
+      oriented with the upper-left corner as reference (dy < 0), along with the corresponding geotransform 
+      and the fill value (None, if there are no masked values); this is equivalent to getGDAL with 
+      lupperleft=True, but all bands are flipped, cast and filled in one operation '''
+  if not var.gdal: raise GDALError, "Variable '{:s}' is not GDAL-enabled.".format(var.name)
+  if var.axisIndex(var.xlon) != var.ndim-1 or var.axisIndex(var.ylat) != var.ndim-2:
+    raise NotImplementedError, "Horizontal axes have to be the last indices."
+  if not var.data: var.load()
+  ny,nx = var.mapSize
+  data = var.data_array.reshape((-1,ny,nx)) # a view, if possible
+  geotransform = list(var.geotransform)
+  # shift longitudes from 0-360 to -180-180 (see getGDAL)
+  if wrap360:
+    shift = int( 180. / geotransform[1] )
+    data = np.roll(data, shift, axis=2) # N.B.: np.roll also works with masked arrays
+    geotransform[0] = geotransform[0] - shift*geotransform[1]
+  # use upper-left corner as reference (flip is only a view)
+  if geotransform[5] > 0:
+    geotransform[3] = geotransform[3] + ny*geotransform[5]; geotransform[5] = -1*geotransform[5]
+    data = data[:,::-1,:]
+  # cast data types the same way as getGDAL
+  dtype = np.dtype(var.dtype)
+  if dtype in (np.float32, np.float64, np.int16, np.int32): pass
+  elif np.issubdtype(dtype,np.inexact): dtype = np.dtype('f4')
+  elif np.issubdtype(dtype,np.integer) or np.issubdtype(dtype,np.bool_): dtype = np.dtype('i2')
+  else: raise TypeError, 'Cannot translate numpy data type into GDAL data type!'
+  # one contiguous copy that applies flip and cast at once; masked values are filled in-place
+  bands = np.ascontiguousarray(ma.getdata(data), dtype=dtype)
+  mask = ma.getmask(data)
+  if mask is not ma.nomask and mask.any():
+    if fillValue is None: fillValue = var.fillValue if var.fillValue is not None else ma.default_fill_value(dtype)
+    np.copyto(bands, fillValue, where=mask, casting='unsafe')
+  else: fillValue = None
+  return bands, tuple(geotransform), fillValue
+
+def getBandTags(var, lcoord=False, lfortran=True, formatter=None):
+  ''' return a list of file name tags for all bands of a variable, in the order of getRasterBands; the 
+      tags are the same as the ones that are used by ASCII_raster for file names, i.e. the formatter and 
+      coordinate tags only apply to the outermost axis (inner axes are sliced with default settings) '''
+  taglists = []
+  for n,ax in enumerate(var.axes[:-2]):
+    if n > 0: lcoord = False; lfortran = True; formatter = None # defaults of recursive ASCII_raster calls
+    lenax = len(ax)
+    one = 1 if lfortran else 0 # Fortran or C indexing
+    if formatter and ax.name in formatter:
+      fmt = formatter[ax.name]
+      if isinstance(fmt, (list,tuple)): axtag,fmt = fmt
+      else: axtag = None 
+    else:
+      axtag = None
+      if lcoord: fmt = '{}'
+      else: fmt = '{{:0{:d}d}}'.format(int(np.ceil(np.log10(lenax+one))))
+    if axtag is None: axtag = ax.name if lcoord else 'i{:s}'.format(ax.name.title())
+    if lcoord: taglists.append(['{:s}_{:s}'.format(axtag,fmt.format(c)) for c in ax.coord])
+    else: taglists.append(['{:s}_{:s}'.format(axtag,fmt.format(i+one)) for i in xrange(lenax)])
+  return ['_'.join(tags) for tags in product(*taglists)] # last axis varies fastest, like reshape
+
+def writeASCIIBand(filepath, band, geotransform, fillValue=None, fmt=None):
+  ''' write a single band to an Arc/Info ASCII Grid file (same layout as the GDAL AAIGrid driver); the 
+      band is formatted with a single string operation, instead of one per row (like np.savetxt) '''
+  ny,nx = band.shape
+  if fmt is None: fmt = '%.8g' if np.issubdtype(band.dtype,np.inexact) else '%d'
+  with open(filepath, 'w') as f:
+    f.write('ncols        {:d}\n'.format(nx))
+    f.write('nrows        {:d}\n'.format(ny))
+    f.write('xllcorner    {:.12f}\n'.format(geotransform[0]))
+    f.write('yllcorner    {:.12f}\n'.format(geotransform[3] + ny*geotransform[5]))
+    if geotransform[1] == -1*geotransform[5]: 
+      f.write('cellsize     {:.12f}\n'.format(geotransform[1]))
+    else: 
+      f.write('dx           {:.12f}\n'.format(geotransform[1]))
+      f.write('dy           {:.12f}\n'.format(-1*geotransform[5]))
+    if fillValue is not None: f.write('NODATA_value {:s}\n'.format(fmt%fillValue))
+    rowfmt = ' '.join([fmt]*nx) + '\n'
+    f.write((rowfmt*ny) % tuple(band.ravel().tolist()))
+  return filepath
+
+def writeGeoTIFF(filepath, bands, geotransform, projection, fillValue=None, tags=None, driver='GTiff', options=None):
+  ''' write all bands to a single multi-band GeoTIFF file (or a Cloud Optimized GeoTIFF) '''
+  gdt = {'float32':gdal.GDT_Float32, 'float64':gdal.GDT_Float64, 
+         'int16':gdal.GDT_Int16, 'int32':gdal.GDT_Int32}[bands.dtype.name]
+  nb,ny,nx = bands.shape
+  if driver == 'COG': # the COG driver only supports CreateCopy
+    dataset = gdal.GetDriverByName('MEM').Create('', nx, ny, nb, gdt)
+  else:
+    if options is None: options = ['TILED=YES','COMPRESS=DEFLATE']
+    dataset = gdal.GetDriverByName(driver).Create(filepath, nx, ny, nb, gdt, options=options)
+  dataset.SetGeoTransform(geotransform)
+  dataset.SetProjection(projection.ExportToWkt())
+  for i in xrange(nb):
+    band = dataset.GetRasterBand(i+1)
+    band.WriteArray(bands[i,:,:])
+    if fillValue is not None: band.SetNoDataValue(float(fillValue))
+    if tags: band.SetDescription(tags[i])
+  if driver == 'COG': 
+    gdal.GetDriverByName('COG').CreateCopy(filepath, dataset, options=options or ['COMPRESS=DEFLATE'])
+  dataset = None # close and flush to disk
+  return filepath
+
+def exportRasterBulk(dataset, folder=None, prefix=None, varlist=None, driver='AAIGrid', NT=None, ext=None, 
+                     wrap360=False, fillValue=None, lcoord=False, lfortran=True, formatter=None, fmt=None, 
+                     options=None):
+  ''' Export GDAL-enabled variables of a dataset to raster files, without creating a GDAL dataset for every 
+      slice: each variable is flipped and cast once (see getRasterBands) and the bands are written by a 
+      pool of NT threads (NT=1 writes serially). With the AAIGrid driver, every band is written to a 
+      separate ASCII raster file, which is named like the files of ASCII_raster; with the GTiff or COG 
+      driver, all bands of a variable are written to a single multi-band file. Returns a dict of file lists. '''
+  if not folder: 
+    raise ArgumentError, "A valid folder is necessary to export a dataset to raster format."
+  if not os.path.exists(folder): os.makedirs(folder) # make sure folder exists
+  if varlist is None: varlist = dataset.variables.keys()
+  if isinstance(varlist, (tuple,list)): varlist = {var:None for var in varlist}
+  if prefix is None: prefix = dataset.name
+  if ext is None: ext = '.asc' if driver == 'AAIGrid' else '.tif'
+  pool = ThreadPool(NT)
+  # N.B.: formatting an ASCII band holds the GIL, but it is a single string operation (see writeASCIIBand), 
+  #       so that the threads mainly overlap file I/O (GDAL also releases the GIL)
+  try:
+    filedict = dict(); results = []
+    for varname,vartag in varlist.iteritems():
+      var = dataset.variables[varname]
+      if not var.gdal: continue # skip variables that are not gdal enabled
+      if vartag is None: vartag = var.name
+      pf = '{:s}_{:s}'.format(prefix,vartag) if prefix else vartag
+      bands, geotransform, fv = getRasterBands(var, wrap360=wrap360, fillValue=fillValue)
+      tags = getBandTags(var, lcoord=lcoord, lfortran=lfortran, formatter=formatter)
+      if driver == 'AAIGrid':
+        filelist = ['{:s}/{:s}_{:s}{:s}'.format(folder,pf,tag,ext) if tag else '{:s}/{:s}{:s}'.format(folder,pf,ext) 
+                    for tag in tags]
+        results += [pool.apply_async(writeASCIIBand, (filepath, bands[i,:,:], geotransform, fv, fmt)) 
+                    for i,filepath in enumerate(filelist)]
+      else:
+        filelist = ['{:s}/{:s}{:s}'.format(folder,pf,ext)]
+        results.append(pool.apply_async(writeGeoTIFF, (filelist[0], bands, geotransform, var.projection, fv, tags, 
+                                                       driver, options)))
+      filedict[varname] = filelist
+    for result in results: result.get() # wait for completion and raise errors
+  finally:
+    pool.close(); pool.join()
+  return filedict
+
+
+## columnar export of station and shape time series (Arrow IPC files, i.e. Feather V2)
+
+def getSampleAxis(dataset):
+  ''' return the station or shape axis of a point dataset '''
+  for axname in ('station','shape'):
+    if dataset.hasAxis(axname): return dataset.getAxis(axname)
+  raise DatasetError, "Dataset '{:s}' has no 'station' or 'shape' axis.".format(dataset.name)
+
+def _arrowArray(data):
+  ''' convert a 1D (masked) array to an Arrow array; contiguous numeric arrays without masked values 
+      are not copied (masked values become nulls) '''
+  if isinstance(data, ma.MaskedArray):
+    mask = ma.getmask(data)
+    if mask is not ma.nomask and mask.any(): return pa.array(ma.getdata(data), mask=mask)
+    data = ma.getdata(data)
+  return pa.array(data)
+
+def _fieldMetadata(var):
+  ''' Arrow field metadata from Variable attributes '''
+  return {'units':str(var.units), 'long_name':str(var.atts.get('long_name',var.name))}
+
+def getColumnarTable(dataset, varlist=None, layout='long'):
+  ''' Convert the time series of a station or shape dataset into an Arrow table; variables with only a 
+      station/shape axis are treated as metadata. 
+      In 'long' layout there is one row per sample (station or shape) and time step: metadata columns 
+      (string columns are dictionary-encoded), a time column and one column per variable; the value 
+      columns are views of the Variable arrays, if these are ordered (sample, time). 
+      In 'wide' layout there is one row per time step and one column per variable and sample (named 
+      '{var}_{sample}'); the metadata are stored in the field metadata of each column, and the columns 
+      are views of the Variable arrays. '''
+  if layout not in ('long','wide'): raise ArgumentError, "Unknown layout '{:s}'.".format(layout)
+  smpax = getSampleAxis(dataset); tax = dataset.getAxis('time')
+  nsmp = len(smpax); ntime = len(tax)
+  # sort variables into metadata and time series
+  metavars = []; tsvars = []
+  for var in dataset.variables.itervalues():
+    if var.ndim == 1 and var.hasAxis(smpax.name): metavars.append(var)
+    elif varlist is not None and var.name not in varlist: continue
+    elif var.ndim == 2 and var.hasAxis(smpax.name) and var.hasAxis(tax.name): tsvars.append(var)
+  if len(tsvars) == 0: raise DatasetError, "Dataset '{:s}' has no station/shape time series.".format(dataset.name)
+  # (sample, time) arrays; views, if the variables are already in this order
+  tsdata = [var.load().getArray(axes=(smpax.name,tax.name), copy=False) for var in tsvars]
+  tsdata = [data if data.flags['C_CONTIGUOUS'] else ma.array(data, order='C') for data in tsdata]
+  names = []; arrays = []; fields = []
+  if layout == 'long':
+    idx = np.repeat(np.arange(nsmp, dtype=np.int32), ntime) # shared by all metadata columns
+    for data,name,meta in [(smpax.coord,smpax.name,{'units':str(smpax.units)})] + \
+                          [(var.load().data_array,var.name,_fieldMetadata(var)) for var in metavars]:
+      if data.dtype.kind in ('S','U'): column = pa.DictionaryArray.from_arrays(pa.array(idx), _arrowArray(data))
+      else: column = _arrowArray(np.take(data, idx))
+      names.append(name); arrays.append(column); fields.append(pa.field(name, column.type, metadata=meta))
+    arrays.append(pa.array(np.tile(tax.coord, nsmp))); names.append(tax.name)
+    fields.append(pa.field(tax.name, arrays[-1].type, metadata={'units':str(tax.units)}))
+    for var,data in zip(tsvars,tsdata):
+      arrays.append(_arrowArray(data.ravel())); names.append(var.name) # ravel is a view
+      fields.append(pa.field(var.name, arrays[-1].type, metadata=_fieldMetadata(var)))
+  else:
+    arrays.append(pa.array(tax.coord)); names.append(tax.name)
+    fields.append(pa.field(tax.name, arrays[-1].type, metadata={'units':str(tax.units)}))
+    metadata = [[str(value) for value in var.load().data_array] for var in metavars]
+    for var,data in zip(tsvars,tsdata):
+      for i in xrange(nsmp):
+        meta = _fieldMetadata(var); meta[smpax.name] = str(smpax.coord[i])
+        for metavar,values in zip(metavars,metadata): meta[metavar.name] = values[i]
+        name = '{:s}_{:s}'.format(var.name,str(smpax.coord[i]))
+        arrays.append(_arrowArray(data[i,:])); names.append(name) # rows are contiguous views
+        fields.append(pa.field(name, arrays[-1].type, metadata=meta))
+  # dataset attributes and layout are stored in the schema metadata
+  atts = {key:value if isinstance(value,(basestring,int,long,float)) else str(value) for key,value in dataset.atts.iteritems()}
+  schema = pa.schema(fields, metadata={'layout':layout, 'sample_axis':smpax.name, 'atts':json.dumps(atts)})
+  return pa.Table.from_arrays(arrays, schema=schema)
+
+def writeColumnar(dataset, filepath, varlist=None, layout='long'):
+  ''' Write the time series of a station or shape dataset to an Arrow IPC file (uncompressed, so that it 
+      can be memory-mapped by readers); see getColumnarTable for the layout. Returns the file path. '''
+  if pa is None: raise ImportError, "The columnar export format requires the 'pyarrow' module."
+  table = getColumnarTable(dataset, varlist=varlist, layout=layout)
+  tmpfilepath = filepath + '.tmp'
+  sink = pa.OSFile(tmpfilepath, 'wb')
+  try:
+    writer = pa.RecordBatchFileWriter(sink, table.schema)
+    writer.write_table(table); writer.close()
+  finally: sink.close()
+  os.rename(tmpfilepath, filepath) # replaces old file
+  return filepath
+
   
 def getFileFormat(fileformat, **expargs):
   ''' function that returns an instance of a specific FileFormat child class specified in expformat; 
@@ -166,8 +472,14 @@ def getFileFormat(fileformat, **expargs):
   # decide based on expformat; instantiate object
   if fileformat == 'ASCII_raster':
     return ASCII_raster(**expargs)
+  elif fileformat == 'ASCII_bulk':
+    return RasterBulk(driver='AAIGrid', **expargs)
+  elif fileformat in ('GTiff','GeoTIFF','COG'):
+    return RasterBulk(driver='COG' if fileformat == 'COG' else 'GTiff', **expargs)
   elif fileformat.lower() in ('netcdf','netcdf4'):
     return NetCDF(**expargs)
+  elif fileformat.lower() in ('arrow','feather'):
+    return Columnar(**expargs)
   else:
     raise NotImplementedError, fileformat
   
@@ -193,6 +505,7 @@ def performExport(dataset, mode, dataargs, expargs, loverwrite=False,
   ## extract meta data from arguments
   dataargs, loadfct, srcage, datamsgstr = getMetaData(dataset, mode, dataargs, lone=False)
   dataset_name = dataargs.dataset_name; periodstr = dataargs.periodstr; domain = dataargs.domain
+  lpoint = bool(dataargs.station or dataargs.shape) # station or shape dataset (no grid)
   
   # parse export options
   expargs = expargs.copy() # first copy, then modify...
@@ -201,6 +514,8 @@ def performExport(dataset, mode, dataargs, expargs, loverwrite=False,
   varlist = expargs.pop('varlist') # this handled outside of export
   # initialize FileFormat class instance
   fileFormat = getFileFormat(expformat, **expargs)
+  if lpoint and isinstance(fileFormat,ASCII_raster): 
+    raise ArgumentError, "Station and shape datasets can not be exported to raster formats."
   # get folder for target dataset and do some checks
   expname = '{:s}_d{:02d}'.format(dataset_name,domain) if domain else dataset_name
   expfolder = fileFormat.defineDataset(name=dataset_name, dataset=dataset, mode=mode, dataargs=dataargs, lwrite=True, ldebug=ldebug)
@@ -230,10 +545,16 @@ def performExport(dataset, mode, dataargs, expargs, loverwrite=False,
     logger.info('\n{0:s}   ***   {1:^65s}   ***   \n{0:s}   ***   {2:^65s}   ***   \n'.format(pidstr,datamsgstr,opmsgstr))
     if not lparallel and ldebug: logger.info('\n'+str(source)+'\n')
     
-    # create GDAL-enabled target dataset
-    sink = Dataset(axes=(source.xlon,source.ylat), name=expname, title=source.title)
-    addGDALtoDataset(dataset=sink, griddef=source.griddef)
-    assert sink.gdal, sink
+    if lpoint:
+      # create target dataset with station/shape meta data (variables without time axis)
+      smpax = getSampleAxis(source)
+      metavars = [var.load() for var in source.variables.itervalues() if var.ndim == 1 and var.hasAxis(smpax.name)]
+      sink = Dataset(varlist=metavars, name=expname, title=source.title)
+    else:
+      # create GDAL-enabled target dataset
+      sink = Dataset(axes=(source.xlon,source.ylat), name=expname, title=source.title)
+      addGDALtoDataset(dataset=sink, griddef=source.griddef)
+      assert sink.gdal, sink
     
     # N.B.: data are not loaded immediately but on demand; this way I/O and computing are further
     #       disentangled and not all variables are always needed
@@ -263,9 +584,10 @@ def performExport(dataset, mode, dataargs, expargs, loverwrite=False,
         if var and vars: raise VariableError, (var,vars)
         if var: vars = (var,)
         for var in vars:
-          addGDALtoVar(var=var, griddef=sink.griddef)
-          if not var.gdal and isinstance(fileFormat,ASCII_raster):
-            raise GDALError, "Exporting to ASCII_raster format requires GDAL-enabled variables."
+          if not lpoint: 
+            addGDALtoVar(var=var, griddef=sink.griddef)
+            if not var.gdal and isinstance(fileFormat,ASCII_raster):
+              raise GDALError, "Exporting to ASCII_raster format requires GDAL-enabled variables."
           # add to new dataset
           sink += var
     # convert units
@@ -300,6 +622,14 @@ if __name__ == '__main__':
   if os.environ.has_key('PYAVG_THREADS'): 
     NP = int(os.environ['PYAVG_THREADS'])
   else: NP = None
+  # write a profiling report (JSON or CSV)
+  if os.environ.has_key('PYAVG_PROFILE'): 
+    profile = os.environ['PYAVG_PROFILE']
+  else: profile = None
+  # process jobs through a queue file on a shared file system (other nodes can join as workers)
+  if os.environ.has_key('PYAVG_QUEUE'): 
+    queuefile = os.environ['PYAVG_QUEUE']
+  else: queuefile = None
   # run script in debug mode
   if os.environ.has_key('PYAVG_DEBUG'): 
     ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -339,6 +669,8 @@ if __name__ == '__main__':
     WRF_filetypes = config['WRF_filetypes']
     domains = config['WRF_domains']
     grids = config['grids']
+    stations = config.get('stations',()) # station and shape datasets (only for columnar formats)
+    shapes = config.get('shapes',())
     # target data specs
     export_arguments = config['export_parameters'] # this is actually a larger data structure
     lm3 = export_arguments['lm3'] # convert water flux from kg/m^2/s to m^3/m^2/s    
@@ -395,6 +727,9 @@ if __name__ == '__main__':
     grids += [None] # special keyword for native grid
 #     grids += ['grw2']# small grid for HGS GRW project
 #     grids += ['glb1_d02']# small grid for HGS GRW project
+    # station and shape datasets (only for columnar formats, instead of grids)
+    stations = [] # e.g. 'ecprecip'
+    shapes = [] # e.g. 'shpavg'
     ## export parameters
     export_arguments = dict(
         project = 'GRW', # project designation  
@@ -434,16 +769,23 @@ if __name__ == '__main__':
   print('\nOVERWRITE: {0:s}\n'.format(str(loverwrite)))
   
   # check formats (will be iterated over in export function, hence not part of task list)
-  if export_arguments['format'] == 'ASCII_raster':
+  if export_arguments['format'] in ('ASCII_raster','ASCII_bulk','GTiff','GeoTIFF','COG'):
     print('Export Folder: {:s}'.format(export_arguments['folder']))
     print('File Prefix: {:s}'.format(export_arguments['prefix']))
   elif export_arguments['format'].lower() in ('netcdf','netcdf4'):
     pass
+  elif export_arguments['format'].lower() in ('arrow','feather'):
+    print('Stations: {:s}'.format(printList(stations)))
+    print('Shapes: {:s}'.format(printList(shapes)))
   else:
     raise ArgumentError, "Unsupported file format: '{:s}'".format(export_arguments['format'])
     
   ## construct argument list
   args = []  # list of job packages
+  # columnar formats export station and shape datasets instead of gridded datasets
+  if export_arguments['format'].lower() in ('arrow','feather'):
+    locations = [dict(station=station) for station in stations] + [dict(shape=shape) for shape in shapes]
+  else: locations = [dict(grid=grid) for grid in grids]
   # loop over modes
   for mode in modes:
     # only climatology mode has periods    
@@ -451,8 +793,8 @@ if __name__ == '__main__':
     elif mode == 'time-series': periodlist = (None,)
     else: raise NotImplementedError, "Unrecognized Mode: '{:s}'".format(mode)
 
-    # loop over target grids ...
-    for grid in grids:
+    # loop over target grids (or stations and shapes) ...
+    for location in locations:
       
         # observational datasets (grid depends on dataset!)
         for dataset in datasets:
@@ -467,25 +809,25 @@ if __name__ == '__main__':
               if resolutions is None: dsreses = mod.LTM_grids
               elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.LTM_grids]  
               for dsres in dsreses: 
-                args.append( (dataset, mode, dict(grid=grid, varlist=load_list, period=None, resolution=dsres)) ) # append to list
+                args.append( (dataset, mode, dict(location, varlist=load_list, period=None, resolution=dsres)) ) # append to list
             # climatologies derived from time-series
             if resolutions is None: dsreses = mod.TS_grids
             elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.TS_grids]  
             for dsres in dsreses:
               for period in periodlist:
-                args.append( (dataset, mode, dict(grid=grid, varlist=load_list, period=period, resolution=dsres)) ) # append to list            
+                args.append( (dataset, mode, dict(location, varlist=load_list, period=period, resolution=dsres)) ) # append to list            
           elif mode == 'time-series': 
             # regrid the entire time-series
             if resolutions is None: dsreses = mod.TS_grids
             elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.TS_grids]  
             for dsres in dsreses:
-              args.append( (dataset, mode, dict(grid=grid, varlist=load_list, period=None, resolution=dsres)) ) # append to list            
+              args.append( (dataset, mode, dict(location, varlist=load_list, period=None, resolution=dsres)) ) # append to list            
         
         # CESM datasets
         for experiment in CESM_experiments:
           for period in periodlist:
             # arguments for worker function: dataset and dataargs       
-            args.append( ('CESM', mode, dict(experiment=experiment, filetypes=CESM_filetypes, grid=grid, 
+            args.append( ('CESM', mode, dict(location, experiment=experiment, filetypes=CESM_filetypes, 
                                              varlist=load_list, period=period, load3D=load3D)) )
         # WRF datasets
         for experiment in WRF_experiments:
@@ -496,7 +838,7 @@ if __name__ == '__main__':
           for domain in tmpdom:
             for period in periodlist:
               # arguments for worker function: dataset and dataargs       
-              args.append( ('WRF', mode, dict(experiment=experiment, filetypes=WRF_filetypes, grid=grid, 
+              args.append( ('WRF', mode, dict(location, experiment=experiment, filetypes=WRF_filetypes, 
                                               varlist=load_list, domain=domain, period=period)) )
       
   # static keyword arguments
@@ -504,6 +846,11 @@ if __name__ == '__main__':
   # N.B.: formats will be iterated over inside export function
   
   ## call parallel execution function
-  ec = asyncPoolEC(performExport, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  if queuefile:
+    # N.B.: export jobs are independent, so no input and output files are declared
+    jobs = [Job(performExport, args=arguments, kwargs=kwargs) for arguments in args]
+    ec = runQueue(jobs, queuefile, NP=NP, ldebug=ldebug, profile=profile)
+  else:
+    ec = asyncPoolEC(performExport, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, profile=profile)
   # exit with fraction of failures (out of 10) as exit code
   exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
@@ -11,7 +11,6 @@ Adapted from regrid.py.
 import os # check if files are present
 import numpy as np
 from importlib import import_module
-from datetime import datetime
 import logging   
 import functools  
 # internal imports
@@ -19,9 +18,11 @@ from geodata.misc import DateError, printList
 from geodata.netcdf import DatasetNetCDF
 from geodata.base import Dataset
 from datasets import gridded_datasets
-from processing.multiprocess import asyncPoolEC
+from processing.multiprocess import asyncPoolDAG, Job
+from processing.jobqueue import runQueue
 from processing.process import CentralProcessingUnit
-from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML
+from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML, getJobFiles, getCheckpointFile
+from processing.manifest import checkBuild, recordBuild
 
 
 # worker function that is to be passed to asyncPool for parallel execution; use of the decorator is assumed
@@ -76,18 +77,20 @@ def performExtraction(dataset, mode, stnfct, dataargs, loverwrite=False, varlist
       tmpfilename = tmppfx + filename      
     filepath = avgfolder + filename
     tmpfilepath = avgfolder + tmpfilename
-    if os.path.exists(filepath): 
-      if not loverwrite: 
-        age = datetime.fromtimestamp(os.path.getmtime(filepath))
-        # if source file is newer than sink file or if sink file is a stub, recompute, otherwise skip
-        if age > srcage and os.path.getsize(filepath) > 1e5: lskip = True
-        # N.B.: NetCDF files smaller than 100kB are usually incomplete header fragments from a previous crashed
-      if not lskip: os.remove(filepath) # recompute
+    # check build manifest: skip, if inputs, parameters and code have not changed since the file was written
+    params = dict(mode=mode, varlist=varlist, stations=stndata.name, period=periodstr)
+    inputs = dataargs.filelist + list(getattr(stndata,'filelist',None) or []) # station file is also an input
+    lskip, reason, build = checkBuild(filepath, inputs=inputs, params=params, 
+                                      code=(performExtraction, CentralProcessingUnit))
+    if loverwrite: lskip = False
+    if os.path.exists(filepath) and not lskip: 
+      logger.info("\n{:s}   >>>   Recomputing file '{:s}' ({:s})\n".format(pidstr,filename,reason or 'overwrite'))
+      os.remove(filepath) # recompute
   
-  # depending on last modification time of file or overwrite setting, start computation, or skip
+  # depending on build manifest or overwrite setting, start computation, or skip
   if lskip:        
     # print message
-    skipmsg =  "\n{:s}   >>>   Skipping: file '{:s}' in dataset '{:s}' already exists and is newer than source file.".format(pidstr,filename,dataset_name)
+    skipmsg =  "\n{:s}   >>>   Skipping: file '{:s}' in dataset '{:s}' already exists and is up-to-date.".format(pidstr,filename,dataset_name)
     skipmsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
     logger.info(skipmsg)              
   else:
@@ -114,12 +117,16 @@ def performExtraction(dataset, mode, stnfct, dataargs, loverwrite=False, varlist
     atts['title'] = '{:s} (Stations) from {:s} {:s}'.format(stndata.title,dataset_name,mode.title())
     # make new dataset
     if lwrite: # write to NetCDF file 
+      # recover completed variables from a previous (crashed) run, if possible
+      ckptfile = None if lreturn else getCheckpointFile(avgfolder, filename, tmppfx='tmp_exstns_', key=build['key'], 
+                                                                   lresume=not loverwrite)
       if os.path.exists(tmpfilepath): os.remove(tmpfilepath) # remove old temp files 
       sink = DatasetNetCDF(folder=avgfolder, filelist=[tmpfilename], atts=atts, mode='w')
     else: sink = Dataset(atts=atts) # ony create dataset in memory
     
     # initialize processing
     CPU = CentralProcessingUnit(source, sink, varlist=varlist, tmp=False, feedback=ldebug)
+    if lwrite and not lreturn: CPU.setCheckpoint(build['key'], filepath=ckptfile, target=filename) # record completed variables
   
     # extract data at station locations
     CPU.Extract(template=stndata, flush=True)
@@ -131,6 +138,7 @@ def performExtraction(dataset, mode, stnfct, dataargs, loverwrite=False, varlist
       logger.info('\n'+str(sink)+'\n')   
     # write results to file
     if lwrite:
+      if not lreturn: CPU.clearCheckpoint() # remove checkpoint attributes
       sink.sync()
       writemsg =  "\n{:s}   >>>   Writing to file '{:s}' in dataset {:s}".format(pidstr,filename,dataset_name)
       writemsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
@@ -141,6 +149,8 @@ def performExtraction(dataset, mode, stnfct, dataargs, loverwrite=False, varlist
         sink.unload(); sink.close(); del sink # destroy all references 
         if os.path.exists(filepath): os.remove(filepath) # remove old file
         os.rename(tmpfilepath,filepath)
+        recordBuild(filepath, build) # add to build manifest
+        if ckptfile: os.remove(ckptfile) # results have been recovered
       # N.B.: there is no temporary file if the dataset is returned, because an open file can't be renamed
         
     # clean up and return
@@ -152,102 +162,31 @@ def performExtraction(dataset, mode, stnfct, dataargs, loverwrite=False, varlist
     # N.B.: garbage is collected in multi-processing wrapper
 
 
-if __name__ == '__main__':
-  
-  ## read environment variables
-  # number of processes NP 
-  if os.environ.has_key('PYAVG_THREADS'): 
-    NP = int(os.environ['PYAVG_THREADS'])
-  else: NP = None
-  # run script in debug mode
-  if os.environ.has_key('PYAVG_DEBUG'): 
-    ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
-  else: ldebug = False
-  # run script in batch or interactive mode
-  if os.environ.has_key('PYAVG_BATCH'): 
-    lbatch =  os.environ['PYAVG_BATCH'] == 'BATCH' 
-  else: lbatch = False # for debugging
-  # re-compute everything or just update 
-  if os.environ.has_key('PYAVG_OVERWRITE'): 
-    loverwrite =  os.environ['PYAVG_OVERWRITE'] == 'OVERWRITE' 
-  else: loverwrite = ldebug # False means only update old files
-  
-  ## define settings
-  if lbatch:
-    # load YAML configuration
-    config = loadYAML('exstns.yaml', lfeedback=True)
-    # read config object
-    NP = NP or config['NP']
-    loverwrite = config['loverwrite']
-    # source data specs
-    modes = config['modes']
-    varlist = config['varlist']
-    periods = config['periods']
-    # Datasets
-    datasets = config['datasets']
-    resolutions = config['resolutions']
-    lLTM = config['lLTM']
-    # CESM
-    CESM_project = config['CESM_project']
-    CESM_experiments = config['CESM_experiments']
-    CESM_filetypes = config['CESM_filetypes']
-    load3D = config['load3D']
-    # WRF
-    WRF_project = config['WRF_project']
-    WRF_experiments = config['WRF_experiments']
-    WRF_filetypes = config['WRF_filetypes']
-    domains = config['domains']
-    # target data specs
-    stations = config['stations']
-  else:
-    NP = 2 ; ldebug = False # for quick computations
-    modes = ('time-series',) # 'climatology','time-series'
-    loverwrite = True
-    varlist = None
-    periods = []
-#     periods += [1]
-#     periods += [3]
-#     periods += [5]
-#     periods += [10]
-    periods += [15]
-    # Observations/Reanalysis
-    datasets = []; resolutions = None
-    lLTM = True # also regrid the long-term mean climatologies 
-#     datasets += ['PRISM','GPCC']; periods = None
-#     datasets += ['PCIC']; periods = None
-#     datasets += ['CFSR']; resolutions = {'CFSR':'031'}
-#     datasets += ['NARR']
-#     datasets += ['GPCC']; resolutions = {'GPCC':['025','05','10','25']}
-#     datasets += ['CRU']
-#     datasets += ['Unity']    
-    # CESM experiments (short or long name) 
-    CESM_project = None # all available experiments
-    load3D = False
-    CESM_experiments = [] # use None to process all CESM experiments
-#     CESM_experiments += ['Ctrl-1']
-#     CESM_experiments += ['Ctrl-1', 'Ctrl-A', 'Ctrl-B', 'Ctrl-C']
-    CESM_filetypes = ['atm'] # ,'lnd'
-    # WRF experiments (short or long name)
-    WRF_project = 'GreatLakes' # only WesternCanada experiments
-    WRF_experiments = [] # use None to process all CESM experiments
-#     WRF_experiments += ['marc-g','marc-gg','marc-g-2050','marc-gg-2050']
-#     WRF_experiments += ['marc-m','marc-mm', 'marc-t','marc-m-2050','marc-mm-2050', 'marc-t-2050']
-#     WRF_experiments += ['erai-g','erai-t']
-    WRF_experiments += ['g-ctrl','g-ens-A','g-ens-B','g-ens-C',]
-    WRF_experiments += ['g-ctrl-2050','g-ens-A-2050','g-ens-B-2050','g-ens-C-2050',]
-    WRF_experiments += ['g-ctrl-2100','g-ens-A-2100','g-ens-B-2100','g-ens-C-2100',]
-#     WRF_experiments += ['ctrl-1','ctrl-2050','ctrl-2100',]
-#     WRF_experiments += ['max-ctrl','max-ens-A','max-ens-B','max-ens-C',][:1]
-#     WRF_experiments += ['max-ctrl-2050','max-ens-A-2050','max-ens-B-2050','max-ens-C-2050',]
-#     WRF_experiments += ['max-ctrl-2100','max-ens-A-2100','max-ens-B-2100','max-ens-C-2100',]        
-    # other WRF parameters 
-    domains = None # domains to be processed
-#     WRF_filetypes = ('hydro','xtrm','srfc','lsm') # filetypes to be processed
-    WRF_filetypes = ('aux',)
-#     WRF_filetypes = ('const',); periods = None
-    # station datasets to match    
-    stations = dict(EC=('precip',)) # currently there is only one type: the EC weather stations
-  
+# function to assemble the job list from a configuration dictionary
+def getJobs(config, loverwrite=False):
+  ''' construct the list of station extraction jobs from a configuration dictionary (same keys as exstns.yaml); 
+      jobs declare their source and target files, so that the job lists of several processing steps 
+      can be combined into one task graph (see processing.pipeline) '''
+  # source data specs
+  modes = config['modes']
+  varlist = config['varlist']
+  periods = config['periods']
+  # Datasets
+  datasets = config['datasets']
+  resolutions = config['resolutions']
+  lLTM = config['lLTM']
+  # CESM
+  CESM_project = config['CESM_project']
+  CESM_experiments = config['CESM_experiments']
+  CESM_filetypes = config['CESM_filetypes']
+  load3D = config['load3D']
+  # WRF
+  WRF_project = config['WRF_project']
+  WRF_experiments = config['WRF_experiments']
+  WRF_filetypes = config['WRF_filetypes']
+  domains = config['domains']
+  # target data specs
+  stations = config['stations']
   
   ## process arguments    
   if isinstance(periods, (np.integer,int)): periods = [periods]
@@ -345,7 +284,122 @@ if __name__ == '__main__':
   # static keyword arguments
   kwargs = dict(loverwrite=loverwrite, varlist=varlist)
           
+  # declare input and output files of each job
+  # N.B.: the target filename depends on the name of the station dataset (argument of the loading function)
+  jobs = []
+  for arguments in args:
+    inputs, outputs = getJobFiles(arguments[0], arguments[1], arguments[3], grid=arguments[2].keywords['name'])
+    jobs.append(Job(performExtraction, args=arguments, kwargs=kwargs, inputs=inputs, outputs=outputs, 
+                    name='{:s} at {:s}'.format(arguments[0],arguments[2].keywords['name'])))
+  
+  return jobs
+
+
+if __name__ == '__main__':
+  
+  ## read environment variables
+  # number of processes NP 
+  if os.environ.has_key('PYAVG_THREADS'): 
+    NP = int(os.environ['PYAVG_THREADS'])
+  else: NP = None
+  # memory limit for admission control (in MB)
+  if os.environ.has_key('PYAVG_MEMORY'): 
+    memory = float(os.environ['PYAVG_MEMORY'])
+  else: memory = None
+  # write a profiling report (JSON or CSV)
+  if os.environ.has_key('PYAVG_PROFILE'): 
+    profile = os.environ['PYAVG_PROFILE']
+  else: profile = None
+  # process jobs through a queue file on a shared file system (other nodes can join as workers)
+  if os.environ.has_key('PYAVG_QUEUE'): 
+    queuefile = os.environ['PYAVG_QUEUE']
+  else: queuefile = None
+  # keep datasets, grids and masks open/cached in workers across jobs and route jobs by shared inputs
+  if os.environ.has_key('PYAVG_CACHE'): 
+    lcache =  os.environ['PYAVG_CACHE'] == 'CACHE' 
+  else: lcache = False
+  # run script in debug mode
+  if os.environ.has_key('PYAVG_DEBUG'): 
+    ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
+  else: ldebug = False
+  # run script in batch or interactive mode
+  if os.environ.has_key('PYAVG_BATCH'): 
+    lbatch =  os.environ['PYAVG_BATCH'] == 'BATCH' 
+  else: lbatch = False # for debugging
+  # re-compute everything or just update 
+  if os.environ.has_key('PYAVG_OVERWRITE'): 
+    loverwrite =  os.environ['PYAVG_OVERWRITE'] == 'OVERWRITE' 
+  else: loverwrite = ldebug # False means only update old files
+  
+  ## define settings
+  if lbatch:
+    # load YAML configuration
+    config = loadYAML('exstns.yaml', lfeedback=True)
+    # read config object
+    NP = NP or config['NP']
+    loverwrite = config['loverwrite']
+  else:
+    NP = 2 ; ldebug = False # for quick computations
+    modes = ('time-series',) # 'climatology','time-series'
+    loverwrite = True
+    varlist = None
+    periods = []
+#     periods += [1]
+#     periods += [3]
+#     periods += [5]
+#     periods += [10]
+    periods += [15]
+    # Observations/Reanalysis
+    datasets = []; resolutions = None
+    lLTM = True # also regrid the long-term mean climatologies 
+#     datasets += ['PRISM','GPCC']; periods = None
+#     datasets += ['PCIC']; periods = None
+#     datasets += ['CFSR']; resolutions = {'CFSR':'031'}
+#     datasets += ['NARR']
+#     datasets += ['GPCC']; resolutions = {'GPCC':['025','05','10','25']}
+#     datasets += ['CRU']
+#     datasets += ['Unity']    
+    # CESM experiments (short or long name) 
+    CESM_project = None # all available experiments
+    load3D = False
+    CESM_experiments = [] # use None to process all CESM experiments
+#     CESM_experiments += ['Ctrl-1']
+#     CESM_experiments += ['Ctrl-1', 'Ctrl-A', 'Ctrl-B', 'Ctrl-C']
+    CESM_filetypes = ['atm'] # ,'lnd'
+    # WRF experiments (short or long name)
+    WRF_project = 'GreatLakes' # only WesternCanada experiments
+    WRF_experiments = [] # use None to process all CESM experiments
+#     WRF_experiments += ['marc-g','marc-gg','marc-g-2050','marc-gg-2050']
+#     WRF_experiments += ['marc-m','marc-mm', 'marc-t','marc-m-2050','marc-mm-2050', 'marc-t-2050']
+#     WRF_experiments += ['erai-g','erai-t']
+    WRF_experiments += ['g-ctrl','g-ens-A','g-ens-B','g-ens-C',]
+    WRF_experiments += ['g-ctrl-2050','g-ens-A-2050','g-ens-B-2050','g-ens-C-2050',]
+    WRF_experiments += ['g-ctrl-2100','g-ens-A-2100','g-ens-B-2100','g-ens-C-2100',]
+#     WRF_experiments += ['ctrl-1','ctrl-2050','ctrl-2100',]
+#     WRF_experiments += ['max-ctrl','max-ens-A','max-ens-B','max-ens-C',][:1]
+#     WRF_experiments += ['max-ctrl-2050','max-ens-A-2050','max-ens-B-2050','max-ens-C-2050',]
+#     WRF_experiments += ['max-ctrl-2100','max-ens-A-2100','max-ens-B-2100','max-ens-C-2100',]        
+    # other WRF parameters 
+    domains = None # domains to be processed
+#     WRF_filetypes = ('hydro','xtrm','srfc','lsm') # filetypes to be processed
+    WRF_filetypes = ('aux',)
+#     WRF_filetypes = ('const',); periods = None
+    # station datasets to match    
+    stations = dict(EC=('precip',)) # currently there is only one type: the EC weather stations
+    # collect settings in a configuration dictionary (same keys as YAML file)
+    config = dict(modes=modes, varlist=varlist, periods=periods, datasets=datasets, resolutions=resolutions,
+                  lLTM=lLTM, CESM_project=CESM_project, CESM_experiments=CESM_experiments,
+                  CESM_filetypes=CESM_filetypes, load3D=load3D, WRF_project=WRF_project,
+                  WRF_experiments=WRF_experiments, WRF_filetypes=WRF_filetypes, domains=domains,
+                  stations=stations)
+  
+  # assemble job list
+  jobs = getJobs(config, loverwrite=loverwrite)
+  
   ## call parallel execution function
-  ec = asyncPoolEC(performExtraction, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  if queuefile:
+    ec = runQueue(jobs, queuefile, NP=NP, ldebug=ldebug, profile=profile)
+  else:
+    ec = asyncPoolDAG(jobs, NP=NP, memory=memory, ldebug=ldebug, ltrialnerror=True, profile=profile, lcache=lcache)
   # exit with fraction of failures (out of 10) as exit code
-  exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
+  exit(int(10+int(10.*ec/len(jobs))) if ec > 0 else 0)
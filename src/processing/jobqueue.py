@@ -0,0 +1,269 @@
+'''
+Created on 2016-03-21
+
+A file-based job queue for the batch processing scripts, so that jobs can be processed by any number of
+worker processes on any number of nodes that share a file system. The queue is a SQLite database;
+workers claim jobs with a lease, which is renewed by a heartbeat, so that jobs of crashed or
+preempted workers are returned to the queue, once the lease expires (jobs of workers on the same node
+are only returned, if the worker process is no longer running). Failed jobs are retried a given
+number of times. Dependencies between jobs are derived from their input and output files (see Job
+in processing.multiprocess).
+
+N.B.: SQLite relies on POSIX file locks, which are not reliable on some network file systems (e.g. NFS
+      without a lock daemon, or Lustre without the 'flock' mount option); on such file systems several
+      workers can claim the same job or corrupt the queue, so the queue file should be placed on a file
+      system with working locks (or only local workers should be used).
+
+The submitting script processes jobs itself (see runQueue); additional workers can join from other
+nodes with:
+
+  python processing/jobqueue.py worker <queue file> [<number of processes>]
+  python processing/jobqueue.py status <queue file>
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import os, sys, imp, errno, socket, sqlite3, pickle, threading, multiprocessing, logging
+from time import time, sleep
+from datetime import datetime
+# internal imports
+from processing.multiprocess import Job, TrialNError, setupLogging, startProfiling, reportProfiling
+
+## job states
+PENDING = 'pending'; RUNNING = 'running'; DONE = 'done'; FAILED = 'failed'
+
+schema = '''CREATE TABLE IF NOT EXISTS jobs (
+              id INTEGER PRIMARY KEY, name TEXT, payload BLOB, depends TEXT, size REAL,
+              state TEXT, attempts INTEGER, retries INTEGER, worker TEXT, lease REAL, exitcode INTEGER)'''
+
+
+## helper functions
+
+def connectQueue(queuefile, timeout=600):
+  ''' open a connection to the queue database (transactions are handled explicitly) '''
+  conn = sqlite3.connect(queuefile, timeout=timeout, isolation_level=None)
+  conn.execute(schema)
+  return conn
+
+def packJob(job):
+  ''' serialize a job; functions from the main script are referenced by file, because other processes
+      do not have the same main module '''
+  module = job.func.__module__
+  if module == '__main__': module = os.path.abspath(sys.modules['__main__'].__file__)
+  return pickle.dumps((module, job.func.__name__, job.args, job.kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+
+def unpackJob(payload):
+  ''' deserialize a job and return function, arguments and keyword arguments '''
+  module, funcname, args, kwargs = pickle.loads(str(payload))
+  if module.endswith('.py') or module.endswith('.pyc'):
+    name = 'jobqueue_' + os.path.splitext(os.path.basename(module))[0]
+    main = getattr(sys.modules['__main__'],'__file__','')
+    if os.path.splitext(os.path.abspath(main))[0] == os.path.splitext(module)[0]: 
+      module = sys.modules['__main__'] # forked from the submitting script
+    elif name in sys.modules: module = sys.modules[name]
+    else: module = imp.load_source(name, os.path.splitext(module)[0]+'.py') # no __main__ section
+  else: module = __import__(module, fromlist=[funcname])
+  return getattr(module, funcname), args, kwargs
+
+def isWorkerAlive(worker):
+  ''' check if a worker ('host:pid') is still running; only workers on this node can be checked, all 
+      others are assumed to be dead (i.e. their leases expire) '''
+  host, _, pid = worker.rpartition(':')
+  if host != socket.gethostname() or not pid.isdigit(): return False
+  if int(pid) == os.getpid(): return False # this worker is not running a job, if it claims a new one
+  try: os.kill(int(pid), 0) # signal 0 only checks, if the process exists
+  except OSError as err: return err.errno != errno.ESRCH
+  return True
+
+
+## queue operations
+
+def submitJobs(queuefile, jobs, retries=1, loverwrite=False):
+  ''' write a list of Job instances to a new queue; jobs depend on all jobs that produce one of their
+      input files, and failed jobs are retried 'retries' times; an existing queue is only replaced, if 
+      all of its jobs are finished, or if loverwrite is True '''
+  if not isinstance(jobs,(list,tuple)) or not all(isinstance(job,Job) for job in jobs): raise TypeError
+  if os.path.exists(queuefile):
+    status = getStatus(queuefile)
+    if status[PENDING] + status[RUNNING] > 0 and not loverwrite:
+      raise IOError, "Queue '{:s}' has {:d} unfinished jobs; remove it or overwrite it explicitly.".format(
+                                                            queuefile,status[PENDING]+status[RUNNING])
+    os.remove(queuefile) # start a new queue
+  producers = dict()
+  for i,job in enumerate(jobs):
+    for filepath in job.outputs:
+      if filepath in producers: raise ValueError, "File '{:s}' is produced by more than one job!".format(filepath)
+      producers[filepath] = i + 1 # SQLite IDs start at 1
+  conn = connectQueue(queuefile)
+  conn.execute('BEGIN IMMEDIATE')
+  for i,job in enumerate(jobs):
+    depends = sorted(set(producers[filepath] for filepath in job.inputs if filepath in producers) - set([i+1]))
+    conn.execute('INSERT INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                 (i+1, job.name, sqlite3.Binary(packJob(job)), ','.join(str(j) for j in depends), job.estimateSize(),
+                  PENDING, 0, retries, None, None, None))
+  conn.execute('COMMIT'); conn.close()
+
+def claimJob(conn, worker, lease=600):
+  ''' claim the largest job that is ready (all dependencies done) and return its ID, name and payload;
+      expired leases are released and jobs that depend on failed jobs are marked as failed; returns None,
+      if no job is ready, and False, if all jobs are finished '''
+  now = time()
+  conn.execute('BEGIN IMMEDIATE') # lock database for writing
+  try:
+    # release expired leases (retry or fail), unless the worker is known to be still running
+    for jobid, owner in conn.execute('SELECT id, worker FROM jobs WHERE state=? AND lease<?', (RUNNING, now)).fetchall():
+      if isWorkerAlive(owner): 
+        conn.execute('UPDATE jobs SET lease=? WHERE id=?', (now+lease, jobid)) # e.g. a stalled heartbeat
+      else:
+        conn.execute('UPDATE jobs SET state=CASE WHEN attempts > retries THEN ? ELSE ? END, worker=NULL ' +
+                     'WHERE id=?', (FAILED, PENDING, jobid))
+    states = dict(conn.execute('SELECT id, state FROM jobs'))
+    if all(state in (DONE,FAILED) for state in states.itervalues()):
+      conn.execute('COMMIT'); return False # nothing left to do
+    job = None
+    for jobid, name, payload, depends in conn.execute('SELECT id, name, payload, depends FROM jobs WHERE state=? ' +
+                                                       'ORDER BY size DESC, id', (PENDING,)).fetchall():
+      depends = [int(j) for j in depends.split(',') if j]
+      if any(states[j] == FAILED for j in depends):
+        conn.execute('UPDATE jobs SET state=?, exitcode=? WHERE id=?', (FAILED, 1, jobid))
+        states[jobid] = FAILED # dependencies of other jobs
+      elif job is None and all(states[j] == DONE for j in depends): job = (jobid, name, payload)
+    if job is not None:
+      conn.execute('UPDATE jobs SET state=?, worker=?, lease=?, attempts=attempts+1 WHERE id=?',
+                   (RUNNING, worker, now+lease, job[0]))
+    conn.execute('COMMIT')
+  except:
+    conn.execute('ROLLBACK'); raise
+  return job
+
+def finishJob(conn, jobid, worker, exitcode):
+  ''' record the exit code of a job; failed jobs are returned to the queue, if they have retries left '''
+  state = DONE if exitcode == 0 else FAILED
+  conn.execute('BEGIN IMMEDIATE')
+  if state == FAILED:
+    conn.execute('UPDATE jobs SET state=CASE WHEN attempts > retries THEN ? ELSE ? END, exitcode=?, worker=NULL ' +
+                 'WHERE id=? AND worker=?', (FAILED, PENDING, exitcode, jobid, worker))
+  else:
+    conn.execute('UPDATE jobs SET state=?, exitcode=? WHERE id=? AND worker=?', (state, exitcode, jobid, worker))
+  conn.execute('COMMIT')
+  # N.B.: if the lease expired in the meantime and another worker claimed the job, nothing is changed
+
+def getStatus(queuefile):
+  ''' return the number of jobs in each state '''
+  conn = connectQueue(queuefile)
+  status = {state:0 for state in (PENDING,RUNNING,DONE,FAILED)}
+  status.update(dict(conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state')))
+  conn.close()
+  return status
+
+class Heartbeat(threading.Thread):
+  ''' background thread that renews the lease of the current job periodically '''
+
+  def __init__(self, queuefile, worker, jobid, lease=600, interval=60):
+    ''' save job information and start as daemon '''
+    super(Heartbeat,self).__init__()
+    self.daemon = True
+    self.queuefile = queuefile; self.worker = worker; self.jobid = jobid
+    self.lease = lease; self.interval = interval
+    self.stopped = threading.Event()
+
+  def run(self):
+    ''' renew lease until stopped '''
+    conn = connectQueue(self.queuefile)
+    while not self.stopped.wait(self.interval):
+      try: conn.execute('UPDATE jobs SET lease=? WHERE id=? AND worker=?', (time()+self.lease, self.jobid, self.worker))
+      except sqlite3.Error: logging.exception('heartbeat') # e.g. database locked: try again next time
+    conn.close()
+
+  def stop(self):
+    ''' stop heartbeat (the thread finishes after the current interval) '''
+    self.stopped.set()
+
+
+## worker functions
+
+def processQueue(queuefile, lease=600, heartbeat=60, poll=10, ldebug=False, logger=None):
+  ''' claim and execute jobs from the queue, until all jobs are finished; this function runs inside a
+      worker process and returns the number of jobs that it processed '''
+  worker = '{:s}:{:d}'.format(socket.gethostname(), os.getpid())
+  if logger is None: logger = setupLogging(lparallel=True, ldebug=ldebug, name='jobqueue.worker').name
+  conn = connectQueue(queuefile)
+  njobs = 0
+  while True:
+    job = claimJob(conn, worker, lease=lease)
+    if job is False: break # all jobs finished
+    elif job is None: sleep(poll); continue # wait for dependencies
+    jobid, name, payload = job
+    # renew lease while the job is running
+    beat = Heartbeat(queuefile, worker, jobid, lease=lease, interval=heartbeat); beat.start()
+    try:
+      func, args, kwargs = unpackJob(payload)
+      kwargs.update(ldebug=ldebug, lparallel=True, logger=logger)
+      ec = TrialNError(func)(*args, **kwargs)
+    except Exception:
+      logging.exception(name); ec = 1 # e.g. unpickling errors
+    beat.stop()
+    finishJob(conn, jobid, worker, ec or 0)
+    njobs += 1
+  conn.close()
+  return njobs
+
+def runWorkers(queuefile, NP=1, lease=600, heartbeat=60, poll=10, ldebug=False):
+  ''' start NP worker processes on this node and wait until all jobs in the queue are finished '''
+  if NP is None: NP = multiprocessing.cpu_count()
+  kwargs = dict(lease=lease, heartbeat=heartbeat, poll=poll, ldebug=ldebug)
+  # N.B.: TrialNError derives the process ID from the process name, hence we always use worker processes
+  workers = [multiprocessing.Process(target=processQueue, args=(queuefile,), kwargs=kwargs) for _ in xrange(NP)]
+  for process in workers: process.start()
+  for process in workers: process.join()
+
+def runQueue(jobs, queuefile, NP=1, retries=1, lease=600, heartbeat=60, poll=10, ldebug=False, profile=None,
+             loverwrite=False):
+  '''
+    A queue-based alternative to asyncPoolDAG: jobs are written to a queue file on a shared file system
+    and processed by NP local worker processes, as well as by any workers that join from other nodes
+    (see module documentation); returns the number of failures as the exit code. A queue with 
+    unfinished jobs is only replaced, if loverwrite is True.
+    N.B.: there is no memory admission (every worker runs one job at a time) and only jobs that are
+          processed by local workers are included in the profile.
+  '''
+  logger = setupLogging(lparallel=True, ldebug=ldebug, name='jobqueue.runQueue')
+  logger.info(datetime.today())
+  logger.info('\nQUEUE: {0:s}, THREADS: {1:s}, JOBS: {2:d}, DEBUG: {3:s}\n'.format(queuefile,str(NP),len(jobs),str(ldebug)))
+  submitJobs(queuefile, jobs, retries=retries, loverwrite=loverwrite)
+  profdir = startProfiling(profile) # before workers are forked
+  runWorkers(queuefile, NP=NP, lease=lease, heartbeat=heartbeat, poll=poll, ldebug=ldebug)
+  # wait for jobs of other workers, if necessary
+  status = getStatus(queuefile)
+  while status[PENDING] + status[RUNNING] > 0:
+    sleep(poll); status = getStatus(queuefile)
+  # evaluate exit codes
+  exitcode = status[FAILED]; nop = status[DONE]
+  if exitcode == 0:
+    logger.info('\n   >>>   All {:d} operations completed successfully!!!   <<<   \n'.format(nop))
+  else:
+    logger.info('\n   ===   {:2d} operations completed successfully!    ===   \n'.format(nop) +
+          '\n   ###   {:2d} operations did not complete/failed!   ###   \n'.format(exitcode))
+  reportProfiling(profile, profdir, logger)
+  logger.info(datetime.today())
+  # return with exit code
+  return exitcode
+
+
+if __name__ == '__main__':
+
+  # simple command line interface: join a queue as worker or print status
+  if len(sys.argv) < 3 or sys.argv[1] not in ('worker','status'):
+    print('Usage: {:s} worker|status <queue file> [<number of processes>]'.format(sys.argv[0])); sys.exit(2)
+  queuefile = sys.argv[2]
+  if not os.path.exists(queuefile):
+    print("Queue file '{:s}' does not exist!".format(queuefile)); sys.exit(2)
+  if sys.argv[1] == 'worker':
+    NP = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    ldebug = os.environ.get('PYAVG_DEBUG','') == 'DEBUG'
+    runWorkers(queuefile, NP=NP, ldebug=ldebug)
+  status = getStatus(queuefile)
+  print('\n   ***   Queue {:s}: {:s}   ***   \n'.format(queuefile,', '.join(
+                  '{:d} {:s}'.format(status[state],state) for state in (PENDING,RUNNING,DONE,FAILED))))
+  sys.exit(1 if status[FAILED] else 0)
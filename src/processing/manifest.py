@@ -0,0 +1,250 @@
+'''
+Created on 2016-03-07
+
+A build manifest for processing outputs: for every output file we record a fingerprint of the contents
+of its input files, the processing parameters (varlist, grid, period etc.) and the version of the code
+that produced it, so that existing outputs can be skipped exactly, instead of relying on modification
+times. Files are identified by a hash of their entire contents, which is cached in the manifest with
+the size, modification time and inode of the file, so that unchanged inputs are not read again. Outputs that were produced
+before the manifest existed are adopted, if they are newer than their inputs. Each output folder has its
+own manifest (a JSON file), which can also be queried from the command line, to find out which outputs
+are stale and why:
+
+  python processing/manifest.py stale <folder> [<folder> ...]
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import os, sys, json, hashlib, inspect
+from datetime import datetime
+from contextlib import contextmanager
+try: import fcntl # file locking (only on Unix)
+except ImportError: fcntl = None
+
+## module settings
+manifest_file = '.build_manifest.json' # name of the manifest file in the output folder
+manifest_lock = '.build_manifest.lock' # lock file (the manifest itself is replaced, so it can't be locked)
+block_size = 2**20 # size of the blocks in which files are read for hashing (1MB)
+hash_prefix = 'sha1:' # marks full-content hashes (older manifests used partial fingerprints)
+
+
+## helper functions
+
+@contextmanager
+def lockManifest(folder):
+  ''' context manager that holds an exclusive lock on the manifest of a folder (for parallel workers) '''
+  if fcntl is None: yield # no locking available
+  else:
+    lockfile = open(os.path.join(folder,manifest_lock), 'a')
+    try:
+      fcntl.flock(lockfile, fcntl.LOCK_EX)
+      yield
+    finally:
+      fcntl.flock(lockfile, fcntl.LOCK_UN); lockfile.close()
+
+def loadManifest(folder):
+  ''' load the manifest of an output folder; returns an empty manifest, if there is none '''
+  filepath = os.path.join(folder,manifest_file)
+  if os.path.exists(filepath):
+    with open(filepath, 'r') as f: manifest = json.load(f)
+  else: manifest = dict()
+  manifest.setdefault('outputs',dict()) # build records, indexed by output filename
+  manifest.setdefault('files',dict()) # cache of file hashes: path -> (size, mtime, inode, hash)
+  return manifest
+
+def writeManifest(folder, manifest):
+  ''' write the manifest of an output folder (atomically, through a temporary file) '''
+  filepath = os.path.join(folder,manifest_file)
+  tmpfilepath = filepath + '.tmp'
+  with open(tmpfilepath, 'w') as f: json.dump(manifest, f, indent=1, sort_keys=True)
+  os.rename(tmpfilepath, filepath) # replaces old manifest
+
+def hashFile(filepath, cache=None):
+  ''' compute a SHA1 hash of the entire file contents; if a cache dict is passed, the hash is only 
+      recomputed, if size, modification time or inode of the file have changed (None is returned, if the 
+      file is missing) '''
+  filepath = os.path.abspath(filepath)
+  if not os.path.exists(filepath): return None
+  stat = os.stat(filepath); fileid = [stat.st_size, stat.st_mtime, stat.st_ino]
+  if cache is not None and filepath in cache and cache[filepath][:3] == fileid:
+    filehash = cache[filepath][3]
+    if filehash.startswith(hash_prefix): return filehash # file has not been touched since it was hashed
+  sha = hashlib.sha1()
+  with open(filepath, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''): sha.update(block) # read in blocks
+  # N.B.: regenerated files often have the same size, header and trailing block (e.g. NetCDF3 files with
+  #       fixed dimensions), so the entire file has to be hashed to detect changes reliably
+  filehash = hash_prefix + sha.hexdigest()
+  if cache is not None: cache[filepath] = fileid + [filehash]
+  return filehash
+
+def hashFileLegacy(filepath):
+  ''' compute the fingerprint that older manifests used, from the file size and the first and last block '''
+  size = os.path.getsize(filepath)
+  sha = hashlib.sha1(str(size))
+  with open(filepath, 'rb') as f:
+    sha.update(f.read(block_size)) # header (or entire file)
+    if size > 2*block_size: f.seek(-block_size, os.SEEK_END)
+    sha.update(f.read(block_size)) # trailing block (empty, if the file has been read completely)
+  return sha.hexdigest()
+
+def matchHash(filepath, oldhash, newhash, outputtime):
+  ''' compare a recorded hash with the current hash of a file; legacy fingerprints (without prefix) are 
+      only accepted, if they still match and the file was not modified after the output was written '''
+  if oldhash == newhash: return True
+  if oldhash is None or newhash is None or oldhash.startswith(hash_prefix): return False
+  return getFileAge(filepath) <= outputtime and hashFileLegacy(filepath) == oldhash
+
+def getFileAge(filepath):
+  ''' return the modification time of a file (None, if it is missing) '''
+  return os.path.getmtime(filepath) if os.path.exists(filepath) else None
+
+def updateFileCache(folder, cache, filelist):
+  ''' merge the hashes of a list of files into the file cache of a manifest (and write it); hashes are
+      computed before the manifest is locked, so that the lock is only held briefly '''
+  with lockManifest(folder):
+    manifest = loadManifest(folder)
+    manifest['files'].update((filepath,cache[filepath]) for filepath in filelist if filepath in cache)
+    writeManifest(folder, manifest) # save updated file hashes
+  return manifest
+
+def getCodeFiles(code):
+  ''' determine source files of modules, classes or functions (module names are also accepted) '''
+  if code is None: return []
+  filelist = []
+  for obj in code:
+    if isinstance(obj,basestring):
+      obj = sys.modules[obj] if obj in sys.modules else __import__(obj, fromlist=[''])
+    filepath = os.path.abspath(inspect.getsourcefile(obj))
+    if filepath not in filelist: filelist.append(filepath)
+  return filelist
+
+def getGridID(griddef):
+  ''' extract the defining properties of a grid (GridDefinition) in a JSON-compatible form '''
+  if griddef is None or isinstance(griddef,basestring): return griddef
+  gridid = dict(name=griddef.name, size=list(griddef.size), geotransform=list(griddef.geotransform))
+  projection = griddef.projection
+  gridid['projection'] = projection.ExportToWkt() if projection is not None else None
+  return gridid
+
+def normalizeParams(params):
+  ''' convert processing parameters into a JSON-compatible form, so they can be compared and stored '''
+  if params is None: return dict()
+  return json.loads(json.dumps(params, sort_keys=True, default=str))
+  # N.B.: objects that are not JSON-serializable are represented by their string representation
+
+
+## build records
+
+def getBuildRecord(filepath, inputs, params=None, code=None, cache=None):
+  ''' assemble the build record for an output file: hashes of input files and code, and parameters '''
+  if cache is None: cache = dict()
+  inputs = [os.path.abspath(inputfile) for inputfile in inputs]
+  record = dict(output=os.path.basename(filepath), params=normalizeParams(params))
+  record['inputs'] = {inputfile:hashFile(inputfile, cache=cache) for inputfile in inputs}
+  record['code'] = {codefile:hashFile(codefile, cache=cache) for codefile in getCodeFiles(code)}
+  # overall key (only used for display and quick comparison)
+  record['key'] = hashlib.sha1(json.dumps([record['inputs'],record['params'],record['code']],
+                                          sort_keys=True)).hexdigest()
+  return record
+
+def compareBuild(filepath, old, new=None, cache=None):
+  ''' compare a stored build record with a new one (or the current state of inputs and code, if the new
+      record is None); returns a list of reasons why the output is stale (empty, if it is up-to-date) '''
+  reasons = []
+  if old is None: return ['no build record']
+  if not os.path.exists(filepath): return ['output missing']
+  stat = os.stat(filepath); outputtime = old['output_id'][1]
+  if [stat.st_size, stat.st_mtime] != old['output_id']: reasons.append('output modified')
+  # compare input files
+  newinputs = new['inputs'] if new else {inputfile:hashFile(inputfile, cache=cache) for inputfile in old['inputs']}
+  for inputfile in sorted(set(old['inputs'])|set(newinputs)):
+    if inputfile not in newinputs: reasons.append("input removed: '{:s}'".format(inputfile))
+    elif inputfile not in old['inputs']: reasons.append("input added: '{:s}'".format(inputfile))
+    elif newinputs[inputfile] is None: reasons.append("input missing: '{:s}'".format(inputfile))
+    elif not matchHash(inputfile, old['inputs'][inputfile], newinputs[inputfile], outputtime):
+      reasons.append("input changed: '{:s}'".format(inputfile))
+  # compare parameters (only possible, if a new record is available)
+  if new:
+    keys = [key for key in sorted(set(old['params'])|set(new['params']))
+            if old['params'].get(key,None) != new['params'].get(key,None)]
+    if keys: reasons.append('parameters changed: {:s}'.format(', '.join(keys)))
+  # compare code version
+  newcode = new['code'] if new else {codefile:hashFile(codefile, cache=cache) for codefile in old['code']}
+  codefiles = [os.path.basename(codefile) for codefile in sorted(set(old['code'])|set(newcode))
+               if not matchHash(codefile, old['code'].get(codefile,None), newcode.get(codefile,None), outputtime)]
+  if codefiles: reasons.append('code changed: {:s}'.format(', '.join(codefiles)))
+  return reasons
+
+def checkBuild(filepath, inputs, params=None, code=None):
+  ''' check if an output file is up-to-date with respect to its inputs, parameters and code; returns
+      a skip flag, a message with the reasons why the output is stale, and the new build record, which
+      should be passed on to recordBuild, once the output has been written '''
+  folder = os.path.dirname(os.path.abspath(filepath))
+  # N.B.: the manifest is replaced atomically, so it can be read without a lock; the lock is only held
+  #       while the updated file hashes are merged into the current manifest
+  cache = loadManifest(folder)['files']
+  new = getBuildRecord(filepath, inputs, params=params, code=code, cache=cache)
+  manifest = updateFileCache(folder, cache, filelist=new['inputs'].keys()+new['code'].keys())
+  missing = [inputfile for inputfile,filehash in new['inputs'].iteritems() if filehash is None]
+  if missing: raise IOError, "Source file '{:s}' does not exist!".format(missing[0])
+  old = manifest['outputs'].get(new['output'],None)
+  if old is None and os.path.exists(filepath):
+    # adopt outputs without a build record, if they are newer than their inputs (like before)
+    if all(getFileAge(filepath) >= getFileAge(inputfile) for inputfile in new['inputs']):
+      recordBuild(filepath, new)
+      return True, '', new
+    else: return False, 'no build record (output older than inputs)', new
+  reasons = compareBuild(filepath, old, new=new)
+  return not reasons, '; '.join(reasons), new
+
+def recordBuild(filepath, record):
+  ''' add the build record of an output file to the manifest (after the output has been written) '''
+  folder = os.path.dirname(os.path.abspath(filepath))
+  stat = os.stat(filepath)
+  record = record.copy()
+  record['output_id'] = [stat.st_size, stat.st_mtime] # to detect modification of the output itself
+  record['date'] = datetime.now().isoformat()
+  with lockManifest(folder):
+    manifest = loadManifest(folder)
+    manifest['outputs'][record['output']] = record
+    writeManifest(folder, manifest)
+
+def removeBuild(filepath):
+  ''' remove the build record of an output file from the manifest (before the output is recomputed) '''
+  folder = os.path.dirname(os.path.abspath(filepath))
+  if not os.path.exists(os.path.join(folder,manifest_file)): return
+  with lockManifest(folder):
+    manifest = loadManifest(folder)
+    if manifest['outputs'].pop(os.path.basename(filepath),None) is not None:
+      writeManifest(folder, manifest)
+
+def getStaleOutputs(folder):
+  ''' check all outputs recorded in the manifest of a folder; returns a dict of reasons for every output
+      (an empty list means up-to-date); changes of parameters can only be detected by the workers '''
+  manifest = loadManifest(folder); cache = manifest['files']
+  stale = {filename:compareBuild(os.path.join(folder,filename), record, cache=cache)
+           for filename,record in manifest['outputs'].iteritems()}
+  updateFileCache(folder, cache, filelist=cache.keys()) # save updated file hashes
+  return stale
+
+
+if __name__ == '__main__':
+
+  # simple command line interface: report stale outputs
+  if len(sys.argv) < 3 or sys.argv[1] != 'stale':
+    print('Usage: {:s} stale <folder> [<folder> ...]'.format(sys.argv[0])); sys.exit(2)
+  nstale = 0
+  for folder in sys.argv[2:]:
+    if not os.path.exists(os.path.join(folder,manifest_file)):
+      print("\n   ***   No build manifest in folder '{:s}'   ***   ".format(folder)); continue
+    print("\n   ***   Outputs in folder '{:s}'   ***   ".format(folder))
+    stale = getStaleOutputs(folder)
+    for filename in sorted(stale):
+      if stale[filename]:
+        print('STALE  {:s}: {:s}'.format(filename,'; '.join(stale[filename]))); nstale += 1
+      else: print('OK     {:s}'.format(filename))
+  print('\n   ===   {:d} stale output(s)   ===   \n'.format(nstale))
+  # exit code indicates if there are stale outputs
+  sys.exit(1 if nstale else 0)
@@ -10,16 +10,21 @@ Some utility functions related to processing datasets (to avoid code repetition)
 import numpy as np
 from importlib import import_module
 from functools import partial
-import yaml,os
+import yaml,os,re,errno,socket,time
 from datetime import datetime
 # internal imports
 from geodata.misc import DatasetError, DateError, isInt
 from utils.misc import namedTuple
+import utils.cache as cache
 from datasets.common import getFileName
 # specific datasets
 import datasets.WRF as WRF
 import datasets.CESM as CESM
 
+# NetCDF attributes used for checkpointing (see CentralProcessingUnit.setCheckpoint)
+from processing.process import checkpoint_att, owner_att, target_att, heartbeat_att
+checkpoint_lease = 6*3600 # owners on other hosts are considered dead, if they did not update their file for 6h
+
 
 # load YAML configuration file
 def loadYAML(default, lfeedback=True):
@@ -108,41 +113,120 @@ def getTargetFile(dataset=None, mode=None, dataargs=None, lwrite=True, grid=None
   # return filename
   return filename
 
+def getSourceFiles(filelist=None, fileclasses=None, filetypes=None, exp=None, domain=None,
+                   periodstr=None, gridstr=None, lclim=None, lts=None):
+  ''' function to assemble the paths of the source files of a set of filetypes (files may not exist yet) '''
+  # if complete file list is given, just use it
+  if filelist: return list(filelist)
+  # prepare period and grid strings
+  periodstr = '_{}'.format(periodstr) if periodstr else ''
+  gridstr = '_{}'.format(gridstr) if gridstr else ''    
+  # assemble filenames from dataset arguments
+  filelist = []
+  for filetype in filetypes:
+    fileclass = fileclasses[filetype] # avoid WRF & CESM name collision
+    if domain is None:
+      if lclim: filename = fileclass.climfile.format(gridstr,periodstr) # insert grid and period
+      elif lts: filename = fileclass.tsfile.format(gridstr) # insert grid
+    else:
+      if lclim: filename = fileclass.climfile.format(domain,gridstr,periodstr) # insert domain number, grid, and period
+      elif lts: filename = fileclass.tsfile.format(domain,gridstr) # insert domain number, and grid
+    filelist.append('{:s}/{:s}'.format(exp.avgfolder,filename))
+  # return list of file paths
+  return filelist
+
 def getSourceAge(filelist=None, fileclasses=None, filetypes=None, exp=None, domain=None,
                  periodstr=None, gridstr=None, lclim=None, lts=None):
   ''' function to to get the latest modification date of a set of filetypes '''
   srcage = datetime.fromordinal(1) # the beginning of time (proleptic Gregorian calendar)
-  # if complete file list is given, just check each file
-  if filelist:
-    for filepath in filelist:
-      if not os.path.exists(filepath): raise IOError, "Source file '{:s}' does not exist!".format(filepath)        
-      # determine age of source file
-      fileage = datetime.fromtimestamp(os.path.getmtime(filepath))          
-      if srcage < fileage: srcage = fileage # use latest modification date
-  else:    
-    # prepare period and grid strings
-    periodstr = '_{}'.format(periodstr) if periodstr else ''
-    gridstr = '_{}'.format(gridstr) if gridstr else ''    
-    # assemble filenames from dataset arguments
-    for filetype in filetypes:
-      fileclass = fileclasses[filetype] # avoid WRF & CESM name collision
-      if domain is None:
-        if lclim: filename = fileclass.climfile.format(gridstr,periodstr) # insert grid and period
-        elif lts: filename = fileclass.tsfile.format(gridstr) # insert grid
-      else:
-        if lclim: filename = fileclass.climfile.format(domain,gridstr,periodstr) # insert domain number, grid, and period
-        elif lts: filename = fileclass.tsfile.format(domain,gridstr) # insert domain number, and grid
-      filepath = '{:s}/{:s}'.format(exp.avgfolder,filename)
-      if not os.path.exists(filepath): raise IOError, "Source file '{:s}' does not exist!".format(filepath)        
-      # determine age of source file
-      fileage = datetime.fromtimestamp(os.path.getmtime(filepath))          
-      if srcage < fileage: srcage = fileage # use latest modification date
+  filelist = getSourceFiles(filelist=filelist, fileclasses=fileclasses, filetypes=filetypes, exp=exp, 
+                            domain=domain, periodstr=periodstr, gridstr=gridstr, lclim=lclim, lts=lts)
+  for filepath in filelist:
+    if not os.path.exists(filepath): raise IOError, "Source file '{:s}' does not exist!".format(filepath)        
+    # determine age of source file
+    fileage = datetime.fromtimestamp(os.path.getmtime(filepath))          
+    if srcage < fileage: srcage = fileage # use latest modification date
   # return latest modification date
   return srcage
 
+## recover temporary files from previous runs (for checkpoint/resume)
+def isProcessAlive(owner, heartbeat=None, lease=checkpoint_lease):
+  ''' check if the process that owns a file is still running ('host:pid'); processes on other hosts 
+      can not be checked directly and are assumed to be dead, once their lease has expired, i.e. if the 
+      last heartbeat (a time stamp) is more than 'lease' seconds old '''
+  host, pid = owner.rsplit(':',1)
+  if host != socket.gethostname(): return heartbeat is None or time.time() - heartbeat < lease
+  if int(pid) == os.getpid(): return False # left over from a previous job in this (persistent) worker
+  try: os.kill(int(pid), 0) # signal 0 only checks, if the process exists
+  except OSError as err: return err.errno != errno.ESRCH # EPERM means it exists (but belongs to someone else)
+  return True
+
+def getCheckpointOwner(filepath):
+  ''' read the checkpoint key, owner, target name and heartbeat from the attributes of a temporary NetCDF 
+      file (the heartbeat is the later of the attribute and the modification time); returns None, if the 
+      file can not be read or has no checkpoint attributes '''
+  import netCDF4 as nc
+  try:
+    with nc.Dataset(filepath, mode='r') as ncfile:
+      atts = ncfile.ncattrs()
+      if any(att not in atts for att in (checkpoint_att,owner_att,target_att)): return None
+      heartbeat = max(ncfile.getncattr(heartbeat_att) if heartbeat_att in atts else 0, os.path.getmtime(filepath))
+      return ncfile.getncattr(checkpoint_att), ncfile.getncattr(owner_att), ncfile.getncattr(target_att), heartbeat
+  except Exception: return None # e.g. truncated or still being created
+
+def getCheckpointFile(folder, filename, tmppfx='tmp_', key=None, lresume=True, lease=checkpoint_lease):
+  ''' move the most recent temporary file that a previous (crashed) run left behind for the same target 
+      file to a checkpoint file, from which completed variables can be recovered, and remove older ones; 
+      only files from processes that are no longer running (or whose lease has expired) are considered, 
+      and only files with the same checkpoint key (e.g. the build key) are recovered (unless key is None); 
+      returns the path of the checkpoint file or None (if lresume=False, all old files are removed) '''
+  ckptfile = folder + 'ckpt_' + filename
+  # parallel runs include the worker ID ('tmp_wrfavg_proc01_<filename>'); the name of a temporary file of 
+  # another target can also end in '_<filename>', so only the worker ID is matched
+  pattern = re.compile(re.escape(tmppfx) + r'(proc\d+_)?' + re.escape(filename) + '$')
+  tmpfiles = [folder + tmpfile for tmpfile in sorted(os.listdir(folder or '.')) if pattern.match(tmpfile)]
+  # N.B.: temporary files of other running processes, files of other targets and files that can not be 
+  #       identified (e.g. files that are just being created) are left alone
+  orphans = []
+  for tmpfile in tmpfiles:
+    owner = getCheckpointOwner(tmpfile)
+    if owner is None or owner[2] != filename: continue
+    if not isProcessAlive(owner[1], heartbeat=owner[3], lease=lease): orphans.append((tmpfile,owner[0]))
+  orphans.sort(key=lambda orphan: os.path.getmtime(orphan[0])) # most recent is last
+  recoverable = [tmpfile for tmpfile,ckptkey in orphans if key is None or ckptkey == key]
+  if lresume and len(recoverable) > 0: os.rename(recoverable[-1], ckptfile) # replaces old checkpoint
+  for tmpfile,ckptkey in orphans: 
+    if os.path.exists(tmpfile): os.remove(tmpfile)
+  if not lresume and os.path.exists(ckptfile): os.remove(ckptfile)
+  # return checkpoint file, if present
+  return ckptfile if os.path.exists(ckptfile) else None
+
+## determine source and target files of a job (for the task graph scheduler)
+def getJobFiles(dataset, mode, dataargs, grid=None, lwrite=True):
+  ''' determine source (input) and target (output) files of a processing job; 'grid' is used to construct 
+      the target filename (see getTargetFile) and the source files do not have to exist yet '''
+  dataargs, loadfct, srcage, datamsgstr = getMetaData(dataset, mode, dataargs.copy(), lcheck=False)
+  # N.B.: getMetaData can modify dataargs, so we work on a copy
+  filename = getTargetFile(dataset=dataset, mode=mode, dataargs=dataargs, lwrite=lwrite, grid=grid, 
+                           period=None, filetype=None)
+  return dataargs.filelist, [dataargs.avgfolder + filename]
+
 ## determine dataset metadata
-def getMetaData(dataset, mode, dataargs, lone=True):
-  ''' determine dataset type and meta data, as well as path to main source file '''
+def getPointLoader(module, lclim, station=None, shape=None, period=None, **kwargs):
+  ''' return a function that loads a station or shape dataset (climatology or time-series) from a dataset 
+      module; kwargs are passed on to the load function '''
+  if station:
+    if lclim: return partial(module.loadStationClimatology, station=station, period=period, **kwargs)
+    else: return partial(module.loadStationTimeSeries, station=station, **kwargs)
+  else:
+    if lclim: return partial(module.loadShapeClimatology, shape=shape, period=period, **kwargs)
+    else: return partial(module.loadShapeTimeSeries, shape=shape, **kwargs)
+
+def getMetaData(dataset, mode, dataargs, lone=True, lcheck=True):
+  ''' determine dataset type and meta data, as well as path to main source file; if lcheck=False, the 
+      source files are not checked (srcage is None), e.g. because they will be created by another job; 
+      station or shape datasets are loaded, if a 'station' or 'shape' argument is present (instead of a 
+      grid, these are also part of the file name) '''
   # determine dataset mode
   lclim = False; lts = False
   if mode == 'climatology': lclim = True
@@ -152,6 +236,12 @@ def getMetaData(dataset, mode, dataargs, lone=True):
   varlist = dataargs.get('varlist',None)
   grid = dataargs.get('grid',None) # get grid
   period = dataargs.get('period',None)
+  station = dataargs.get('station',None); shape = dataargs.get('shape',None) # station or shape datasets
+  if station and shape: raise DatasetError, "Only one of 'station' or 'shape' can be specified!"
+  if ( station or shape ) and grid: raise DatasetError, "Station or shape datasets have no grid!"
+  lpoint = bool(station or shape)
+  gridname = station or shape or grid # station and shape names take the place of the grid in file names
+  load3D = None # only for CESM
   # determine meta data based on dataset type
   if dataset == 'WRF': 
     # WRF datasets
@@ -161,7 +251,7 @@ def getMetaData(dataset, mode, dataargs, lone=True):
     avgfolder = exp.avgfolder
     filetypes = dataargs['filetypes']
     domain = dataargs.get('domain',None)
-    periodstr, gridstr = getPeriodGridString(period, grid, exp=exp)
+    periodstr, gridstr = getPeriodGridString(period, gridname, exp=exp)
     # check arguments
     if period is None and lclim: raise DatasetError, "A 'period' argument is required to load climatologies!"
     if lone and len(filetypes) > 1: raise DatasetError # process only one file at a time
@@ -170,11 +260,14 @@ def getMetaData(dataset, mode, dataargs, lone=True):
     if lone: 
       datamsgstr = "Processing WRF '{:s}'-file from Experiment '{:s}' (d{:02d})".format(filetypes[0], dataset_name, domain)
     else: datamsgstr = "Processing WRF dataset from Experiment '{:s}' (d{:02d})".format(dataset_name, domain)       
-    # figure out age of source file(s)
-    srcage = getSourceAge(fileclasses=WRF.fileclasses, filetypes=filetypes, exp=exp, domain=domain,
-                          periodstr=periodstr, gridstr=gridstr, lclim=lclim, lts=lts)
+    # figure out source file(s)
+    filelist = getSourceFiles(fileclasses=WRF.fileclasses, filetypes=filetypes, exp=exp, domain=domain,
+                              periodstr=periodstr, gridstr=gridstr, lclim=lclim, lts=lts)
     # load source data
-    if lclim:
+    if lpoint:
+      loadfct = getPointLoader(WRF, lclim, station=station, shape=shape, period=period, experiment=exp, 
+                               name=None, domains=domain, varlist=varlist, filetypes=filetypes, varatts=None)
+    elif lclim:
       loadfct = partial(WRF.loadWRF, experiment=exp, name=None, domains=domain, grid=grid, varlist=varlist,
                         period=period, filetypes=filetypes, varatts=None, lconst=True) # still want topography...
     elif lts:
@@ -187,7 +280,7 @@ def getMetaData(dataset, mode, dataargs, lone=True):
     exp = dataargs['experiment']  
     avgfolder = exp.avgfolder
     dataset_name = exp.name
-    periodstr, gridstr = getPeriodGridString(period, grid, exp=exp)
+    periodstr, gridstr = getPeriodGridString(period, gridname, exp=exp)
     filetypes = dataargs['filetypes']
     # check arguments
     if period is None and lclim: raise DatasetError, "A 'period' argument is required to load climatologies!"
@@ -196,12 +289,16 @@ def getMetaData(dataset, mode, dataargs, lone=True):
     if lone:
       datamsgstr = "Processing CESM '{:s}'-file from Experiment '{:s}'".format(filetypes[0], dataset_name) 
     else: datamsgstr = "Processing CESM dataset from Experiment '{:s}'".format(dataset_name) 
-    # figure out age of source file(s)
-    srcage = getSourceAge(fileclasses=CESM.fileclasses, filetypes=filetypes, exp=exp, domain=None,
-                          periodstr=periodstr, gridstr=gridstr, lclim=lclim, lts=lts)
+    # figure out source file(s)
+    filelist = getSourceFiles(fileclasses=CESM.fileclasses, filetypes=filetypes, exp=exp, domain=None,
+                              periodstr=periodstr, gridstr=gridstr, lclim=lclim, lts=lts)
     # load source data 
     load3D = dataargs.pop('load3D',None) # if 3D fields should be loaded (default: False)
-    if lclim:
+    if lpoint:
+      loadfct = getPointLoader(CESM, lclim, station=station, shape=shape, period=period, experiment=exp, 
+                               name=None, varlist=varlist, filetypes=filetypes, varatts=None, load3D=load3D, 
+                               translateVars=None)
+    elif lclim:
       loadfct = partial(CESM.loadCESM, experiment=exp, name=None, grid=grid, period=period, varlist=varlist, 
                         filetypes=filetypes, varatts=None, load3D=load3D, translateVars=None)
     elif lts:
@@ -217,35 +314,46 @@ def getMetaData(dataset, mode, dataargs, lone=True):
     if resolution: obs_res = '{0:s}_{1:s}'.format(dataset_name,resolution)
     else: obs_res = dataset_name   
     # figure out period
-    periodstr, gridstr = getPeriodGridString(period, grid, beginyear=1979)
+    periodstr, gridstr = getPeriodGridString(period, gridname, beginyear=1979)
     if period is None and lclim: periodstr = 'LTM'
     datamsgstr = "Processing Dataset '{:s}'".format(dataset_name)
     # assemble filename to check modification dates (should be only one file)    
-    filename = getFileName(grid=grid, period=period, name=obs_res, filetype=mode)
+    filename = getFileName(grid=gridname, period=period, name=obs_res, filetype=mode)
     avgfolder = module.avgfolder
     filepath = '{:s}/{:s}'.format(avgfolder,filename)
     # load pre-processed climatology
-    if lclim:
+    if lpoint:
+      loadfct = getPointLoader(module, lclim, station=station, shape=shape, period=period, name=dataset_name, 
+                               varlist=varlist, resolution=resolution, varatts=None)
+    elif lclim:
       loadfct = partial(module.loadClimatology, name=dataset_name, period=period, grid=grid, 
                         varlist=varlist, resolution=resolution, varatts=None)
     elif lts:
       loadfct = partial(module.loadTimeSeries, name=dataset_name, grid=grid, varlist=varlist,
                         resolution=resolution, varatts=None)
     # check if the source file is actually correct
-    if os.path.exists(filepath): filelist = [filepath]
+    if os.path.exists(filepath) or not lcheck: filelist = [filepath]
+    # N.B.: if the source is not checked, it may be created by another job (e.g. regridding), so 
+    #       the dataset is not loaded (and the filelist may be incomplete, if the file is not created)
     else:
       source = loadfct() # don't load dataset, just construct the file list
       filelist = source.filelist
-    # figure out age of source file(s)
-    srcage = getSourceAge(filelist=filelist, lclim=lclim, lts=lts)
-      # N.B.: it would be nice to print a message, but then we would have to make the logger available,
-      #       which would be too much trouble
   else:
     raise DatasetError, "Dataset '{:s}' not found!".format(dataset)
+  # figure out age of source file(s)
+  srcage = getSourceAge(filelist=filelist) if lcheck else None
+  # reuse open datasets in persistent workers (only if caching is enabled)
+  loadkey = (dataset, mode, dataset_name, obs_res, tuple(filetypes), domain, str(grid), str(period), str(varlist), load3D, 
+             station, shape)
+  loadfct = partial(cache.cachedLoad, 'datasets', loadkey, filelist, loadfct)
+  # N.B.: workers unload variables after every job, but keep the files open; cached datasets are shared
+  #       by all jobs in a worker, so jobs must not modify the source dataset (see utils.cache.cachedLoad)
+  # N.B.: it would be nice to print a message, but then we would have to make the logger available,
+  #       which would be too much trouble
   ## assemble and return meta data
   dataargs = namedTuple(dataset_name=dataset_name, period=period, periodstr=periodstr, avgfolder=avgfolder, 
                         filetypes=filetypes,filetype=filetypes[0], domain=domain, obs_res=obs_res, 
-                        varlist=varlist, grid=grid, gridstr=gridstr) 
+                        varlist=varlist, grid=grid, gridstr=gridstr, filelist=filelist, station=station, shape=shape) 
   # return meta data
   return dataargs, loadfct, srcage, datamsgstr    
 
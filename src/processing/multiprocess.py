@@ -12,10 +12,14 @@ import logging
 import sys
 import gc # garbage collection
 import types
-import os
+import os, shutil, tempfile
+import threading, pickle, Queue
 import numpy as np
+from collections import deque
 from datetime import datetime
-from time import sleep
+from time import sleep, time
+import utils.profiling as prof
+import utils.cache as cache
 
 
 ## test functions
@@ -95,6 +99,18 @@ def test_func_dec(n, wait=1, lparallel=False, pidstr='', logger=None, ldebug=Fal
   logger.info('{:s} Current Process ID: {:d}'.format(pidstr,pid))
   assert int(pidstr[-3:-1]) == pid
   
+def test_func_crash(n):
+  ''' test function that kills its (worker) process without returning '''
+  os._exit(n)
+
+def test_func_dag(inputs, output, wait=0.1, lparallel=False, pidstr='', logger=None, ldebug=False):
+  ''' test function for the task graph scheduler: all inputs have to exist '''
+  sleep(wait)
+  for filepath in inputs: 
+    if not os.path.exists(filepath): raise IOError, filepath
+  with open(output, 'w') as f: f.write(str(inputs))
+  logger.info('{:s} Wrote {:s}'.format(pidstr,output))
+  
 
 ## production functions
 
@@ -134,6 +150,7 @@ class TrialNError():
 
     # execute decorated function in try-block
     kwargs['logger'] = logger
+    prof.startJob(name='{:s}{:s}'.format(self.func.__name__,str(args[:2]))) # only if profiling is enabled
     try:
       # decorated function
       ec = self.func(*args, pidstr=pidstr, **kwargs)
@@ -144,15 +161,57 @@ class TrialNError():
       # an error occurred
       logging.exception(pidstr) # print stack trace of last exception and current process ID 
       return 1 # indicate failure
+    finally: prof.saveJob() # save profile of this job for aggregation
+
+
+def setupLogging(lparallel=False, ldebug=False, name='multiprocess.asyncPoolEC'):
+  ''' set up (parallel) logging for pool functions and return the logger '''
+  # logging level
+  if ldebug: loglevel = logging.DEBUG
+  else: loglevel = logging.INFO
+  # set up parallel logging (multiprocessing)
+  if lparallel:
+    multiprocessing.log_to_stderr()
+    mplogger = multiprocessing.get_logger()
+    #if ldebug: mplogger.setLevel(logging.DEBUG)
+    if ldebug: mplogger.setLevel(logging.INFO)
+    else: mplogger.setLevel(logging.ERROR)
+  # set up general logging
+  logger = logging.getLogger(name) # standard logger
+  logger.setLevel(loglevel)
+  ch = logging.StreamHandler(sys.stdout) # stdout, not stderr
+  ch.setLevel(loglevel)
+  ch.setFormatter(logging.Formatter('%(message)s'))
+  logger.addHandler(ch)
+  return logger
 
 
-def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
+def startProfiling(profile):
+  ''' enable profiling of pool functions, if a report file is given, and return the (temporary) folder 
+      where the workers save their reports (has to be called before the pool is created) '''
+  if profile is None: return None
+  folder = tempfile.mkdtemp(prefix='profile_')
+  prof.startProfiling(folder)
+  return folder
+
+def reportProfiling(profile, folder, logger):
+  ''' merge profiles of all jobs, write report to file and print a summary '''
+  if profile is None: return
+  report = prof.collectReports(folder)
+  prof.writeReport(report, profile)
+  logger.info(prof.printReport(report))
+  logger.info("\n   ***   Profile written to '{:s}'   ***   \n".format(profile))
+  prof.stopProfiling(); shutil.rmtree(folder)
+
+
+def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True, profile=None):
   ''' 
     A function that executes func with arguments args (len(args) times) on NP number of processors;
     args must be a list of argument tuples; kwargs are keyword arguments to func, which do not change
     between calls.
     Func is assumed to take a keyword argument lparallel to indicate parallel execution, and return 
     a common exit status (0 = no error, > 0 for an error code).
+    If a 'profile' file (JSON or CSV) is given, jobs are profiled and a merged report is written.
     This function returns the number of failures as the exit code. 
   '''
   # input checking
@@ -169,23 +228,8 @@ def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
   kwargs['ldebug'] = ldebug
   kwargs['lparallel'] = lparallel  
 
-  # logging level
-  if ldebug: loglevel = logging.DEBUG
-  else: loglevel = logging.INFO
-  # set up parallel logging (multiprocessing)
-  if lparallel:
-    multiprocessing.log_to_stderr()
-    mplogger = multiprocessing.get_logger()
-    #if ldebug: mplogger.setLevel(logging.DEBUG)
-    if ldebug: mplogger.setLevel(logging.INFO)
-    else: mplogger.setLevel(logging.ERROR)
-  # set up general logging
-  logger = logging.getLogger('multiprocess.asyncPoolEC') # standard logger
-  logger.setLevel(loglevel)
-  ch = logging.StreamHandler(sys.stdout) # stdout, not stderr
-  ch.setLevel(loglevel)
-  ch.setFormatter(logging.Formatter('%(message)s'))
-  logger.addHandler(ch)
+  # set up logging
+  logger = setupLogging(lparallel=lparallel, ldebug=ldebug, name='multiprocess.asyncPoolEC')
   kwargs['logger'] = logger.name
 #   # process sub logger
 #   sublogger = logging.getLogger('multiprocess.asyncPoolEC.func') # standard logger
@@ -200,6 +244,7 @@ def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
   
   # apply decorator
   if ltrialnerror: func = TrialNError(func)
+  profdir = startProfiling(profile) # N.B.: profiling requires the decorator
   
   # print first logging message
   logger.info(datetime.today())
@@ -245,10 +290,341 @@ def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
   else:
     logger.info('\n   ===   {:2d} operations completed successfully!    ===   \n'.format(nop) +
           '\n   ###   {:2d} operations did not complete/failed!   ###   \n'.format(exitcode))
+  reportProfiling(profile, profdir, logger)
   logger.info(datetime.today())
   # return with exit code
   return exitcode
 
+
+## persistent worker pool with affinity scheduling
+
+def _affinityWorker(inqueue, outqueue, initializer=None, initargs=()):
+  ''' worker loop for AffinityPool: execute tasks until None is received; module state (e.g. caches) 
+      persists across tasks '''
+  if initializer is not None: initializer(*initargs)
+  for task in iter(inqueue.get, None):
+    taskid, func, args, kwargs = pickle.loads(task)
+    try: result = pickle.dumps((taskid, (True, func(*args, **kwargs))), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as err:
+      try: result = pickle.dumps((taskid, (False, err)), protocol=pickle.HIGHEST_PROTOCOL)
+      except Exception: result = pickle.dumps((taskid, (False, Exception(str(err))))) # not all exceptions can be pickled
+    outqueue.put(result)
+
+class WorkerLostError(Exception):
+  ''' Exception for tasks whose worker process died, before the task was completed. '''
+  pass
+
+class AffinityResult(object):
+  ''' The result of a task in an AffinityPool (same interface as multiprocessing.pool.AsyncResult). '''
+  
+  def __init__(self):
+    ''' Initialize empty result. '''
+    self._event = threading.Event()
+    self._success = None; self._value = None
+    
+  def ready(self): return self._event.is_set()
+  
+  def successful(self): 
+    if not self.ready(): raise ValueError, 'Result is not ready!'
+    return self._success
+  
+  def wait(self, timeout=None): self._event.wait(timeout)
+  
+  def get(self, timeout=None):
+    ''' Wait for the result and return it (or raise the exception of the task). '''
+    self.wait(timeout)
+    if not self.ready(): raise multiprocessing.TimeoutError
+    if self._success: return self._value
+    else: raise self._value
+    
+  def _set(self, success, value):
+    self._success = success; self._value = value
+    self._event.set()
+
+
+class AffinityPool(object):
+  ''' 
+    A process pool with persistent workers, that routes tasks with the same affinity key (e.g. the same 
+    source files) to the same worker, so that caches in the worker (see utils.cache) are actually reused. 
+    Idle workers prefer tasks with a key they have recently processed, then tasks that no other worker 
+    has processed, and then any task (so that no worker is idle, while tasks are pending). 
+    If a worker process dies (e.g. it is killed by the OOM killer), its current task fails with a 
+    WorkerLostError, which is raised by the get method of the result, and the worker is replaced. 
+  '''
+  
+  def __init__(self, processes=None, initializer=None, initargs=(), history=4, interval=1.):
+    ''' Start worker processes and a thread that collects results; workers are checked every 'interval' seconds. '''
+    self._interval = interval
+    if processes is None: processes = multiprocessing.cpu_count()
+    self._outqueue = multiprocessing.Queue()
+    self._initializer = initializer; self._initargs = initargs
+    self._inqueues = [None]*processes; self._workers = [None]*processes
+    for i in xrange(processes): self._startWorker(i)
+    self._history = [deque(maxlen=history) for _ in self._workers] # recent affinity keys of each worker
+    self._busy = [None]*processes # ID of current task of each worker
+    self._tasks = [] # pending tasks
+    self._results = dict(); self._taskid = 0; self._closed = False
+    self._lock = threading.Lock()
+    self._collector = threading.Thread(target=self._collect)
+    self._collector.daemon = True; self._collector.start()
+    
+  def _startWorker(self, i):
+    ''' Start (or replace) a worker process with its own task queue. '''
+    self._inqueues[i] = multiprocessing.Queue()
+    # N.B.: TrialNError derives the process ID from the process name
+    worker = multiprocessing.Process(target=_affinityWorker, name='AffinityWorker-{:d}'.format(i+1), 
+                                     args=(self._inqueues[i], self._outqueue, self._initializer, self._initargs))
+    worker.daemon = True; worker.start()
+    self._workers[i] = worker
+    
+  def apply_async(self, func, args=(), kwds=None, affinity=None):
+    ''' Submit a task with an (optional) affinity key and return an AffinityResult. '''
+    if self._closed: raise ValueError, 'Pool is closed!'
+    result = AffinityResult()
+    with self._lock:
+      self._taskid += 1; self._results[self._taskid] = result
+      self._tasks.append((self._taskid, func, tuple(args), kwds or dict(), affinity))
+      self._dispatch()
+    return result
+  
+  def hasAffinity(self, key):
+    ''' Check if an idle worker has recently processed tasks with the same affinity key. '''
+    if key is None: return False
+    with self._lock:
+      return any(busy is None and key in history for busy,history in zip(self._busy,self._history))
+  
+  def _dispatch(self):
+    ''' Assign pending tasks to idle workers (the lock has to be held). '''
+    # 1) tasks with a key that an idle worker has processed recently go to that worker
+    for task in list(self._tasks):
+      worker = next((i for i,busy in enumerate(self._busy) if busy is None and task[4] in self._history[i]), None)
+      if task[4] is not None and worker is not None: self._submit(worker, task)
+    # 2) tasks with a key that no busy worker has processed go to the least associated idle worker
+    for task in list(self._tasks):
+      idle = [i for i,busy in enumerate(self._busy) if busy is None]
+      if not idle: return
+      if any(task[4] in self._history[i] for i,busy in enumerate(self._busy) if busy is not None): continue
+      self._submit(min(idle, key=lambda i: len(self._history[i])), task)
+    # 3) remaining tasks go to any idle worker (no worker should be idle, while tasks are pending)
+    for task in list(self._tasks):
+      idle = [i for i,busy in enumerate(self._busy) if busy is None]
+      if not idle: return
+      self._submit(idle[0], task)
+      
+  def _submit(self, worker, task):
+    ''' Send a task to a worker (the lock has to be held). '''
+    self._tasks.remove(task)
+    taskid, func, args, kwargs, key = task
+    try: payload = pickle.dumps((taskid, func, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as err: 
+      self._results.pop(taskid)._set(False, err); return # worker remains idle
+    history = self._history[worker]
+    if key is not None:
+      if key in history: history.remove(key)
+      history.append(key) # most recent last
+    self._busy[worker] = taskid
+    self._inqueues[worker].put(payload)
+      
+  def _checkWorkers(self):
+    ''' Fail the tasks of workers that died and replace them (the lock has to be held). '''
+    for i,worker in enumerate(self._workers):
+      if worker.is_alive(): continue
+      taskid = self._busy[i]
+      if taskid is not None:
+        self._busy[i] = None
+        err = WorkerLostError("Worker '{:s}' died with exit code {:s} (task {:d}).".format(worker.name,str(worker.exitcode),taskid))
+        self._results.pop(taskid)._set(False, err)
+      self._history[i].clear() # caches are lost
+      if not self._closed or self._tasks: self._startWorker(i)
+    self._dispatch()
+    
+  def _collect(self):
+    ''' Record results and assign new tasks to idle workers (runs in a thread); the workers are checked 
+        at most once per interval, whether results arrive or not. '''
+    lastcheck = time()
+    while True:
+      try: result = self._outqueue.get(timeout=self._interval)
+      except Queue.Empty: result = False
+      if result is None: break
+      with self._lock:
+        if result:
+          taskid, (success, value) = pickle.loads(result)
+          if taskid in self._busy: self._busy[self._busy.index(taskid)] = None
+          if taskid in self._results: self._results.pop(taskid)._set(success, value)
+          self._dispatch()
+        # N.B.: a steady stream of results from other workers must not delay detection of dead workers
+        if time() - lastcheck >= self._interval: 
+          self._checkWorkers(); lastcheck = time()
+        
+  def close(self):
+    ''' Prevent further submission of tasks. '''
+    self._closed = True
+    
+  def join(self):
+    ''' Wait for all tasks to complete and shut down workers (close has to be called first). '''
+    if not self._closed: raise ValueError, 'Pool is still running!'
+    while self._tasks or any(busy is not None for busy in self._busy): sleep(0.1)
+    # N.B.: tasks of workers that die are failed by the collector thread, so this does not block
+    for inqueue in self._inqueues: inqueue.put(None)
+    for worker in self._workers: worker.join()
+    self._outqueue.put(None); self._collector.join()
+    
+  def terminate(self):
+    ''' Stop workers immediately. '''
+    self._closed = True
+    for worker in self._workers: worker.terminate()
+    self._outqueue.put(None)
+
+
+## task graph scheduler
+
+class Job(object):
+  ''' 
+    A job for the task graph scheduler (asyncPoolDAG): a worker function with arguments, that declares 
+    its input and output files; a job depends on all jobs that produce one of its input files. 
+    'size' is the estimated source size in bytes (default: size of input files, once they exist) and 
+    'memory' is the estimated memory footprint in MB (default: equal to the source size). 
+    Jobs with the same 'affinity' key (default: the input files) are preferably executed by the same 
+    worker, if caching is enabled. 
+  '''
+  
+  def __init__(self, func, args=None, kwargs=None, inputs=None, outputs=None, size=None, memory=None, 
+               name=None, affinity=None):
+    ''' Save function and arguments and normalize file lists. '''
+    if not callable(func): raise TypeError
+    self.func = func
+    self.args = tuple(args) if args is not None else ()
+    self.kwargs = kwargs.copy() if kwargs is not None else dict()
+    self.inputs = [os.path.abspath(filepath) for filepath in inputs or []]
+    self.outputs = [os.path.abspath(filepath) for filepath in outputs or []]
+    self.size = size
+    self.memory = memory
+    self.name = name or '{:s}{:s}'.format(getattr(func,'__name__','job'),str(self.args[:2]))
+    self.affinity = affinity if affinity is not None else tuple(sorted(self.inputs)) or None
+    
+  def estimateSize(self):
+    ''' Estimate source size from the input files that exist (only called, when the job is ready). '''
+    if self.size is None:
+      self.size = sum(os.path.getsize(filepath) for filepath in self.inputs if os.path.exists(filepath))
+    if self.memory is None: self.memory = self.size / 1024.**2 # in MB
+    return self.size
+  
+
+def asyncPoolDAG(jobs, kwargs=None, NP=1, memory=None, ldebug=False, ltrialnerror=True, profile=None, lcache=False):
+  ''' 
+    A dependency-aware version of asyncPoolEC that executes a list of Job instances on NP processors; 
+    jobs are started as soon as all jobs that produce their input files have completed successfully, 
+    and ready jobs are started largest-first (by estimated source size), to reduce tail latency. 
+    If 'memory' (in MB) is given, jobs are only started, if the sum of their memory estimates does not 
+    exceed the limit (a single job is always admitted). Jobs that depend on failed jobs are not started 
+    and count as failures. kwargs are keyword arguments that are passed to all jobs. 
+    If a 'profile' file (JSON or CSV) is given, jobs are profiled and a merged report is written.
+    If 'lcache' is True, workers keep open datasets, GridDefinitions and shape masks across jobs (see 
+    utils.cache) and jobs that share inputs are routed to the same worker (see AffinityPool). 
+    This function returns the number of failures as the exit code. 
+  '''
+  # input checking
+  if not isinstance(jobs,(list,tuple)) or not all(isinstance(job,Job) for job in jobs): raise TypeError
+  if kwargs is None: kwargs = dict()
+  elif not isinstance(kwargs,dict): raise TypeError
+  if NP is not None and not isinstance(NP,int): raise TypeError
+  if memory is not None and not isinstance(memory,(int,float,np.number)): raise TypeError
+  if not isinstance(ldebug,(bool,np.bool)): raise TypeError
+  if not isinstance(ltrialnerror,(bool,np.bool)): raise TypeError
+  
+  # figure out if running parallel
+  if NP is not None and NP == 1: lparallel = False
+  else: lparallel = True
+  if NP is None: NP = multiprocessing.cpu_count()
+  kwargs = kwargs.copy()
+  kwargs['ldebug'] = ldebug
+  kwargs['lparallel'] = lparallel  
+  logger = setupLogging(lparallel=lparallel, ldebug=ldebug, name='multiprocess.asyncPoolDAG')
+  kwargs['logger'] = logger.name
+  
+  ## construct task graph
+  producers = dict()
+  for i,job in enumerate(jobs):
+    for filepath in job.outputs:
+      if filepath in producers: raise ValueError, "File '{:s}' is produced by more than one job!".format(filepath)
+      producers[filepath] = i
+  depends = [set(producers[filepath] for filepath in job.inputs if filepath in producers) - set([i]) 
+             for i,job in enumerate(jobs)]
+  
+  # print first logging message
+  logger.info(datetime.today())
+  logger.info('\nTHREADS: {0:s}, MEMORY: {1:s}, JOBS: {2:d}, DEBUG: {3:s}\n'.format(str(NP),str(memory),len(jobs),str(ldebug)))
+  
+  ## loop over and process jobs as they become ready
+  profdir = startProfiling(profile) # N.B.: profiling requires the decorator
+  if lparallel and lcache: pool = AffinityPool(processes=NP, initializer=cache.enableCaching)
+  elif lparallel: pool = multiprocessing.Pool(processes=NP)
+  elif lcache: cache.enableCaching() # in this process
+  pending = set(xrange(len(jobs))); ready = []; running = dict(); exitcodes = dict()
+  while pending or ready or running:
+    # find jobs that are ready or can never run
+    for i in sorted(pending):
+      if any(exitcodes.get(j,0) > 0 for j in depends[i]):
+        logger.info('\n   ###   Skipping {:s}: a dependency failed!   ###   \n'.format(jobs[i].name))
+        exitcodes[i] = 1; pending.remove(i)
+      elif all(j in exitcodes for j in depends[i]):
+        jobs[i].estimateSize(); ready.append(i); pending.remove(i)
+    if not ready and not running:
+      # N.B.: only possible, if there is a circular dependency
+      for i in pending: 
+        logger.info('\n   ###   Skipping {:s}: circular dependency!   ###   \n'.format(jobs[i].name))
+        exitcodes[i] = 1
+      break
+    # start ready jobs, largest first (and jobs that an idle worker has cached inputs for), subject to memory admission
+    if lparallel and lcache: ready.sort(key=lambda i: (pool.hasAffinity(jobs[i].affinity), jobs[i].size), reverse=True)
+    else: ready.sort(key=lambda i: jobs[i].size, reverse=True)
+    for i in list(ready):
+      if len(running) >= NP: break
+      if memory is not None and running and sum(jobs[j].memory for j in running) + jobs[i].memory > memory: continue
+      ready.remove(i)
+      func = TrialNError(jobs[i].func) if ltrialnerror else jobs[i].func
+      jobkwargs = jobs[i].kwargs.copy(); jobkwargs.update(kwargs)
+      logger.debug('\n   ***   Starting {:s} ({:.1f} MB)   ***   \n'.format(jobs[i].name,jobs[i].memory))
+      if lparallel and lcache: running[i] = pool.apply_async(func, jobs[i].args, jobkwargs, affinity=jobs[i].affinity)
+      elif lparallel: running[i] = pool.apply_async(func, jobs[i].args, jobkwargs) # AsyncResult
+      else: running[i] = func(*jobs[i].args, **jobkwargs) # exit code
+    # wait for jobs to finish and record exit codes
+    finished = dict()
+    while running and not finished:
+      for i,result in running.iteritems():
+        if not lparallel: finished[i] = result
+        elif result.ready():
+          try: finished[i] = result.get()
+          except Exception: 
+            logging.exception(jobs[i].name) # only without TrialNError
+            finished[i] = 1
+      if not finished: sleep(0.1) # poll
+    for i,ec in finished.iteritems():
+      del running[i]
+      if ec is None: ec = 0 
+      elif ec < 0: raise ValueError, 'Exit codes have to be zero or positive!'
+      exitcodes[i] = 1 if ec > 0 else 0
+  if lparallel:
+    pool.close()
+    pool.join() 
+    logger.debug('\n   ***   all processes joined   ***   \n')
+  elif lcache: cache.disableCaching() # close cached files
+    
+  # evaluate exit codes    
+  exitcode = sum(exitcodes.values())
+  nop = len(jobs) - exitcode
+  # print summary (to log)
+  if exitcode == 0:
+    logger.info('\n   >>>   All {:d} operations completed successfully!!!   <<<   \n'.format(nop))
+  else:
+    logger.info('\n   ===   {:2d} operations completed successfully!    ===   \n'.format(nop) +
+          '\n   ###   {:2d} operations did not complete/failed!   ###   \n'.format(exitcode))
+  reportProfiling(profile, profdir, logger)
+  logger.info(datetime.today())
+  # return with exit code
+  return exitcode
+
+
 def apply_along_axis(fct, axis, data, NP=0, chunksize=200, ldebug=False, laax=True, *args, **kwargs):
   ''' a parallelized version of numpy's apply_along_axis; the preferred way of passing arguments is,
       by using functools.partial, but arguments can also be passed to this function; the call-signature
@@ -0,0 +1,89 @@
+'''
+Created on 2016-04-28
+
+A script that chains several processing steps (wrfavg, regrid, exstns and shpavg) into one task graph:
+the job lists of all steps are combined and processed by one scheduler (asyncPoolDAG or the job queue),
+so that e.g. a regridding job starts as soon as the climatology it depends on has been computed,
+rather than after all climatologies are done. Dependencies between steps are derived from the source
+and target files of the jobs (see getJobFiles in processing.misc).
+
+The configuration file (pipeline.yaml) has one section for each step, with the same keys as the YAML
+file of the step; alternatively, a section can be the path of a YAML file of the step. The global
+settings (NP and loverwrite) apply to all steps.
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import os
+import yaml
+from importlib import import_module
+# internal imports
+from processing.multiprocess import asyncPoolDAG
+from processing.jobqueue import runQueue
+from processing.misc import loadYAML
+
+# processing steps in the order in which their job lists are assembled
+step_list = ('wrfavg', 'regrid', 'exstns', 'shpavg')
+
+
+## function to assemble the job lists of all steps
+def getPipelineJobs(config, loverwrite=False):
+  ''' construct a combined job list from the configuration sections of all processing steps that are
+      present in the configuration; sections can also be paths to YAML files '''
+  jobs = []
+  for step in step_list:
+    section = config.get(step,None)
+    if section is None: continue
+    if isinstance(section,basestring):
+      with open(section) as f: section = yaml.load(f, Loader=yaml.Loader)
+    # N.B.: the module of each step provides a getJobs function (the main program is not executed)
+    module = import_module('processing.{0:s}'.format(step))
+    print('\n ***   Assembling {:s} jobs   ***   '.format(step))
+    jobs += module.getJobs(section, loverwrite=loverwrite)
+  return jobs
+
+
+if __name__ == '__main__':
+
+  ## read environment variables
+  # number of processes NP
+  if os.environ.has_key('PYAVG_THREADS'):
+    NP = int(os.environ['PYAVG_THREADS'])
+  else: NP = None
+  # memory limit for admission control (in MB)
+  if os.environ.has_key('PYAVG_MEMORY'):
+    memory = float(os.environ['PYAVG_MEMORY'])
+  else: memory = None
+  # write a profiling report (JSON or CSV)
+  if os.environ.has_key('PYAVG_PROFILE'):
+    profile = os.environ['PYAVG_PROFILE']
+  else: profile = None
+  # process jobs through a queue file on a shared file system (other nodes can join as workers)
+  if os.environ.has_key('PYAVG_QUEUE'):
+    queuefile = os.environ['PYAVG_QUEUE']
+  else: queuefile = None
+  # keep datasets, grids and masks open/cached in workers across jobs and route jobs by shared inputs
+  if os.environ.has_key('PYAVG_CACHE'):
+    lcache =  os.environ['PYAVG_CACHE'] == 'CACHE'
+  else: lcache = False
+  # run script in debug mode
+  if os.environ.has_key('PYAVG_DEBUG'):
+    ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG'
+  else: ldebug = False
+
+  ## load YAML configuration (there is no interactive mode)
+  config = loadYAML('pipeline.yaml', lfeedback=True)
+  NP = NP or config['NP']
+  loverwrite = config['loverwrite']
+
+  # assemble combined job list
+  jobs = getPipelineJobs(config, loverwrite=loverwrite)
+
+  ## call parallel execution function
+  if queuefile:
+    ec = runQueue(jobs, queuefile, NP=NP, ldebug=ldebug, profile=profile)
+  else:
+    ec = asyncPoolDAG(jobs, NP=NP, memory=memory, ldebug=ldebug, ltrialnerror=True, profile=profile, lcache=lcache)
+  # exit with fraction of failures (out of 10) as exit code
+  exit(int(10+int(10.*ec/len(jobs))) if ec > 0 else 0)
@@ -13,7 +13,7 @@ Simple methods for copying and averaging variables will already be provided in t
 import numpy as np
 import numpy.ma as ma
 import functools
-import gc
+import gc, os, json, tempfile, shutil, atexit, socket, time
 from osgeo import gdal, osr
 # internal imports
 from geodata.misc import VariableError, AxisError, PermissionError, DatasetError, GDALError, ArgumentError #, DateError
@@ -23,18 +23,98 @@ from utils.nctools import writeNetCDF
 from geodata.gdal import addGDALtoDataset, GridDefinition, gdalInterp,\
   NamedShape
 from collections import OrderedDict
+import utils.profiling as prof
+import utils.cache as cache
+from processing.manifest import getGridID
 # default data types
 dtype_int = np.dtype('int16')
 dtype_float = np.dtype('float32')
+# NetCDF attributes used for checkpointing
+checkpoint_att = 'checkpoint_key' # identifies the computation (e.g. the build key from the manifest)
+completed_att = 'completed_vars' # comma-separated list of variables that have been written completely
+owner_att = 'checkpoint_owner' # host and process ID of the process that writes the file ('host:pid')
+target_att = 'checkpoint_target' # name of the target file (the temporary file is renamed to this)
+heartbeat_att = 'checkpoint_heartbeat' # time of the last update (a lease for owners on other hosts)
 
 class ProcessError(Exception):
   ''' Error class for exceptions occurring in methods of the CPU (CentralProcessingUnit). '''
   pass
 
+class ScratchStore(object):
+  ''' A scratch backend for temporary datasets: the data of intermediate Variables is written to raw 
+      (uncompressed) .npy files and replaced by copy-on-write memory maps, so that the next processing 
+      step reads them without decompression and the OS pages data in and out as needed. The files are 
+      unlinked as soon as they are mapped, so their space is released with the last reference. '''
+  
+  def __init__(self, folder=None):
+    ''' Create a private scratch folder (in the system temp folder, if no folder is given); use 
+        getScratchStore to obtain the store of the current process. '''
+    if folder is not None and not os.path.exists(folder): raise IOError, "Scratch folder '{:s}' does not exist!".format(folder)
+    self.parent = folder
+    self.pid = os.getpid()
+    self.folder = None
+    self.counter = 0
+    self.nbytes = 0
+    
+  def close(self):
+    ''' Remove the scratch folder (existing memory maps remain valid, because the files are unlinked); 
+        the folder is created again, when the next array is mapped. '''
+    if self.folder is not None and self.pid == os.getpid(): shutil.rmtree(self.folder, True)
+    self.folder = None
+    
+  def mapArray(self, array):
+    ''' Write an array to a scratch file and return a memory map of it. '''
+    if self.folder is None: self.folder = tempfile.mkdtemp(prefix='scratch_', dir=self.parent)
+    self.counter += 1
+    filepath = os.path.join(self.folder,'{:d}.npy'.format(self.counter))
+    np.save(filepath, array)
+    mmap = np.load(filepath, mmap_mode='c') # copy-on-write: in-place operations don't modify the file
+    os.remove(filepath) # the mapping remains valid
+    self.nbytes += array.nbytes
+    return mmap
+    
+  def spill(self, var):
+    ''' Replace the data of a Variable with a memory map (masks are mapped separately). '''
+    data = var.data_array
+    if data is None or isinstance(ma.getdata(data),np.memmap) or data.ndim == 0: return var
+    mmap = self.mapArray(np.asarray(ma.getdata(data)))
+    if isinstance(data,ma.MaskedArray) or np.issubdtype(mmap.dtype, np.inexact):
+      # N.B.: the map is always wrapped in a masked array, so that invalid values are not masked on load
+      mask = ma.getmask(data)
+      if mask is not ma.nomask: mask = self.mapArray(mask)
+      mmap = ma.MaskedArray(mmap, mask=mask, copy=False,
+                              fill_value=data.fill_value if isinstance(data,ma.MaskedArray) else None)
+    var.unload(); var.load(data=mmap)
+    return var
+    
+  
+_scratch_store = None # the scratch store of the current process (see getScratchStore)
+
+def getScratchStore(folder=None):
+  ''' Return the scratch store of the current process; a new store is only created, if the scratch folder 
+      changes or the process was forked. '''
+  global _scratch_store
+  store = _scratch_store
+  if store is None or store.pid != os.getpid() or store.parent != folder:
+    if store is not None: store.close() # only removes folders of this process
+    store = _scratch_store = ScratchStore(folder=folder)
+    atexit.register(store.close) # N.B.: atexit handlers do not run in pool workers (see closeScratchStore)
+  return store
+
+def closeScratchStore():
+  ''' Remove the scratch folder of the current process; this has to be called explicitly in worker 
+      processes, because they exit without calling atexit handlers. '''
+  if _scratch_store is not None: _scratch_store.close()
+    
+  
 class CentralProcessingUnit(object):
   
-  def __init__(self, source, target=None, varlist=None, ignorelist=None, tmp=True, feedback=True):
-    ''' Initialize processor and pass input and output datasets. '''
+  def __init__(self, source, target=None, varlist=None, ignorelist=None, tmp=True, feedback=True, ldefer=False, 
+               scratch=None):
+    ''' Initialize processor and pass input and output datasets; in deferred mode (ldefer=True), the 
+        next operation is only set up and variables are passed in by a MultiSinkUnit. If 'scratch' is 
+        a folder (or True for the system temp folder), intermediate results are memory-mapped from 
+        scratch files, instead of being kept in RAM (see ScratchStore). '''
     # check varlist
     if varlist is None: varlist = source.variables.keys() # all source variables
     elif not isinstance(varlist,(list,tuple)): raise TypeError
@@ -59,11 +139,21 @@ class CentralProcessingUnit(object):
     self.tmp = tmp
     if tmp: self.tmpput = Dataset(name='tmp', title='Temporary Dataset', varlist=[], atts={})
     else: self.tmpput = None
+    if scratch: self.scratch = getScratchStore(folder=None if scratch is True else scratch)
+    else: self.scratch = None
     # determine if temporary storage is used and assign target dataset
     if self.tmp: self.target = self.tmpput
     else: self.target = self.output 
     # whether or not to print status output
     self.feedback = feedback
+    # deferred processing (multi-sink mode)
+    self.ldefer = ldefer
+    self.deferred = None # operation and flush setting, once an operation has been set up
+    # checkpointing (see setCheckpoint)
+    self.checkpoint = None # key that identifies the computation
+    self.completed = [] # variables that have been written to the output dataset
+    self.resume = dict() # verified variables from a previous run that can be recovered
+    self.resumeds = None # dataset with the previous run's results
         
   def getTmp(self, asNC=False, filename=None, deepcopy=False, **kwargs):
     ''' Get a copy of the temporary data in dataset format. '''
@@ -131,34 +221,144 @@ class CentralProcessingUnit(object):
         self.source = self.tmpput
         self.target = self.output
         self.tmp = False # not using temporary storage anymore
+    # in deferred mode, only register the operation; variables will be passed in by a MultiSinkUnit
+    if self.ldefer:
+      if self.deferred is not None: raise ProcessError, "Only one operation can be deferred at a time."
+      self.deferred = (function, flush)
+      return # source will be updated in finish()
     # loop over input variables
     for varname in self.varlist:
       # check agaisnt ignore list
       if varname not in self.ignorelist: 
-        # check if variable already exists
-        if self.target.hasVariable(varname):
-          # "in-place" operations
-          var = self.target.variables[varname]         
-          newvar = function(var) # perform actual processing
-          if newvar.ndim != var.ndim or newvar.shape != var.shape: raise VariableError
-          if newvar is not var: self.target.replaceVariable(var,newvar)
-        elif self.source.hasVariable(varname):        
-          var = self.source.variables[varname]
-          ldata = var.data # whether data was pre-loaded 
-          # perform operation from source and copy results to target
-          newvar = function(var) # perform actual processing
-          if not ldata: var.unload() # if it was already loaded, don't unload        
-          self.target.addVariable(newvar, copy=True) # copy=True allows recasting as, e.g., a NC variable
-        else:
-          raise DatasetError, "Variable '%s' not found in input dataset."%varname
-        assert varname == newvar.name
-        # flush data to disk immediately      
-        if flush: 
-          self.output.variables[varname].unload() # again, free memory
-        newvar.unload(); del var, newvar # free space; already added to new dataset
+        self.processVariable(function, varname, flush=flush)
     # after everything is said and done:
     self.source = self.target # set target to source for next time
     
+  def processVariable(self, function, varname, source=None, flush=False):
+    ''' Apply an operation/function to a single variable and add the result to the target dataset; 
+        a different source dataset can be passed (e.g. a source that is shared in multi-sink mode). '''
+    if source is None: source = self.source
+    # recover variables that were completed in a previous run
+    if varname in self.resume:
+      if self.target is self.output: self.resumeVariable(varname)
+      return # skip intermediate steps; the result will be recovered in the final step
+    # check if variable already exists
+    if self.target.hasVariable(varname):
+      # "in-place" operations
+      var = self.target.variables[varname]         
+      with prof.timer('compute', varname): newvar = function(var) # perform actual processing
+      if newvar.ndim != var.ndim or newvar.shape != var.shape: raise VariableError
+      if newvar is not var: self.target.replaceVariable(var,newvar)
+      ldata = False
+    elif source.hasVariable(varname):        
+      var = source.variables[varname]
+      ldata = var.data # whether data was pre-loaded 
+      # perform operation from source and copy results to target
+      with prof.timer('compute', varname): newvar = function(var) # perform actual processing
+      if not ldata: var.unload() # if it was already loaded, don't unload        
+      with prof.timer('write', varname): 
+        self.target.addVariable(newvar, copy=True) # copy=True allows recasting as, e.g., a NC variable
+    else:
+      raise DatasetError, "Variable '%s' not found in input dataset."%varname
+    assert varname == newvar.name
+    # move intermediate results to scratch files (memory-mapped)
+    if self.scratch is not None and self.target is not self.output:
+      with prof.timer('write', varname): self.scratch.spill(self.target.variables[varname])
+    # flush data to disk immediately      
+    if flush: 
+      with prof.timer('write', varname): self.output.variables[varname].unload() # again, free memory
+    if newvar is not var or not ldata: newvar.unload() # don't unload pre-loaded source variables
+    del var, newvar # free space; already added to new dataset
+    # record completed variable
+    if self.checkpoint is not None and self.target is self.output: self.recordVariable(varname)
+    
+  def setCheckpoint(self, key, filepath=None, target=None):
+    ''' Enable checkpointing for a NetCDF output dataset: completed variables are recorded in the NetCDF 
+        attributes, along with a key that identifies the computation (e.g. the build key), the name of the 
+        target file and a heartbeat; if a file from a previous run with the same key is passed, verified 
+        variables will be recovered from it. '''
+    if not isinstance(self.output,DatasetNetCDF): raise DatasetError, "Checkpointing requires a NetCDF output dataset."
+    if not isinstance(key,basestring): raise TypeError
+    if target is not None and not isinstance(target,basestring): raise TypeError
+    self.checkpoint = key; self.completed = []
+    owner = '{:s}:{:d}'.format(socket.gethostname(), os.getpid()) # process that writes the output
+    for att,value in ((checkpoint_att,key),(owner_att,owner),(target_att,target)):
+      if value is None: continue
+      self.output.atts[att] = value
+      self.output.dataset.setncattr(att, value)
+    self.updateHeartbeat() # also makes attributes visible to other processes (see getCheckpointFile)
+    # open previous results and verify variables
+    if filepath is not None and os.path.exists(filepath):
+      try:
+        folder, filename = os.path.split(filepath)
+        resumeds = DatasetNetCDF(folder=folder+'/', filelist=[filename], mode='r')
+      except Exception: resumeds = None # e.g. truncated file (this is not an error)
+      if resumeds is not None and resumeds.atts.get(checkpoint_att,None) == key:
+        for varname in resumeds.atts.get(completed_att,'').split(','):
+          if varname in self.varlist and resumeds.hasVariable(varname):
+            var = resumeds.variables[varname]
+            try: var.load(); lvalid = var.data_array.shape == var.shape # make sure data can be read 
+            except Exception: lvalid = False
+            var.unload()
+            if lvalid: self.resume[varname] = var
+        self.resumeds = resumeds
+      if self.feedback and self.resume: 
+        print('\n   +++   recovering {:d} variables from {:s}   +++   '.format(len(self.resume),filepath))
+    
+  def resumeVariable(self, varname):
+    ''' Copy a completed variable from a previous run to the output dataset. '''
+    var = self.resume[varname]
+    for ax in var.axes:
+      if self.output.hasAxis(ax.name) and len(self.output.axes[ax.name]) != len(ax): 
+        raise ProcessError, "Axis '{:s}' of recovered Variable '{:s}' is inconsistent with output.".format(ax.name,varname)
+    if self.feedback: print('\n'+varname+' (recovered)'),
+    var.load()
+    self.output.addVariable(var, copy=True) # written in recordVariable
+    var.unload()
+    self.recordVariable(varname)
+    self.output.variables[varname].unload() # free memory
+    
+  def recordVariable(self, varname):
+    ''' Write a completed variable to disk and record it in the NetCDF attributes of the output. '''
+    if varname not in self.completed: self.completed.append(varname)
+    self.output.variables[varname].sync() # make sure data is on disk
+    completed = ','.join(self.completed)
+    self.output.atts[completed_att] = completed
+    self.output.dataset.setncattr(completed_att, completed)
+    self.updateHeartbeat()
+    
+  def updateHeartbeat(self):
+    ''' Record the current time in the NetCDF attributes of the output, to show that it is still being 
+        written (owners on other hosts can not be checked directly, see getCheckpointFile). '''
+    heartbeat = time.time()
+    self.output.atts[heartbeat_att] = heartbeat
+    self.output.dataset.setncattr(heartbeat_att, heartbeat)
+    self.output.dataset.sync()
+    
+  def clearCheckpoint(self):
+    ''' Remove checkpoint attributes from the output dataset and close the previous run's results. '''
+    for att in (checkpoint_att,completed_att,owner_att,target_att,heartbeat_att):
+      if att in self.output.atts: del self.output.atts[att]
+      if att in self.output.dataset.ncattrs(): self.output.dataset.delncattr(att)
+    if self.resumeds is not None: self.resumeds.close()
+    self.checkpoint = None; self.resume = dict(); self.resumeds = None
+    
+  def finish(self):
+    ''' Complete a deferred operation, after all variables have been passed in (multi-sink mode); 
+        subsequent operations are processed normally (i.e. not deferred). '''
+    if self.deferred is None: raise ProcessError, "No deferred operation to finish."
+    # add GDAL functionality to variables in target, since they were added after the setup
+    tgt = self.target
+    if tgt.__dict__.get('gdal',False): griddef = tgt.griddef # e.g. regridding
+    elif self.input.gdal and tgt.hasAxis(self.input.xlon.name) and tgt.hasAxis(self.input.ylat.name): 
+      griddef = self.input.griddef # e.g. climatology (same grid as source)
+    else: griddef = None # e.g. shape averages and station data
+    if griddef is not None: self.target = addGDALtoDataset(tgt, griddef=griddef)
+    if self.tmp: self.tmpput = self.target
+    # reset and set target to source for next time
+    self.deferred = None; self.ldefer = False
+    self.source = self.target
+    
     
   ## functions (or function pairs, rather) that perform operations on the data
   # every function pair needs to have a setup function and a processing function
@@ -169,8 +369,8 @@ class CentralProcessingUnit(object):
                    memory=500, **kwargs):
     ''' Average over a limited area of a gridded datasets; calls processAverageShape. 
         A dictionary of NamedShape objects is expected to define the averaging areas. 
-        'memory' controls the garbage collection interval and approximately corresponds 
-        to MB in temporary (it does not include loading the variable into RAM, though). '''
+        'memory' limits the number of shapes that are averaged at once and approximately 
+        corresponds to MB in temporary (it does not include loading the variable into RAM, though). '''
     if not self.source.gdal: raise DatasetError, "Source dataset must be GDAL enabled! {:s} is not.".format(self.source.name)
     if not isinstance(shape_dict,OrderedDict): raise TypeError
     if not all(isinstance(shape,NamedShape) for shape in shape_dict.itervalues()): raise TypeError
@@ -232,8 +432,13 @@ class CentralProcessingUnit(object):
     mask_array = np.zeros((len(shpax),)+srcgrd.size[::-1], dtype=np.bool) 
     # N.B.: rasterize() returns mask in (y,x) shape, size is ordered as (x,y)
     shape_masks = []; shp_full = []; shp_empty = []; shp_encl = []
+    gridkey = json.dumps(getGridID(srcgrd), sort_keys=True) # masks are cached in persistent workers
     for i,shape in enumerate(shape_dict.itervalues()):
-      mask = shape.rasterize(griddef=srcgrd, asVar=False)
+      def rasterize(shape=shape):
+        prof.count('gdal_rasterize')
+        return shape.rasterize(griddef=srcgrd, asVar=False)
+      with prof.timer('gdal', 'shp_mask'): 
+        mask = cache.cachedLoad('masks', (shape.name, gridkey), [shape.shapefile], rasterize)
       mask_array[i,:] = mask
       masksum = mask.sum() 
       lfull = masksum == 0; shp_full.append( lfull )
@@ -276,8 +481,8 @@ class CentralProcessingUnit(object):
     if ltmptoo: assert self.tmpput.name == 'tmptoo' # set above, when temp. dataset is created    
   # the previous method sets up the process, the next method performs the computation
   def processShapeAverage(self, var, masks=None, ylat=None, xlon=None, shpax=None, memory=500):
-    ''' Compute masked area averages from variable data. 'memory' controls the garbage collection 
-        interval approximately corresponds to MB in RAM.'''
+    ''' Compute masked area averages from variable data; shapes are averaged in chunks, so that the 
+        temporary weights and masks of each chunk approximately fit into 'memory' MB. ''' 
     # process gdal variables (if a variable has a horiontal grid, it should be GDAL enabled)
     if var.gdal and ( np.issubdtype(var.dtype,np.integer) or np.issubdtype(var.dtype,np.inexact) ):
       if self.feedback: print('\n'+var.name),
@@ -303,36 +508,28 @@ class CentralProcessingUnit(object):
       if self.feedback: 
         varname = var.name
         print '\n ... averaging ',varname 
-      ## compute shape averages for each time step
-      # Basically, for each shape the entire array is masked, using the shape and the broadcasting 
-      # functionality for horizontal masks of the Variable class (which creates a lot of overhead);
-      # then the masked average is taken and the process is repeated for the next shape/mask.
-      # Using mapMean creates a lot of overhead and there are probably more efficient ways to do it. 
-      if var.ndim == 2:
-        for i,mask in enumerate(masks): 
-          if mask is None: tgtdata[i] = np.NaN # NaN for missing values (i.e. no overlap)
-          else: tgtdata[i] = var.mapMean(mask=mask, asVar=False, squeeze=True) # compute the averages
-          if self.feedback: print varname, i
-          # garbage collection is typically not necessary for 2D fields
-      elif var.ndim > 2:
-        cnt = float(0.); inc = float(var.data_array.nbytes) / (1024.*1024.) # counter/increment to estimate memory useage (in MB)
-        for i,mask in enumerate(masks):
-          if mask is None: tgtdata[i,:] = np.NaN # NaN for missing values (i.e. no overlap) 
-          else:
-            tgtdata[i,:] = var.mapMean(mask=mask, asVar=False, squeeze=True).filled(np.NaN) # mapMean returns a masked array
-            # N.B.: this is necessary, because sometimes shapes only contain invalid values
-            cnt += inc # keep track of memory
-            # N.B.: mapMean creates a lot of temporary arrays that don't get garbage-collected
-          if self.feedback: print varname, i, cnt
-          if cnt > memory: 
-            cnt = 0 # reset counter
-            gc.collect() # collect garbage in certain itnervals
-            if self.feedback: print 'garbage collected'  
-      else: raise AxisError 
+      ## compute shape averages for chunks of shapes and all time steps at once
+      # The masks of a chunk are stacked and passed to mapMean, which computes area-weighted averages 
+      # for all shapes with a single tensordot over all leading axes (without broadcasting the masks);
+      # mapMean allocates weights and a validity mask for every shape and map point, and the results
+      # for every shape and all leading axes, so the chunk size is limited by 'memory'.
+      tgtdata[:] = np.NaN # NaN for missing values (i.e. no overlap)
+      ishp = [i for i,mask in enumerate(masks) if mask is not None]
+      npts = var.mapSize[0]*var.mapSize[1]; nlead = var.data_array.size // npts
+      shpmem = ( npts*9. + nlead*8. ) / (1024.*1024.) # approximate temporary memory per shape in MB
+      nchunk = max(1, int(memory / shpmem)) # number of shapes per chunk
+      for i0 in xrange(0, len(ishp), nchunk):
+        ichk = ishp[i0:i0+nchunk]
+        mask_stack = np.concatenate([masks[i].reshape((1,)+masks[i].shape) for i in ichk], axis=0)
+        means = var.mapMean(mask=mask_stack, asVar=False, squeeze=True).filled(np.NaN) # masked array
+        # N.B.: this is necessary, because sometimes shapes only contain invalid values
+        tgtdata[ichk,...] = np.rollaxis(means, -1) # the shape axis is last in mapMean output 
+        del means, mask_stack
+        if self.feedback: print varname, ichk[-1]
       # create new Variable
       assert shape == tgtdata.shape
       newvar = var.copy(axes=axes, data=tgtdata) # new axes and data
-      del tgtdata, mask # clean up (just to make sure)      
+      del tgtdata # clean up (just to make sure)      
       gc.collect() # clean
     else:
       var.load() # need to load variables into memory to copy it (and we are not doing anything else...)
@@ -416,10 +613,11 @@ class CentralProcessingUnit(object):
       if src.zs.axisIndex(xlon.name) == 0: zs.transpose() # assuming lat,lon or y,x order is more common
       ye,xe = zs.shape # assuming order lat,lon or y,x
       xe -= 1; ye -= 1 # last valid index, not length
-      for n,lon,lat in zip(xrange(len(stnax)),lons,lats):
-        ip = xlon.getIndex(lon, mode='left', outOfBounds=True)
-        jp = ylat.getIndex(lat, mode='left', outOfBounds=True)
-        if ip is not None and jp is not None:
+      # look up indices for all stations at once
+      ips, ioob = xlon.getIndexArray(lons, mode='left', lmask=True)
+      jps, joob = ylat.getIndexArray(lats, mode='left', lmask=True)
+      for n,ip,jp,xoob,yoob in zip(xrange(len(stnax)),ips,jps,ioob,joob):
+        if not ( xoob or yoob ): # skip out-of-bounds stations
           # find neighboring point with smallest altitude error 
 #           ip = im+1 if im < xe else im  
 #           jp = jm+1 if jm < ye else jm
@@ -434,14 +632,12 @@ class CentralProcessingUnit(object):
               if zd < zdiff: ii,jj,zdiff,zerr = i,j,zd,ze # preliminary selection, triggers at least once               
           ixlon.append(ii); iylat.append(jj); istn.append(n); zs_err.append(zerr) # final selection          
     else: 
-      # just choose horizontally closest point 
-      for n,lon,lat in zip(xrange(len(stnax)),lons,lats):
-        i = xlon.getIndex(lon, mode='closest', outOfBounds=True)
-        j = ylat.getIndex(lat, mode='closest', outOfBounds=True)
-        if i is not None and j is not None: 
-          if lzs: # compute elevation error
-            zs_err.append(zs[j,i]-stn_zs[n])          
-          ixlon.append(i); iylat.append(j); istn.append(n)
+      # just choose horizontally closest point (vectorized)
+      ixlon, ioob = xlon.getIndexArray(lons, mode='closest', lmask=True)
+      iylat, joob = ylat.getIndexArray(lats, mode='closest', lmask=True)
+      istn = np.where(np.logical_not(np.logical_or(ioob,joob)))[0] # valid stations
+      ixlon = ixlon[istn]; iylat = iylat[istn]
+      if lzs: zs_err = zs[iylat,ixlon]-stn_zs[istn] # compute elevation error
     # N.B.: it is necessary to append, because we don't know the number of valid points
     ixlon = np.array(ixlon, dtype='int'); iylat = np.array(iylat, dtype='int')
     istn = np.array(istn, dtype='int'); zs_err = np.array(zs_err, dtype='float')
@@ -617,8 +813,9 @@ class CentralProcessingUnit(object):
       # if necessary, shift array back, to ensure proper wrapping of coordinates
       # prepare regridding
       # get GDAL dataset instances
-      srcdata = var.getGDAL(load=True, wrap360=lwrapSrc)
-      tgtdata = newvar.getGDAL(load=False, wrap360=lwrapTgt, allocate=True, fillValue=var.fillValue)
+      with prof.timer('gdal'):
+        srcdata = var.getGDAL(load=True, wrap360=lwrapSrc)
+        tgtdata = newvar.getGDAL(load=False, wrap360=lwrapTgt, allocate=True, fillValue=var.fillValue)
       # determine GDAL interpolation
       if 'gdal_interp' in var.__dict__: gdal_interp = var.gdal_interp
       elif 'gdal_interp' in var.atts: gdal_interp = var.atts['gdal_interp'] 
@@ -626,7 +823,9 @@ class CentralProcessingUnit(object):
         if np.issubdtype(var.dtype, np.integer): gdal_interp = int_interp # can't process logicals anyway...
         else: gdal_interp = float_interp                          
       # perform regridding
-      err = gdal.ReprojectImage(srcdata, tgtdata, var.projection.ExportToWkt(), newvar.projection.ExportToWkt(), gdal_interp)
+      with prof.timer('gdal'):
+        err = gdal.ReprojectImage(srcdata, tgtdata, var.projection.ExportToWkt(), newvar.projection.ExportToWkt(), gdal_interp)
+      prof.count('gdal_reproject')
       #print srcdata.ReadAsArray().std(), tgtdata.ReadAsArray().std()
       #print var.projection.ExportToWkt()
       #print newvar.projection.ExportToWkt()
@@ -636,7 +835,7 @@ class CentralProcessingUnit(object):
       if err != 0: raise GDALError, 'ERROR CODE %i'%err
       #tgtdata.FlushCash()  
       # load data into new variable
-      newvar.loadGDAL(tgtdata, mask=lmask, wrap360=lwrapTgt, fillValue=var.fillValue)      
+      with prof.timer('gdal'): newvar.loadGDAL(tgtdata, mask=lmask, wrap360=lwrapTgt, fillValue=var.fillValue)      
       del tgtdata # clean up (just to make sure)
     else:
       var.load() # need to load variables into memory, because we are not doing anything else...
@@ -804,3 +1003,64 @@ class CentralProcessingUnit(object):
     # return variable
     return newvar
 
+
+class MultiSinkUnit(object):
+  ''' A class that passes every variable of a shared source dataset to several processing units (sinks), 
+      so that each variable is only loaded once, no matter how many products are generated from it. 
+      Sinks are added with addSink, which returns a CentralProcessingUnit in deferred mode; after one 
+      operation (e.g. Climatology, Regrid, ShapeAverage or Extract) has been set up for every sink, 
+      process() performs all operations in a single pass over the source variables. 
+      N.B.: source variables are loaded whole, one at a time (not in time chunks), because the operations 
+            of the CentralProcessingUnit work on complete variables, so that peak memory is one source 
+            variable plus the outputs; sinks have to share a source dataset within one job, i.e. at the 
+            moment this is used to compute the climatologies of all periods in wrfavg, while regrid, 
+            shpavg and exstns jobs still load their sources separately (they are independent jobs with 
+            their own build records and checkpoints). '''
+  
+  def __init__(self, source, varlist=None, ignorelist=None, feedback=True):
+    ''' Initialize shared source dataset and default variable and ignore lists. '''
+    if not isinstance(source,Dataset): raise TypeError
+    if isinstance(source,DatasetNetCDF) and not 'r' in source.mode: raise PermissionError
+    self.source = source
+    self.varlist = varlist
+    self.ignorelist = ignorelist
+    self.feedback = feedback
+    self.sinks = [] # list of CentralProcessingUnits
+    
+  def addSink(self, target=None, varlist=None, ignorelist=None, tmp=False, feedback=None, scratch=None):
+    ''' Add a new sink/target dataset and return a CentralProcessingUnit in deferred mode. '''
+    if varlist is None: varlist = self.varlist
+    if ignorelist is None: ignorelist = self.ignorelist
+    if ignorelist is not None: ignorelist = list(ignorelist) # each unit can modify its own list
+    if feedback is None: feedback = self.feedback
+    CPU = CentralProcessingUnit(self.source, target, varlist=varlist, ignorelist=ignorelist, tmp=tmp, 
+                                feedback=feedback, ldefer=True, scratch=scratch)
+    self.sinks.append(CPU)
+    return CPU
+  
+  def process(self):
+    ''' Load every source variable once (completely) and pass it to all sinks that need it; then finish all 
+        operations. '''
+    sinks = [CPU for CPU in self.sinks if CPU.deferred is not None]
+    if len(sinks) < len(self.sinks): raise ProcessError, "No operation has been set up for some sinks."
+    # variables in the order of the source dataset, followed by variables that are not in the source
+    varlist = [varname for varname in self.source.variables.iterkeys() 
+               if any(varname in CPU.varlist for CPU in sinks)]
+    for CPU in sinks: varlist += [varname for varname in CPU.varlist if varname not in varlist]
+    if self.feedback: print('\n   +++   processing {:d} sinks in one pass   +++   '.format(len(sinks)))
+    for varname in varlist:
+      consumers = [CPU for CPU in sinks if varname in CPU.varlist and varname not in CPU.ignorelist]
+      if len(consumers) == 0: continue
+      # load variable once for all sinks (unless it is not needed from the source)
+      var = self.source.variables.get(varname,None)
+      lload = var is not None and not var.data and any(not CPU.target.hasVariable(varname) and 
+                                                       varname not in CPU.resume for CPU in consumers)
+      if lload: var.load()
+      for CPU in consumers:
+        function, flush = CPU.deferred
+        CPU.processVariable(function, varname, source=self.source, flush=flush)
+      if lload: var.unload() # free memory before the next variable is loaded
+      del var; gc.collect()
+    # complete operations (add GDAL functionality etc.)
+    for CPU in sinks: CPU.finish()
+    if self.feedback: print('\n')
@@ -10,7 +10,6 @@ A script to reproject and resample datasets in this package onto a given grid.
 import os # check if files are present
 import numpy as np
 from importlib import import_module
-from datetime import datetime
 import logging     
 # internal imports
 from geodata.misc import DateError, printList
@@ -19,9 +18,11 @@ from geodata.base import Dataset
 from geodata.gdal import GDALError, GridDefinition, addGeoLocator
 from datasets import gridded_datasets
 from datasets.common import addLengthAndNamesOfMonth, getCommonGrid
-from processing.multiprocess import asyncPoolEC
+from processing.multiprocess import asyncPoolDAG, Job
+from processing.jobqueue import runQueue
 from processing.process import CentralProcessingUnit
-from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML
+from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML, getJobFiles, getCheckpointFile
+from processing.manifest import checkBuild, recordBuild, getGridID
 
 
 # worker function that is to be passed to asyncPool for parallel execution; use of the decorator is assumed
@@ -66,18 +67,19 @@ def performRegridding(dataset, mode, griddef, dataargs, loverwrite=False, varlis
       tmpfilename = tmppfx + filename      
     filepath = avgfolder + filename
     tmpfilepath = avgfolder + tmpfilename
-    if os.path.exists(filepath): 
-      if not loverwrite: 
-        age = datetime.fromtimestamp(os.path.getmtime(filepath))
-        # if source file is newer than sink file or if sink file is a stub, recompute, otherwise skip
-        if age > srcage and os.path.getsize(filepath) > 1e6: lskip = True
-        # N.B.: NetCDF files smaller than 1MB are usually incomplete header fragments from a previous crashed
-      if not lskip: os.remove(filepath) # recompute
+    # check build manifest: skip, if inputs, parameters and code have not changed since the file was written
+    params = dict(mode=mode, varlist=varlist, grid=getGridID(griddef), period=periodstr)
+    lskip, reason, build = checkBuild(filepath, inputs=dataargs.filelist, params=params, 
+                                      code=(performRegridding, CentralProcessingUnit))
+    if loverwrite: lskip = False
+    if os.path.exists(filepath) and not lskip: 
+      logger.info("\n{:s}   >>>   Recomputing file '{:s}' ({:s})\n".format(pidstr,filename,reason or 'overwrite'))
+      os.remove(filepath) # recompute
   
-  # depending on last modification time of file or overwrite setting, start computation, or skip
+  # depending on build manifest or overwrite setting, start computation, or skip
   if lskip:        
     # print message
-    skipmsg =  "\n{:s}   >>>   Skipping: file '{:s}' in dataset '{:s}' already exists and is newer than source file.".format(pidstr,filename,dataset_name)
+    skipmsg =  "\n{:s}   >>>   Skipping: file '{:s}' in dataset '{:s}' already exists and is up-to-date.".format(pidstr,filename,dataset_name)
     skipmsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
     logger.info(skipmsg)              
   else:
@@ -105,12 +107,16 @@ def performRegridding(dataset, mode, griddef, dataargs, loverwrite=False, varlis
       
     # make new dataset
     if lwrite: # write to NetCDF file 
+      # recover completed variables from a previous (crashed) run, if possible
+      ckptfile = None if lreturn else getCheckpointFile(avgfolder, filename, tmppfx='tmp_regrid_', key=build['key'], 
+                                                                   lresume=not loverwrite)
       if os.path.exists(tmpfilepath): os.remove(tmpfilepath) # remove old temp files 
       sink = DatasetNetCDF(folder=avgfolder, filelist=[tmpfilename], atts=atts, mode='w')
     else: sink = Dataset(atts=atts) # ony create dataset in memory
     
     # initialize processing
     CPU = CentralProcessingUnit(source, sink, varlist=varlist, tmp=False, feedback=ldebug)
+    if lwrite and not lreturn: CPU.setCheckpoint(build['key'], filepath=ckptfile, target=filename) # record completed variables
   
     # perform regridding (if target grid is different from native grid!)
     if griddef.name != dataset:
@@ -133,6 +139,7 @@ def performRegridding(dataset, mode, griddef, dataargs, loverwrite=False, varlis
       logger.info('\n'+str(sink)+'\n')   
     # write results to file
     if lwrite:
+      if not lreturn: CPU.clearCheckpoint() # remove checkpoint attributes
       sink.sync()
       writemsg =  "\n{:s}   >>>   Writing to file '{:s}' in dataset {:s}".format(pidstr,filename,dataset_name)
       writemsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
@@ -143,6 +150,8 @@ def performRegridding(dataset, mode, griddef, dataargs, loverwrite=False, varlis
         sink.unload(); sink.close(); del sink # destroy all references 
         if os.path.exists(filepath): os.remove(filepath) # remove old file
         os.rename(tmpfilepath,filepath) # this would also overwrite the old file...
+        recordBuild(filepath, build) # add to build manifest
+        if ckptfile: os.remove(ckptfile) # results have been recovered
       # N.B.: there is no temporary file if the dataset is returned, because an open file can't be renamed
         
     # clean up and return
@@ -154,6 +163,141 @@ def performRegridding(dataset, mode, griddef, dataargs, loverwrite=False, varlis
     # N.B.: garbage is collected in multi-processing wrapper
 
 
+# function to assemble the job list from a configuration dictionary
+def getJobs(config, loverwrite=False):
+  ''' construct the list of regridding jobs from a configuration dictionary (same keys as regrid.yaml); 
+      jobs declare their source and target files, so that the job lists of several processing steps 
+      can be combined into one task graph (see processing.pipeline) '''
+  # source data specs
+  modes = config['modes']
+  varlist = config['varlist']
+  periods = config['periods']
+  # Datasets
+  datasets = config['datasets']
+  resolutions = config['resolutions']
+  lLTM = config['lLTM']
+  # CESM
+  CESM_project = config['CESM_project']
+  CESM_experiments = config['CESM_experiments']
+  CESM_filetypes = config['CESM_filetypes']
+  load3D = config['load3D']
+  # WRF
+  WRF_project = config['WRF_project']
+  WRF_experiments = config['WRF_experiments']
+  WRF_filetypes = config['WRF_filetypes']
+  domains = config['domains']
+  # target data specs
+  grids = config['grids']
+  
+  ## process arguments    
+  if isinstance(periods, (np.integer,int)): periods = [periods]
+  # check and expand WRF experiment list
+  WRF_experiments = getExperimentList(WRF_experiments, WRF_project, 'WRF')
+  if isinstance(domains, (np.integer,int)): domains = [domains]
+  # check and expand CESM experiment list
+  CESM_experiments = getExperimentList(CESM_experiments, CESM_project, 'CESM')
+  # expand datasets and resolutions
+  if datasets is None: datasets = gridded_datasets  
+  
+  # print an announcement
+  if len(WRF_experiments) > 0:
+    print('\n Regridding WRF Datasets:')
+    print([exp.name for exp in WRF_experiments])
+  if len(CESM_experiments) > 0:
+    print('\n Regridding CESM Datasets:')
+    print([exp.name for exp in CESM_experiments])
+  if len(datasets) > 0:
+    print('\n And Observational Datasets:')
+    print(datasets)
+  print('\n To Grid and Resolution:')
+  for grid,reses in grids.iteritems():
+    print('   {0:s} {1:s}'.format(grid,printList(reses) if reses else ''))
+  print('\nOVERWRITE: {0:s}\n'.format(str(loverwrite)))
+  
+    
+  ## construct argument list
+  args = []  # list of job packages
+  # loop over modes
+  for mode in modes:
+    # only climatology mode has periods    
+    if mode == 'climatology': 
+      periodlist = periods if isinstance(periods, (tuple,list)) else (periods,)
+    elif mode == 'time-series': 
+      periodlist = (None,) # ignore periods
+    else: raise NotImplementedError, "Unrecognized Mode: '{:s}'".format(mode)
+
+    # loop over target grids ...
+    for grid,reses in grids.iteritems():
+      # ... and resolutions
+      if reses is None: reses = (None,)
+      for res in reses:
+        
+        # load target grid definition
+        griddef = getCommonGrid(grid, res=res)
+        # check if grid was defined properly
+        if not isinstance(griddef,GridDefinition): 
+          raise GDALError, 'No valid grid defined! (grid={0:s})'.format(grid)        
+        
+        # observational datasets (grid depends on dataset!)
+        for dataset in datasets:
+          mod = import_module('datasets.{0:s}'.format(dataset))
+          if isinstance(resolutions,dict): 
+            if dataset not in resolutions: resolutions[dataset] = ('',)
+            elif not isinstance(resolutions[dataset],(list,tuple)): resolutions[dataset] = (resolutions[dataset],)                
+          elif resolutions is not None: raise TypeError                                
+          if mode == 'climatology':
+            # some datasets come with a climatology 
+            if lLTM:
+              if resolutions is None: dsreses = mod.LTM_grids
+              elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.LTM_grids]  
+              for dsres in dsreses: 
+                args.append( (dataset, mode, griddef, dict(varlist=varlist, period=None, resolution=dsres)) ) # append to list
+            # climatologies derived from time-series
+            if resolutions is None: dsreses = mod.TS_grids
+            elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.TS_grids]  
+            for dsres in dsreses:
+              for period in periodlist:
+                args.append( (dataset, mode, griddef, dict(varlist=varlist, period=period, resolution=dsres)) ) # append to list            
+          elif mode == 'time-series': 
+            # regrid the entire time-series
+            if resolutions is None: dsreses = mod.TS_grids
+            elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.TS_grids]  
+            for dsres in dsreses:
+              args.append( (dataset, mode, griddef, dict(varlist=varlist, period=None, resolution=dsres)) ) # append to list            
+        
+        # CESM datasets
+        for experiment in CESM_experiments:
+          for filetype in CESM_filetypes:
+            for period in periodlist:
+              # arguments for worker function: dataset and dataargs       
+              args.append( ('CESM', mode, griddef, dict(experiment=experiment, varlist=varlist, filetypes=[filetype], 
+                                                        period=period, load3D=load3D)) )
+        # WRF datasets
+        for experiment in WRF_experiments:
+          for filetype in WRF_filetypes:
+            # effectively, loop over domains
+            if domains is None:
+              tmpdom = range(1,experiment.domains+1)
+            else: tmpdom = domains
+            for domain in tmpdom:
+              for period in periodlist:
+                # arguments for worker function: dataset and dataargs       
+                args.append( ('WRF', mode, griddef, dict(experiment=experiment, varlist=varlist, filetypes=[filetype], 
+                                                         domain=domain, period=period)) )
+      
+  # static keyword arguments
+  kwargs = dict(loverwrite=loverwrite, varlist=varlist)
+  
+  # declare input and output files of each job
+  jobs = []
+  for arguments in args:
+    inputs, outputs = getJobFiles(arguments[0], arguments[1], arguments[3], grid=arguments[2].name.lower())
+    jobs.append(Job(performRegridding, args=arguments, kwargs=kwargs, inputs=inputs, outputs=outputs, 
+                    name='{:s} to {:s}'.format(arguments[0],arguments[2].name)))
+  
+  return jobs
+
+
 if __name__ == '__main__':
   
   ## read environment variables
@@ -161,6 +305,22 @@ if __name__ == '__main__':
   if os.environ.has_key('PYAVG_THREADS'): 
     NP = int(os.environ['PYAVG_THREADS'])
   else: NP = None
+  # memory limit for admission control (in MB)
+  if os.environ.has_key('PYAVG_MEMORY'): 
+    memory = float(os.environ['PYAVG_MEMORY'])
+  else: memory = None
+  # write a profiling report (JSON or CSV)
+  if os.environ.has_key('PYAVG_PROFILE'): 
+    profile = os.environ['PYAVG_PROFILE']
+  else: profile = None
+  # process jobs through a queue file on a shared file system (other nodes can join as workers)
+  if os.environ.has_key('PYAVG_QUEUE'): 
+    queuefile = os.environ['PYAVG_QUEUE']
+  else: queuefile = None
+  # keep datasets, grids and masks open/cached in workers across jobs and route jobs by shared inputs
+  if os.environ.has_key('PYAVG_CACHE'): 
+    lcache =  os.environ['PYAVG_CACHE'] == 'CACHE' 
+  else: lcache = False
   # run script in debug mode
   if os.environ.has_key('PYAVG_DEBUG'): 
     ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -181,26 +341,6 @@ if __name__ == '__main__':
     # read config object
     NP = NP or config['NP']
     loverwrite = config['loverwrite']
-    # source data specs
-    modes = config['modes']
-    varlist = config['varlist']
-    periods = config['periods']
-    # Datasets
-    datasets = config['datasets']
-    resolutions = config['resolutions']
-    lLTM = config['lLTM']
-    # CESM
-    CESM_project = config['CESM_project']
-    CESM_experiments = config['CESM_experiments']
-    CESM_filetypes = config['CESM_filetypes']
-    load3D = config['load3D']
-    # WRF
-    WRF_project = config['WRF_project']
-    WRF_experiments = config['WRF_experiments']
-    WRF_filetypes = config['WRF_filetypes']
-    domains = config['domains']
-    # target data specs
-    grids = config['grids']
   else:
     # settings for testing and debugging
 #     NP = 1 ; ldebug = True # for quick computations
@@ -278,108 +418,19 @@ if __name__ == '__main__':
 #     grids['cesm1x1'] = (None,) # CESM grid
 #     grids['NARR'] = (None,) # NARR grid
 #     grids['CRU'] = (None,) # CRU grid
-    
+    # collect settings in a configuration dictionary (same keys as YAML file)
+    config = dict(modes=modes, varlist=varlist, periods=periods, datasets=datasets, resolutions=resolutions,
+                  lLTM=lLTM, CESM_project=CESM_project, CESM_experiments=CESM_experiments,
+                  CESM_filetypes=CESM_filetypes, load3D=load3D, WRF_project=WRF_project,
+                  WRF_experiments=WRF_experiments, WRF_filetypes=WRF_filetypes, domains=domains, grids=grids)
   
-  ## process arguments    
-  if isinstance(periods, (np.integer,int)): periods = [periods]
-  # check and expand WRF experiment list
-  WRF_experiments = getExperimentList(WRF_experiments, WRF_project, 'WRF')
-  if isinstance(domains, (np.integer,int)): domains = [domains]
-  # check and expand CESM experiment list
-  CESM_experiments = getExperimentList(CESM_experiments, CESM_project, 'CESM')
-  # expand datasets and resolutions
-  if datasets is None: datasets = gridded_datasets  
-  
-  # print an announcement
-  if len(WRF_experiments) > 0:
-    print('\n Regridding WRF Datasets:')
-    print([exp.name for exp in WRF_experiments])
-  if len(CESM_experiments) > 0:
-    print('\n Regridding CESM Datasets:')
-    print([exp.name for exp in CESM_experiments])
-  if len(datasets) > 0:
-    print('\n And Observational Datasets:')
-    print(datasets)
-  print('\n To Grid and Resolution:')
-  for grid,reses in grids.iteritems():
-    print('   {0:s} {1:s}'.format(grid,printList(reses) if reses else ''))
-  print('\nOVERWRITE: {0:s}\n'.format(str(loverwrite)))
-  
-    
-  ## construct argument list
-  args = []  # list of job packages
-  # loop over modes
-  for mode in modes:
-    # only climatology mode has periods    
-    if mode == 'climatology': 
-      periodlist = periods if isinstance(periods, (tuple,list)) else (periods,)
-    elif mode == 'time-series': 
-      periodlist = (None,) # ignore periods
-    else: raise NotImplementedError, "Unrecognized Mode: '{:s}'".format(mode)
-
-    # loop over target grids ...
-    for grid,reses in grids.iteritems():
-      # ... and resolutions
-      if reses is None: reses = (None,)
-      for res in reses:
-        
-        # load target grid definition
-        griddef = getCommonGrid(grid, res=res)
-        # check if grid was defined properly
-        if not isinstance(griddef,GridDefinition): 
-          raise GDALError, 'No valid grid defined! (grid={0:s})'.format(grid)        
-        
-        # observational datasets (grid depends on dataset!)
-        for dataset in datasets:
-          mod = import_module('datasets.{0:s}'.format(dataset))
-          if isinstance(resolutions,dict): 
-            if dataset not in resolutions: resolutions[dataset] = ('',)
-            elif not isinstance(resolutions[dataset],(list,tuple)): resolutions[dataset] = (resolutions[dataset],)                
-          elif resolutions is not None: raise TypeError                                
-          if mode == 'climatology':
-            # some datasets come with a climatology 
-            if lLTM:
-              if resolutions is None: dsreses = mod.LTM_grids
-              elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.LTM_grids]  
-              for dsres in dsreses: 
-                args.append( (dataset, mode, griddef, dict(varlist=varlist, period=None, resolution=dsres)) ) # append to list
-            # climatologies derived from time-series
-            if resolutions is None: dsreses = mod.TS_grids
-            elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.TS_grids]  
-            for dsres in dsreses:
-              for period in periodlist:
-                args.append( (dataset, mode, griddef, dict(varlist=varlist, period=period, resolution=dsres)) ) # append to list            
-          elif mode == 'time-series': 
-            # regrid the entire time-series
-            if resolutions is None: dsreses = mod.TS_grids
-            elif isinstance(resolutions,dict): dsreses = [dsres for dsres in resolutions[dataset] if dsres in mod.TS_grids]  
-            for dsres in dsreses:
-              args.append( (dataset, mode, griddef, dict(varlist=varlist, period=None, resolution=dsres)) ) # append to list            
-        
-        # CESM datasets
-        for experiment in CESM_experiments:
-          for filetype in CESM_filetypes:
-            for period in periodlist:
-              # arguments for worker function: dataset and dataargs       
-              args.append( ('CESM', mode, griddef, dict(experiment=experiment, varlist=varlist, filetypes=[filetype], 
-                                                        period=period, load3D=load3D)) )
-        # WRF datasets
-        for experiment in WRF_experiments:
-          for filetype in WRF_filetypes:
-            # effectively, loop over domains
-            if domains is None:
-              tmpdom = range(1,experiment.domains+1)
-            else: tmpdom = domains
-            for domain in tmpdom:
-              for period in periodlist:
-                # arguments for worker function: dataset and dataargs       
-                args.append( ('WRF', mode, griddef, dict(experiment=experiment, varlist=varlist, filetypes=[filetype], 
-                                                         domain=domain, period=period)) )
-      
-  # static keyword arguments
-  kwargs = dict(loverwrite=loverwrite, varlist=varlist)
+  # assemble job list
+  jobs = getJobs(config, loverwrite=loverwrite)
   
   ## call parallel execution function
-  ec = asyncPoolEC(performRegridding, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  if queuefile:
+    ec = runQueue(jobs, queuefile, NP=NP, ldebug=ldebug, profile=profile)
+  else:
+    ec = asyncPoolDAG(jobs, NP=NP, memory=memory, ldebug=ldebug, ltrialnerror=True, profile=profile, lcache=lcache)
   # exit with fraction of failures (out of 10) as exit code
-  exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
+  exit(int(10+int(10.*ec/len(jobs))) if ec > 0 else 0)
@@ -11,7 +11,6 @@ Adapted from regrid.py.
 import os # check if files are present
 import numpy as np
 from importlib import import_module
-from datetime import datetime
 import logging   
 from collections import OrderedDict
 # internal imports
@@ -19,8 +18,10 @@ from geodata.misc import DateError, printList
 from geodata.netcdf import DatasetNetCDF
 from geodata.base import Dataset
 from datasets import gridded_datasets
-from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML
-from processing.multiprocess import asyncPoolEC
+from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML, getJobFiles, getCheckpointFile
+from processing.manifest import checkBuild, recordBuild
+from processing.multiprocess import asyncPoolDAG, Job
+from processing.jobqueue import runQueue
 from processing.process import CentralProcessingUnit
 
 # import shape objects
@@ -70,18 +71,20 @@ def performShapeAverage(dataset, mode, shape_name, shape_dict, dataargs, loverwr
       tmpfilename = tmppfx + filename      
     filepath = avgfolder + filename
     tmpfilepath = avgfolder + tmpfilename
-    if os.path.exists(filepath): 
-      if not loverwrite: 
-        age = datetime.fromtimestamp(os.path.getmtime(filepath))
-        # if source file is newer than sink file or if sink file is a stub, recompute, otherwise skip
-        if age > srcage and os.path.getsize(filepath) > 1e4: lskip = True
-        # N.B.: NetCDF files smaller than 10kB are usually incomplete header fragments from a previous crashed
-      if not lskip: os.remove(filepath) # recompute
+    # check build manifest: skip, if inputs, parameters and code have not changed since the file was written
+    params = dict(mode=mode, varlist=varlist, shapes=shape_dict.keys(), period=periodstr)
+    inputs = dataargs.filelist + [shape.shapefile for shape in shape_dict.itervalues()] # shapefiles are inputs
+    lskip, reason, build = checkBuild(filepath, inputs=inputs, params=params, 
+                                      code=(performShapeAverage, CentralProcessingUnit))
+    if loverwrite: lskip = False
+    if os.path.exists(filepath) and not lskip: 
+      logger.info("\n{:s}   >>>   Recomputing file '{:s}' ({:s})\n".format(pidstr,filename,reason or 'overwrite'))
+      os.remove(filepath) # recompute
   
-  # depending on last modification time of file or overwrite setting, start computation, or skip
+  # depending on build manifest or overwrite setting, start computation, or skip
   if lskip:        
     # print message
-    skipmsg =  "\n{:s}   >>>   Skipping: file '{:s}' in dataset '{:s}' already exists and is newer than source file.".format(pidstr,filename,dataset_name)
+    skipmsg =  "\n{:s}   >>>   Skipping: file '{:s}' in dataset '{:s}' already exists and is up-to-date.".format(pidstr,filename,dataset_name)
     skipmsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
     logger.info(skipmsg)              
   else:
@@ -108,12 +111,16 @@ def performShapeAverage(dataset, mode, shape_name, shape_dict, dataargs, loverwr
     atts['title'] = 'Area Averages from {:s} {:s}'.format(dataset_name,mode.title())
     # make new dataset
     if lwrite: # write to NetCDF file 
+      # recover completed variables from a previous (crashed) run, if possible
+      ckptfile = None if lreturn else getCheckpointFile(avgfolder, filename, tmppfx='tmp_{:s}_'.format(shape_name), 
+                                                                   key=build['key'], lresume=not loverwrite)
       if os.path.exists(tmpfilepath): os.remove(tmpfilepath) # remove old temp files 
       sink = DatasetNetCDF(folder=avgfolder, filelist=[tmpfilename], atts=atts, mode='w')
     else: sink = Dataset(atts=atts) # ony create dataset in memory
     
     # initialize processing
     CPU = CentralProcessingUnit(source, sink, varlist=varlist, tmp=False, feedback=ldebug)
+    if lwrite and not lreturn: CPU.setCheckpoint(build['key'], filepath=ckptfile, target=filename) # record completed variables
   
     # extract data at station locations
     CPU.ShapeAverage(shape_dict=shape_dict, shape_name=shape_name, flush=True)
@@ -125,6 +132,7 @@ def performShapeAverage(dataset, mode, shape_name, shape_dict, dataargs, loverwr
       logger.info('\n'+str(sink)+'\n')   
     # write results to file
     if lwrite:
+      if not lreturn: CPU.clearCheckpoint() # remove checkpoint attributes
       sink.sync()
       writemsg =  "\n{:s}   >>>   Writing to file '{:s}' in dataset {:s}".format(pidstr,filename,dataset_name)
       writemsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
@@ -135,6 +143,8 @@ def performShapeAverage(dataset, mode, shape_name, shape_dict, dataargs, loverwr
         sink.unload(); sink.close(); del sink # destroy all references 
         if os.path.exists(filepath): os.remove(filepath) # remove old file
         os.rename(tmpfilepath,filepath)
+        recordBuild(filepath, build) # add to build manifest
+        if ckptfile: os.remove(ckptfile) # results have been recovered
       # N.B.: there is no temporary file if the dataset is returned, because an open file can't be renamed
         
     # clean up and return
@@ -146,108 +156,33 @@ def performShapeAverage(dataset, mode, shape_name, shape_dict, dataargs, loverwr
     # N.B.: garbage is collected in multi-processing wrapper
 
 
-if __name__ == '__main__':
+# function to assemble the job list from a configuration dictionary
+def getJobs(config, loverwrite=False):
+  ''' construct the list of shape averaging jobs from a configuration dictionary (same keys as shpavg.yaml); 
+      jobs declare their source and target files, so that the job lists of several processing steps 
+      can be combined into one task graph (see processing.pipeline) '''
+  # source data specs
+  modes = config['modes']
+  varlist = config['varlist']
+  periods = config['periods']
+  # Datasets
+  datasets = config['datasets']
+  resolutions = config['resolutions']
+  lLTM = config['lLTM']
+  # CESM
+  CESM_project = config['CESM_project']
+  CESM_experiments = config['CESM_experiments']
+  CESM_filetypes = config['CESM_filetypes']
+  load3D = config['load3D']
+  # WRF
+  WRF_project = config['WRF_project']
+  WRF_experiments = config['WRF_experiments']
+  WRF_filetypes = config['WRF_filetypes']
+  domains = config['domains']
+  # target data specs
+  shape_name = config['shape_name']
+  shapes = config['shapes']
   
-  ## read environment variables
-  # number of processes NP 
-  if os.environ.has_key('PYAVG_THREADS'): 
-    NP = int(os.environ['PYAVG_THREADS'])
-  else: NP = None
-  # run script in debug mode
-  if os.environ.has_key('PYAVG_DEBUG'): 
-    ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
-  else: ldebug = False # i.e. append
-  # run script in batch or interactive mode
-  if os.environ.has_key('PYAVG_BATCH'): 
-    lbatch =  os.environ['PYAVG_BATCH'] == 'BATCH' 
-  else: lbatch = False # for debugging
-  # re-compute everything or just update 
-  if os.environ.has_key('PYAVG_OVERWRITE'): 
-    loverwrite =  os.environ['PYAVG_OVERWRITE'] == 'OVERWRITE' 
-  else: loverwrite = ldebug # False means only update old files
-  
-  ## define settings
-  if lbatch:
-    # load YAML configuration
-    config = loadYAML('shpavg.yaml', lfeedback=True)
-    # read config object
-    NP = NP or config['NP']
-    loverwrite = config['loverwrite']
-    # source data specs
-    modes = config['modes']
-    varlist = config['varlist']
-    periods = config['periods']
-    # Datasets
-    datasets = config['datasets']
-    resolutions = config['resolutions']
-    lLTM = config['lLTM']
-    # CESM
-    CESM_project = config['CESM_project']
-    CESM_experiments = config['CESM_experiments']
-    CESM_filetypes = config['CESM_filetypes']
-    load3D = config['load3D']
-    # WRF
-    WRF_project = config['WRF_project']
-    WRF_experiments = config['WRF_experiments']
-    WRF_filetypes = config['WRF_filetypes']
-    domains = config['domains']
-    # target data specs
-    shape_name = config['shape_name']
-    shapes = config['shapes']
-  else:
-#     NP = 1 ; ldebug = True # for quick computations
-    NP = 3 ; ldebug = False # for quick computations
-#     modes = ('time-series',) # 'climatology','time-series'
-    modes = ('time-series','climatology') 
-    loverwrite = True
-    varlist = None # ['T2']
-    periods = []
-#     periods += [1]
-#     periods += [3]
-#    periods += [5]
-#    periods += [10]
-    periods += [15]
-    # Observations/Reanalysis
-    lLTM = True 
-    datasets = []; resolutions = None
-    resolutions = {'CRU':'','GPCC':'05','NARR':'','CFSR':'05'}
-#     datasets += ['PRISM']; periods = None; lLTM = True
-#     datasets += ['PCIC','PRISM']; periods = None; lLTM = True
-#     datasets += ['CFSR']; resolutions = {'CFSR':'031'}
-    datasets += ['GPCC','Unity']
-    # CESM experiments (short or long name) 
-    CESM_project = None # use all experiments in project module
-    load3D = False
-    CESM_experiments = [] # use None to process all CESM experiments
-#     CESM_experiments += ['Ctrl-1']
-#     CESM_filetypes = ['atm'] # ,'lnd'
-    CESM_filetypes = ['lnd']
-    # WRF experiments (short or long name)
-    WRF_project = 'GreatLakes' # only use GreatLakes experiments
-    WRF_experiments = []
-#     WRF_experiments += ['erai-t', 'erai-g']
-#     WRF_experiments += ['g-ctrl', 'g-ctrl-2050', 'g-ctrl-2100']
-#     WRF_experiments += ['max-ctrl','max-ens-A','max-ens-B','max-ens-C',][1:]
-#     WRF_experiments += ['max-ens','max-ens-2050','max-ens-2100'] # requires different implementation...
-    # other WRF parameters 
-#     domains = None # domains to be processed
-    domains = (2,) # domains to be processed
-    WRF_filetypes = ('srfc',)
-#     WRF_filetypes = ('srfc','xtrm','plev3d','hydro','lsm') # filetypes to be processed # ,'rad'
-#     WRF_filetypes = ('xtrm','lsm') # filetypes to be processed    
-#     WRF_filetypes = ('const',); periods = None
-    # define shape data  
-    shape_name = 'shpavg' # Canadian shapes
-    shapes = dict()
-#     shapes['basins'] = None # river basins (in Canada) from WSC module
-#     shapes['provinces'] = None # Canadian provinces from EC module
-#     shapes['provinces'] = ['BC'] # Canadian provinces from EC module
-#     shape_name = 'basins' # only Canadian river basins
-#     shapes = dict()
-    shapes['basins'] = ['GLB','GRW'] # river basins (in Canada) from WSC module
-    shapes['provinces'] = ['ON'] # Canadian provinces from EC module
-     
- 
   ## process arguments    
   if isinstance(periods, (np.integer,int)): periods = [periods]
   # check and expand WRF experiment list
@@ -350,7 +285,125 @@ if __name__ == '__main__':
   # static keyword arguments
   kwargs = dict(loverwrite=loverwrite, varlist=varlist)
           
+  # declare input and output files of each job
+  jobs = []
+  for arguments in args:
+    inputs, outputs = getJobFiles(arguments[0], arguments[1], arguments[4], grid=arguments[2])
+    jobs.append(Job(performShapeAverage, args=arguments, kwargs=kwargs, inputs=inputs, outputs=outputs, 
+                    name='{:s} over {:s}'.format(arguments[0],arguments[2])))
+  
+  return jobs
+
+
+if __name__ == '__main__':
+  
+  ## read environment variables
+  # number of processes NP 
+  if os.environ.has_key('PYAVG_THREADS'): 
+    NP = int(os.environ['PYAVG_THREADS'])
+  else: NP = None
+  # memory limit for admission control (in MB)
+  if os.environ.has_key('PYAVG_MEMORY'): 
+    memory = float(os.environ['PYAVG_MEMORY'])
+  else: memory = None
+  # write a profiling report (JSON or CSV)
+  if os.environ.has_key('PYAVG_PROFILE'): 
+    profile = os.environ['PYAVG_PROFILE']
+  else: profile = None
+  # process jobs through a queue file on a shared file system (other nodes can join as workers)
+  if os.environ.has_key('PYAVG_QUEUE'): 
+    queuefile = os.environ['PYAVG_QUEUE']
+  else: queuefile = None
+  # keep datasets, grids and masks open/cached in workers across jobs and route jobs by shared inputs
+  if os.environ.has_key('PYAVG_CACHE'): 
+    lcache =  os.environ['PYAVG_CACHE'] == 'CACHE' 
+  else: lcache = False
+  # run script in debug mode
+  if os.environ.has_key('PYAVG_DEBUG'): 
+    ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
+  else: ldebug = False # i.e. append
+  # run script in batch or interactive mode
+  if os.environ.has_key('PYAVG_BATCH'): 
+    lbatch =  os.environ['PYAVG_BATCH'] == 'BATCH' 
+  else: lbatch = False # for debugging
+  # re-compute everything or just update 
+  if os.environ.has_key('PYAVG_OVERWRITE'): 
+    loverwrite =  os.environ['PYAVG_OVERWRITE'] == 'OVERWRITE' 
+  else: loverwrite = ldebug # False means only update old files
+  
+  ## define settings
+  if lbatch:
+    # load YAML configuration
+    config = loadYAML('shpavg.yaml', lfeedback=True)
+    # read config object
+    NP = NP or config['NP']
+    loverwrite = config['loverwrite']
+  else:
+#     NP = 1 ; ldebug = True # for quick computations
+    NP = 3 ; ldebug = False # for quick computations
+#     modes = ('time-series',) # 'climatology','time-series'
+    modes = ('time-series','climatology') 
+    loverwrite = True
+    varlist = None # ['T2']
+    periods = []
+#     periods += [1]
+#     periods += [3]
+#    periods += [5]
+#    periods += [10]
+    periods += [15]
+    # Observations/Reanalysis
+    lLTM = True 
+    datasets = []; resolutions = None
+    resolutions = {'CRU':'','GPCC':'05','NARR':'','CFSR':'05'}
+#     datasets += ['PRISM']; periods = None; lLTM = True
+#     datasets += ['PCIC','PRISM']; periods = None; lLTM = True
+#     datasets += ['CFSR']; resolutions = {'CFSR':'031'}
+    datasets += ['GPCC','Unity']
+    # CESM experiments (short or long name) 
+    CESM_project = None # use all experiments in project module
+    load3D = False
+    CESM_experiments = [] # use None to process all CESM experiments
+#     CESM_experiments += ['Ctrl-1']
+#     CESM_filetypes = ['atm'] # ,'lnd'
+    CESM_filetypes = ['lnd']
+    # WRF experiments (short or long name)
+    WRF_project = 'GreatLakes' # only use GreatLakes experiments
+    WRF_experiments = []
+#     WRF_experiments += ['erai-t', 'erai-g']
+#     WRF_experiments += ['g-ctrl', 'g-ctrl-2050', 'g-ctrl-2100']
+#     WRF_experiments += ['max-ctrl','max-ens-A','max-ens-B','max-ens-C',][1:]
+#     WRF_experiments += ['max-ens','max-ens-2050','max-ens-2100'] # requires different implementation...
+    # other WRF parameters 
+#     domains = None # domains to be processed
+    domains = (2,) # domains to be processed
+    WRF_filetypes = ('srfc',)
+#     WRF_filetypes = ('srfc','xtrm','plev3d','hydro','lsm') # filetypes to be processed # ,'rad'
+#     WRF_filetypes = ('xtrm','lsm') # filetypes to be processed    
+#     WRF_filetypes = ('const',); periods = None
+    # define shape data  
+    shape_name = 'shpavg' # Canadian shapes
+    shapes = dict()
+#     shapes['basins'] = None # river basins (in Canada) from WSC module
+#     shapes['provinces'] = None # Canadian provinces from EC module
+#     shapes['provinces'] = ['BC'] # Canadian provinces from EC module
+#     shape_name = 'basins' # only Canadian river basins
+#     shapes = dict()
+    shapes['basins'] = ['GLB','GRW'] # river basins (in Canada) from WSC module
+    shapes['provinces'] = ['ON'] # Canadian provinces from EC module
+    # collect settings in a configuration dictionary (same keys as YAML file)
+    config = dict(modes=modes, varlist=varlist, periods=periods, datasets=datasets, resolutions=resolutions,
+                  lLTM=lLTM, CESM_project=CESM_project, CESM_experiments=CESM_experiments,
+                  CESM_filetypes=CESM_filetypes, load3D=load3D, WRF_project=WRF_project,
+                  WRF_experiments=WRF_experiments, WRF_filetypes=WRF_filetypes, domains=domains,
+                  shape_name=shape_name, shapes=shapes)
+  
+  # assemble job list
+  jobs = getJobs(config, loverwrite=loverwrite)
+  
   ## call parallel execution function
-  ec = asyncPoolEC(performShapeAverage, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  if queuefile:
+    ec = runQueue(jobs, queuefile, NP=NP, ldebug=ldebug, profile=profile)
+  else:
+    ec = asyncPoolDAG(jobs, NP=NP, memory=memory, ldebug=ldebug, ltrialnerror=True, profile=profile, lcache=lcache)
   # exit with fraction of failures (out of 10) as exit code
-  exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
+  exit(int(10+int(10.*ec/len(jobs))) if ec > 0 else 0)
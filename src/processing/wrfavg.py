@@ -9,16 +9,17 @@ Script to produce climatology files from monthly mean time-series' for all or a
 # external
 import numpy as np
 import os, gc
-from datetime import datetime
 # internal
 from geodata.base import Variable
 from geodata.netcdf import DatasetNetCDF
 from geodata.gdal import GridDefinition
 from geodata.misc import isInt, DateError
 from datasets.common import name_of_month, days_per_month, getCommonGrid
-from processing.process import CentralProcessingUnit
-from processing.multiprocess import asyncPoolEC
-from processing.misc import getExperimentList, loadYAML
+from processing.process import CentralProcessingUnit, MultiSinkUnit, closeScratchStore
+from processing.multiprocess import asyncPoolDAG, Job
+from processing.jobqueue import runQueue
+from processing.misc import getExperimentList, loadYAML, getCheckpointFile
+from processing.manifest import checkBuild, recordBuild, getGridID
 # WRF specific
 from datasets.WRF import loadWRF_TS, fileclasses, Exp
 
@@ -63,8 +64,7 @@ def computeClimatology(experiment, filetype, domain, periods=None, offset=0, gri
     # N.B.: at this point we don't want to initialize a full GDAL-enabled dataset, since we don't even
     #       know if we need it, and it creates a lot of overhead
     
-    # determine age of source file
-    if not loverwrite: sourceage = datetime.fromtimestamp(os.path.getmtime(filepath))
+    tsfilepath = filepath # the source file (filepath is reused for the sink files below)
   
     # figure out start date
     filebegin = int(begintuple[0]) # first element is the year
@@ -79,6 +79,7 @@ def computeClimatology(experiment, filetype, domain, periods=None, offset=0, gri
     if periods is None: periods = [begindate-fileend]
     #   periods.sort(reverse=True) # reverse, so that largest chunk is done first
     source = None # will later be assigned to the source dataset
+    pending = [] # climatologies that still have to be computed (and written)
     for period in periods:       
               
       # figure out period
@@ -103,20 +104,20 @@ def computeClimatology(experiment, filetype, domain, periods=None, offset=0, gri
         assert os.path.exists(expfolder)
         filepath = expfolder+filename
         tmpfilepath = expfolder+tmpfilename
-        lskip = False # else just go ahead
-        if os.path.exists(filepath): 
-          if not loverwrite: 
-            age = datetime.fromtimestamp(os.path.getmtime(filepath))
-            # if sink file is newer than source file, skip (do not recompute)
-            if age > sourceage and os.path.getsize(filepath) > 1e6: lskip = True
-            # N.B.: NetCDF files smaller than 1MB are usually incomplete header fragments from a previous crash
-            #print sourceage, age
-          if not lskip: os.remove(filepath) 
+        # check build manifest: skip, if inputs, parameters and code have not changed since the file was written
+        params = dict(filetype=filetype, domain=domain, varlist=varlist, grid=getGridID(griddef), 
+                      period=periodstr, offset=offset, shift=shift)
+        lskip, reason, build = checkBuild(filepath, inputs=[tsfilepath], params=params, 
+                                          code=(computeClimatology, CentralProcessingUnit))
+        if loverwrite: lskip = False
+        if os.path.exists(filepath) and not lskip: 
+          logger.info("\n{:s}   >>>   Recomputing file '{:s}' ({:s})\n".format(pidstr,filename,reason or 'overwrite'))
+          os.remove(filepath) 
         
-        # depending on last modification time of file or overwrite setting, start computation, or skip
+        # depending on build manifest or overwrite setting, start computation, or skip
         if lskip:        
           # print message
-          skipmsg =  "\n{:s}   >>>   Skipping: file '{:s}' in dataset '{:s}' already exists and is newer than source file.".format(pidstr,filename,dataset_name)
+          skipmsg =  "\n{:s}   >>>   Skipping: file '{:s}' in dataset '{:s}' already exists and is up-to-date.".format(pidstr,filename,dataset_name)
           skipmsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
           logger.info(skipmsg)              
         else:
@@ -131,9 +132,11 @@ def computeClimatology(experiment, filetype, domain, periods=None, offset=0, gri
           ## actually load datasets
           if source is None:
             source = loadWRF_TS(experiment=experiment, filetypes=[filetype], domains=domain) # comes out as a tuple... 
+            MSU = MultiSinkUnit(source, varlist=varlist, feedback=ldebug) # all periods are processed in one pass
           if not lparallel and ldebug: logger.info('\n'+str(source)+'\n')
   
-          # prepare sink
+          # prepare sink (and recover completed variables from a previous run, if possible)
+          ckptfile = getCheckpointFile(expfolder, filename, tmppfx='tmp_wrfavg_', key=build['key'], lresume=not loverwrite)
           if os.path.exists(tmpfilepath): os.remove(tmpfilepath) # remove old temp files
           sink = DatasetNetCDF(name='WRF Climatology', folder=expfolder, filelist=[tmpfilename], atts=source.atts.copy(), mode='w')
           sink.atts.period = periodstr 
@@ -141,57 +144,76 @@ def computeClimatology(experiment, filetype, domain, periods=None, offset=0, gri
           # initialize processing
           if griddef is None: lregrid = False
           else: lregrid = True
-          CPU = CentralProcessingUnit(source, sink, varlist=varlist, tmp=lregrid, feedback=ldebug) # no need for lat/lon
+          CPU = MSU.addSink(sink, tmp=lregrid, scratch=expfolder if lregrid else None) # no need for lat/lon
+          # N.B.: climatologies are memory-mapped from raw scratch files until they are regridded
+          CPU.setCheckpoint(build['key'], filepath=ckptfile, target=filename) # record completed variables
           
-          # start processing climatology
+          # set up climatology (computed below, together with the other periods)
           if shift != 0: 
             logger.info('{0:s}   (shifting climatology by {1:d} month, to start with January)   \n'.format(pidstr,shift))
-          CPU.Climatology(period=period, offset=offset, shift=shift, flush=False)
-          # N.B.: immediate flushing should not be necessary for climatologies, since they are much smaller!
+          CPU.Climatology(period=period, offset=offset, shift=shift, flush=not lregrid)
+          # N.B.: climatologies are written and unloaded as soon as they are computed, so that the climatologies 
+          #       of all periods are not held in memory at once (before regridding they are memory-mapped)
+          pending.append((filename, filepath, tmpfilepath, ckptfile, build, sink, CPU))
           
-          # reproject and resample (regrid) dataset
-          if lregrid:
-            CPU.Regrid(griddef=griddef, flush=True)
-            logger.info('%s    ---   '+str(griddef.geotansform)+'   ---   \n'%(pidstr))              
-          
-          # sync temporary storage with output dataset (sink)
-          CPU.sync(flush=True)
-          
-          # add Geopotential Height Variance
-          if 'GHT_Var' in sink and 'Z_var' not in sink:
-            data_array = ( sink['GHT_Var'].data_array - sink['Z'].data_array**2 )**0.5
-            atts = dict(name='Z_var',units='m',long_name='Square Root of Geopotential Height Variance')
-            sink += Variable(axes=sink['Z'].axes, data=data_array, atts=atts)
-            
-          # add (relative) Vorticity Variance
-          if 'Vorticity_Var' in sink and 'zeta_var' not in sink:
-            data_array = ( sink['Vorticity_Var'].data_array - sink['zeta'].data_array**2 )**0.5
-            atts = dict(name='zeta_var',units='1/s',long_name='Square Root of Relative Vorticity Variance')
-            sink += Variable(axes=sink['zeta'].axes, data=data_array, atts=atts)
-            
-          # add names and length of months
-          sink.axisAnnotation('name_of_month', name_of_month, 'time', 
-                              atts=dict(name='name_of_month', units='', long_name='Name of the Month'))        
-          if not sink.hasVariable('length_of_month'):
-            sink += Variable(name='length_of_month', units='days', axes=(sink.time,), data=days_per_month,
-                          atts=dict(name='length_of_month',units='days',long_name='Length of Month'))
-          
-          # close... and write results to file
-          sink.sync()
-          sink.close()
-          writemsg =  "\n{:s}   >>>   Writing to file '{:s}' in dataset {:s}".format(pidstr,filename,dataset_name)
-          writemsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
-          logger.info(writemsg)      
-          # rename file to proper name
-          if os.path.exists(filepath): os.remove(filepath) # remove old file
-          os.rename(tmpfilepath,filepath) # this will overwrite the old file
-          
-          # print dataset
-          if not lparallel and ldebug:
-            logger.info('\n'+str(sink)+'\n')
-          
-          # clean up (not sure if this is necessary, but there seems to be a memory leak...   
-          del sink, CPU; gc.collect() # get rid of these guys immediately
+    ## compute climatologies for all periods, loading every source variable only once
+    try:
+      if len(pending) > 0: 
+        MSU.process(); del MSU
+      while len(pending) > 0:
+        # N.B.: periods are removed from the list, so that they can be released, once they are written
+        filename, filepath, tmpfilepath, ckptfile, build, sink, CPU = pending.pop(0)
+        # reproject and resample (regrid) dataset
+        if griddef is not None:
+          CPU.Regrid(griddef=griddef, flush=True)
+          logger.info('%s    ---   '+str(griddef.geotansform)+'   ---   \n'%(pidstr))              
+      
+        # sync temporary storage with output dataset (sink)
+        CPU.sync(flush=True)
+      
+        # add Geopotential Height Variance
+        if 'GHT_Var' in sink and 'Z_var' not in sink:
+          sink['GHT_Var'].load(); sink['Z'].load() # may have been flushed to disk already
+          data_array = ( sink['GHT_Var'].data_array - sink['Z'].data_array**2 )**0.5
+          atts = dict(name='Z_var',units='m',long_name='Square Root of Geopotential Height Variance')
+          sink += Variable(axes=sink['Z'].axes, data=data_array, atts=atts)
+        
+        # add (relative) Vorticity Variance
+        if 'Vorticity_Var' in sink and 'zeta_var' not in sink:
+          sink['Vorticity_Var'].load(); sink['zeta'].load() # may have been flushed to disk already
+          data_array = ( sink['Vorticity_Var'].data_array - sink['zeta'].data_array**2 )**0.5
+          atts = dict(name='zeta_var',units='1/s',long_name='Square Root of Relative Vorticity Variance')
+          sink += Variable(axes=sink['zeta'].axes, data=data_array, atts=atts)
+        
+        # add names and length of months
+        sink.axisAnnotation('name_of_month', name_of_month, 'time', 
+                            atts=dict(name='name_of_month', units='', long_name='Name of the Month'))        
+        if not sink.hasVariable('length_of_month'):
+          sink += Variable(name='length_of_month', units='days', axes=(sink.time,), data=days_per_month,
+                        atts=dict(name='length_of_month',units='days',long_name='Length of Month'))
+      
+        # close... and write results to file
+        CPU.clearCheckpoint() # remove checkpoint attributes
+        sink.sync()
+        sink.close()
+        writemsg =  "\n{:s}   >>>   Writing to file '{:s}' in dataset {:s}".format(pidstr,filename,dataset_name)
+        writemsg += "\n{:s}   >>>   ('{:s}')\n".format(pidstr,filepath)
+        logger.info(writemsg)      
+        # rename file to proper name
+        if os.path.exists(filepath): os.remove(filepath) # remove old file
+        os.rename(tmpfilepath,filepath) # this will overwrite the old file
+        recordBuild(filepath, build) # add to build manifest
+        if ckptfile: os.remove(ckptfile) # results have been recovered
+      
+        # print dataset
+        if not lparallel and ldebug:
+          logger.info('\n'+str(sink)+'\n')
+      
+        # clean up (not sure if this is necessary, but there seems to be a memory leak...   
+        del sink, CPU; gc.collect() # get rid of these guys immediately
+    finally:
+      # N.B.: worker processes exit without atexit handlers, so scratch files have to be removed here
+      closeScratchStore()
           
     # clean up and return
     if source is not None: source.unload(); del source
@@ -202,6 +224,65 @@ def computeClimatology(experiment, filetype, domain, periods=None, offset=0, gri
   return 0 # so far, there is no measure of success, hence, if there is no crash...
 
 
+# function to assemble the job list from a configuration dictionary
+def getJobs(config, loverwrite=False):
+  ''' construct the list of climatology jobs from a configuration dictionary (same keys as wrfavg.yaml); 
+      jobs declare their source and target files, so that the job lists of several processing steps 
+      can be combined into one task graph (see processing.pipeline) '''
+  # source data specs
+  varlist = config['varlist']
+  periods = config['periods']
+  offset = config['offset']
+  project = config['project']
+  experiments = config['experiments']
+  filetypes = config['filetypes']
+  domains = config['domains']
+  grid = config['grid']
+  
+  # check and expand WRF experiment list
+  experiments = getExperimentList(experiments, project, 'WRF')
+  if isinstance(domains, (np.integer,int)): domains = [domains]
+  if isinstance(periods, (np.integer,int)): periods = [periods]
+
+  # shall we do some fancy regridding on-the-fly?
+  if not grid: griddef = None
+  else: griddef = getCommonGrid(grid)
+  
+  # print an announcement
+  print('\n Computing Climatologies for WRF experiments:\n')
+  print([exp.name for exp in experiments])
+  if grid != 'native': print('\nRegridding to \'{0:s}\' grid.\n'.format(grid))
+  print('\nOVERWRITE: {0:s}\n'.format(str(loverwrite)))
+      
+  # assemble argument list and do regridding
+  args = [] # list of arguments for workers, i.e. "work packages"
+  # generate list of parameters
+  for experiment in experiments:    
+    # loop over file types
+    for filetype in filetypes:                
+      # effectively, loop over domains
+      if domains is None:
+        tmpdom = range(1,experiment.domains+1)
+      else: tmpdom = domains
+      for domain in tmpdom:
+        # arguments for worker function
+        args.append( (experiment, filetype, domain) )        
+  # static keyword arguments
+  kwargs = dict(periods=periods, offset=offset, griddef=griddef, loverwrite=loverwrite, varlist=varlist)        
+  # declare input and output files of each job (the begin date is taken from the experiment)
+  gridstr = '' if griddef is None or griddef.name is 'WRF' else '_'+griddef.name
+  jobs = []
+  for experiment,filetype,domain in args:
+    fileclass = fileclasses[filetype]; begindate = int(experiment.begindate[0:4]) + offset
+    inputs = ['{:s}/{:s}'.format(experiment.avgfolder, fileclass.tsfile.format(domain,''))]
+    outputs = [experiment.avgfolder+fileclass.climfile.format(domain,gridstr,'_{0:4d}-{1:4d}'.format(begindate,begindate+period)) 
+               for period in periods]
+    jobs.append(Job(computeClimatology, args=(experiment,filetype,domain), kwargs=kwargs, inputs=inputs, outputs=outputs,
+                    name='{:s} {:s} (d{:02d})'.format(experiment.name,filetype,domain)))
+  
+  return jobs
+
+
 if __name__ == '__main__':
   
   ## read environment Variables
@@ -209,6 +290,22 @@ if __name__ == '__main__':
   if os.environ.has_key('PYAVG_THREADS'): 
     NP = int(os.environ['PYAVG_THREADS'])
   else: NP = None
+  # memory limit for admission control (in MB)
+  if os.environ.has_key('PYAVG_MEMORY'): 
+    memory = float(os.environ['PYAVG_MEMORY'])
+  else: memory = None
+  # write a profiling report (JSON or CSV)
+  if os.environ.has_key('PYAVG_PROFILE'): 
+    profile = os.environ['PYAVG_PROFILE']
+  else: profile = None
+  # process jobs through a queue file on a shared file system (other nodes can join as workers)
+  if os.environ.has_key('PYAVG_QUEUE'): 
+    queuefile = os.environ['PYAVG_QUEUE']
+  else: queuefile = None
+  # keep datasets, grids and masks open/cached in workers across jobs and route jobs by shared inputs
+  if os.environ.has_key('PYAVG_CACHE'): 
+    lcache =  os.environ['PYAVG_CACHE'] == 'CACHE' 
+  else: lcache = False
   # run script in debug mode
   if os.environ.has_key('PYAVG_DEBUG'): 
     ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -230,15 +327,6 @@ if __name__ == '__main__':
     # read config object
     NP = NP or config['NP']
     loverwrite = config['loverwrite']
-    # source data specs
-    varlist = config['varlist']
-    periods = config['periods']
-    offset = config['offset']
-    project = config['project']
-    experiments = config['experiments']
-    filetypes = config['filetypes']
-    domains = config['domains']
-    grid = config['grid']
   else:
 #     NP = 1 ; ldebug = True # just for tests
     NP = 2 ; ldebug = False # just for tests
@@ -263,38 +351,17 @@ if __name__ == '__main__':
     filetypes = ['srfc','xtrm','plev3d','hydro','lsm'][1:] # filetypes to be processed # ,'rad'
 #     filetypes = ['srfc'] # filetypes to be processed
     grid = None # use native grid
-
-  # check and expand WRF experiment list
-  experiments = getExperimentList(experiments, project, 'WRF')
-  if isinstance(domains, (np.integer,int)): domains = [domains]
-  if isinstance(periods, (np.integer,int)): periods = [periods]
-
-  # shall we do some fancy regridding on-the-fly?
-  if not grid: griddef = None
-  else: griddef = getCommonGrid(grid)
+    # collect settings in a configuration dictionary (same keys as YAML file)
+    config = dict(varlist=varlist, periods=periods, offset=offset, project=project, experiments=experiments,
+                  filetypes=filetypes, domains=domains, grid=grid)
+  
+  # assemble job list
+  jobs = getJobs(config, loverwrite=loverwrite)
   
-  # print an announcement
-  print('\n Computing Climatologies for WRF experiments:\n')
-  print([exp.name for exp in experiments])
-  if grid != 'native': print('\nRegridding to \'{0:s}\' grid.\n'.format(grid))
-  print('\nOVERWRITE: {0:s}\n'.format(str(loverwrite)))
-      
-  # assemble argument list and do regridding
-  args = [] # list of arguments for workers, i.e. "work packages"
-  # generate list of parameters
-  for experiment in experiments:    
-    # loop over file types
-    for filetype in filetypes:                
-      # effectively, loop over domains
-      if domains is None:
-        tmpdom = range(1,experiment.domains+1)
-      else: tmpdom = domains
-      for domain in tmpdom:
-        # arguments for worker function
-        args.append( (experiment, filetype, domain) )        
-  # static keyword arguments
-  kwargs = dict(periods=periods, offset=offset, griddef=griddef, loverwrite=loverwrite, varlist=varlist)        
   # call parallel execution function
-  ec = asyncPoolEC(computeClimatology, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  if queuefile:
+    ec = runQueue(jobs, queuefile, NP=NP, ldebug=ldebug, profile=profile)
+  else:
+    ec = asyncPoolDAG(jobs, NP=NP, memory=memory, ldebug=ldebug, ltrialnerror=True, profile=profile, lcache=lcache)
   # exit with fraction of failures (out of 10) as exit code
-  exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
+  exit(int(10+int(10.*ec/len(jobs))) if ec > 0 else 0)
@@ -0,0 +1,120 @@
+'''
+Created on 2016-03-28
+
+Bounded LRU caches for objects that are expensive to construct and are often reused by consecutive
+jobs in the same worker process, e.g. open dataset handles, GridDefinitions, rasterized shape masks
+and MapSetup instances (with their Basemap). All caches are disabled (size zero) by default; they are
+enabled in persistent pool workers (see AffinityPool in processing.multiprocess, and plotting.batch).
+Entries that are derived from files should include the file key (size and modification time), so that
+modified files are reloaded.
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import os
+from collections import OrderedDict
+
+
+class LRUCache(object):
+  ''' A bounded mapping that discards the least recently used entries; a 'close' function can be
+      passed to release resources of discarded entries (e.g. open files). '''
+
+  def __init__(self, name, maxsize=0, close=None):
+    ''' Initialize empty cache; a size of zero disables caching. '''
+    self.name = name
+    self.maxsize = maxsize
+    self.close = close
+    self.entries = OrderedDict() # most recently used last
+    self.hits = 0; self.misses = 0
+
+  def __len__(self): return len(self.entries)
+
+  def __contains__(self, key): return key in self.entries
+
+  def get(self, key, default=None):
+    ''' Return a cached value and mark it as recently used. '''
+    if key not in self.entries: return default
+    value = self.entries.pop(key); self.entries[key] = value
+    return value
+
+  def put(self, key, value):
+    ''' Add a value to the cache and discard the least recently used entries, if necessary. '''
+    if self.maxsize <= 0: return # caching disabled
+    if key in self.entries: self._discard(key)
+    self.entries[key] = value
+    while len(self.entries) > self.maxsize: self._discard(next(iter(self.entries)))
+
+  def load(self, key, loadfct):
+    ''' Return a cached value, or call loadfct and cache the result. '''
+    if key in self.entries:
+      self.hits += 1
+      return self.get(key)
+    self.misses += 1
+    value = loadfct()
+    self.put(key, value)
+    return value
+
+  def resize(self, maxsize):
+    ''' Change the size of the cache (a size of zero clears and disables the cache). '''
+    self.maxsize = maxsize
+    while len(self.entries) > max(maxsize,0): self._discard(next(iter(self.entries)))
+
+  def clear(self):
+    ''' Discard all entries. '''
+    while self.entries: self._discard(next(iter(self.entries)))
+
+  def _discard(self, key):
+    ''' Remove an entry and release its resources. '''
+    value = self.entries.pop(key)
+    if self.close is not None: self.close(value)
+
+
+## module caches (separate copies in every worker process)
+
+def closeDataset(dataset):
+  ''' Close the files of a discarded dataset. '''
+  if hasattr(dataset,'close'): dataset.close()
+
+default_sizes = dict(datasets=4, griddefs=16, masks=32, mapsetups=8) # number of entries, if caching is enabled
+_caches = dict(datasets=LRUCache('datasets', close=closeDataset), griddefs=LRUCache('griddefs'),
+               masks=LRUCache('masks'), mapsetups=LRUCache('mapsetups'))
+
+def getCache(name):
+  ''' Return a module cache by name ('datasets', 'griddefs', 'masks' or 'mapsetups'). '''
+  return _caches[name]
+
+def enableCaching(**sizes):
+  ''' Enable module caches (sizes default to default_sizes). '''
+  for name,cache in _caches.iteritems(): cache.resize(sizes.get(name,default_sizes[name]))
+
+def disableCaching():
+  ''' Clear and disable all module caches. '''
+  for cache in _caches.itervalues(): cache.resize(0)
+
+def isEnabled(name):
+  ''' Check if a module cache is enabled. '''
+  return _caches[name].maxsize > 0
+
+def getCacheStats():
+  ''' Return number of entries, hits and misses of all module caches. '''
+  return {name:dict(entries=len(cache), hits=cache.hits, misses=cache.misses) for name,cache in _caches.iteritems()}
+
+def getFileKey(filelist):
+  ''' Return a hashable key that changes, when one of the files is modified. '''
+  key = []
+  for filepath in filelist:
+    filepath = os.path.abspath(filepath)
+    if os.path.exists(filepath):
+      stat = os.stat(filepath); key.append((filepath, stat.st_size, stat.st_mtime))
+    else: key.append((filepath, None, None))
+  return tuple(key)
+
+def cachedLoad(name, key, filelist, loadfct):
+  ''' Load an object through a module cache; the key is extended by the file key of filelist.
+      N.B.: cached objects are shared by all subsequent jobs in the same worker, and have to be treated 
+            as read-only (e.g. variables of a cached dataset can be loaded and unloaded, but variables,
+            axes or attributes must not be added, removed or modified); copy the object, if necessary. '''
+  cache = _caches[name]
+  if cache.maxsize <= 0: return loadfct() # skip file key
+  return cache.load((key, getFileKey(filelist)), loadfct)
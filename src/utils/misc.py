@@ -11,8 +11,10 @@ import numpy as np
 import scipy.linalg as la
 from utils.signalsmooth import smooth
 import collections as col
+import hashlib, weakref
 # internal imports
 from geodata.misc import ArgumentError, isEqual, AxisError
+from utils.cache import LRUCache
 
 ## a method to tabulate variables (adapted from Variable) 
 def tabulate(data, row_idx=0, col_idx=1, header=None, labels=None, cell_str='{}', cell_idx=None, cell_fct=None, 
@@ -332,9 +334,20 @@ def expandArgumentList(inner_list=None, outer_list=None, expand_list=None, lprod
 
 
 # convenience function to evaluate a list of DistVar's
+# memo of evaluated distributions (plotting functions often evaluate the same DistVar several times);
+# DistVars are only referenced weakly, so that the memo does not keep them alive
+_distvar_memo = LRUCache('distvars', maxsize=16)
+
+def _supportKey(support):
+  ''' hashable fingerprint of a support/bins argument '''
+  if isinstance(support,np.ndarray): return (support.shape, hashlib.sha1(np.ascontiguousarray(support).tostring()).hexdigest())
+  elif isinstance(support,(list,tuple)): return tuple(support)
+  else: return support
+
 def evalDistVars(varlist, bins=None, support=None, method='pdf', ldatasetLink=True, bootstrap_axis='bootstrap'):
   ''' Convenience function to evaluate a list of DistVars on a given support/bins;
-      leaves other Variables untouched. '''
+      leaves other Variables untouched. Evaluated distributions are memoized per DistVar 
+      instance, support and method (copies with their own data are returned). '''
   from geodata.stats import DistVar, VarKDE, VarRV # avoid circular import
   # evaluate distribution variables on support/bins
   if support is not None or bins is not None:
@@ -347,11 +360,18 @@ def evalDistVars(varlist, bins=None, support=None, method='pdf', ldatasetLink=Tr
     for var in varlist:
       if var is None: new = None
       else: 
+        key = (id(var), method, _supportKey(support), bootstrap_axis)
+        memo = _distvar_memo.get(key)
+        if memo is not None and memo[0]() is var: 
+          newlist.append(memo[1].copy(data=memo[1].data_array.copy())); continue # the same DistVar (not just the same id)
+        orig = var # for memo
         # remove bootstrap axis
         if bootstrap_axis is not None and var.hasAxis(bootstrap_axis): var = var(**slc)
         # evluate distributions
         if isinstance(var,(DistVar,VarKDE,VarRV)): 
           new = getattr(var,method)(support=support) # evaluate DistVar
+          _distvar_memo.put(key, (weakref.ref(orig),new))
+          new = new.copy(data=new.data_array.copy()) # the memoized Variable should not be modified
           #if ldatasetLink: new.dataset= var.dataset # preserve dataset links to construct references
         else: new = var
       newlist.append(new)
@@ -429,6 +449,38 @@ def PCA(data, degree=None, lprewhiten=False, lpostwhiten=False, lEOF=False, lfee
   if lEOF: return pca, eig, eof
   else: return pca, eig  
 
+# randomized truncated SVD (Halko et al., 2011)
+def randomizedSVD(data, k, noversample=10, niter=4, seed=None):
+  ''' Compute the k leading singular values and vectors of a 2D array using a randomized range finder 
+      with niter power iterations; only arrays of size (m, k+noversample) are added to the input, so that
+      it is suitable for matrices with many columns (e.g. grid points); returns U, S, Vt (like svd). '''
+  if not data.ndim == 2: raise ArgumentError
+  l = min(k+noversample, min(data.shape))
+  rng = np.random.RandomState(seed)
+  Q = la.qr(np.dot(data, rng.standard_normal((data.shape[1],l))), mode='economic')[0]
+  for i in xrange(niter): # power iterations (with re-orthogonalization)
+    Q = la.qr(np.dot(data.T, Q), mode='economic')[0]
+    Q = la.qr(np.dot(data, Q), mode='economic')[0]
+  U, S, Vt = la.svd(np.dot(Q.T, data), full_matrices=False) # small (l, n) matrix
+  return np.dot(Q, U[:,:k]), S[:k], Vt[:k,:]
+
+# incremental truncated SVD of centered data (Ross et al., 2008)
+def incrementalSVD(chunk, k, S=None, Vt=None, mean=None, n=0):
+  ''' Update the k leading singular values S and right singular vectors Vt of the centered data with a 
+      new chunk of samples (rows); mean is the running mean of the columns and n the number of samples 
+      processed so far; only an array of size (k+chunk+1, columns) is decomposed. Returns the updated 
+      S, Vt, mean and n. '''
+  if not chunk.ndim == 2: raise ArgumentError
+  b = chunk.shape[0]; nn = n + b
+  cmean = chunk.mean(axis=0)
+  if n == 0: M = chunk - cmean
+  else:
+    correction = np.sqrt(float(n*b)/nn) * (mean - cmean) # accounts for the shift of the mean
+    M = np.concatenate([S.reshape((-1,1))*Vt, chunk - cmean, correction.reshape((1,-1))], axis=0)
+  S, Vt = la.svd(M, full_matrices=False)[1:]
+  mean = cmean if n == 0 else ( n*mean + b*cmean ) / nn
+  return S[:k], Vt[:k,:], mean, nn
+
 # histogram wrapper that suppresses additional output
 def histogram(a, bins=10, range=None, weights=None, density=None): 
   ''' histogram wrapper that suppresses bin edge output, but is otherwise the same '''
@@ -459,47 +511,88 @@ def flip(a, axis=0):
   idx[axis] = slice(None, None, -1) # this one reverses the order
   return a[idx] # apply abd return
   
+# function to compute polynomial trends of many series at once
+def polyTrend(y, x=None, degree=1, rcond=None, w=None):
+  ''' evaluate least-squares polynomial trends for all series (columns) of a 2D array (n, m) at once; all 
+      series share the design matrix, so that only one least-squares problem has to be solved; NaN values 
+      are ignored (series with NaN's are solved through their normal equations, all at once) '''
+  n = y.shape[0]
+  if x is None: x = np.arange(n)
+  if len(x) != n: raise AxisError, "Axis and series have different lengths."
+  V = np.vander(np.asarray(x, dtype=np.float64), degree+1) # shared design matrix
+  Vw = V if w is None else V * w.reshape((n,1))
+  scale = np.sqrt((Vw*Vw).sum(axis=0)); Vw = Vw / scale # scale columns for better conditioning (like polyfit)
+  valid = np.isfinite(y)
+  if valid.all():
+    yw = y if w is None else y * w.reshape((n,1))
+    if rcond is None: rcond = n*np.finfo(np.float64).eps # polyfit default
+    coef = np.linalg.lstsq(Vw, yw, rcond=rcond)[0]
+  else:
+    yw = np.where(valid, y, 0.) if w is None else np.where(valid, y, 0.) * w.reshape((n,1))
+    G = np.einsum('ni,nm,nj->mij', Vw, valid.astype(np.float64), Vw) # one normal matrix per series
+    b = np.einsum('ni,nm->mi', Vw, yw)
+    lfew = valid.sum(axis=0) <= degree # not enough valid values for a fit
+    G[lfew] = np.eye(degree+1)
+    coef = np.linalg.solve(G, b[:,:,np.newaxis])[:,:,0].T
+    coef[:,lfew] = np.NaN
+  coef /= scale.reshape((degree+1,1))
+  return np.dot(V, coef) # evaluate trends
+
 # function to detrend a time-series
-def detrend(var, ax=None, lcopy=True, ldetrend=True, ltrend=False, degree=1, rcond=None, w=None,  
+def detrend(var, ax=None, axis=None, lcopy=True, ldetrend=True, ltrend=False, degree=1, rcond=None, w=None,  
             lsmooth=False, lresidual=False, window_len=11, window='hanning'): 
-  ''' subtract a linear trend from a time-series array (operation is in-place) '''
+  ''' subtract a linear trend from a time-series array (operation is in-place); if an axis index is given,
+      every series along that axis is detrended and/or smoothed separately (in one vectorized operation),
+      otherwise the flattened array is treated as one series '''
   # check input
   if not isinstance(var,np.ndarray): raise NotImplementedError # too many checks
+  if ldetrend and ltrend: raise ArgumentError, "Can either return trend/polyfit or residuals, not both."
+  if lsmooth and lresidual: raise ArgumentError, "Can either return smoothed array or residuals, not both."
   if lcopy: var = var.copy() # make copy - not in-place!
   # fit over entire array (usually not what we want...)
-  if ax is None and ldetrend: ax = np.arange(var.size) # make dummy axis, if necessary
-  if var.ndim != 1:
+  if axis is None and var.ndim != 1:
     shape = var.shape 
     var = var.ravel() # flatten array, if necessary
   else: shape = None
+  if axis is None: axis = 0
   # apply optional detrending
   if ldetrend or ltrend:
-    # fit linear trend
-    trend = np.polyfit(ax, var, deg=degree, rcond=rcond, w=w, full=False, cov=False)
-    # evaluate and subtract linear trend
-    if ldetrend and ltrend: raise ArgumentError, "Can either return trend/polyfit or residuals, not both."
-    elif ldetrend and not ltrend: var -= np.polyval(trend, ax) # residuals
-    elif ltrend and not ldetrend: var = np.polyval(trend, ax) # residuals
+    # fit trends of all series at once (series along first axis)
+    series = np.moveaxis(var, axis, 0)
+    y = series.reshape((series.shape[0],-1)).astype(np.float64) # copy
+    if isinstance(var, np.ma.MaskedArray): y[np.ma.getmaskarray(series).reshape(y.shape)] = np.NaN
+    trend = polyTrend(y, x=ax, degree=degree, rcond=rcond, w=w)
+    trend = np.moveaxis(trend.reshape(series.shape), 0, axis)
+    # subtract trend or return trend
+    if ldetrend: var -= trend # residuals
+    else: var = trend.astype(var.dtype) # trend
   # apply optional smoothing
-  if lsmooth and lresidual: raise ArgumentError, "Can either return smoothed array or residuals, not both."
-  elif lsmooth: var = smooth(var, window_len=window_len, window=window)  
-  elif lresidual: var -= smooth(var, window_len=window_len, window=window)
+  if lsmooth: var = smooth(var, window_len=window_len, window=window, axis=axis)  
+  elif lresidual: var -= smooth(var, window_len=window_len, window=window, axis=axis)
   # return detrended and/or smoothed time-series
   if shape is not None: var = var.reshape(shape)
   return var
 
-# function to smooth a vector (numpy array): moving mean, nothing fancy
-def movingMean(x,i):
-  ''' smooth a vector (x, numpy array) using a moving mean of window width 2*i+1 '''
-  if x.ndim > 1: raise ValueError
-  xs = x.copy() # smoothed output vector
-  i = 2*i
-  d = i+1 # denominator  for later
-  while i>0:    
-    t = x.copy(); t[i:] = t[:-i];  xs += t
-    t = x.copy(); t[:-i] = t[i:];  xs += t
-    i-=2
-  return xs/d
+# function to smooth an array along an axis: moving mean, nothing fancy
+def movingMean(x, i, axis=-1, lnan=True):
+  ''' smooth an array (x, numpy array) along an axis using a centered moving mean of window width 2*i+1; 
+      means are computed from cumulative sums, and near the boundaries, only the available values are used; 
+      if lnan is True, NaN values are ignored (otherwise windows with NaN values are NaN) '''
+  if i < 1: return x.copy()
+  xt = np.moveaxis(np.asarray(x, dtype=np.float64), axis, -1)
+  n = xt.shape[-1]
+  valid = np.isfinite(xt); xt = np.where(valid, xt, 0.) # N.B.: NaN's would spoil all following sums
+  # cumulative sums with a leading zero, so that window sums are differences
+  zeros = np.zeros(xt.shape[:-1]+(1,))
+  csum = np.concatenate([zeros,np.cumsum(xt, axis=-1)], axis=-1)
+  ccnt = np.concatenate([zeros,np.cumsum(valid, axis=-1)], axis=-1)
+  lo = np.maximum(np.arange(n)-i, 0); hi = np.minimum(np.arange(n)+i+1, n) # window boundaries
+  cnt = ccnt[...,hi] - ccnt[...,lo]
+  with np.errstate(invalid='ignore', divide='ignore'):
+    xs = ( csum[...,hi] - csum[...,lo] ) / cnt
+  if lnan: xs[~valid] = np.NaN # keep missing values
+  else: xs[cnt < hi-lo] = np.NaN # any NaN in the window
+  return np.moveaxis(xs, -1, axis)
 
 
 # function to traverse nested lists recursively and perform the operation fct on the end members
@@ -1,9 +1,19 @@
-"""
-Functions that ignore NaN.
+'''
+Created on 2016-04-26
+
+NaN-aware reduction kernels, which replace an old copy of the NumPy nanfunctions module: NaN's and
+masked values are treated as missing values, and the input array is never copied (or filled); instead,
+the array is processed in slabs along the reduction axis, and count, sum and the sum of squared
+deviations from the mean of each slab are merged with the pairwise update formula of Chan et al.
+(a blocked version of Welford's algorithm). Single precision and integer data are accumulated in
+double precision; results are returned in the precision of the input (or dtype, or out).
+For masked input arrays, masked arrays are returned, where empty slices (or slices with too few
+degrees of freedom) are masked; otherwise empty slices are NaN.
 
 Functions
 ---------
 
+- `nancount` -- number of valid values
 - `nanmin` -- minimum non-NaN value
 - `nanmax` -- maximum non-NaN value
 - `nanargmin` -- index of minimum non-NaN value
@@ -12,1006 +22,235 @@ Functions
 - `nanmean` -- mean of non-NaN values
 - `nanvar` -- variance of non-NaN values
 - `nanstd` -- standard deviation of non-NaN values
+- `nansem` -- standard error of the mean of non-NaN values
 
-"""
-from __future__ import division, absolute_import, print_function
+@author: Andre R. Erler, GPL v3
+'''
+
+from __future__ import division
 
 import warnings
 import numpy as np
+import numpy.ma as ma
+
+
+__all__ = ['nancount', 'nansum', 'nanmax', 'nanmin', 'nanargmax', 'nanargmin', 'nanmean',
+           'nanvar', 'nanstd', 'sem', 'nansem']
+
+slab_size = 2**18 # approximate number of elements that are processed at a time (limits temporary arrays)
+
+
+## helper functions
+
+def _prepareArray(a, axis):
+  ''' return data and mask (views), the internal reduction axis and the shape of the result with and
+      without keepdims; multiple axes are merged into one (axis=None flattens the array) '''
+  a = np.asanyarray(a)
+  data = ma.getdata(a); mask = ma.getmask(a) # no copies
+  if axis is None: axes = range(data.ndim)
+  elif isinstance(axis,(tuple,list)): axes = sorted(ax % data.ndim for ax in axis) if data.ndim else []
+  else: axes = [axis % data.ndim] if data.ndim else []
+  kshape = tuple(1 if i in axes else n for i,n in enumerate(data.shape)) # keepdims
+  rshape = tuple(n for i,n in enumerate(data.shape) if i not in axes)
+  if len(axes) != 1:
+    # merge reduction axes into last axis (this only copies non-contiguous arrays)
+    nax = len(axes)
+    data = np.moveaxis(data, axes, range(data.ndim-nax,data.ndim)).reshape(rshape+(-1,))
+    if mask is not ma.nomask: mask = np.moveaxis(mask, axes, range(mask.ndim-nax,mask.ndim)).reshape(rshape+(-1,))
+    iaxis = data.ndim-1
+  else: iaxis = axes[0]
+  return data, mask, iaxis, kshape, rshape
+
+def _iterSlabs(data, mask, axis):
+  ''' iterate over contiguous slabs along the first axis; yields the index of the slab in the result
+      (with keepdims), the data of the slab and a boolean array that marks valid values (None, if all
+      values are valid); if the first axis is the reduction axis, results of slabs have to be merged '''
+  n = data.shape[0]
+  nslab = max(1, slab_size*n//max(data.size,1)) # slab length along first axis
+  lnan = issubclass(data.dtype.type, np.inexact)
+  for i0 in xrange(0, n, nslab):
+    idx = slice(i0,i0+nslab)
+    x = data[idx]
+    if lnan: valid = ~np.isnan(x)
+    else: valid = None
+    if mask is not ma.nomask:
+      valid = ~mask[idx] if valid is None else np.logical_and(valid, ~mask[idx], out=valid)
+    yield (Ellipsis if axis == 0 else idx), x, valid
+
+def _accumType(dtype):
+  ''' accumulate in (at least) double precision '''
+  return np.promote_types(dtype, np.float64)
+
+def _moments(a, axis=None, lvar=True, acctype=None):
+  ''' single pass kernel: return count, sum and sum of squared deviations from the mean (None, if
+      lvar=False) of valid values (with keepdims along the internal axis) and the shapes of the result '''
+  data, mask, iaxis, kshape, rshape = _prepareArray(a, axis)
+  acctype = _accumType(data.dtype) if acctype is None else acctype
+  shape = data.shape[:iaxis] + (1,) + data.shape[iaxis+1:]
+  cnt = np.zeros(shape, dtype=np.intp); tot = np.zeros(shape, dtype=acctype)
+  M2 = np.zeros(shape, dtype=acctype) if lvar else None
+  for ridx, x, valid in _iterSlabs(data, mask, iaxis):
+    if valid is None: n = x.shape[iaxis]; xs = x
+    else: n = valid.sum(axis=iaxis, keepdims=True, dtype=np.intp); xs = np.where(valid, x, 0)
+    s = xs.sum(axis=iaxis, keepdims=True, dtype=acctype)
+    if lvar:
+      # squared deviations from the slab mean
+      m = s / np.maximum(n,1)
+      d = np.subtract(xs, m, dtype=acctype)
+      if valid is not None: d *= valid # remove missing values
+      m2 = np.multiply(d, d, out=d).sum(axis=iaxis, keepdims=True)
+      # merge with previous slabs (Chan et al.); without previous slabs (cnt=0), this is just m2
+      delta = m - tot[ridx] / np.maximum(cnt[ridx],1)
+      M2[ridx] += m2; M2[ridx] += delta**2 * ( cnt[ridx] * n / np.maximum(cnt[ridx]+n,1) )
+    cnt[ridx] += n; tot[ridx] += s
+  return cnt, tot, M2, kshape, rshape
+
+def _returnResult(res, bad, a, kshape, rshape, dtype, out, keepdims, lfill=True):
+  ''' insert NaN's for bad slices, cast into output dtype or array, restore shape and mask results of
+      masked arrays '''
+  # N.B.: results and bad slices have the internal shape (with keepdims)
+  if lfill and bad.any(): res[bad] = np.NaN
+  shape = kshape if keepdims else rshape
+  res = res.reshape(shape); bad = bad.reshape(shape)
+  if out is not None:
+    np.copyto(out, res, casting='unsafe')
+    if isinstance(out,ma.MaskedArray) and bad.any(): out[bad] = ma.masked
+    return out
+  res = res.astype(dtype, copy=False)
+  if isinstance(a,ma.MaskedArray): res = ma.masked_array(res, mask=bad)
+  return res[()] if res.ndim == 0 else res
+
+def _resultType(a, dtype, out):
+  ''' output dtype of mean-like reductions: dtype or floating point type of input '''
+  if out is not None: dtype = out.dtype
+  elif dtype is None:
+    dtype = a.dtype if issubclass(a.dtype.type, np.inexact) else np.dtype(np.float64)
+  dtype = np.dtype(dtype)
+  if not issubclass(dtype.type, np.inexact): raise TypeError("If a is inexact, then dtype must be inexact")
+  return dtype
+
+
+## reduction kernels
+
+def nancount(a, axis=None, keepdims=False):
+  ''' Count the valid (non-NaN and unmasked) values along an axis. '''
+  data, mask, iaxis, kshape, rshape = _prepareArray(a, axis)
+  cnt = np.zeros(data.shape[:iaxis] + (1,) + data.shape[iaxis+1:], dtype=np.intp)
+  for ridx, x, valid in _iterSlabs(data, mask, iaxis):
+    if valid is None: cnt[ridx] += x.shape[iaxis]
+    else: cnt[ridx] += valid.sum(axis=iaxis, keepdims=True, dtype=np.intp)
+  cnt = cnt.reshape(kshape if keepdims else rshape)
+  return cnt[()] if cnt.ndim == 0 else cnt
+
+def nansum(a, axis=None, dtype=None, out=None, keepdims=False):
+  ''' Sum of valid values along an axis; floating point data are accumulated in double precision and the
+      sum of empty slices is NaN. '''
+  a = np.asanyarray(a)
+  if issubclass(a.dtype.type, np.inexact): acctype = _accumType(a.dtype)
+  else: acctype = np.promote_types(a.dtype, np.int_) if dtype is None else np.dtype(dtype)
+  if out is not None: dtype = out.dtype
+  elif dtype is None: dtype = a.dtype if issubclass(a.dtype.type, np.inexact) else acctype
+  cnt, tot, M2, kshape, rshape = _moments(a, axis=axis, lvar=False, acctype=acctype)
+  lfill = issubclass(np.dtype(dtype).type, np.inexact)
+  return _returnResult(tot, cnt == 0, a, kshape, rshape, dtype, out, keepdims, lfill=lfill)
 
+def nanmean(a, axis=None, dtype=None, out=None, keepdims=False):
+  ''' Mean of valid values along an axis (accumulated in double precision); the mean of empty slices
+      is NaN (with a RuntimeWarning). '''
+  a = np.asanyarray(a); dtype = _resultType(a, dtype, out)
+  cnt, tot, M2, kshape, rshape = _moments(a, axis=axis, lvar=False)
+  with np.errstate(invalid='ignore', divide='ignore'): avg = tot / cnt
+  isbad = (cnt == 0)
+  if isbad.any(): warnings.warn("Mean of empty slice", RuntimeWarning)
+  return _returnResult(avg, isbad, a, kshape, rshape, dtype, out, keepdims)
 
-__all__ = [
-    'nansum', 'nanmax', 'nanmin', 'nanargmax', 'nanargmin', 'nanmean',
-    'nanvar', 'nanstd'
-    ]
-
-
-def _replace_nan(a, val):
-    """
-    If `a` is of inexact type, make a copy of `a`, replace NaNs with
-    the `val` value, and return the copy together with a boolean mask
-    marking the locations where NaNs were present. If `a` is not of
-    inexact type, do nothing and return `a` together with a mask of None.
-
-    Parameters
-    ----------
-    a : array-like
-        Input array.
-    val : float
-        NaN values are set to val before doing the operation.
-
-    Returns
-    -------
-    y : ndarray
-        If `a` is of inexact type, return a copy of `a` with the NaNs
-        replaced by the fill value, otherwise return `a`.
-    mask: {bool, None}
-        If `a` is of inexact type, return a boolean mask marking locations of
-        NaNs, otherwise return None.
-
-    """
-    is_new = not isinstance(a, np.ndarray)
-    if is_new:
-        a = np.array(a)
-    if not issubclass(a.dtype.type, np.inexact):
-        return a, None
-    if not is_new:
-        # need copy
-        a = np.array(a, subok=True)
-
-    mask = np.isnan(a)
-    np.copyto(a, val, where=mask)
-    return a, mask
-
-
-def _copyto(a, val, mask):
-    """
-    Replace values in `a` with NaN where `mask` is True.  This differs from
-    copyto in that it will deal with the case where `a` is a numpy scalar.
-
-    Parameters
-    ----------
-    a : ndarray or numpy scalar
-        Array or numpy scalar some of whose values are to be replaced
-        by val.
-    val : numpy scalar
-        Value used a replacement.
-    mask : ndarray, scalar
-        Boolean array. Where True the corresponding element of `a` is
-        replaced by `val`. Broadcasts.
-
-    Returns
-    -------
-    res : ndarray, scalar
-        Array with elements replaced or scalar `val`.
-
-    """
-    if isinstance(a, np.ndarray):
-        np.copyto(a, val, where=mask, casting='unsafe')
-    else:
-        a = a.dtype.type(val)
-    return a
-
-
-def _divide_by_count(a, b, out=None):
-    """
-    Compute a/b ignoring invalid results. If `a` is an array the division
-    is done in place. If `a` is a scalar, then its type is preserved in the
-    output. If out is None, then then a is used instead so that the
-    division is in place. Note that this is only called with `a` an inexact
-    type.
-
-    Parameters
-    ----------
-    a : {ndarray, numpy scalar}
-        Numerator. Expected to be of inexact type but not checked.
-    b : {ndarray, numpy scalar}
-        Denominator.
-    out : ndarray, optional
-        Alternate output array in which to place the result.  The default
-        is ``None``; if provided, it must have the same shape as the
-        expected output, but the type will be cast if necessary.
-
-    Returns
-    -------
-    ret : {ndarray, numpy scalar}
-        The return value is a/b. If `a` was an ndarray the division is done
-        in place. If `a` is a numpy scalar, the division preserves its type.
-
-    """
-    with np.errstate(invalid='ignore'):
-        if isinstance(a, np.ndarray):
-            if out is None:
-                return np.divide(a, b, out=a, casting='unsafe')
-            else:
-                return np.divide(a, b, out=out, casting='unsafe')
-        else:
-            if out is None:
-                return a.dtype.type(a / b)
-            else:
-                # This is questionable, but currently a numpy scalar can
-                # be output to a zero dimensional array.
-                return np.divide(a, b, out=out, casting='unsafe')
-
-
-def nanmin(a, axis=None, out=None, keepdims=False):
-    """
-    Return minimum of an array or minimum along an axis, ignoring any NaNs.
-    When all-NaN slices are encountered a ``RuntimeWarning`` is raised and
-    Nan is returned for that slice.
-
-    Parameters
-    ----------
-    a : array_like
-        Array containing numbers whose minimum is desired. If `a` is not an
-        array, a conversion is attempted.
-    axis : int, optional
-        Axis along which the minimum is computed. The default is to compute
-        the minimum of the flattened array.
-    out : ndarray, optional
-        Alternate output array in which to place the result.  The default
-        is ``None``; if provided, it must have the same shape as the
-        expected output, but the type will be cast if necessary.  See
-        `doc.ufuncs` for details.
-
-        .. versionadded:: 1.8.0
-    keepdims : bool, optional
-        If this is set to True, the axes which are reduced are left in the
-        result as dimensions with size one. With this option, the result
-        will broadcast correctly against the original `a`.
-
-        .. versionadded:: 1.8.0
-
-    Returns
-    -------
-    nanmin : ndarray
-        An array with the same shape as `a`, with the specified axis
-        removed.  If `a` is a 0-d array, or if axis is None, an ndarray
-        scalar is returned.  The same dtype as `a` is returned.
-
-    See Also
-    --------
-    nanmax :
-        The maximum value of an array along a given axis, ignoring any NaNs.
-    amin :
-        The minimum value of an array along a given axis, propagating any NaNs.
-    fmin :
-        Element-wise minimum of two arrays, ignoring any NaNs.
-    minimum :
-        Element-wise minimum of two arrays, propagating any NaNs.
-    isnan :
-        Shows which elements are Not a Number (NaN).
-    isfinite:
-        Shows which elements are neither NaN nor infinity.
-
-    amax, fmax, maximum
-
-    Notes
-    -----
-    Numpy uses the IEEE Standard for Binary Floating-Point for Arithmetic
-    (IEEE 754). This means that Not a Number is not equivalent to infinity.
-    Positive infinity is treated as a very large number and negative
-    infinity is treated as a very small (i.e. negative) number.
-
-    If the input has a integer type the function is equivalent to np.min.
-
-    Examples
-    --------
-    >>> a = np.array([[1, 2], [3, np.nan]])
-    >>> np.nanmin(a)
-    1.0
-    >>> np.nanmin(a, axis=0)
-    array([ 1.,  2.])
-    >>> np.nanmin(a, axis=1)
-    array([ 1.,  3.])
-
-    When positive infinity and negative infinity are present:
-
-    >>> np.nanmin([1, 2, np.nan, np.inf])
-    1.0
-    >>> np.nanmin([1, 2, np.nan, np.NINF])
-    -inf
-
-    """
-    if not isinstance(a, np.ndarray) or type(a) is np.ndarray:
-        # Fast, but not safe for subclasses of ndarray
-        res = np.fmin.reduce(a, axis=axis, out=out, keepdims=keepdims)
-        if np.isnan(res).any():
-            warnings.warn("All-NaN axis encountered", RuntimeWarning)
-    else:
-        # Slow, but safe for subclasses of ndarray
-        a, mask = _replace_nan(a, +np.inf)
-        res = np.amin(a, axis=axis, out=out, keepdims=keepdims)
-        if mask is None:
-            return res
+def nanvar(a, axis=None, dtype=None, out=None, ddof=0, keepdims=False):
+  ''' Variance of valid values along an axis, with N - ddof degrees of freedom (computed in a single pass
+      and accumulated in double precision); slices with zero degrees of freedom are NaN. '''
+  a = np.asanyarray(a); dtype = _resultType(a, dtype, out)
+  cnt, tot, M2, kshape, rshape = _moments(a, axis=axis, lvar=True)
+  dof = cnt - ddof
+  with np.errstate(invalid='ignore', divide='ignore'): var = M2 / dof
+  isbad = (dof <= 0)
+  if isbad.any(): warnings.warn("Degrees of freedom <= 0 for slice.", RuntimeWarning)
+  return _returnResult(var, isbad, a, kshape, rshape, dtype, out, keepdims)
 
-        # Check for all-NaN axis
-        mask = np.all(mask, axis=axis, keepdims=keepdims)
-        if np.any(mask):
-            res = _copyto(res, mask, np.nan)
-            warnings.warn("All-NaN axis encountered", RuntimeWarning)
+def nanstd(a, axis=None, dtype=None, out=None, ddof=0, keepdims=False):
+  ''' Standard deviation of valid values along an axis (square root of nanvar). '''
+  a = np.asanyarray(a); dtype = _resultType(a, dtype, out)
+  cnt, tot, M2, kshape, rshape = _moments(a, axis=axis, lvar=True)
+  dof = cnt - ddof
+  with np.errstate(invalid='ignore', divide='ignore'): std = np.sqrt(M2 / dof)
+  isbad = (dof <= 0)
+  if isbad.any(): warnings.warn("Degrees of freedom <= 0 for slice.", RuntimeWarning)
+  return _returnResult(std, isbad, a, kshape, rshape, dtype, out, keepdims)
 
-    # check if keepdims worked, otherwise reshape manually
-    if keepdims and axis is not None and res.ndim < a.ndim:
-      shape = list(a.shape)
-      shape[axis] = 1
-      res = res.reshape(shape)
+def sem(a, axis=None, dtype=None, out=None, ddof=0, keepdims=False):
+  ''' Compute the standard error of the mean along the specified axis. '''
+  dof = (a.shape[axis] if axis is not None else a.size) -ddof
+  sse = np.var(a, axis=axis, dtype=dtype, out=out, ddof=ddof, keepdims=keepdims)
+  return np.sqrt(sse/dof)
 
-    return res
+def nansem(a, axis=None, dtype=None, out=None, ddof=0, keepdims=False):
+  ''' Standard error of the mean of valid values along an axis: sqrt(SSE)/dof, where SSE is the sum of
+      squared errors and dof = N - ddof, i.e. the standard deviation divided by sqrt(dof). '''
+  a = np.asanyarray(a); dtype = _resultType(a, dtype, out)
+  cnt, tot, M2, kshape, rshape = _moments(a, axis=axis, lvar=True)
+  dof = cnt - ddof
+  with np.errstate(invalid='ignore', divide='ignore'): sem = np.sqrt(M2) / dof
+  isbad = (dof <= 0)
+  if isbad.any(): warnings.warn("Degrees of freedom <= 0 for slice.", RuntimeWarning)
+  return _returnResult(sem, isbad, a, kshape, rshape, dtype, out, keepdims)
+
+def _extremum(a, axis, out, keepdims, lmax):
+  ''' minimum or maximum of valid values; slabs are merged with np.minimum/np.maximum '''
+  a = np.asanyarray(a)
+  data, mask, iaxis, kshape, rshape = _prepareArray(a, axis)
+  if data.shape[iaxis] == 0: raise ValueError("zero-size array to reduction operation, which has no identity")
+  if issubclass(data.dtype.type, np.inexact): fill = -np.inf if lmax else np.inf
+  elif data.dtype == np.bool_: fill = not lmax
+  else: fill = np.iinfo(data.dtype).min if lmax else np.iinfo(data.dtype).max
+  ufunc = np.maximum if lmax else np.minimum
+  shape = data.shape[:iaxis] + (1,) + data.shape[iaxis+1:]
+  res = np.empty(shape, dtype=data.dtype); res.fill(fill)
+  cnt = np.zeros(shape, dtype=np.intp)
+  for ridx, x, valid in _iterSlabs(data, mask, iaxis):
+    if valid is None: xs = x; cnt[ridx] += x.shape[iaxis]
+    else:
+      xs = np.where(valid, x, fill)
+      cnt[ridx] += valid.sum(axis=iaxis, keepdims=True, dtype=np.intp)
+    res[ridx] = ufunc(res[ridx], ufunc.reduce(xs, axis=iaxis, keepdims=True))
+  isbad = (cnt == 0)
+  lfill = issubclass(res.dtype.type, np.inexact)
+  if lfill and isbad.any(): warnings.warn("All-NaN slice encountered", RuntimeWarning)
+  return _returnResult(res, isbad, a, kshape, rshape, res.dtype, out, keepdims, lfill=lfill)
 
+def nanmin(a, axis=None, out=None, keepdims=False):
+  ''' Minimum of valid values along an axis; the minimum of all-NaN slices is NaN (with a
+      RuntimeWarning). '''
+  return _extremum(a, axis, out, keepdims, lmax=False)
 
 def nanmax(a, axis=None, out=None, keepdims=False):
-    """
-    Return the maximum of an array or maximum along an axis, ignoring any
-    NaNs.  When all-NaN slices are encountered a ``RuntimeWarning`` is
-    raised and NaN is returned for that slice.
-
-    Parameters
-    ----------
-    a : array_like
-        Array containing numbers whose maximum is desired. If `a` is not an
-        array, a conversion is attempted.
-    axis : int, optional
-        Axis along which the maximum is computed. The default is to compute
-        the maximum of the flattened array.
-    out : ndarray, optional
-        Alternate output array in which to place the result.  The default
-        is ``None``; if provided, it must have the same shape as the
-        expected output, but the type will be cast if necessary.  See
-        `doc.ufuncs` for details.
-
-        .. versionadded:: 1.8.0
-    keepdims : bool, optional
-        If this is set to True, the axes which are reduced are left in the
-        result as dimensions with size one. With this option, the result
-        will broadcast correctly against the original `a`.
-
-        .. versionadded:: 1.8.0
-
-    Returns
-    -------
-    nanmax : ndarray
-        An array with the same shape as `a`, with the specified axis removed.
-        If `a` is a 0-d array, or if axis is None, an ndarray scalar is
-        returned.  The same dtype as `a` is returned.
-
-    See Also
-    --------
-    nanmin :
-        The minimum value of an array along a given axis, ignoring any NaNs.
-    amax :
-        The maximum value of an array along a given axis, propagating any NaNs.
-    fmax :
-        Element-wise maximum of two arrays, ignoring any NaNs.
-    maximum :
-        Element-wise maximum of two arrays, propagating any NaNs.
-    isnan :
-        Shows which elements are Not a Number (NaN).
-    isfinite:
-        Shows which elements are neither NaN nor infinity.
-
-    amin, fmin, minimum
-
-    Notes
-    -----
-    Numpy uses the IEEE Standard for Binary Floating-Point for Arithmetic
-    (IEEE 754). This means that Not a Number is not equivalent to infinity.
-    Positive infinity is treated as a very large number and negative
-    infinity is treated as a very small (i.e. negative) number.
-
-    If the input has a integer type the function is equivalent to np.max.
-
-    Examples
-    --------
-    >>> a = np.array([[1, 2], [3, np.nan]])
-    >>> np.nanmax(a)
-    3.0
-    >>> np.nanmax(a, axis=0)
-    array([ 3.,  2.])
-    >>> np.nanmax(a, axis=1)
-    array([ 2.,  3.])
-
-    When positive infinity and negative infinity are present:
-
-    >>> np.nanmax([1, 2, np.nan, np.NINF])
-    2.0
-    >>> np.nanmax([1, 2, np.nan, np.inf])
-    inf
-
-    """
-    if not isinstance(a, np.ndarray) or type(a) is np.ndarray:
-        # Fast, but not safe for subclasses of ndarray
-        res = np.fmax.reduce(a, axis=axis, out=out, keepdims=keepdims)
-        if np.isnan(res).any():
-            warnings.warn("All-NaN slice encountered", RuntimeWarning)
-    else:
-        # Slow, but safe for subclasses of ndarray
-        a, mask = _replace_nan(a, -np.inf)
-        res = np.amax(a, axis=axis, out=out, keepdims=keepdims)
-        if mask is None:
-            return res
-
-        # Check for all-NaN axis
-        mask = np.all(mask, axis=axis, keepdims=keepdims)
-        if np.any(mask):
-            res = _copyto(res, mask, np.nan)
-            warnings.warn("All-NaN axis encountered", RuntimeWarning)
-    
-    # check if keepdims worked, otherwise reshape manually
-    if keepdims and axis is not None and res.ndim < a.ndim:
-      shape = list(a.shape)
-      shape[axis] = 1
-      res = res.reshape(shape)
-
-    return res
-
+  ''' Maximum of valid values along an axis; the maximum of all-NaN slices is NaN (with a
+      RuntimeWarning). '''
+  return _extremum(a, axis, out, keepdims, lmax=True)
+
+def _argextremum(a, axis, lmax):
+  ''' index of the minimum or maximum valid value (uses a filled copy) '''
+  a = np.asanyarray(a)
+  data = ma.getdata(a); valid = ~ma.getmaskarray(a)
+  if issubclass(data.dtype.type, np.inexact):
+    valid &= ~np.isnan(data); fill = -np.inf if lmax else np.inf
+  elif data.dtype == np.bool_: fill = not lmax
+  else: fill = np.iinfo(data.dtype).min if lmax else np.iinfo(data.dtype).max
+  if not valid.any(axis=axis).all(): raise ValueError("All-NaN slice encountered")
+  data = np.where(valid, data, fill)
+  return data.argmax(axis=axis) if lmax else data.argmin(axis=axis)
 
 def nanargmin(a, axis=None):
-    """
-    Return the indices of the minimum values in the specified axis ignoring
-    NaNs. For all-NaN slices ``ValueError`` is raised. Warning: the results
-    cannot be trusted if a slice contains only NaNs and Infs.
-
-    Parameters
-    ----------
-    a : array_like
-        Input data.
-    axis : int, optional
-        Axis along which to operate.  By default flattened input is used.
-
-    Returns
-    -------
-    index_array : ndarray
-        An array of indices or a single index value.
-
-    See Also
-    --------
-    argmin, nanargmax
-
-    Examples
-    --------
-    >>> a = np.array([[np.nan, 4], [2, 3]])
-    >>> np.argmin(a)
-    0
-    >>> np.nanargmin(a)
-    2
-    >>> np.nanargmin(a, axis=0)
-    array([1, 1])
-    >>> np.nanargmin(a, axis=1)
-    array([1, 0])
-
-    """
-    a, mask = _replace_nan(a, np.inf)
-    res = np.argmin(a, axis=axis)
-    if mask is not None:
-        mask = np.all(mask, axis=axis)
-        if np.any(mask):
-            raise ValueError("All-NaN slice encountered")
-    return res
-
+  ''' Index of the minimum valid value along an axis; raises ValueError for all-NaN slices. '''
+  return _argextremum(a, axis, lmax=False)
 
 def nanargmax(a, axis=None):
-    """
-    Return the indices of the maximum values in the specified axis ignoring
-    NaNs. For all-NaN slices ``ValueError`` is raised. Warning: the
-    results cannot be trusted if a slice contains only NaNs and -Infs.
-
-
-    Parameters
-    ----------
-    a : array_like
-        Input data.
-    axis : int, optional
-        Axis along which to operate.  By default flattened input is used.
-
-    Returns
-    -------
-    index_array : ndarray
-        An array of indices or a single index value.
-
-    See Also
-    --------
-    argmax, nanargmin
-
-    Examples
-    --------
-    >>> a = np.array([[np.nan, 4], [2, 3]])
-    >>> np.argmax(a)
-    0
-    >>> np.nanargmax(a)
-    1
-    >>> np.nanargmax(a, axis=0)
-    array([1, 0])
-    >>> np.nanargmax(a, axis=1)
-    array([1, 1])
-
-    """
-    a, mask = _replace_nan(a, -np.inf)
-    res = np.argmax(a, axis=axis)
-    if mask is not None:
-        mask = np.all(mask, axis=axis)
-        if np.any(mask):
-            raise ValueError("All-NaN slice encountered")
-    return res
-
-
-def nansum(a, axis=None, dtype=None, out=None, keepdims=0):
-    """
-    Return the sum of array elements over a given axis treating Not a
-    Numbers (NaNs) as zero.
-
-    FutureWarning: In Numpy versions <= 1.8 Nan is returned for slices that
-    are all-NaN or empty. In later versions zero will be returned.
-
-    Parameters
-    ----------
-    a : array_like
-        Array containing numbers whose sum is desired. If `a` is not an
-        array, a conversion is attempted.
-    axis : int, optional
-        Axis along which the sum is computed. The default is to compute the
-        sum of the flattened array.
-    dtype : data-type, optional
-        The type of the returned array and of the accumulator in which the
-        elements are summed.  By default, the dtype of `a` is used.  An
-        exception is when `a` has an integer type with less precision than
-        the platform (u)intp. In that case, the default will be either
-        (u)int32 or (u)int64 depending on whether the platform is 32 or 64
-        bits. For inexact inputs, dtype must be inexact.
-
-        .. versionadded:: 1.8.0
-    out : ndarray, optional
-        Alternate output array in which to place the result.  The default
-        is ``None``. If provided, it must have the same shape as the
-        expected output, but the type will be cast if necessary.  See
-        `doc.ufuncs` for details. The casting of NaN to integer can yield
-        unexpected results.
-
-        .. versionadded:: 1.8.0
-    keepdims : bool, optional
-        If True, the axes which are reduced are left in the result as
-        dimensions with size one. With this option, the result will
-        broadcast correctly against the original `arr`.
-
-        .. versionadded:: 1.8.0
-
-    Returns
-    -------
-    y : ndarray or numpy scalar
-
-    See Also
-    --------
-    numpy.sum : Sum across array propagating NaNs.
-    isnan : Show which elements are NaN.
-    isfinite: Show which elements are not NaN or +/-inf.
-
-    Notes
-    -----
-    If both positive and negative infinity are present, the sum will be Not
-    A Number (NaN).
-
-    Numpy integer arithmetic is modular. If the size of a sum exceeds the
-    size of an integer accumulator, its value will wrap around and the
-    result will be incorrect. Specifying ``dtype=double`` can alleviate
-    that problem.
-
-    Examples
-    --------
-    >>> np.nansum(1)
-    1
-    >>> np.nansum([1])
-    1
-    >>> np.nansum([1, np.nan])
-    1.0
-    >>> a = np.array([[1, 1], [1, np.nan]])
-    >>> np.nansum(a)
-    3.0
-    >>> np.nansum(a, axis=0)
-    array([ 2.,  1.])
-    >>> np.nansum([1, np.nan, np.inf])
-    inf
-    >>> np.nansum([1, np.nan, np.NINF])
-    -inf
-    >>> np.nansum([1, np.nan, np.inf, -np.inf]) # both +/- infinity present
-    nan
-
-    """
-    a, mask = _replace_nan(a, 0)
-
-    if mask is None:
-        return np.sum(a, axis=axis, dtype=dtype, out=out, keepdims=keepdims)
-    mask = np.all(mask, axis=axis, keepdims=keepdims)
-    tot = np.sum(a, axis=axis, dtype=dtype, out=out, keepdims=keepdims)
-    if np.any(mask):
-        tot = _copyto(tot, np.nan, mask)
-        warnings.warn("In Numpy 1.9 the sum along empty slices will be zero.",
-                      FutureWarning)
-
-    # check if keepdims worked, otherwise reshape manually
-    if keepdims and axis is not None and tot.ndim < a.ndim:
-      shape = list(a.shape)
-      shape[axis] = 1
-      tot = tot.reshape(shape)
-
-    return tot
-
-
-def nanmean(a, axis=None, dtype=None, out=None, keepdims=False):
-    """
-    Compute the arithmetic mean along the specified axis, ignoring NaNs.
-
-    Returns the average of the array elements.  The average is taken over
-    the flattened array by default, otherwise over the specified axis.
-    `float64` intermediate and return values are used for integer inputs.
-
-    For all-NaN slices, NaN is returned and a `RuntimeWarning` is raised.
-
-    .. versionadded:: 1.8.0
-
-    Parameters
-    ----------
-    a : array_like
-        Array containing numbers whose mean is desired. If `a` is not an
-        array, a conversion is attempted.
-    axis : int, optional
-        Axis along which the means are computed. The default is to compute
-        the mean of the flattened array.
-    dtype : data-type, optional
-        Type to use in computing the mean.  For integer inputs, the default
-        is `float64`; for inexact inputs, it is the same as the input
-        dtype.
-    out : ndarray, optional
-        Alternate output array in which to place the result.  The default
-        is ``None``; if provided, it must have the same shape as the
-        expected output, but the type will be cast if necessary.  See
-        `doc.ufuncs` for details.
-    keepdims : bool, optional
-        If this is set to True, the axes which are reduced are left in the
-        result as dimensions with size one. With this option, the result
-        will broadcast correctly against the original `arr`.
-
-    Returns
-    -------
-    m : ndarray, see dtype parameter above
-        If `out=None`, returns a new array containing the mean values,
-        otherwise a reference to the output array is returned. Nan is
-        returned for slices that contain only NaNs.
-
-    See Also
-    --------
-    average : Weighted average
-    mean : Arithmetic mean taken while not ignoring NaNs
-    var, nanvar
-
-    Notes
-    -----
-    The arithmetic mean is the sum of the non-NaN elements along the axis
-    divided by the number of non-NaN elements.
-
-    Note that for floating-point input, the mean is computed using the same
-    precision the input has.  Depending on the input data, this can cause
-    the results to be inaccurate, especially for `float32`.  Specifying a
-    higher-precision accumulator using the `dtype` keyword can alleviate
-    this issue.
-
-    Examples
-    --------
-    >>> a = np.array([[1, np.nan], [3, 4]])
-    >>> np.nanmean(a)
-    2.6666666666666665
-    >>> np.nanmean(a, axis=0)
-    array([ 2.,  4.])
-    >>> np.nanmean(a, axis=1)
-    array([ 1.,  3.5])
-
-    """
-    arr, mask = _replace_nan(a, 0)
-    if mask is None:
-        return np.mean(arr, axis=axis, dtype=dtype, out=out, keepdims=keepdims)
-
-    if dtype is not None:
-        dtype = np.dtype(dtype)
-    if dtype is not None and not issubclass(dtype.type, np.inexact):
-        raise TypeError("If a is inexact, then dtype must be inexact")
-    if out is not None and not issubclass(out.dtype.type, np.inexact):
-        raise TypeError("If a is inexact, then out must be inexact")
-
-    # The warning context speeds things up.
-    with warnings.catch_warnings():
-        warnings.simplefilter('ignore')
-        cnt = np.sum(~mask, axis=axis, dtype=np.intp, keepdims=keepdims)
-        tot = np.sum(arr, axis=axis, dtype=dtype, out=out, keepdims=keepdims)
-        avg = _divide_by_count(tot, cnt, out=out)
-
-    isbad = (cnt == 0)
-    if isbad.any():
-        warnings.warn("Mean of empty slice", RuntimeWarning)
-        # NaN is the only possible bad value, so no further
-        # action is needed to handle bad results.
-    
-    # check if keepdims worked, otherwise reshape manually
-    if keepdims and axis is not None and avg.ndim < arr.ndim:
-      shape = list(arr.shape)
-      shape[axis] = 1
-      avg = avg.reshape(shape)
-
-    return avg
-
-
-def nanvar(a, axis=None, dtype=None, out=None, ddof=0, keepdims=False):
-    """
-    Compute the variance along the specified axis, while ignoring NaNs.
-
-    Returns the variance of the array elements, a measure of the spread of
-    a distribution.  The variance is computed for the flattened array by
-    default, otherwise over the specified axis.
-
-    For all-NaN slices or slices with zero degrees of freedom, NaN is
-    returned and a `RuntimeWarning` is raised.
-
-    .. versionadded:: 1.8.0
-
-    Parameters
-    ----------
-    a : array_like
-        Array containing numbers whose variance is desired.  If `a` is not an
-        array, a conversion is attempted.
-    axis : int, optional
-        Axis along which the variance is computed.  The default is to compute
-        the variance of the flattened array.
-    dtype : data-type, optional
-        Type to use in computing the variance.  For arrays of integer type
-        the default is `float32`; for arrays of float types it is the same as
-        the array type.
-    out : ndarray, optional
-        Alternate output array in which to place the result.  It must have
-        the same shape as the expected output, but the type is cast if
-        necessary.
-    ddof : int, optional
-        "Delta Degrees of Freedom": the divisor used in the calculation is
-        ``N - ddof``, where ``N`` represents the number of non-NaN
-        elements. By default `ddof` is zero.
-    keepdims : bool, optional
-        If this is set to True, the axes which are reduced are left
-        in the result as dimensions with size one. With this option,
-        the result will broadcast correctly against the original `arr`.
-
-    Returns
-    -------
-    variance : ndarray, see dtype parameter above
-        If `out` is None, return a new array containing the variance,
-        otherwise return a reference to the output array. If ddof is >= the
-        number of non-NaN elements in a slice or the slice contains only
-        NaNs, then the result for that slice is NaN.
-
-    See Also
-    --------
-    std : Standard deviation
-    mean : Average
-    var : Variance while not ignoring NaNs
-    nanstd, nanmean
-    numpy.doc.ufuncs : Section "Output arguments"
-
-    Notes
-    -----
-    The variance is the average of the squared deviations from the mean,
-    i.e.,  ``var = mean(abs(x - x.mean())**2)``.
-
-    The mean is normally calculated as ``x.sum() / N``, where ``N = len(x)``.
-    If, however, `ddof` is specified, the divisor ``N - ddof`` is used
-    instead.  In standard statistical practice, ``ddof=1`` provides an
-    unbiased estimator of the variance of a hypothetical infinite
-    population.  ``ddof=0`` provides a maximum likelihood estimate of the
-    variance for normally distributed variables.
-
-    Note that for complex numbers, the absolute value is taken before
-    squaring, so that the result is always real and nonnegative.
-
-    For floating-point input, the variance is computed using the same
-    precision the input has.  Depending on the input data, this can cause
-    the results to be inaccurate, especially for `float32` (see example
-    below).  Specifying a higher-accuracy accumulator using the ``dtype``
-    keyword can alleviate this issue.
-
-    Examples
-    --------
-    >>> a = np.array([[1, np.nan], [3, 4]])
-    >>> np.var(a)
-    1.5555555555555554
-    >>> np.nanvar(a, axis=0)
-    array([ 1.,  0.])
-    >>> np.nanvar(a, axis=1)
-    array([ 0.,  0.25])
-
-    """
-    arr, mask = _replace_nan(a, 0)
-    if mask is None:
-        return np.var(arr, axis=axis, dtype=dtype, out=out, ddof=ddof,
-                      keepdims=keepdims)
-
-    if dtype is not None:
-        dtype = np.dtype(dtype)
-    if dtype is not None and not issubclass(dtype.type, np.inexact):
-        raise TypeError("If a is inexact, then dtype must be inexact")
-    if out is not None and not issubclass(out.dtype.type, np.inexact):
-        raise TypeError("If a is inexact, then out must be inexact")
-
-    with warnings.catch_warnings():
-        warnings.simplefilter('ignore')
-
-        # Compute mean
-        cnt = np.sum(~mask, axis=axis, dtype=np.intp, keepdims=True)
-        avg = np.sum(arr, axis=axis, dtype=dtype, keepdims=True)
-        avg = _divide_by_count(avg, cnt)
-
-        # check if keepdims worked, otherwise reshape manually
-        if avg.ndim < arr.ndim and axis is not None:
-          shape = list(arr.shape)
-          shape[axis] = 1
-          avg = avg.reshape(shape)
-
-        # Compute squared deviation from mean.
-        arr -= avg
-        arr = _copyto(arr, 0, mask)
-        if issubclass(arr.dtype.type, np.complexfloating):
-            sqr = np.multiply(arr, arr.conj(), out=arr).real
-        else:
-            sqr = np.multiply(arr, arr, out=arr)
-
-        # Compute variance.
-        var = np.sum(sqr, axis=axis, dtype=dtype, out=out, keepdims=keepdims)
-        if var.ndim < cnt.ndim:
-            # Subclasses of ndarray may ignore keepdims, so check here.
-            cnt = cnt.squeeze(axis)
-        dof = cnt - ddof
-        var = _divide_by_count(var, dof)
-
-    isbad = (dof <= 0)
-    if np.any(isbad):
-        warnings.warn("Degrees of freedom <= 0 for slice.", RuntimeWarning)
-        # NaN, inf, or negative numbers are all possible bad
-        # values, so explicitly replace them with NaN.
-        var = _copyto(var, np.nan, isbad)
-        
-        # check if keepdims worked, otherwise reshape manually
-    if keepdims and axis is not None and var.ndim < arr.ndim:
-      shape = list(arr.shape)
-      shape[axis] = 1
-      var = var.reshape(shape)
-
-    return var
-
-
-def nanstd(a, axis=None, dtype=None, out=None, ddof=0, keepdims=False):
-    """
-    Compute the standard deviation along the specified axis, while
-    ignoring NaNs.
-
-    Returns the standard deviation, a measure of the spread of a
-    distribution, of the non-NaN array elements. The standard deviation is
-    computed for the flattened array by default, otherwise over the
-    specified axis.
-
-    For all-NaN slices or slices with zero degrees of freedom, NaN is
-    returned and a `RuntimeWarning` is raised.
-
-    .. versionadded:: 1.8.0
-
-    Parameters
-    ----------
-    a : array_like
-        Calculate the standard deviation of the non-NaN values.
-    axis : int, optional
-        Axis along which the standard deviation is computed. The default is
-        to compute the standard deviation of the flattened array.
-    dtype : dtype, optional
-        Type to use in computing the standard deviation. For arrays of
-        integer type the default is float64, for arrays of float types it
-        is the same as the array type.
-    out : ndarray, optional
-        Alternative output array in which to place the result. It must have
-        the same shape as the expected output but the type (of the
-        calculated values) will be cast if necessary.
-    ddof : int, optional
-        Means Delta Degrees of Freedom.  The divisor used in calculations
-        is ``N - ddof``, where ``N`` represents the number of non-NaN
-        elements.  By default `ddof` is zero.
-    keepdims : bool, optional
-        If this is set to True, the axes which are reduced are left
-        in the result as dimensions with size one. With this option,
-        the result will broadcast correctly against the original `arr`.
-
-    Returns
-    -------
-    standard_deviation : ndarray, see dtype parameter above.
-        If `out` is None, return a new array containing the standard
-        deviation, otherwise return a reference to the output array. If
-        ddof is >= the number of non-NaN elements in a slice or the slice
-        contains only NaNs, then the result for that slice is NaN.
-
-    See Also
-    --------
-    var, mean, std
-    nanvar, nanmean
-    numpy.doc.ufuncs : Section "Output arguments"
-
-    Notes
-    -----
-    The standard deviation is the square root of the average of the squared
-    deviations from the mean: ``std = sqrt(mean(abs(x - x.mean())**2))``.
-
-    The average squared deviation is normally calculated as
-    ``x.sum() / N``, where ``N = len(x)``.  If, however, `ddof` is
-    specified, the divisor ``N - ddof`` is used instead. In standard
-    statistical practice, ``ddof=1`` provides an unbiased estimator of the
-    variance of the infinite population. ``ddof=0`` provides a maximum
-    likelihood estimate of the variance for normally distributed variables.
-    The standard deviation computed in this function is the square root of
-    the estimated variance, so even with ``ddof=1``, it will not be an
-    unbiased estimate of the standard deviation per se.
-
-    Note that, for complex numbers, `std` takes the absolute value before
-    squaring, so that the result is always real and nonnegative.
-
-    For floating-point input, the *std* is computed using the same
-    precision the input has. Depending on the input data, this can cause
-    the results to be inaccurate, especially for float32 (see example
-    below).  Specifying a higher-accuracy accumulator using the `dtype`
-    keyword can alleviate this issue.
-
-    Examples
-    --------
-    >>> a = np.array([[1, np.nan], [3, 4]])
-    >>> np.nanstd(a)
-    1.247219128924647
-    >>> np.nanstd(a, axis=0)
-    array([ 1.,  0.])
-    >>> np.nanstd(a, axis=1)
-    array([ 0.,  0.5])
-
-    """
-    var = nanvar(a, axis=axis, dtype=dtype, out=out, ddof=ddof,
-                 keepdims=keepdims)
-    if isinstance(var, np.ndarray):
-        std = np.sqrt(var, out=var)
-    else:
-        std = var.dtype.type(np.sqrt(var))
-    
-    # check if keepdims worked, otherwise reshape manually
-    if keepdims and axis is not None and std.ndim < a.ndim:
-      shape = list(a.shape)
-      shape[axis] = 1
-      std = std.reshape(shape)
-
-    return std
-
-
-def sem(a, axis=None, dtype=None, out=None, ddof=0, keepdims=False):
-    """
-    Compute the standard error of the mean along the specified axis.
-    """
-    dof = (a.shape[axis] if axis is not None else a.size) -ddof
-    sse = np.var(a, axis=axis, dtype=dtype, out=out, ddof=ddof, keepdims=keepdims)        
-    return np.sqrt(sse/dof)
-
-
-def nansem(a, axis=None, dtype=None, out=None, ddof=0, keepdims=False):
-    """
-    Compute the standard error of the mean along the specified axis, while
-    ignoring NaNs.
-
-    Returns the standard deviation, a measure of the spread of a
-    distribution, of the non-NaN array elements. The standard deviation is
-    computed for the flattened array by default, otherwise over the
-    specified axis.
-
-    For all-NaN slices or slices with zero degrees of freedom, NaN is
-    returned and a `RuntimeWarning` is raised.
-
-    .. versionadded:: 1.8.0
-
-    Parameters
-    ----------
-    a : array_like
-        Calculate the standard deviation of the non-NaN values.
-    axis : int, optional
-        Axis along which the standard deviation is computed. The default is
-        to compute the standard deviation of the flattened array.
-    dtype : dtype, optional
-        Type to use in computing the standard deviation. For arrays of
-        integer type the default is float64, for arrays of float types it
-        is the same as the array type.
-    out : ndarray, optional
-        Alternative output array in which to place the result. It must have
-        the same shape as the expected output but the type (of the
-        calculated values) will be cast if necessary.
-    ddof : int, optional
-        Means Delta Degrees of Freedom.  The divisor used in calculations
-        is ``N - ddof``, where ``N`` represents the number of non-NaN
-        elements.  By default `ddof` is zero.
-    keepdims : bool, optional
-        If this is set to True, the axes which are reduced are left
-        in the result as dimensions with size one. With this option,
-        the result will broadcast correctly against the original `arr`.
-
-    Returns
-    -------
-    standard_error_of_mean : ndarray, see dtype parameter above.
-        If `out` is None, return a new array containing the standard
-        deviation, otherwise return a reference to the output array. If
-        ddof is >= the number of non-NaN elements in a slice or the slice
-        contains only NaNs, then the result for that slice is NaN.
-
-    See Also
-    --------
-    var, mean, std
-    nanvar, nanmean, nanstd
-    numpy.doc.ufuncs : Section "Output arguments"
-
-    """
-    arr, mask = _replace_nan(a, 0)
-    if mask is None:
-        dof = (arr.shape[axis] if axis is not None else arr.size) -ddof
-        sse = np.var(arr, axis=axis, dtype=dtype, out=out, ddof=ddof, keepdims=keepdims)        
-        return np.sqrt(sse/dof)
-
-    if dtype is not None:
-        dtype = np.dtype(dtype)
-    if dtype is not None and not issubclass(dtype.type, np.inexact):
-        raise TypeError("If a is inexact, then dtype must be inexact")
-    if out is not None and not issubclass(out.dtype.type, np.inexact):
-        raise TypeError("If a is inexact, then out must be inexact")
-
-    with warnings.catch_warnings():
-        warnings.simplefilter('ignore')
-
-        # Compute mean
-        if mask is None: # this is for test purpose (usually mask == None is handled above)
-            cnt = arr.shape[axis] if axis is not None else arr.size
-            if not issubclass(arr.dtype.type, np.inexact):
-                arr = np.array(arr, subok=True, dtype=np.float_)
-        else:
-            cnt = np.sum(~mask, axis=axis, dtype=np.intp, keepdims=True)
-        avg = np.sum(arr, axis=axis, dtype=dtype, keepdims=True)
-        avg = _divide_by_count(avg, cnt)
-
-        # check if keepdims worked, otherwise reshape manually
-        if avg.ndim < arr.ndim and axis is not None:
-          shape = list(arr.shape)
-          shape[axis] = 1
-          avg = avg.reshape(shape)
-
-        # compute sum of square errors (SSE)
-        arr -= avg
-        arr = _copyto(arr, 0, mask)
-        if issubclass(arr.dtype.type, np.complexfloating):
-            sqr = np.multiply(arr, arr.conj(), out=arr).real
-        else:
-            sqr = np.multiply(arr, arr, out=arr)
-        sse = np.sum(sqr, axis=axis, dtype=dtype, out=out, keepdims=keepdims)                
-        
-        # compute standard error of mean: sem = std/sqrt(dof) = sqrt(SSE)/dof (using std = sqrt(SSE/dof) )
-        # take square root of variance
-        if isinstance(sse, np.ndarray):
-            sem = np.sqrt(sse, out=sse)
-            # Subclasses of ndarray may ignore keepdims, so check here.
-            if isinstance(cnt, np.ndarray) and sse.ndim < cnt.ndim: cnt = cnt.squeeze(axis)
-        else:
-            sem = sse.dtype.type(np.sqrt(sse))
-        dof = cnt - ddof
-        sem = _divide_by_count(sem, dof)
-
-    isbad = (dof <= 0)
-    if np.any(isbad):
-        warnings.warn("Degrees of freedom <= 0 for slice.", RuntimeWarning)
-        # NaN, inf, or negative numbers are all possible bad
-        # values, so explicitly replace them with NaN.
-        sem = _copyto(sem, np.nan, isbad)
-        
-        # check if keepdims worked, otherwise reshape manually
-    if keepdims and axis is not None and sem.ndim < arr.ndim:
-      shape = list(arr.shape)
-      shape[axis] = 1
-      sem = sem.reshape(shape)
-
-    return sem
+  ''' Index of the maximum valid value along an axis; raises ValueError for all-NaN slices. '''
+  return _argextremum(a, axis, lmax=True)
@@ -0,0 +1,184 @@
+'''
+Created on 2016-03-14
+
+An opt-in instrumentation layer for the processing pipeline: per-variable and per-phase timers (e.g.
+'load', 'compute', 'gdal' and 'write'), bytes read and written, call counters and peak memory usage
+(the peak of a worker process over its lifetime, and the increase of that peak during each job).
+Timers are exclusive, i.e. time spent in a nested timer (e.g. 'load' inside 'compute') is only
+attributed to the inner phase. When profiling is not enabled, all functions return immediately.
+
+Reports of individual jobs are written to a folder by the pool workers and merged at the end of a
+run (see processing.multiprocess); the merged report can be saved as JSON or CSV and printed as a table.
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import os, json, csv, resource
+from time import time
+from glob import glob
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+## module state (inherited by forked worker processes)
+_profile = None # profile of the current job (None means profiling is disabled)
+_stack = [] # stack of active timers: [phase, variable, start time, time spent in nested timers]
+_folder = None # folder where job reports are collected
+
+class Profile(object):
+  ''' Container for the measurements of a single job. '''
+
+  def __init__(self, name=None):
+    ''' Initialize (empty) measurements. '''
+    self.name = name
+    self.start = time()
+    self.times = defaultdict(float) # (variable, phase) -> seconds
+    self.calls = defaultdict(int) # (variable, phase) -> number of calls
+    self.bytes = defaultdict(int) # (variable, 'read'/'write') -> bytes
+    self.counters = defaultdict(int) # e.g. GDAL and NetCDF calls
+    self.peak_start = getPeakRSS() # peak memory usage of the worker before this job
+
+  def getReport(self):
+    ''' Return measurements as a JSON-compatible dict. '''
+    peak_rss = getPeakRSS()
+    # N.B.: the peak RSS can not be reset, so it is the peak of the worker process over its lifetime (which 
+    #       includes previous jobs); a job that does not exceed the previous peak has no increase
+    report = dict(name=self.name, wall=time()-self.start, worker_peak_rss=peak_rss, 
+                  peak_rss_increase=peak_rss-self.peak_start)
+    report['records'] = [dict(variable=var, phase=phase, seconds=self.times[(var,phase)],
+                              calls=self.calls[(var,phase)]) for var,phase in sorted(self.times)]
+    report['bytes'] = [dict(variable=var, mode=mode, bytes=nbytes) for (var,mode),nbytes in sorted(self.bytes.iteritems())]
+    report['counters'] = dict(self.counters)
+    return report
+
+
+## functions for instrumentation
+
+def isEnabled():
+  ''' Check if profiling is enabled. '''
+  return _profile is not None
+
+def getPeakRSS():
+  ''' Peak resident set size of the current process over its lifetime in MB (Linux reports kB). '''
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+@contextmanager
+def _timer(phase, variable):
+  ''' Exclusive timer for a phase of the computation of a variable (see timer). '''
+  if variable is None: variable = _stack[-1][1] if _stack else ''
+  frame = [phase, variable, time(), 0.]
+  _stack.append(frame)
+  try: yield
+  finally:
+    _stack.pop()
+    elapsed = time() - frame[2]
+    _profile.times[(variable,phase)] += elapsed - frame[3] # exclude nested timers
+    _profile.calls[(variable,phase)] += 1
+    if _stack: _stack[-1][3] += elapsed # nested time for the enclosing timer
+
+@contextmanager
+def _notimer():
+  ''' Placeholder, if profiling is disabled. '''
+  yield
+
+def timer(phase, variable=None):
+  ''' Return a context manager that times a phase of the computation; if no variable is given, the
+      variable of the enclosing timer is used. '''
+  if _profile is None: return _notimer()
+  return _timer(phase, variable)
+
+def addBytes(mode, nbytes, variable=None):
+  ''' Record bytes read or written (mode = 'read' or 'write'). '''
+  if _profile is None: return
+  if variable is None: variable = _stack[-1][1] if _stack else ''
+  _profile.bytes[(variable,mode)] += int(nbytes)
+
+def count(name, n=1):
+  ''' Increment a call counter (e.g. for GDAL or NetCDF calls). '''
+  if _profile is None: return
+  _profile.counters[name] += n
+
+
+## functions to collect and report results
+
+def startProfiling(folder):
+  ''' Enable profiling; reports of individual jobs are saved in folder (must be called before worker
+      processes are created, so that they inherit the settings). '''
+  global _profile, _folder
+  if not os.path.exists(folder): os.makedirs(folder)
+  for filename in glob(os.path.join(folder,'job_*.json')): os.remove(filename) # old reports
+  _folder = folder; _profile = Profile()
+
+def stopProfiling():
+  ''' Disable profiling. '''
+  global _profile, _folder
+  _profile = None; _folder = None; del _stack[:]
+
+def startJob(name=None):
+  ''' Reset measurements at the beginning of a job. '''
+  global _profile
+  if _profile is None: return
+  _profile = Profile(name=name); del _stack[:]
+
+def saveJob():
+  ''' Save the report of the current job to the profiling folder (one file per job). '''
+  if _profile is None or _folder is None: return
+  filename = os.path.join(_folder,'job_{:d}_{:d}.json'.format(os.getpid(),int(time()*1e6)))
+  with open(filename,'w') as f: json.dump(_profile.getReport(), f)
+
+def collectReports(folder=None):
+  ''' Merge the reports of all jobs in the profiling folder into one report. '''
+  if folder is None: folder = _folder
+  jobs = []
+  for filename in sorted(glob(os.path.join(folder,'job_*.json'))):
+    with open(filename,'r') as f: jobs.append(json.load(f))
+    os.remove(filename)
+  # aggregate measurements
+  times = defaultdict(float); calls = defaultdict(int); nbytes = defaultdict(int); counters = defaultdict(int)
+  for job in jobs:
+    for record in job['records']:
+      times[record['phase']] += record['seconds']; calls[record['phase']] += record['calls']
+    for record in job['bytes']: nbytes[record['mode']] += record['bytes']
+    for name,n in job['counters'].iteritems(): counters[name] += n
+  summary = dict(phases={phase:dict(seconds=times[phase], calls=calls[phase]) for phase in times},
+                 bytes=dict(nbytes), counters=dict(counters), njobs=len(jobs),
+                 wall=sum(job['wall'] for job in jobs),
+                 worker_peak_rss=max([job['worker_peak_rss'] for job in jobs] or [0.]),
+                 peak_rss_increase=max([job['peak_rss_increase'] for job in jobs] or [0.]))
+  return dict(summary=summary, jobs=jobs)
+
+def writeReport(report, filename):
+  ''' Write report to a JSON file, or to a CSV file with one row per job, variable and phase
+      (bytes and counters are added as special phases), depending on the file extension. '''
+  if filename.lower().endswith('.csv'):
+    with open(filename,'wb') as f:
+      writer = csv.writer(f)
+      writer.writerow(['job','variable','phase','seconds','calls','bytes'])
+      for job in report['jobs']:
+        for record in job['records']:
+          writer.writerow([job['name'],record['variable'],record['phase'],record['seconds'],record['calls'],''])
+        for record in job['bytes']:
+          writer.writerow([job['name'],record['variable'],'bytes_'+record['mode'],'','',record['bytes']])
+        for name,n in sorted(job['counters'].iteritems()):
+          writer.writerow([job['name'],'',name,'',n,''])
+        writer.writerow([job['name'],'','wall',job['wall'],1,''])
+        writer.writerow([job['name'],'','worker_peak_rss_mb',job['worker_peak_rss'],'',''])
+        writer.writerow([job['name'],'','peak_rss_increase_mb',job['peak_rss_increase'],'',''])
+  else:
+    with open(filename,'w') as f: json.dump(report, f, indent=1, sort_keys=True)
+
+def printReport(report):
+  ''' Return a summarized table of the report as a string. '''
+  summary = report['summary']
+  total = sum(phase['seconds'] for phase in summary['phases'].itervalues()) or 1.
+  string = '\n   ***   Profile of {:d} Jobs ({:.1f} s, peak worker RSS {:.0f} MB)   ***   \n'.format(
+                    summary['njobs'], summary['wall'], summary['worker_peak_rss'])
+  string += '\n{:<20s} {:>12s} {:>8s} {:>10s}\n'.format('Phase','Time [s]','Share','Calls')
+  for name,phase in sorted(summary['phases'].iteritems(), key=lambda item: item[1]['seconds'], reverse=True):
+    string += '{:<20s} {:12.2f} {:7.1f}% {:10d}\n'.format(name,phase['seconds'],100.*phase['seconds']/total,phase['calls'])
+  for mode,nbytes in sorted(summary['bytes'].iteritems()):
+    string += '{:<20s} {:12.1f} MB\n'.format('bytes '+mode,nbytes/1024.**2)
+  for name,n in sorted(summary['counters'].iteritems()):
+    string += '{:<20s} {:12d}\n'.format(name,n)
+  return string
@@ -6,7 +6,7 @@ from: http://scipy.org/Cookbook/SignalSmooth
 
 import numpy as np
 
-def smooth(x, window_len=11, window='hanning'):
+def smooth(x, window_len=11, window='hanning', axis=-1, lnan=False, fft_len=64):
     """smooth the data using a window with requested size.
     
     This method is based on the convolution of a scaled window with the signal.
@@ -19,6 +19,11 @@ def smooth(x, window_len=11, window='hanning'):
         window_len: the dimension of the smoothing window
         window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
             flat window will produce a moving average smoothing.
+        axis: the axis along which the signal is smoothed; arrays with more than one
+            dimension are treated as a batch of signals, which are smoothed at once
+        lnan: ignore NaN values, i.e. the window is renormalized over the valid values
+            (NaN values in the input remain NaN); otherwise NaN values spread over the window
+        fft_len: windows longer than this are convolved using FFTs
 
     output:
         the smoothed signal
@@ -38,10 +43,11 @@ def smooth(x, window_len=11, window='hanning'):
     TODO: the window parameter could be the window itself if an array instead of a string   
     """
 
-    if x.ndim != 1:
-        raise ValueError, "smooth only accepts 1 dimension arrays."
+    x = np.asarray(x)
+    if x.ndim == 0:
+        raise ValueError, "smooth needs at least a 1 dimension array."
 
-    if x.size < window_len:
+    if x.shape[axis] < window_len:
         raise ValueError, "Input vector needs to be bigger than window size."
 
     if window_len < 3:
@@ -50,15 +56,45 @@ def smooth(x, window_len=11, window='hanning'):
     if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
         raise ValueError, "Window is on of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'"
 
-    s=np.r_[2*x[0]-x[window_len:1:-1], x, 2*x[-1]-x[-1:-window_len:-1]]
-    #print(len(s))
-    
+    # signals along the last axis; reflected copies at both ends (as for 1D signals)
+    xt = np.moveaxis(x, axis, -1).astype('d')
+    s = np.concatenate([2*xt[...,:1]-xt[...,window_len:1:-1], xt, 2*xt[...,-1:]-xt[...,-1:-window_len:-1]], axis=-1)
+
     if window == 'flat': #moving average
         w = np.ones(window_len,'d')
     else:
         w = getattr(np, window)(window_len)
-    y = np.convolve(w/w.sum(), s, mode='same')
-    return y[window_len-1:-window_len+1]
+    w = w/w.sum()
+
+    # indices of the smoothed signal in the full convolution (equivalent to convolve(mode='same') and
+    # removing the reflected copies)
+    j0 = (window_len-1)//2 + window_len-1; j1 = j0 + s.shape[-1] - 2*(window_len-1)
+    valid = np.isfinite(s)
+    if valid.all():
+        y = _convolve(s, w, j0, j1, fft_len)
+    else:
+        num = _convolve(np.where(valid, s, 0.), w, j0, j1, fft_len)
+        den = _convolve(valid.astype('d'), w, j0, j1, fft_len)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if lnan: y = np.where(den > 0, num/den, np.nan)
+            else: y = np.where(den > 1.-1e-8, num, np.nan) # NaN, if any value in the window is NaN
+        if lnan: y[~np.isfinite(xt)] = np.nan
+    return np.moveaxis(y, -1, axis)
+
+
+def _convolve(s, w, j0, j1, fft_len=64):
+    """ elements j0 to j1 of the full convolution of signals s (last axis) with window w """
+    if len(w) > fft_len:
+        # FFT convolution for long windows
+        n = s.shape[-1] + len(w) - 1
+        y = np.fft.irfft(np.fft.rfft(s, n, axis=-1) * np.fft.rfft(w, n), n, axis=-1)
+        return y[...,j0:j1]
+    else:
+        # direct convolution for short windows (one array operation per window element)
+        y = np.zeros(s.shape[:-1]+(j1-j0,), dtype='d')
+        for m in xrange(len(w)):
+            y += w[m]*s[...,j0-m:j1-m]
+        return y
 
 
 #*********** part2: 2d